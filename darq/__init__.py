@@ -15,10 +15,13 @@ from darq.services.type import TypeServiceAPI
 from darq.services.storage import StorageAPI
 from darq.services.storage import api as storage_api
 from darq.services.history import History
+from darq.services.index import Index
+from darq.services.metadata import Metadata
 
 from darq.runtime.object import ObjectIdentifier, ObjectProxy
 from darq.runtime.service import Service
 from darq.runtime.service import ServiceAPI
+from darq.runtime.service import Subscriber
 from darq.runtime.tool import Tool
 from darq.runtime.type import Type
 from darq.runtime.util import Facility, Level, log
@@ -38,6 +41,7 @@ from darq.kernel import loop
 from darq.kernel import open_port
 from darq.kernel import close_port
 from darq.kernel import send_message
+from darq.kernel import set_port_listener
 from darq.kernel import _state
 
 # Event loop.
@@ -27,16 +27,41 @@ _state = ProcessRuntimeState()
 
 def init(event_loop: EventLoopInterface):
     """Initialise the process' runtime state."""
-    _state.loop = event_loop
+    _state.set_loop(event_loop)
 
 
 def init_callbacks(event_loop: EventLoopInterface, listener: EventListener):
     """Initialise the process' runtime state, using the callback model."""
-    _state.loop = event_loop
+    _state.set_loop(event_loop)
     _state.listener = listener
     return
 
 
+def set_port_listener(port: int, listener: typing.Optional[EventListener]):
+    """Set the listener for messages delivered to a port.
+
+    Messages for a port without a listener of its own are delivered to
+    the process-wide listener, set by init_callbacks().  This lets
+    several service APIs, and a service itself, share a process.
+
+    :param port: Local port number.
+    :param listener: Listener, or None to revert to the process-wide one."""
+
+    _state.set_port_listener(port, listener)
+    return
+
+
+def connect():
+    """Connect to the p-Kernel now, rather than when first needed.
+
+    The connection is kept if the process is later initialised with
+    another event loop."""
+
+    if _state.socket is None:
+        _state.connect_to_p_kernel()
+    return
+
+
 def loop():
     """Return a reference to the runtime event loop."""
     return _state.loop
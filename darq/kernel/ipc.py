@@ -576,17 +576,50 @@ class ProcessRuntimeState:
 
         # Event loop.
         self.loop: typing.Optional[EventLoopInterface] = None
+
+        # Process-wide listener, set by init_callbacks().
+        self.listener: typing.Optional[EventListener] = None
+
+        # Listeners for individual ports, overriding the process-wide one.
+        self.port_listeners: dict[int, EventListener] = {}
         return
 
     def get_next_request_id(self) -> int:
         self.request_id += 1
         return self.request_id
 
+    def set_loop(self, loop: EventLoopInterface):
+        """Set the event loop, moving any p-Kernel connection to it."""
+
+        if self.socket is not None and self.loop is not None and loop is not self.loop:
+            self.loop.cancel_socket(self.socket)
+            loop.add_socket(self.socket, self)
+        self.loop = loop
+        return
+
+    def set_port_listener(self, port: int, listener: typing.Optional[EventListener]):
+        """Set the listener for messages delivered to a port.
+
+        :param port: Local port number.
+        :param listener: Listener, or None to use the process-wide one."""
+
+        if listener is None:
+            self.port_listeners.pop(port, None)
+        else:
+            self.port_listeners[port] = listener
+        return
+
+    def get_listener(self, port: int) -> typing.Optional[EventListener]:
+        """Return the listener for a port, if any."""
+        return self.port_listeners.get(port, self.listener)
+
     def connect_to_p_kernel(self):
         """Establish the TCP connection to the p-kerenl."""
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Messages are small, and latency matters more than packing.
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.loop.add_socket(self.socket, self)
         self.socket.connect(('localhost', IPC_PORT))
         return
@@ -659,18 +692,26 @@ class ProcessRuntimeState:
 
     def handle_deliver_message(self, message: DeliverMessage):
         # Check destination.
+        listener = self.get_listener(message.destination)
         if message.destination not in self.ports:
-            self.listener.on_error(0, 0, "Bad port")
+            if listener is not None:
+                listener.on_error(0, 0, "Bad port")
+            return
+
+        if listener is None:
+            logging.warning(f"No listener for port {message.destination}: "
+                            f"message from {message.source} dropped")
             return
 
-        self.listener.on_message(message.source, message.destination, message.payload)
+        listener.on_message(message.source, message.destination, message.payload)
         return
 
     def handle_open_port_response(self, message: OpenPortResponse):
         # Look up the request.
         pending_request = self.requests.get(message.request_id)
         if pending_request is None:
-            self.listener.on_error(0, 0, "response to unknown request")
+            if self.listener is not None:
+                self.listener.on_error(0, 0, "response to unknown request")
             return
 
         pending_request.complete(message.result, message)
@@ -742,7 +783,7 @@ class ProcessRuntimeState:
 
         # Check response.
         if pending_request.is_success():
-            return pending_request.result
+            return pending_request.response_message.port
         else:
             raise get_exception(pending_request.result)
 
@@ -750,8 +791,11 @@ class ProcessRuntimeState:
 
         assert message.port in self.ports
 
-        self.listener.on_close_port(message.port)
+        listener = self.get_listener(message.port)
+        if listener is not None:
+            listener.on_close_port(message.port)
 
+        self.port_listeners.pop(message.port, None)
         del self.ports[message.port]
         del self.requests[message.request_id]
         return
@@ -787,5 +831,7 @@ class ProcessRuntimeState:
         self.send_to_p_kernel(request)
 
         # FIXME: once sending is properly async, this can be (re)moved.
-        self.listener.on_send_message(0, 0)  ## FIXME: these params make no sense
+        listener = self.get_listener(source)
+        if listener is not None:
+            listener.on_send_message(0, 0)  ## FIXME: these params make no sense
         return
@@ -31,6 +31,9 @@ class EventLoopInterface:
     def cancel_socket(self, sock: socket.socket):
         pass
 
+    def set_writeable(self, sock: socket.socket, enabled: bool):
+        pass
+
     def add_timer(self, duration: float, callback) -> int:
         pass
 
@@ -115,6 +118,7 @@ class SelectTimerCollection:
         :returns: Timer identifier (used to cancel)."""
 
         timer_state = SelectTimerState(self.next_id, interval, listener)
+        timer_state.set_epxiry(time.time())
         self.next_id += 1
 
         self.timers.append(timer_state)
@@ -152,6 +156,7 @@ class SelectEventLoop(EventLoopInterface):
     def __init__(self):
         """Constructor."""
         self.sockets: typing.Dict[socket.socket, typing.Any] = {}
+        self.writers: typing.Set[socket.socket] = set()
         self.timers: SelectTimerCollection = SelectTimerCollection()
         self.active: bool = False
 
@@ -167,6 +172,21 @@ class SelectEventLoop(EventLoopInterface):
 
         :param sock: Socket for which to cancel monitoring."""
         del self.sockets[sock]
+        self.writers.discard(sock)
+
+    def set_writeable(self, sock: socket.socket, enabled: bool):
+        """Enable or disable writeable events for a socket.
+
+        Sockets are monitored only for readability unless enabled: a
+        connected socket is almost always writeable, so monitoring it
+        otherwise would never let the loop wait.
+
+        :param sock: Monitored socket.
+        :param enabled: True to report writeable events."""
+        if enabled:
+            self.writers.add(sock)
+        else:
+            self.writers.discard(sock)
 
     def add_timer(self, duration, listener) -> int:
         """Add timer to event loop.
@@ -198,14 +218,12 @@ class SelectEventLoop(EventLoopInterface):
         """Process the next event."""
 
         if len(self.timers) > 0:
-            timeout = self.timers[0].expiry
-            for t in self.timers[1:]:
-                # FIXME: get next timer expiry time, or fallback timeout
-                pass
+            expiry = min(t.expiry for t in self.timers)
+            timeout = max(0.0, expiry - time.time())
         else:
             timeout = 10.0
 
-        rr, rw, _ = select.select(self.sockets, self.sockets, [], timeout)
+        rr, rw, _ = select.select(self.sockets, self.writers, [], timeout)
 
         for s in rr:
             listener = self.sockets.get(s)
@@ -217,9 +235,10 @@ class SelectEventLoop(EventLoopInterface):
             if listener is not None:
                 listener.on_writeable(s)
 
-        for t in self.timers:
+        # Listeners may add or cancel timers.
+        for t in list(self.timers):
             now = time.time()
-            if t.expiry < now:
+            if t.expiry < now and t in self.timers:
                 t.expiry += t.duration
                 t.listener.on_timeout(t.timer_id, t.expiry, now)
 
@@ -239,7 +258,7 @@ class QtSocketState:
 
         self.write_notifier = QSocketNotifier(sock.fileno(), QSocketNotifier.Type.Write)
         self.write_notifier.activated.connect(self.on_writeable)
-        self.read_notifier.setEnabled(True)
+        self.write_notifier.setEnabled(False)
         return
 
     def on_readable(self, sock):
@@ -256,13 +275,14 @@ class QtEventLoop(EventLoopInterface):
     def __init__(self):
         super().__init__()
         self.loop = None
-        self.timers = {}
+        self.next_id: int = 0
+        self.timers: dict[int, QTimer] = {}
         self.sockets: dict[int, QtSocketState] = {}
         return
 
     def add_socket(self, sock: socket.socket, callback: SocketListener):
-        # All sockets have both read and write monitoring; no sockets
-        # support exception monitoring.
+        # Sockets have read monitoring, and write monitoring once enabled
+        # by set_writeable(); no sockets support exception monitoring.
         if sock.fileno() in self.sockets:
             raise DuplicateSocketError(sock)
 
@@ -284,23 +304,37 @@ class QtEventLoop(EventLoopInterface):
         del self.sockets[sock.fileno()]
         return
 
+    def set_writeable(self, sock: socket.socket, enabled: bool):
+        if sock.fileno() not in self.sockets:
+            raise SocketNotFoundError(sock)
+
+        self.sockets[sock.fileno()].write_notifier.setEnabled(enabled)
+        return
+
     def add_timer(self, duration: float, callback: TimerListener) -> int:
 
         # Convert duration to milliseconds
-        ms_duration = int(duration / 1000)
+        ms_duration = int(duration * 1000)
+
+        self.next_id += 1
+        timer_id = self.next_id
 
         timer = QTimer()
-        timer.timeout.connect(callback.on_timeout)
+        timer.timeout.connect(
+            lambda: callback.on_timeout(timer_id, time.time(), time.time()))
         timer.start(ms_duration)
 
-        self.timers[timer.timerId()] = timer
-        return timer.timerId()
+        self.timers[timer_id] = timer
+        return timer_id
 
     def cancel_timer(self, timer_id: int):
-        pass
+        timer = self.timers.pop(timer_id, None)
+        if timer is not None:
+            timer.stop()
+        return
 
     def add_deferred(self, callback):
-        pass
+        QTimer.singleShot(0, callback)
 
     def run(self):
         """Enter event loop.  Run until stop() is called."""
@@ -308,8 +342,11 @@ class QtEventLoop(EventLoopInterface):
         self.loop.exec()
 
     def next(self):
-        # FIXME FIXME FIXME
-        self.loop.processEvents(None, 10)
+        """Wait for, and process, the next events.
+
+        This works whether or not run() has been called: an application
+        may run Qt's loop itself, with QApplication.exec()."""
+        QApplication.processEvents(QEventLoop.ProcessEventsFlag.WaitForMoreEvents)
 
     def stop(self):
         """Exit inner-most event loop instance."""
@@ -3,11 +3,13 @@
 
 import logging
 import os
+import typing
 
 import orjson
 
 import darq
-from ..kernel import EventLoopInterface, EventListener, open_port, close_port, send_message
+from ..kernel import EventLoopInterface, EventListener, open_port, close_port, send_message, set_port_listener
+from ..kernel.loop import TimerListener
 
 
 class Service(EventListener):
@@ -18,6 +20,8 @@ class Service(EventListener):
 
         # Service port.
         self.port: int = port
+        if port != 0:
+            set_port_listener(port, self)
 
         # Write PID to run file (unless managed by systemd).
         if os.environ.get("INVOCATION_ID"):
@@ -115,6 +119,113 @@ class Service(EventListener):
         pass
 
 
+class Subscriber(TimerListener):
+    """Batched delivery of service notifications to a client port.
+
+    Events posted to a Subscriber are queued, and sent together as a
+    single message once the batching interval expires.  An event posted
+    with a key replaces any queued event with the same key, so a burst
+    of changes to one thing is delivered as one event.
+
+    The queue is capped: if it fills, the queued events are discarded,
+    and the next message is flagged as an overflow, telling the client
+    it has missed events and must resynchronise."""
+
+    def __init__(self, service: Service, port: int, method: str,
+                 limit: int = 1000, interval: float = 0.05):
+        """Constructor.
+
+        :param service: Service sending the notifications.
+        :param port: Client port to be notified.
+        :param method: Method name for notification messages.
+        :param limit: Maximum number of queued events.
+        :param interval: Batching interval, in seconds."""
+
+        self.service = service
+        self.port: int = port
+        self.method: str = method
+        self.limit: int = limit
+        self.interval: float = interval
+
+        # Queued events, in order, by coalescing key.
+        self.pending: dict = {}
+        self.next_key: int = 0
+
+        # True if events were discarded since the last message.
+        self.overflow: bool = False
+
+        # Flush timer, if one is running.
+        self.timer_id: typing.Optional[int] = None
+
+        # Statistics.
+        self.sent: int = 0
+        self.coalesced: int = 0
+        self.dropped: int = 0
+        return
+
+    def post(self, event: dict, key=None):
+        """Queue an event for delivery.
+
+        :param event: Event dictionary.
+        :param key: Optional coalescing key; an event replaces any queued
+        event with the same key."""
+
+        if self.overflow:
+            self.dropped += 1
+            return
+
+        if key is None:
+            key = self.next_key
+            self.next_key += 1
+
+        if key in self.pending:
+            # Re-queue at the end, so the order reflects the latest change.
+            del self.pending[key]
+            self.coalesced += 1
+
+        elif len(self.pending) >= self.limit:
+            self.dropped += len(self.pending) + 1
+            self.pending.clear()
+            self.overflow = True
+
+        if not self.overflow:
+            self.pending[key] = event
+
+        if self.timer_id is None:
+            self.timer_id = darq.loop().add_timer(self.interval, self)
+        return
+
+    def on_timeout(self, timer_id: int, expiry_time: float, actual_time: float):
+        """Send queued events when the batching interval expires."""
+        self.cancel()
+        self.flush()
+        return
+
+    def flush(self):
+        """Send all queued events now."""
+
+        if not self.pending and not self.overflow:
+            return
+
+        message = {"method": self.method,
+                   "events": list(self.pending.values())}
+        if self.overflow:
+            message["overflow"] = True
+
+        darq.send_message(self.service.port, self.port, orjson.dumps(message))
+        self.sent += len(self.pending)
+        self.pending.clear()
+        self.overflow = False
+        return
+
+    def cancel(self):
+        """Stop the flush timer, if running."""
+        if self.timer_id is not None:
+            darq.loop().cancel_timer(self.timer_id)
+            self.timer_id = None
+        return
+
+
 class ServiceAPI(EventListener):
     """Base class for runtime service APIs.
 
@@ -130,31 +241,76 @@ class ServiceAPI(EventListener):
         # Remote port for service instance.
         self._service_port = port
 
-        # Local (ephemeral) port for receiving replies.
-        self._port = open_port()
+        # Local (ephemeral) port for receiving replies.  It has its own
+        # listener, so replies reach this API even when the process-wide
+        # listener is a service, or another API.
+        self._port = open_port(0)
+        set_port_listener(self._port, self)
+
+        # Last transaction identifier used.
+        self._xid: int = 0
+
+        # Replies by transaction identifier; None until received.
+        self._replies: dict[int, typing.Optional[dict]] = {}
 
     def rpc(self, request: dict) -> dict:
-        """Send a server request, and await a reply."""
+        """Send a server request, and await a reply.
+
+        Each request is given a unique transaction identifier (xid),
+        which the service copies to its reply.  Services may complete
+        requests out of order, so replies are matched to requests by
+        xid, not by arrival order."""
+
+        self._xid += 1
+        xid = self._xid
+        request["xid"] = xid
+        self._replies[xid] = None
+
         buf = orjson.dumps(request)
         send_message(self._port, self._service_port, buf)
 
-        buf = self._socket.recv()
-        response = orjson.loads(buf)
-        return response
+        # Run the event loop until the reply is delivered.
+        while self._replies[xid] is None:
+            darq.loop().next()
+
+        return self._replies.pop(xid)
+
+    def send(self, request: dict):
+        """Send a server request, without waiting for a reply.
+
+        The request has no transaction identifier: services that accept
+        such requests do not reply to them."""
+
+        buf = orjson.dumps(request)
+        send_message(self._port, self._service_port, buf)
+        return
 
     def on_message(self, source: int, destination: int, buffer: bytes):
         """Handle a delivered message."""
 
         if destination == self._port:
             message = orjson.loads(buffer)
-            # FIXME: interrupt event loop
-            self.handle_request(source, message)
+
+            xid = message.get("xid")
+            if xid in self._replies:
+                self._replies[xid] = message
+            else:
+                self.handle_request(source, message)
 
         else:
             # FIXME: deal with unhandled dest port
             pass
         pass
 
+    def handle_request(self, source: int, message: dict):
+        """Handle an unsolicited message pushed by the service.
+
+        :param source: Sending port number.
+        :param message: Decoded message as dictionary.
+
+        Override this method to receive service notifications."""
+        pass
+
     def on_chunk(self, source: int, destination: int, stream: int, offset: int, chunk: bytes):
         """Handle a delivered stream chunk."""
 
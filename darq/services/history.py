@@ -1,60 +1,210 @@
 # darqos
 # Copyright (C) 2020-2022 David Arnold
 
+import atexit
 import enum
+import time
+import typing
 
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
+import darq
+from darq.kernel.loop import TimerListener
 from darq.runtime.service import ServiceAPI
 
+# Default maximum number of buffered events.
+DEFAULT_BATCH_SIZE = 100
+
+# Default maximum time, in seconds, an event is buffered.
+DEFAULT_FLUSH_INTERVAL = 0.5
+
+# Subscription callback: callback(events, overflow).
+SubscribeCallback = typing.Callable[[list, bool], None]
+
+# Unix epoch, as a naive UTC datetime.
+EPOCH = datetime(1970, 1, 1)
+
 @enum.unique
 class Event(enum.Enum):
-    """Events recorded by the history service."""
+    """Events recorded by the history service.
+
+    Events are sent and stored as these integer codes, so codes must
+    never be reused."""
+
+    # Event of a type unknown to this version.
+    UNKNOWN = 0
 
     # Object was created.
-    CREATED = "created"
+    CREATED = 1
 
     # Object was read, but not modified.
-    READ = "read"
+    READ = 2
 
     # Object was altered.
-    MODIFIED = "modified"
+    MODIFIED = 3
 
     # Object was printed (?)
-    PRINTED = "printed"
+    PRINTED = 4
+
+
+def to_microseconds(timestamp: datetime) -> int:
+    """Convert a datetime to integer microseconds since the epoch.
+
+    :param timestamp: Time; if naive, it's taken to be UTC."""
+
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_microseconds(timestamp: int) -> datetime:
+    """Convert integer microseconds since the epoch to a naive UTC datetime."""
+    return EPOCH + timedelta(microseconds=timestamp)
 
 
-class History(ServiceAPI):
-    """Interface to the History Service."""
+def decode_events(rows: list) -> list:
+    """Convert events from a reply.
+
+    :param rows: List of (timestamp, subject, event, count) lists, with
+    integer timestamps and event codes.
+    :returns: List of (datetime, subject, Event, count) tuples."""
+
+    return [(from_microseconds(timestamp), subject, Event(event), count)
+            for timestamp, subject, event, count in rows]
+
+
+class HistoryPage:
+    """A page of events, newest first.
+
+    Pages carry opaque cursors marking their ends: 'next_cursor' leads
+    to older events, and 'prev_cursor' to newer ones.  Cursors remain
+    valid as events are added, so a page's neighbours can be fetched at
+    any later time, without skipping or repeating events."""
+
+    def __init__(self, reply: dict):
+        """Constructor.
+
+        :param reply: Service reply to a get_page request."""
+
+        # Events, as (datetime, subject, Event, count) tuples, newest first.
+        self.events: list = decode_events(reply["events"])
+
+        # Cursor for the next (older) page.
+        self.next_cursor: str = reply["next"]
+
+        # Cursor for the previous (newer) page.
+        self.prev_cursor: str = reply["prev"]
+
+        # True if there were older events, when the page was fetched.
+        self.has_next: bool = reply["more_older"]
+
+        # True if there were newer events, when the page was fetched.
+        self.has_prev: bool = reply["more_newer"]
+        return
+
+    def __len__(self):
+        return len(self.events)
+
+
+class History(ServiceAPI, TimerListener):
+    """Interface to the History Service.
+
+    Events are buffered, and sent to the service in batches, without
+    waiting for a reply: a batch is sent when it reaches batch_size
+    events, or flush_interval seconds after its first event, whichever
+    comes first.  Queries send any buffered events first, so they see
+    the caller's own events, and close() sends them too; it's called
+    at exit, so a process's last events aren't lost.
+
+    Times are sent to the service as integer microseconds since the
+    epoch, and events as their integer codes; results are converted
+    back to (naive, UTC) datetimes and Events."""
 
     @staticmethod
-    def api() -> "History":
-        return History()
+    def api(batch_size: int = DEFAULT_BATCH_SIZE,
+            flush_interval: float = DEFAULT_FLUSH_INTERVAL) -> "History":
+        return History(batch_size, flush_interval)
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        """Constructor.
+
+        :param batch_size: Maximum number of buffered events; one sends
+        every event immediately.
+        :param flush_interval: Maximum time, in seconds, an event is
+        buffered."""
 
-    def __init__(self):
         super().__init__(11002)
+
+        self.batch_size: int = max(1, batch_size)
+        self.flush_interval: float = flush_interval
+
+        # Buffered events, as (timestamp, subject, event code) tuples.
+        self.pending: list[tuple] = []
+
+        # Flush timer, if one is running.
+        self.timer_id: typing.Optional[int] = None
+
+        # Subscription callback, if subscribed.
+        self._subscriber: typing.Optional[SubscribeCallback] = None
+
+        atexit.register(self.close)
         return
 
     def add_event(self, subject: str, event: Event):
-        """Record an event."""
+        """Record an event.
 
-        request = {"method": "add_event",
-                   "xid": "xxx",
-                   "timestamp": datetime.utcnow(),
-                   "subject": subject,
-                   "event": event}
-        reply = self.rpc(request)
-        return reply["result"]
+        The event is timestamped now, and buffered for sending."""
+
+        self.pending.append((time.time_ns() // 1000, subject, Event(event).value))
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timer_id is None:
+            self.timer_id = darq.loop().add_timer(self.flush_interval, self)
+        return
+
+    def flush(self):
+        """Send any buffered events now."""
+
+        if self.timer_id is not None:
+            darq.loop().cancel_timer(self.timer_id)
+            self.timer_id = None
+
+        if not self.pending:
+            return
+
+        request = {"method": "add_events",
+                   "events": self.pending}
+        self.send(request)
+        self.pending = []
+        return
+
+    def close(self):
+        """Send any buffered events, now and no longer at exit."""
+
+        self.flush()
+        atexit.unregister(self.close)
+        return
+
+    def on_timeout(self, timer_id: int, expiry_time: float, actual_time: float):
+        """Send buffered events when the flush interval expires."""
+        darq.loop().cancel_timer(timer_id)
+        self.timer_id = None
+        self.flush()
+        return
 
     def get_events_for_period(self, start_time: datetime, end_time: datetime):
         """Get list of events within a time range."""
 
+        self.flush()
         request = {"method": "get_events_for_period",
-                   "xid": "xxx",
-                   "start_time": start_time,
-                   "end_time": end_time}
+                   "start_time": to_microseconds(start_time),
+                   "end_time": to_microseconds(end_time)}
         reply = self.rpc(request)
-        return reply["events"]
+        return decode_events(reply["events"])
 
     def get_events(self, start_time: datetime, count: int, older: bool):
         """Get events from a starting time.
@@ -65,13 +215,169 @@ class History(ServiceAPI):
 
         This request is intended for pagination of large requests."""
 
+        self.flush()
         request = {"method": "get_events",
-                   "xid": "xxx",
-                   "start_time": start_time,
+                   "start_time": to_microseconds(start_time),
                    "count": count,
                    "older": older}
         reply = self.rpc(request)
-        return reply["events"]
+        return decode_events(reply["events"])
+
+    def get_page(self, count: int,
+                 start_time: typing.Optional[datetime] = None) -> HistoryPage:
+        """Get the first page of events.
+
+        :param count: Maximum number of events.
+        :param start_time: Page holds the newest events at or before
+        this time; if None, the newest events of all."""
+
+        self.flush()
+        request = {"method": "get_page",
+                   "count": count}
+        if start_time is not None:
+            request["start_time"] = to_microseconds(start_time)
+        return HistoryPage(self.rpc(request))
+
+    def next_page(self, cursor: str, count: int) -> HistoryPage:
+        """Get the page of events older than a cursor.
+
+        :param cursor: A page's next_cursor.
+        :param count: Maximum number of events."""
+
+        self.flush()
+        request = {"method": "get_page",
+                   "cursor": cursor,
+                   "count": count,
+                   "older": True}
+        return HistoryPage(self.rpc(request))
+
+    def prev_page(self, cursor: str, count: int) -> HistoryPage:
+        """Get the page of events newer than a cursor.
+
+        :param cursor: A page's prev_cursor.
+        :param count: Maximum number of events."""
+
+        self.flush()
+        request = {"method": "get_page",
+                   "cursor": cursor,
+                   "count": count,
+                   "older": False}
+        return HistoryPage(self.rpc(request))
+
+    def get_subject_events(self, subject: str, count: int,
+                           before: typing.Optional[datetime] = None) -> list:
+        """Get a subject's events, newest first.
+
+        :param subject: Subject object identifier.
+        :param count: Maximum number of events.
+        :param before: If set, only events before this time."""
+
+        self.flush()
+        request = {"method": "get_subject_events",
+                   "subject": subject,
+                   "count": count}
+        if before is not None:
+            request["before"] = to_microseconds(before)
+        reply = self.rpc(request)
+        return decode_events(reply["events"])
+
+    def get_recent_subjects(self, count: int) -> list:
+        """Get the most recently touched subjects.
+
+        :param count: Maximum number of subjects.
+        :returns: List of (subject, last touched time, event count),
+        most recent first."""
+
+        self.flush()
+        request = {"method": "get_recent_subjects",
+                   "count": count}
+        reply = self.rpc(request)
+        return [(subject, from_microseconds(timestamp), events)
+                for subject, timestamp, events in reply["subjects"]]
+
+    def get_top_subjects(self, start_time: datetime, end_time: datetime,
+                         count: int, event: typing.Optional[Event] = None) -> list:
+        """Get the subjects with the most events in a period.
+
+        :param start_time: Start of period.
+        :param end_time: End of period (exclusive).
+        :param count: Maximum number of subjects.
+        :param event: If set, count only this type of event.
+        :returns: List of (subject, event count), most events first."""
+
+        self.flush()
+        request = {"method": "get_top_subjects",
+                   "start_time": to_microseconds(start_time),
+                   "end_time": to_microseconds(end_time),
+                   "count": count}
+        if event is not None:
+            request["event"] = Event(event).value
+        reply = self.rpc(request)
+        return reply["subjects"]
+
+    def get_daily_counts(self, start_time: datetime, end_time: datetime) -> list:
+        """Get counts of each type of event, by day.
+
+        :param start_time: Start of period; rounded down to a whole day.
+        :param end_time: End of period; rounded up to a whole day.
+        :returns: List of (date, Event, count), ordered by date.
+
+        Days are UTC calendar days."""
+
+        self.flush()
+        request = {"method": "get_daily_counts",
+                   "start_time": to_microseconds(start_time),
+                   "end_time": to_microseconds(end_time)}
+        reply = self.rpc(request)
+        return [(from_microseconds(day).date(), Event(event), count)
+                for day, event, count in reply["counts"]]
+
+    def subscribe(self, callback: SubscribeCallback,
+                  subjects: typing.Optional[list] = None,
+                  events: typing.Optional[list] = None) -> bool:
+        """Receive newly recorded events as they happen.
+
+        :param callback: Called as callback(events, overflow), with a
+        batch of events, each a dictionary with timestamp (a datetime),
+        subject and event (an Event).  If overflow is True, events were missed, and the caller
+        should re-read any history it depends on.
+        :param subjects: Subjects of interest, or None for all.
+        :param events: Event types of interest, or None for all.
+
+        Events are pushed in batches, so a burst of events costs one
+        message.  Subscribing again replaces the previous filter and
+        callback."""
+
+        request = {"method": "subscribe"}
+        if subjects is not None:
+            request["subjects"] = list(subjects)
+        if events is not None:
+            request["events"] = [Event(e).value for e in events]
+        reply = self.rpc(request)
+        if reply["result"]:
+            self._subscriber = callback
+        return reply["result"]
+
+    def unsubscribe(self) -> bool:
+        """Stop receiving newly recorded events."""
+
+        request = {"method": "unsubscribe"}
+        reply = self.rpc(request)
+        self._subscriber = None
+        return reply["result"]
+
+    def handle_request(self, source: int, message: dict):
+        """Handle events pushed by the service."""
+
+        if message.get("method") != "events" or self._subscriber is None:
+            return
+
+        events = [{"timestamp": from_microseconds(e["timestamp"]),
+                   "subject": e["subject"],
+                   "event": Event(e["event"])}
+                  for e in message["events"]]
+        self._subscriber(events, message.get("overflow", False))
+        return
 
 
 def test():
@@ -95,6 +401,16 @@ def test():
     assert len(all) == 5
     assert len(old) == 3
     assert len(new) == 2
+    assert new[-1][2] == Event.PRINTED
+
+    # Page through the same events, two at a time.
+    page = api.get_page(2, later_time)
+    assert len(page) == 2
+    older = api.next_page(page.next_cursor, 2)
+    assert len(older) == 1
+    newer = api.prev_page(page.prev_cursor, 2)
+    assert len(newer) == 2
+    assert not newer.has_prev
     return
 
 
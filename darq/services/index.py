@@ -0,0 +1,895 @@
+# darqos
+# Copyright (C) 2024 David Arnold
+
+import bisect
+import heapq
+import itertools
+import re
+import typing
+import unicodedata
+
+from darq.runtime.service import ServiceAPI
+
+# Completions returned by default.
+DEFAULT_COMPLETIONS = 10
+
+# Keys per block of a PrefixIndex, before it's split in two.
+COMPLETION_BLOCK_SIZE = 256
+
+# Labels fetched per request when loading a CompletionMirror.
+LABELS_BATCH = 5000
+
+# Label change callback: callback(changes, overflow), where each change
+# is (entry, kind, label, weight), or (entry, None, None, None) for a
+# removed label.
+LabelsCallback = typing.Callable[[list, bool], None]
+
+WORD_START = re.compile(r"(?<![^\W_])[^\W_]")
+
+# Greater than any character in a key.
+KEY_END = "\U0010ffff"
+
+# Most edits in a fuzzy completion.  Completions follow each keystroke,
+# so a typo is usually completed while it's the only one, and allowing
+# two multiplies the time taken.
+COMPLETION_EDITS = 1
+
+# Most characters read by one fuzzy match, bounding its time, whatever
+# the size of the dictionary.
+FUZZY_BUDGET = 50000
+
+
+def normalize(text: str) -> str:
+    """Normalise text for completion: case-folded, with single spaces."""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def completion_keys(label: str) -> list:
+    """Return the keys under which a label is completed.
+
+    A label completes from the start of any of its words: "Book Details"
+    has keys "book details" and "details"."""
+
+    text = normalize(label)
+    return list(dict.fromkeys(text[m.start():] for m in WORD_START.finditer(text)))
+
+
+def fuzzy_edits(text: str) -> int:
+    """Return the edits allowed in a fuzzy match of a word or prefix.
+
+    Short words have too many neighbours for a typo to be recovered:
+    "at" is one edit from dozens of words."""
+
+    length = len(text)
+    return 0 if length < 3 else 1 if length < 6 else 2
+
+
+def prefix_end(prefix: str) -> typing.Optional[str]:
+    """Return the least string after all those starting with prefix.
+
+    :returns: The string, or None if there is none."""
+
+    while prefix:
+        code = ord(prefix[-1]) + 1
+        if code <= 0x10ffff:
+            # Skip the surrogates, which can't be encoded.
+            if 0xd800 <= code < 0xe000:
+                code = 0xe000
+            return prefix[:-1] + chr(code)
+        prefix = prefix[:-1]
+    return None
+
+
+class LevenshteinAutomaton:
+    """A Levenshtein automaton: matches words within some edits of a query.
+
+    Edits are insertions, deletions, substitutions and transpositions
+    of adjacent characters.  A state is the last row of the edit
+    distance table against the query, with values above the edits
+    capped, and the costs of the transpositions the last character read
+    allows.  Transitions only depend on where the next character appears
+    in the query, so every character not in it takes the same one.
+    States and transitions are made as they're first needed, and then
+    looked up, so, after the first few words, reading a character costs
+    a dictionary lookup rather than a row of the table."""
+
+    def __init__(self, query: str, edits: int):
+        """Constructor.
+
+        :param query: Normalised query.
+        :param edits: Maximum edits."""
+
+        self.query = query
+        self.edits = edits
+
+        # Positions of each character in the query, as a bitmask.
+        self.masks: dict[str, int] = {}
+        for j, c in enumerate(query):
+            self.masks[c] = self.masks.get(c, 0) | 1 << j
+
+        # Each state's (row, transpositions), its least value, and its
+        # last: the edits to match the query.  transpositions[j] is the
+        # cost at column j if the next character is query[j - 2].
+        self.rows: list[tuple] = []
+        self.least: list[int] = []
+        self.distance: list[int] = []
+        self.transitions: list[dict[int, int]] = []
+        self.states: dict[tuple, int] = {}
+
+        # Characters that might lead to a match from each state, if known:
+        # see live_characters().
+        self.live: list = []
+
+        over = edits + 1
+        self.start = self.state(tuple(min(j, over) for j in range(len(query) + 1)),
+                                (over,) * (len(query) + 1))
+        return
+
+    def state(self, row: tuple, transpositions: tuple) -> int:
+        """(Internal) Return the state for a row."""
+
+        key = (row, transpositions)
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = len(self.rows)
+            self.rows.append(key)
+            self.least.append(min(row))
+            self.distance.append(row[-1])
+            self.transitions.append({})
+            self.live.append(None)
+        return state
+
+    def step(self, state: int, c: str) -> int:
+        """Return the state after reading a character."""
+
+        mask = self.masks.get(c, 0)
+        following = self.transitions[state].get(mask)
+        if following is None:
+            following = self.transitions[state][mask] = self.compute(state, mask)
+        return following
+
+    def next_key(self, states: list, key: str, depth: int) -> typing.Optional[str]:
+        """Return the least string that might match after a dead prefix.
+
+        Skipping to it passes over the prefix, all strings starting with
+        it, and any after them that can't match.
+
+        :param states: states[i] is the state after key[:i].
+        :param key: Key read.
+        :param depth: key[:depth + 1] can't start a match.
+        :returns: The string, or None if no later string can match."""
+
+        while depth >= 0:
+            state = states[depth]
+            live = self.live[state]
+            if live is None:
+                live = self.live[state] = self.live_characters(state)
+
+            if live is True:
+                return prefix_end(key[:depth + 1])
+            for c in live:
+                if c > key[depth]:
+                    return key[:depth] + c
+            depth -= 1
+        return None
+
+    def live_characters(self, state: int) -> typing.Union[bool, list]:
+        """(Internal) Return the characters that might lead to a match.
+
+        :returns: True if any might, or else a sorted list of those in
+        the query that might."""
+
+        if self.least[self.step(state, "")] <= self.edits:
+            return True
+        return [c for c in sorted(self.masks)
+                if self.least[self.step(state, c)] <= self.edits]
+
+    def compute(self, state: int, mask: int) -> int:
+        """(Internal) Compute a transition."""
+
+        row, transpositions = self.rows[state]
+        over = self.edits + 1
+        following = [min(row[0] + 1, over)]
+        for j in range(1, len(self.query) + 1):
+            v = row[j - 1] + (not mask >> (j - 1) & 1)
+            if row[j] + 1 < v:
+                v = row[j] + 1
+            if following[j - 1] + 1 < v:
+                v = following[j - 1] + 1
+            if j > 1 and mask >> (j - 2) & 1 and transpositions[j] < v:
+                v = transpositions[j]
+            following.append(v if v < over else over)
+
+        transpositions = tuple(min(row[j - 2] + 1, over) if j > 1 and mask >> (j - 1) & 1
+                               else over for j in range(len(row)))
+        return self.state(tuple(following), transpositions)
+
+
+def gallop(keys: typing.Sequence[str], key: str, low: int, size: int) -> int:
+    """Return the position of the first of some sorted keys not less
+    than key, searching forwards from low, where it's likely close.
+
+    :param size: Number of keys."""
+
+    step = 1
+    high = low
+    while high < size and keys[high] < key:
+        low = high + 1
+        high += step
+        step *= 2
+    return bisect.bisect_left(keys, key, low, min(high, size))
+
+
+def fuzzy_matches(keys: typing.Sequence[str], query: str, edits: int,
+                  prefix: bool = False, exact: int = 0, budget: int = FUZZY_BUDGET,
+                  find: typing.Optional[typing.Callable] = None) -> list:
+    """Return the keys of a sorted dictionary within some edits of a query.
+
+    The keys are run through a LevenshteinAutomaton for the query, in
+    order, as if they were a trie: each key only from where it differs
+    from the key before.  Once no key starting with a prefix can match,
+    the walk skips them all.  So only a small part of a large dictionary
+    is visited, and at most budget characters are read, whatever its
+    size.
+
+    :param keys: Sorted keys; repeats are ignored.
+    :param query: Normalised query.
+    :param edits: Maximum edits.
+    :param prefix: If True, match keys starting with a prefix within the
+    edits, and return those prefixes rather than the keys.  A prefix is
+    followed by any longer ones needing fewer edits.
+    :param exact: Only match keys starting with this many of the query's
+    characters, unchanged.
+    :param budget: Maximum characters read; the search stops there, with
+    the matches found so far.
+    :param find: find(key, low) returns the position of the first key
+    not less than key, from low; by default, the keys are searched.
+    :returns: List of (key or prefix, edits)."""
+
+    count = len(keys)
+    if find is None:
+        def find(key: str, low: int) -> int:
+            return gallop(keys, key, low, count)
+
+    automaton = LevenshteinAutomaton(query, edits)
+    step = automaton.step
+    least = automaton.least
+    distance = automaton.distance
+
+    # states[i] is the state after the first i characters of the current
+    # key.  In prefix mode, fewest[i] is the fewest edits of a prefix
+    # matched in those i.
+    states = [automaton.start]
+    fewest = [edits + 1]
+    current = ""
+
+    matches = []
+    if prefix and not exact and len(query) <= edits:
+        matches.append(("", len(query)))
+        fewest[0] = len(query)
+
+    i = 0
+    size = count
+    if exact:
+        i = find(query[:exact], 0)
+        last = prefix_end(query[:exact])
+        if last is not None:
+            size = find(last, i)
+
+    while i < size and budget > 0:
+        key = keys[i]
+        common = 0
+        shortest = min(len(key), len(current))
+        while common < shortest and key[common] == current[common]:
+            common += 1
+        del states[common + 1:]
+        del fewest[common + 1:]
+        current = key
+
+        # Past the key, and any repeats of it, by default.
+        skip = key + "\0"
+        for d in range(common, len(key)):
+            state = step(states[d], key[d])
+            states.append(state)
+            budget -= 1
+
+            if least[state] > edits:
+                skip = automaton.next_key(states, key, d)
+                break
+            if prefix:
+                best = fewest[d]
+                if distance[state] < best:
+                    best = distance[state]
+                    matches.append((key[:d + 1], best))
+                fewest.append(best)
+                if least[state] >= best:
+                    skip = prefix_end(key[:d + 1])
+                    break
+        else:
+            if not prefix and distance[states[-1]] <= edits:
+                matches.append((key, distance[states[-1]]))
+
+        i = size if skip is None else find(skip, i + 1)
+    return matches
+
+
+class PrefixIndex:
+    """Top-ranked completions of a prefix, from a sorted key list.
+
+    Keys are (key, entry) pairs, kept sorted in blocks of up to twice
+    COMPLETION_BLOCK_SIZE, so an insert or delete only shifts one block.
+    The keys with a prefix are a contiguous run, found by binary search.
+    Each block caches its best entries, so the best completions of a
+    run spanning many blocks are found from the blocks' caches, and
+    only the partial blocks at either end of the run are scanned.  A
+    change invalidates only its block's cache."""
+
+    def __init__(self, rank: typing.Callable, cached: int = DEFAULT_COMPLETIONS):
+        """Constructor.
+
+        :param rank: Returns an entry's rank; higher ranks first.
+        :param cached: Entries cached per block; completions of more
+        than this scan the whole run."""
+
+        self.rank = rank
+        self.cached: int = cached
+
+        self.blocks: list[list[tuple]] = []
+        self.firsts: list[tuple] = []
+        self.tops: list[typing.Optional[list]] = []
+
+        # Position of each block's first key, if known.
+        self.offsets: typing.Optional[list[int]] = None
+        return
+
+    def __len__(self):
+        return sum(len(block) for block in self.blocks)
+
+    def find_block(self, key: tuple) -> int:
+        """(Internal) Return the block that should hold a key."""
+        return max(0, bisect.bisect_right(self.firsts, key) - 1)
+
+    def insert(self, key: tuple):
+        """Add a (key, entry) pair."""
+
+        self.offsets = None
+        if not self.blocks:
+            self.blocks.append([key])
+            self.firsts.append(key)
+            self.tops.append(None)
+            return
+
+        i = self.find_block(key)
+        block = self.blocks[i]
+        bisect.insort(block, key)
+        self.firsts[i] = block[0]
+        self.tops[i] = None
+
+        if len(block) > 2 * COMPLETION_BLOCK_SIZE:
+            half = block[COMPLETION_BLOCK_SIZE:]
+            del block[COMPLETION_BLOCK_SIZE:]
+            self.blocks.insert(i + 1, half)
+            self.firsts.insert(i + 1, half[0])
+            self.tops.insert(i + 1, None)
+        return
+
+    def remove(self, key: tuple):
+        """Remove a (key, entry) pair, if present."""
+
+        if not self.blocks:
+            return
+
+        i = self.find_block(key)
+        block = self.blocks[i]
+        j = bisect.bisect_left(block, key)
+        if j == len(block) or block[j] != key:
+            return
+
+        del block[j]
+        self.offsets = None
+        if block:
+            self.firsts[i] = block[0]
+            self.tops[i] = None
+        else:
+            del self.blocks[i]
+            del self.firsts[i]
+            del self.tops[i]
+        return
+
+    def warm(self):
+        """Fill every block's cache.
+
+        Caches are otherwise filled as queries first need them, and
+        filling most of them at once, for a short prefix, can take
+        longer than a keystroke should; so, after a bulk load, they're
+        filled in advance."""
+
+        for i, block in enumerate(self.blocks):
+            if self.tops[i] is None:
+                self.tops[i] = self.best(block, self.cached)
+        return
+
+    def keys(self) -> "PrefixKeys":
+        """Return the keys, as a sorted sequence of str."""
+
+        if self.offsets is None:
+            self.offsets = [0]
+            self.offsets.extend(itertools.accumulate(len(block) for block in self.blocks))
+        return PrefixKeys(self.blocks, self.firsts, self.offsets)
+
+    def best(self, keys, limit: int) -> list:
+        """(Internal) Return the best distinct entries of some keys."""
+        return heapq.nlargest(limit, {entry for _, entry in keys}, key=self.rank)
+
+    def complete(self, prefix: str, limit: int) -> list:
+        """Return the best entries with a key starting with prefix.
+
+        :param prefix: Normalised prefix.
+        :param limit: Maximum number of entries.
+        :returns: Entries, best first."""
+
+        low, high = (prefix,), (prefix + KEY_END,)
+        first = self.find_block(low)
+        last = bisect.bisect_left(self.firsts, high)
+
+        candidates = set()
+        for i in range(first, last):
+            block = self.blocks[i]
+            if block[0] >= low and block[-1] < high and limit <= self.cached:
+                if self.tops[i] is None:
+                    self.tops[i] = self.best(block, self.cached)
+                candidates.update(self.tops[i])
+            else:
+                start = bisect.bisect_left(block, low)
+                end = bisect.bisect_left(block, high)
+                candidates.update(self.best(block[start:end], limit))
+
+        return heapq.nlargest(limit, candidates, key=self.rank)
+
+
+class PrefixKeys:
+    """A PrefixIndex's keys, as a sorted sequence of str, for searching.
+
+    Keys with several entries are repeated.  The view is only valid until
+    the index is next changed."""
+
+    def __init__(self, blocks: list, firsts: list, offsets: list):
+        self.blocks = blocks
+        self.firsts = firsts
+        self.offsets = offsets
+        return
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __getitem__(self, i: int) -> str:
+        b = bisect.bisect_right(self.offsets, i) - 1
+        return self.blocks[b][i - self.offsets[b]][0]
+
+    def find(self, key: str, low: int = 0) -> int:
+        """Return the position of the first key not less than key."""
+
+        target = (key,)
+        b = max(bisect.bisect_left(self.firsts, target) - 1, 0)
+        position = self.offsets[b] + bisect.bisect_left(self.blocks[b], target)
+        return max(position, low)
+
+
+class CompletionIndex:
+    """Completion of labels: type names, object labels, etc.
+
+    Each entry has an identifier, a kind (eg. "type", "object" or
+    "kb"), a label, and a weight, which ranks it against others with
+    matching labels; shorter labels rank first among equal weights.  A
+    prefix matches the start of any word of a label."""
+
+    def __init__(self):
+
+        # Entries, by identifier: (kind, label, weight).
+        self.entries: dict[str, tuple] = {}
+
+        # Prefix index per kind.
+        self.kinds: dict[str, PrefixIndex] = {}
+        return
+
+    def __len__(self):
+        return len(self.entries)
+
+    def rank(self, entry: str) -> tuple:
+        """(Internal) Return an entry's rank."""
+        _, label, weight = self.entries[entry]
+        return weight, -len(label), entry
+
+    def set(self, entry: str, kind: str, label: str, weight: float = 0.0):
+        """Add or replace an entry."""
+
+        self.remove(entry)
+        self.entries[entry] = (kind, label, weight)
+
+        index = self.kinds.get(kind)
+        if index is None:
+            index = self.kinds[kind] = PrefixIndex(self.rank)
+        for key in completion_keys(label):
+            index.insert((key, entry))
+        return
+
+    def remove(self, entry: str) -> bool:
+        """Remove an entry.
+
+        :returns: True if it was present."""
+
+        old = self.entries.get(entry)
+        if old is None:
+            return False
+
+        kind, label, _ = old
+        for key in completion_keys(label):
+            self.kinds[kind].remove((key, entry))
+        del self.entries[entry]
+        return True
+
+    def clear(self):
+        """Remove all entries."""
+        self.entries.clear()
+        self.kinds.clear()
+        return
+
+    def warm(self):
+        """Prepare for completion, after a bulk load."""
+        for index in self.kinds.values():
+            index.warm()
+        return
+
+    def complete(self, prefix: str, limit: int = DEFAULT_COMPLETIONS,
+                 kinds: typing.Optional[typing.Iterable[str]] = None,
+                 fuzzy: bool = False) -> list:
+        """Return the best entries with a word starting with prefix.
+
+        :param prefix: Text typed so far.
+        :param limit: Maximum number of entries.
+        :param kinds: Kinds of entries, or None for all.
+        :param fuzzy: If True, and there are fewer than limit matches,
+        also match words starting with a prefix one typo away (see
+        fuzzy_edits()) with the same first letter, ranked after exact
+        matches.
+        :returns: List of (entry, kind, label, weight), best first."""
+
+        prefix = normalize(prefix)
+        kinds = self.kinds if kinds is None else kinds
+
+        candidates = []
+        for kind in kinds:
+            index = self.kinds.get(kind)
+            if index is not None:
+                candidates.extend(index.complete(prefix, limit))
+        best = heapq.nlargest(limit, candidates, key=self.rank)
+
+        edits = min(fuzzy_edits(prefix), COMPLETION_EDITS) if fuzzy else 0
+        if edits and len(best) < limit:
+            # Fewest edits of each candidate.
+            distances = {}
+            for kind in kinds:
+                index = self.kinds.get(kind)
+                if index is None:
+                    continue
+                keys = index.keys()
+                for match, distance in fuzzy_matches(keys, prefix, edits, prefix=True,
+                                                     exact=1, find=keys.find):
+                    for entry in index.complete(match, limit):
+                        if distance < distances.get(entry, edits + 1):
+                            distances[entry] = distance
+            best = heapq.nlargest(limit, distances,
+                                  key=lambda e: (-distances[e], self.rank(e)))
+
+        return [(entry, *self.entries[entry]) for entry in best]
+
+
+class IndexServiceError(Exception):
+    """A request was rejected by the Index service."""
+    pass
+
+
+class Index(ServiceAPI):
+    """Interface to the Index Service.
+
+    Objects register their text, under their object identifier, to be
+    found by full-text search.  Registering an object's text again
+    replaces it.
+
+    Separately, the service keeps labels for completion, as the user
+    types: see complete(), and CompletionMirror."""
+
+    @staticmethod
+    def api() -> "Index":
+        return Index()
+
+    def __init__(self):
+        super().__init__(11005)
+
+        # Label change callback, if watching.
+        self._labels_callback: typing.Optional[LabelsCallback] = None
+        return
+
+    def add(self, object_id: str, text: str):
+        """Index an object's text.
+
+        :param object_id: Object identifier.
+        :param text: Object's text, replacing any previously indexed."""
+
+        request = {"method": "add",
+                   "object": object_id,
+                   "text": text}
+        self.rpc(request)
+        return
+
+    def add_many(self, documents: typing.Iterable[tuple[str, str]]) -> int:
+        """Index several objects' text.
+
+        :param documents: Iterable of (object identifier, text).
+        :returns: Number of objects indexed."""
+
+        request = {"method": "add_many",
+                   "documents": [list(document) for document in documents]}
+        return self.rpc(request)["count"]
+
+    def delete(self, object_id: str) -> bool:
+        """Remove an object from the index.
+
+        :returns: True if it was indexed."""
+
+        request = {"method": "delete",
+                   "object": object_id}
+        return self.rpc(request)["result"]
+
+    def search(self, query: str, limit: int = 20,
+               match_all: bool = False,
+               fuzzy: bool = False) -> list[tuple[str, float]]:
+        """Find the objects best matching a query.
+
+        :param query: Query text.
+        :param limit: Maximum number of results.
+        :param match_all: If True, only objects with every word of the
+        query match; otherwise, objects with any word do.
+        :param fuzzy: If True, query words also match words a typo away
+        (see fuzzy_edits()), scoring less the more edits they need.
+        :returns: List of (object identifier, score), best first."""
+
+        request = {"method": "search",
+                   "query": query,
+                   "limit": limit,
+                   "match_all": match_all}
+        if fuzzy:
+            request["fuzzy"] = True
+        reply = self.rpc(request)
+        return [(object_id, score) for object_id, score in reply["results"]]
+
+    def similar(self, object_id: typing.Optional[str] = None,
+                text: typing.Optional[str] = None,
+                limit: int = 10) -> list[tuple[str, float]]:
+        """Find the objects most similar to an object, or to a text.
+
+        Needs the service's optional similarity index.
+
+        :param object_id: Object to match; it isn't itself returned.
+        :param text: Text to match, if no object is given.
+        :param limit: Maximum number of results.
+        :returns: List of (object identifier, similarity), most similar
+        first; similarity is from -1 to 1."""
+
+        request = {"method": "similar",
+                   "limit": limit}
+        if object_id is not None:
+            request["object"] = object_id
+        else:
+            request["text"] = text
+        reply = self.rpc(request)
+        if not reply["result"]:
+            raise IndexServiceError(reply["description"])
+        return [(object_id, score) for object_id, score in reply["results"]]
+
+    def set_label(self, entry: str, kind: str, label: str, weight: float = 0.0):
+        """Add or replace a completion label.
+
+        :param entry: Entry identifier, eg. an object identifier.
+        :param kind: Kind of entry, eg. "type", "object" or "kb".
+        :param label: Label text.
+        :param weight: Rank against other matching labels."""
+
+        self.set_labels([(entry, kind, label, weight)])
+        return
+
+    def set_labels(self, labels: typing.Iterable[tuple]):
+        """Add or replace several completion labels.
+
+        :param labels: Iterable of (entry, kind, label, weight)."""
+
+        request = {"method": "set_labels",
+                   "labels": [list(label) for label in labels]}
+        self.rpc(request)
+        return
+
+    def remove_label(self, entry: str) -> bool:
+        """Remove a completion label.
+
+        :returns: True if it was present."""
+
+        request = {"method": "remove_label",
+                   "entry": entry}
+        return self.rpc(request)["result"]
+
+    def complete(self, prefix: str, limit: int = DEFAULT_COMPLETIONS,
+                 kinds: typing.Optional[list] = None,
+                 fuzzy: bool = False) -> list:
+        """Return the best labels with a word starting with prefix.
+
+        :param prefix: Text typed so far.
+        :param limit: Maximum number of labels.
+        :param kinds: Kinds of entries, or None for all.
+        :param fuzzy: If True, also match typos of the prefix, ranked
+        after closer matches.
+        :returns: List of (entry, kind, label, weight), best first.
+
+        For completion as the user types, use a CompletionMirror, which
+        answers locally."""
+
+        request = {"method": "complete",
+                   "prefix": prefix,
+                   "limit": limit}
+        if kinds is not None:
+            request["kinds"] = list(kinds)
+        if fuzzy:
+            request["fuzzy"] = True
+        return [tuple(c) for c in self.rpc(request)["completions"]]
+
+    def get_labels(self) -> typing.Iterator[tuple]:
+        """Yield every completion label, as (entry, kind, label, weight)."""
+
+        after = None
+        while True:
+            request = {"method": "get_labels",
+                       "count": LABELS_BATCH}
+            if after is not None:
+                request["after"] = after
+            reply = self.rpc(request)
+
+            for label in reply["labels"]:
+                yield tuple(label)
+            if not reply["more"]:
+                return
+            after = reply["labels"][-1][0]
+
+    def watch_labels(self, callback: LabelsCallback) -> bool:
+        """Receive completion label changes as they happen.
+
+        :param callback: Called as callback(changes, overflow); if
+        overflow is True, changes were missed, and the caller should
+        reload the labels."""
+
+        reply = self.rpc({"method": "watch_labels"})
+        if reply["result"]:
+            self._labels_callback = callback
+        return reply["result"]
+
+    def unwatch_labels(self) -> bool:
+        """Stop receiving completion label changes."""
+
+        reply = self.rpc({"method": "unwatch_labels"})
+        self._labels_callback = None
+        return reply["result"]
+
+    def handle_request(self, source: int, message: dict):
+        """Handle label changes pushed by the service."""
+
+        if message.get("method") != "labels" or self._labels_callback is None:
+            return
+
+        changes = [(c["entry"], c.get("kind"), c.get("label"), c.get("weight"))
+                   for c in message["events"]]
+        self._labels_callback(changes, message.get("overflow", False))
+        return
+
+    def flush(self):
+        """Write recent changes to the index's segments now."""
+
+        request = {"method": "flush"}
+        self.rpc(request)
+        return
+
+    def stats(self) -> dict:
+        """Return index statistics."""
+
+        request = {"method": "stats"}
+        return self.rpc(request)["stats"]
+
+
+class CompletionMirror:
+    """A local copy of the Index service's completion labels.
+
+    Type-ahead completion must answer within a frame of each keystroke,
+    which leaves no time for a request to a service.  The mirror loads
+    all the labels once, then follows changes pushed by the service, and
+    completes from its own CompletionIndex."""
+
+    def __init__(self, api: Index):
+        """Constructor.
+
+        :param api: Index service API."""
+
+        self.api = api
+        self.index = CompletionIndex()
+
+        # Watch first, so no change is missed while loading.
+        self.api.watch_labels(self.on_labels)
+        self.reload()
+        return
+
+    def reload(self):
+        """Load all labels from the service."""
+
+        self.index.clear()
+        for entry, kind, label, weight in self.api.get_labels():
+            self.index.set(entry, kind, label, weight)
+        self.index.warm()
+        return
+
+    def on_labels(self, changes: list, overflow: bool):
+        """Apply label changes pushed by the service."""
+
+        if overflow:
+            self.reload()
+            return
+
+        for entry, kind, label, weight in changes:
+            if kind is None:
+                self.index.remove(entry)
+            else:
+                self.index.set(entry, kind, label, weight)
+        return
+
+    def complete(self, prefix: str, limit: int = DEFAULT_COMPLETIONS,
+                 kinds: typing.Optional[list] = None,
+                 fuzzy: bool = False) -> list:
+        """Return the best labels with a word starting with prefix.
+
+        :returns: List of (entry, kind, label, weight), best first."""
+        return self.index.complete(prefix, limit, kinds, fuzzy)
+
+    def close(self):
+        """Stop following changes."""
+        self.api.unwatch_labels()
+        return
+
+
+def test():
+    api = Index.api()
+
+    api.add("test-1", "The quick brown fox jumps over the lazy dog")
+    api.add_many([("test-2", "A quick brown dog"),
+                  ("test-3", "Lazy afternoons")])
+
+    results = api.search("quick dog", match_all=True)
+    assert [object_id for object_id, _ in results] == ["test-2", "test-1"]
+
+    api.add("test-2", "Replaced text")
+    assert [r[0] for r in api.search("lazy")] == ["test-3", "test-1"]
+    assert [r[0] for r in api.search("quick")] == ["test-1"]
+    assert api.search("qiuck") == []
+    assert [r[0] for r in api.search("qiuck", fuzzy=True)] == ["test-1"]
+
+    for object_id in ("test-1", "test-2", "test-3"):
+        api.delete(object_id)
+
+    api.set_labels([("test-type-1", "type", "Book Details", 1.0),
+                    ("test-type-2", "type", "Bookmark", 0.0),
+                    ("test-4", "object", "Booking confirmation", 5.0)])
+    assert [c[0] for c in api.complete("boo")] == ["test-4", "test-type-1", "test-type-2"]
+    assert [c[0] for c in api.complete("DET", kinds=["type"])] == ["test-type-1"]
+    assert [c[0] for c in api.complete("bokm", fuzzy=True)] == ["test-type-2"]
+
+    for entry in ("test-type-1", "test-type-2", "test-4"):
+        api.remove_label(entry)
+    return
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,355 @@
+# darqos
+# Copyright (C) 2024 David Arnold
+
+import base64
+import enum
+import itertools
+import typing
+
+from datetime import datetime, timedelta, timezone
+
+from darq.runtime.service import ServiceAPI
+
+# Unix epoch, as a naive UTC datetime.
+EPOCH = datetime(1970, 1, 1)
+
+# Attribute value types.
+Value = typing.Union[bool, int, float, str, datetime, bytes]
+
+# Default bytes per bulk import chunk.
+DEFAULT_CHUNK_SIZE = 32 * 1024
+
+# Import chunks sent between acknowledgements, to bound the number
+# queued for the service.
+IMPORT_WINDOW = 16
+
+
+@enum.unique
+class ValueType(enum.Enum):
+    """Types of metadata values.
+
+    Values are sent and stored with these integer codes, so codes must
+    never be reused."""
+
+    INTEGER = 1
+    REAL = 2
+    TEXT = 3
+    BOOLEAN = 4
+
+    # Naive datetimes are taken to be UTC.
+    DATETIME = 5
+
+    BYTES = 6
+
+
+def encode_value(value: Value) -> list:
+    """Convert a value to its [type, value] form, for a request."""
+
+    # bool is a subclass of int, so must be checked first.
+    if isinstance(value, bool):
+        return [ValueType.BOOLEAN.value, value]
+    if isinstance(value, int):
+        return [ValueType.INTEGER.value, value]
+    if isinstance(value, float):
+        return [ValueType.REAL.value, value]
+    if isinstance(value, str):
+        return [ValueType.TEXT.value, value]
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        delta = value - EPOCH
+        microseconds = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        return [ValueType.DATETIME.value, microseconds]
+    if isinstance(value, (bytes, bytearray)):
+        return [ValueType.BYTES.value, base64.b64encode(value).decode()]
+    raise TypeError(f"Unsupported metadata value type: {type(value).__name__}")
+
+
+def decode_value(value: list) -> Value:
+    """Convert a value from its [type, value] form, in a reply."""
+
+    value_type, data = ValueType(value[0]), value[1]
+    if value_type == ValueType.DATETIME:
+        return EPOCH + timedelta(microseconds=data)
+    if value_type == ValueType.BYTES:
+        return base64.b64decode(data)
+    return data
+
+
+# Query constructors.
+#
+# Queries are built from conditions on single attributes, combined with
+# all_of() and any_of(), eg.
+#
+#   all_of(eq("type", "book"), between("published", 1990, 2000))
+
+def eq(name: str, value: Value) -> list:
+    """Attribute equals value."""
+    return ["eq", name, encode_value(value)]
+
+
+def lt(name: str, value: Value) -> list:
+    """Attribute is less than value."""
+    return ["lt", name, encode_value(value)]
+
+
+def le(name: str, value: Value) -> list:
+    """Attribute is less than or equal to value."""
+    return ["le", name, encode_value(value)]
+
+
+def gt(name: str, value: Value) -> list:
+    """Attribute is greater than value."""
+    return ["gt", name, encode_value(value)]
+
+
+def ge(name: str, value: Value) -> list:
+    """Attribute is greater than or equal to value."""
+    return ["ge", name, encode_value(value)]
+
+
+def between(name: str, low: Value, high: Value) -> list:
+    """Attribute is at least low, and less than high."""
+    return ["between", name, encode_value(low), encode_value(high)]
+
+
+def prefix(name: str, text: str) -> list:
+    """Text attribute starts with text."""
+    return ["prefix", name, text]
+
+
+def exists(name: str) -> list:
+    """Object has the attribute."""
+    return ["exists", name]
+
+
+def all_of(*queries: list) -> list:
+    """All of the queries match."""
+    return ["and", *queries]
+
+
+def any_of(*queries: list) -> list:
+    """Any of the queries match."""
+    return ["or", *queries]
+
+
+class MetadataError(Exception):
+    """A request was rejected by the Metadata service."""
+    pass
+
+
+class Metadata(ServiceAPI):
+    """Interface to the Metadata Service.
+
+    Objects have named attributes, each with a typed value: bool, int,
+    float, str, datetime, or bytes."""
+
+    @staticmethod
+    def api() -> "Metadata":
+        return Metadata()
+
+    def __init__(self):
+        super().__init__(11004)
+        return
+
+    def request(self, request: dict) -> dict:
+        """(Internal) Send a request, raising MetadataError if rejected."""
+
+        reply = self.rpc(request)
+        if "description" in reply:
+            raise MetadataError(reply["description"])
+        return reply
+
+    def set(self, object_id: str, name: str, value: Value):
+        """Set an attribute of an object.
+
+        :param object_id: Object identifier.
+        :param name: Attribute name.
+        :param value: Attribute value."""
+
+        request = {"method": "set",
+                   "object": object_id,
+                   "name": name,
+                   "value": encode_value(value)}
+        self.request(request)
+        return
+
+    def set_many(self, object_id: str, attributes: dict):
+        """Set several attributes of an object, replacing existing values.
+
+        :param object_id: Object identifier.
+        :param attributes: Dictionary of attribute name to value."""
+
+        request = {"method": "set_many",
+                   "object": object_id,
+                   "attributes": {name: encode_value(value)
+                                  for name, value in attributes.items()}}
+        self.request(request)
+        return
+
+    def get(self, object_id: str, name: str) -> typing.Optional[Value]:
+        """Get an attribute of an object, or None if it's not set."""
+
+        request = {"method": "get",
+                   "object": object_id,
+                   "name": name}
+        reply = self.request(request)
+        if not reply["result"]:
+            return None
+        return decode_value(reply["value"])
+
+    def get_all(self, object_id: str) -> dict:
+        """Get all attributes of an object, as a dictionary."""
+
+        request = {"method": "get_all",
+                   "object": object_id}
+        reply = self.request(request)
+        return {name: decode_value(value)
+                for name, value in reply["attributes"].items()}
+
+    def delete(self, object_id: str, name: str) -> bool:
+        """Delete an attribute of an object.
+
+        :returns: True if it was set."""
+
+        request = {"method": "delete",
+                   "object": object_id,
+                   "name": name}
+        return self.request(request)["result"]
+
+    def delete_all(self, object_id: str) -> int:
+        """Delete all attributes of an object.
+
+        :returns: Number of attributes deleted."""
+
+        request = {"method": "delete_all",
+                   "object": object_id}
+        return self.request(request)["deleted"]
+
+    def search(self, query: list, limit: int = 1000,
+               after: typing.Optional[str] = None) -> tuple[list, bool]:
+        """Find objects matching a query.
+
+        :param query: Query, built with eq(), between(), all_of(), etc.
+        :param limit: Maximum number of objects.
+        :param after: If set, only objects with identifiers after this;
+        pass the last object returned to fetch the next batch.
+        :returns: (objects, more): matching object identifiers, in
+        order, and True if there were more than limit."""
+
+        request = {"method": "search",
+                   "query": query,
+                   "limit": limit}
+        if after is not None:
+            request["after"] = after
+        reply = self.request(request)
+        return reply["objects"], reply["more"]
+
+    def explain(self, query: list) -> list:
+        """Describe how the service would evaluate a query.
+
+        :returns: List of plan steps, as text."""
+
+        request = {"method": "explain",
+                   "query": query}
+        return self.request(request)["plan"]
+
+    def import_records(self, source: typing.BinaryIO, format: str = "ndjson",
+                       chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+        """Load a stream of records into the store.
+
+        :param source: Readable binary file of records.
+        :param format: Record format: "ndjson" or "binary"; see
+        doc/metadata.rst.
+        :param chunk_size: Bytes sent per request.
+        :returns: Dictionary with counts of records and attributes
+        loaded, and of malformed records skipped ("errors"), with the
+        first few problems ("messages").
+
+        The file is sent in chunks, without waiting for each to be
+        acknowledged; the service stages the records, and adds them to
+        the store (and its indexes) all at once, at the end.  Records
+        replace existing values of the attributes they include."""
+
+        request = {"method": "import_begin",
+                   "format": format}
+        stream = self.request(request)["stream"]
+
+        try:
+            for n in itertools.count(1):
+                data = source.read(chunk_size)
+                if not data:
+                    break
+
+                request = {"method": "import_chunk",
+                           "stream": stream,
+                           "data": base64.b64encode(data).decode()}
+                if n % IMPORT_WINDOW == 0:
+                    self.request(request)
+                else:
+                    self.send(request)
+
+        except BaseException:
+            self.rpc({"method": "import_cancel",
+                      "stream": stream})
+            raise
+
+        request = {"method": "import_end",
+                   "stream": stream}
+        reply = self.request(request)
+        return {name: reply[name]
+                for name in ("records", "attributes", "errors", "messages")}
+
+    def export_records(self, destination: typing.BinaryIO,
+                       format: str = "ndjson") -> int:
+        """Write the whole store as a stream of records.
+
+        :param destination: Writable binary file.
+        :param format: Record format: "ndjson" or "binary".
+        :returns: Number of bytes written.
+
+        The store is fetched a chunk at a time, so neither the service
+        nor the caller holds it all in memory."""
+
+        written = 0
+        cursor = None
+        while True:
+            request = {"method": "export",
+                       "format": format}
+            if cursor is not None:
+                request["cursor"] = cursor
+            reply = self.request(request)
+
+            data = base64.b64decode(reply["data"])
+            destination.write(data)
+            written += len(data)
+
+            cursor = reply["next"]
+            if cursor is None:
+                return written
+
+
+def test():
+    api = Metadata.api()
+
+    api.set_many("test-1", {"title": "Dune", "year": 1965, "read": True})
+    api.set_many("test-2", {"title": "Dune Messiah", "year": 1969})
+    api.set("test-3", "title", "Hyperion")
+    api.set("test-3", "year", 1989.0)
+
+    assert api.get("test-1", "year") == 1965
+    assert api.get_all("test-2") == {"title": "Dune Messiah", "year": 1969}
+
+    objects, more = api.search(all_of(prefix("title", "Dune"), ge("year", 1966)))
+    assert objects == ["test-2"] and not more
+
+    objects, _ = api.search(any_of(eq("read", True), gt("year", 1980)))
+    assert objects == ["test-1", "test-3"]
+
+    for object_id in ("test-1", "test-2", "test-3"):
+        api.delete_all(object_id)
+    return
+
+
+if __name__ == "__main__":
+    test()
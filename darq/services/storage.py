@@ -1,7 +1,8 @@
 # darqos
 # Copyright (C) 2022 David Arnold
 
-from typing import Union
+from collections import OrderedDict
+from typing import Callable, Optional, Union
 
 import darq
 from darq.runtime.service import ServiceAPI
@@ -14,33 +15,255 @@ import base64
 # for now, just hack it up and we'll factor it out later.
 
 
+# Change notification callback: callback(key, version, op).
+WatchCallback = Callable[[Optional[str], int, Optional[str]], None]
+
+# Watch held by the read cache: (key, prefix).
+CACHE_WATCH = ("", True)
+
+
+class ReadCache:
+    """Least-recently-used cache of stored values, bounded by size.
+
+    Each cached value is tagged with the version number reported by the
+    Storage service.  Invalidation notifications carrying an older (or
+    equal) version are ignored, so a write-through from this process
+    isn't discarded by the notification of its own write."""
+
+    def __init__(self, capacity: int):
+        """Constructor.
+
+        :param capacity: Maximum total size of cached values, in bytes."""
+
+        # Maximum number of value bytes held.
+        self.capacity: int = capacity
+
+        # Number of value bytes currently held.
+        self.size: int = 0
+
+        # Cached entries, least-recently used first: key -> (value, version).
+        self.entries: OrderedDict[str, tuple[bytes, int]] = OrderedDict()
+
+        # Statistics.
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+        return
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the cached value for key, or None if not cached.
+
+        :param key: Storage key."""
+
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key: str) -> Optional[tuple[bytes, int]]:
+        """Return the cached (value, version) for key, or None.
+
+        :param key: Storage key."""
+
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, value: bytes, version: int):
+        """Add or replace a cached value.
+
+        :param key: Storage key.
+        :param value: Stored value.
+        :param version: Service version number for this value."""
+
+        self.discard(key)
+
+        # Values larger than the whole cache are never cached.
+        if len(value) > self.capacity:
+            return
+
+        while self.size + len(value) > self.capacity:
+            _, (old_value, _) = self.entries.popitem(last=False)
+            self.size -= len(old_value)
+            self.evictions += 1
+
+        self.entries[key] = (bytes(value), version)
+        self.size += len(value)
+        return
+
+    def discard(self, key: str):
+        """Remove a key from the cache, if present.
+
+        :param key: Storage key."""
+
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+        return
+
+    def invalidate(self, key: str, version: Optional[int]):
+        """Handle a change notification from the service.
+
+        :param key: Changed key.
+        :param version: Version number after the change, or None if the
+        key was deleted."""
+
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        if version is not None and entry[1] >= version:
+            return
+
+        self.discard(key)
+        self.invalidations += 1
+        return
+
+    def clear(self):
+        """Discard all cached values."""
+        self.entries.clear()
+        self.size = 0
+        return
+
+    def stats(self) -> dict:
+        """Return a dictionary of cache statistics."""
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "capacity": self.capacity}
+
+
 class StorageAPI(ServiceAPI):
     """Interface to storage system."""
 
-    def __init__(self):
-        """Constructor."""
+    def __init__(self, cache_size: int = 0):
+        """Constructor.
+
+        :param cache_size: Size in bytes of the client-side read cache.
+        Zero (the default) disables caching.
+
+        When caching is enabled, this client watches all keys for
+        changes, so cached values are dropped
+        as soon as another process writes their key.  The cache's watch
+        is its own: unwatch() doesn't cancel it."""
         super().__init__(11001)
+
+        # Watch callbacks: (key, prefix, callback).
+        self._watches: list[tuple[str, bool, WatchCallback]] = []
+
+        # Watches requested from the service, and their number of
+        # holders (calls to watch(), and the cache): (key, prefix) -> count.
+        self._watched: dict[tuple[str, bool], int] = {}
+
+        self._cache: Optional[ReadCache] = None
+        if cache_size > 0:
+            self._cache = ReadCache(cache_size)
+            self._hold_watch(*CACHE_WATCH)
         return
 
+    def watch(self, key: str, prefix: bool = False,
+              callback: Optional[WatchCallback] = None) -> bool:
+        """Request change notifications for a key, or key prefix.
+
+        :param key: Key, or key prefix, to watch.
+        :param prefix: If True, watch all keys starting with 'key'.
+        :param callback: Optional function called for each change, as
+        callback(key, version, op), where op is "set", "update" or
+        "delete".  On overflow, it's called once with key and op None:
+        changes were missed, and the watcher should re-read.
+
+        The service batches notifications, and coalesces repeated
+        changes to a key, so a callback sees the latest version, but
+        not necessarily every intermediate one."""
+
+        result = self._hold_watch(key, prefix)
+        if result and callback is not None:
+            self._watches.append((key, prefix, callback))
+        return result
+
+    def unwatch(self, key: Optional[str] = None, prefix: bool = False) -> bool:
+        """Cancel change notifications.
+
+        :param key: Key, or key prefix, to stop watching; if None, cancel
+        all watches.  The read cache keeps watching all keys.
+        :param prefix: If True, 'key' is a prefix."""
+
+        result = True
+        for watch in list(self._watched) if key is None else [(key, prefix)]:
+            held = self._watched.get(watch, 0)
+            if self._cache is not None and watch == CACHE_WATCH:
+                if held > 1:
+                    self._release_watch(*watch, held - 1)
+            else:
+                result = self._release_watch(*watch, held) and result
+
+        if key is None:
+            self._watches.clear()
+        else:
+            self._watches = [w for w in self._watches
+                             if (w[0], w[1]) != (key, prefix)]
+        return result
+
+    def _hold_watch(self, key: str, prefix: bool) -> bool:
+        """(Internal) Take a hold on a watch, requesting it from the
+        service if it's not already held."""
+
+        held = self._watched.get((key, prefix), 0)
+        if held == 0:
+            request = {"method": "watch",
+                       "key": key,
+                       "prefix": prefix}
+            if not self.rpc(request)["result"]:
+                return False
+        self._watched[(key, prefix)] = held + 1
+        return True
+
+    def _release_watch(self, key: str, prefix: bool, count: int) -> bool:
+        """(Internal) Release holds on a watch, cancelling it at the
+        service once none remain."""
+
+        held = self._watched.pop((key, prefix), 0) - count
+        if held > 0:
+            self._watched[(key, prefix)] = held
+            return True
+
+        request = {"method": "unwatch",
+                   "key": key,
+                   "prefix": prefix}
+        return self.rpc(request)["result"]
+
     def set(self, key: str, value: Union[bytes, bytearray]):
         request = {"method": "set",
-                   "xid": "xxx",
                    "key": key,
                    "value": base64.b64encode(value).decode()}
         reply = self.rpc(request)
+        if self._cache is not None and reply["result"]:
+            self._cache.put(key, value, reply["version"])
         return reply["result"]
 
     def update(self, key: str, value: Union[bytes, bytearray]):
         request = {"method": "update",
-                   "xid": "xxx",
                    "key": key,
                    "value": base64.b64encode(value).decode()}
         reply = self.rpc(request)
+        if self._cache is not None:
+            if reply["result"]:
+                self._cache.put(key, value, reply["version"])
+            else:
+                self._cache.discard(key)
         return reply["result"]
 
     def exists(self, key: str) -> bool:
+        if self._cache is not None and key in self._cache.entries:
+            return True
+
         request = {"method": "exists",
-                   "xid": "xxx",
                    "key": key}
         reply = self.rpc(request)
         assert reply['method'] == "exists"
@@ -49,26 +272,114 @@ class StorageAPI(ServiceAPI):
         return reply['result']
 
     def get(self, key: str) -> bytes:
+        return self.get_versioned(key)[0]
+
+    def get_versioned(self, key: str) -> tuple[bytes, int]:
+        """Return the value for a key, and its version number.
+
+        :param key: Storage key.
+        :returns: (value, version) tuple; version is zero if not set.
+
+        Pass the version to cas() or delete() to make a later write
+        conditional on the key not having changed in the meantime."""
+
+        if self._cache is not None:
+            entry = self._cache.get_entry(key)
+            if entry is not None:
+                return entry
+
         request = {"method": "get",
-                   "xid": "xxx",
                    "key": key}
         reply = self.rpc(request)
-        print(reply)
 
         value = base64.b64decode(reply["value"])
-        return value
+        if self._cache is not None and reply["result"]:
+            self._cache.put(key, value, reply["version"])
+        return value, reply["version"]
+
+    def cas(self, key: str, expected_version: int,
+            value: Union[bytes, bytearray]) -> tuple[bool, int]:
+        """Set the value for a key, if its version is unchanged.
+
+        :param key: Storage key.
+        :param expected_version: Version returned by get_versioned(), or
+        zero to require that the key is not yet set.
+        :param value: New value.
+        :returns: (success, version) tuple: on success the new version,
+        otherwise the key's current version (zero if not set)."""
+
+        request = {"method": "cas",
+                   "key": key,
+                   "expected_version": expected_version,
+                   "value": base64.b64encode(value).decode()}
+        reply = self.rpc(request)
+        if self._cache is not None:
+            if reply["result"]:
+                self._cache.put(key, value, reply["version"])
+            else:
+                self._cache.discard(key)
+        return reply["result"], reply["version"]
+
+    def delete(self, key: str, expected_version: int = 0):
+        """Delete a key.
+
+        :param key: Storage key.
+        :param expected_version: If non-zero, delete only if the key's
+        version is unchanged.
+        :returns: True if the key was deleted."""
 
-    def delete(self, key: str):
         request = {"method": "delete",
-                   "xid": "xxx",
-                   "key": key}
+                   "key": key,
+                   "expected_version": expected_version}
         reply = self.rpc(request)
+        if self._cache is not None:
+            self._cache.discard(key)
         return reply["result"]
 
+    def stats(self) -> dict:
+        """Return service-side storage and deduplication statistics."""
+        request = {"method": "stats"}
+        reply = self.rpc(request)
+        return reply["stats"]
+
+    def cache_stats(self) -> Optional[dict]:
+        """Return read cache statistics, or None if caching is disabled."""
+        if self._cache is None:
+            return None
+        return self._cache.stats()
+
+    def handle_request(self, source: int, message: dict):
+        """Handle change notifications from the service."""
+
+        if message.get("method") != "changed":
+            return
+
+        if message.get("overflow"):
+            # Changes were missed: nothing cached can be trusted.
+            if self._cache is not None:
+                self._cache.clear()
+            for _, _, callback in self._watches:
+                callback(None, 0, None)
+
+        for event in message["events"]:
+            key = event["key"]
+            version = event["version"]
+            op = event["op"]
+
+            if self._cache is not None:
+                self._cache.invalidate(key, None if op == "delete" else version)
+
+            for watched, prefix, callback in self._watches:
+                if key == watched or (prefix and key.startswith(watched)):
+                    callback(key, version, op)
+        return
+
+
+def api(cache_size: int = 0):
+    """Return a client API for the Storage service.
 
-def api():
-    """Return a client API for the Storage service."""
-    return StorageAPI()
+    :param cache_size: Size in bytes of the read cache, or zero for none."""
+    return StorageAPI(cache_size)
 
 
 def test():
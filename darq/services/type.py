@@ -3,14 +3,12 @@
 # Copyright (C) 2022 David Arnold
 
 
-from typing import List
+from typing import Iterable, List, Optional
 
 from darq.runtime.service import ServiceAPI
+from darq.runtime.type import Type, TypeTool
 
 
-# Default URL for Type service.
-DEFAULT_URL = "tcp://localhost:11006"
-
 # Message field name for method name string.
 METHOD = "method"
 
@@ -18,6 +16,50 @@ METHOD = "method"
 RESULT = "result"
 
 
+def type_to_dict(typedef: Type, implementation: str = "") -> dict:
+    """(Internal) Return the request form of a type."""
+
+    return {"uti": typedef.uti,
+            "name": typedef.name,
+            "description": typedef.description,
+            "implementation": implementation,
+            "conforms_to": list(typedef.conforms_to)}
+
+
+def type_from_dict(d: dict) -> Type:
+    """(Internal) Return a type from its reply form."""
+
+    typedef = Type(d["uti"], d["name"])
+    typedef.description = d["description"]
+    typedef.conforms_to = d["conforms_to"]
+    return typedef
+
+
+def tool_to_dict(tool: TypeTool) -> dict:
+    """(Internal) Return the request form of a tool."""
+
+    return {"name": tool.name,
+            "uti": tool.type,
+            "actions": list(tool.actions),
+            "implementation": tool.impl}
+
+
+def tool_from_dict(d: dict) -> TypeTool:
+    """(Internal) Return a tool from its reply form."""
+
+    tool = TypeTool()
+    tool.name = d["name"]
+    tool.type = d["uti"]
+    tool.actions = d["actions"]
+    tool.impl = d["implementation"]
+    return tool
+
+
+class TypeServiceError(Exception):
+    """A request was rejected by the Type service."""
+    pass
+
+
 class TypeServiceAPI(ServiceAPI):
     """Interface to the type system.
 
@@ -37,6 +79,13 @@ class TypeServiceAPI(ServiceAPI):
     Implementation, along with the object's identifier.  It will return
     an endpoint via which the object is accessible.
 
+    Tools (and lenses) register for a type and the actions they
+    support.  resolve() finds the tool for an action on an object of a
+    type, falling back to the tools for the type's supertypes.  Its
+    results are cached: the first resolve() asks the service for change
+    notifications, and the cache is emptied whenever the types or tools
+    change, so that, mostly, resolving an action needs no request.
+
     https://en.wikipedia.org/wiki/Uniform_Type_Identifier
 
     """
@@ -45,60 +94,188 @@ class TypeServiceAPI(ServiceAPI):
     def api() -> "TypeServiceAPI":
         return TypeServiceAPI()
 
-    def __init__(self, url: str = None):
-        """Constructor.
+    def __init__(self):
+        super().__init__(11006)
 
-        :param url: Optional service identifier."""
+        # Resolved tools (or None), by (UTI, action).
+        self._resolved: dict[tuple, Optional[TypeTool]] = {}
 
-        super().__init__(url if url is not None else DEFAULT_URL)
+        # True once watching for changes; cache entries are from this
+        # generation of the service's types and tools.
+        self._watching: bool = False
+        self._generation: int = 0
         return
 
-    def register(self, type_id: str, desc: str, impl: str, icon: str) -> bool:
-        """Register the factory implementation for a type.
+    def request(self, request: dict) -> dict:
+        """(Internal) Send a request, raising TypeServiceError if rejected."""
+
+        reply = self.rpc(request)
+        if "description" in reply:
+            raise TypeServiceError(reply["description"])
+        return reply
 
-        :param type_id: String UTI for this type.
-        :param desc: String user-visible description of this type.
-        :param impl: String URI for the type implementation's executable.
-        :param icon: String URI for the type's icon."""
+    def register(self, typedef: Type, implementation: str = ""):
+        """Register a type, replacing any existing definition.
+
+        :param typedef: Type definition, including the UTIs of the types
+        it conforms to.
+        :param implementation: Storage URL for the type implementation."""
+
+        request = type_to_dict(typedef, implementation)
+        request[METHOD] = "register"
+        self.request(request)
+        return
+
+    def register_many(self, typedefs: Iterable[Type]) -> int:
+        """Register many types, in a single transaction.
+
+        :param typedefs: Type definitions.
+        :returns: Number of types registered."""
 
         request = {
-            METHOD: "register",
-            "id": type_id,
-            "description": desc,
-            "implementation_uri": impl,
-            "icon_uri": icon
+            METHOD: "register_many",
+            "types": [type_to_dict(typedef) for typedef in typedefs]
         }
 
-        response = self.rpc(request)
-        # FIXME: add error message.
-        return response[RESULT]
+        return self.request(request)["count"]
 
     def deregister(self, type_id: str) -> bool:
         """Deregister a type implementation.
 
-        :param type_id: String UTI for type to be deregistered."""
+        :param type_id: String UTI for type to be deregistered.
+        :returns: True if the type was registered."""
 
         request = {
             METHOD: "deregister",
-            "id": type_id
+            "uti": type_id
         }
 
-        response = self.rpc(request)
-        # FIXME: add error message.
-        return response[RESULT]
+        return self.request(request)[RESULT]
 
-    def get(self, type_id: str):
-        pass
+    def get(self, type_id: str) -> Optional[Type]:
+        """Return a type's definition, or None if not registered.
 
-    def register_tool(self):
-        pass
+        :param type_id: String UTI for the type."""
 
-    def deregister_tool(self):
-        pass
+        reply = self.request({METHOD: "get", "uti": type_id})
+        return type_from_dict(reply["type"]) if reply[RESULT] else None
+
+    def find(self, name: str) -> List[Type]:
+        """Return the definitions of types with a short name."""
+
+        reply = self.request({METHOD: "find", "name": name})
+        return [type_from_dict(d) for d in reply["types"]]
+
+    def subtypes(self, type_id: str) -> List[str]:
+        """Return the UTIs of types directly conforming to a type."""
+
+        return self.request({METHOD: "subtypes", "uti": type_id})["types"]
+
+    def all_subtypes(self, type_id: str) -> List[str]:
+        """Return the UTIs of all types conforming to a type, directly
+        or indirectly."""
+
+        return self.request({METHOD: "all_subtypes", "uti": type_id})["types"]
+
+    def supertypes(self, type_id: str) -> List[str]:
+        """Return the UTIs of all types a type conforms to, directly or
+        indirectly."""
+
+        return self.request({METHOD: "supertypes", "uti": type_id})["types"]
+
+    def conforms(self, type_id: str, parent_id: str) -> bool:
+        """Return True if a type is, or conforms to, another.
+
+        :param type_id: String UTI for the type.
+        :param parent_id: String UTI for the possible supertype."""
+
+        return self.request({METHOD: "conforms", "uti": type_id,
+                             "parent": parent_id})[RESULT]
+
+    def all_types(self) -> List[Type]:
+        """Return the definitions of all registered types."""
+
+        reply = self.request({METHOD: "list"})
+        return [type_from_dict(d) for d in reply["types"]]
+
+    def register_tool(self, tool: TypeTool):
+        """Register a tool (or lens), replacing any with the same name.
+
+        :param tool: Tool, with the type and actions it supports."""
+
+        request = tool_to_dict(tool)
+        request[METHOD] = "register_tool"
+        self.request(request)
+        return
+
+    def deregister_tool(self, name: str) -> bool:
+        """Deregister a tool.
+
+        :param name: Tool name.
+        :returns: True if the tool was registered."""
+
+        return self.request({METHOD: "deregister_tool", "name": name})[RESULT]
+
+    def tools(self) -> List[TypeTool]:
+        """Return all registered tools."""
+
+        reply = self.request({METHOD: "tools"})
+        return [tool_from_dict(d) for d in reply["tools"]]
+
+    def resolve(self, type_id: str, action: str) -> Optional[TypeTool]:
+        """Return the tool for an action on objects of a type.
+
+        :param type_id: String UTI for the object's type.
+        :param action: Action name, eg. "view".
+        :returns: The tool registered for the type and action, or else
+        for its nearest supertype, or None."""
+
+        if not self._watching:
+            self._generation = self.request({METHOD: "watch"})["generation"]
+            self._watching = True
+
+        key = (type_id, action)
+        if key in self._resolved:
+            return self._resolved[key]
+
+        reply = self.request({METHOD: "resolve", "uti": type_id, "action": action})
+        tool = tool_from_dict(reply["tool"]) if reply[RESULT] else None
+        if reply["generation"] > self._generation:
+            # Changed since the cache was filled: the notification is
+            # still on its way.
+            self._resolved.clear()
+            self._generation = reply["generation"]
+        if reply["generation"] == self._generation:
+            self._resolved[key] = tool
+        return tool
+
+    def handle_request(self, source: int, message: dict):
+        """Handle change notifications from the service."""
+
+        if message.get("method") != "changed":
+            return
+
+        self._resolved.clear()
+        for event in message["events"]:
+            self._generation = max(self._generation, event["generation"])
+        return
+
+    def create(self, type_id: str) -> int:
+        """Start the implementation of a type, to create an instance.
+
+        :param type_id: String UTI for the type.
+        :returns: Process identifier of the type implementation."""
+
+        return self.request({METHOD: "create", "uti": type_id})["pid"]
+
+    def stats(self) -> dict:
+        """Return type registry and implementation pool statistics."""
+
+        return self.request({METHOD: "stats"})["stats"]
 
     def perform_action(self, object_id, action, context):
         # FIXME: this is the heart of it: do something to an object
-        # FIXME: get type, find tool for action, do action.
+        # FIXME: get type, resolve() tool for action, do action.
         pass
 
     def activate(self, type_id: str):
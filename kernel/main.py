@@ -23,6 +23,7 @@ import os
 import platform
 import random
 import select
+import socket
 import subprocess
 import sys
 
@@ -103,6 +104,8 @@ class PseudoKernel(darq.Service, SocketListener, TimerListener):
         if sock == self.socket:
             # This is the server's listening socket.
             client_socket, client_addr = self.socket.accept()
+            # Messages are small, and latency matters more than packing.
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             client = IPCClient(self, client_socket)
             self.clients[client_socket] = client
 
@@ -352,7 +355,12 @@ class PseudoKernel(darq.Service, SocketListener, TimerListener):
         # Look up destination.
         destination = self.fds.get(message.destination)
         if destination is None:
-            raise Exception("bad destination port in send")  # FIXME: needs proper exception (and on_error)
+            # The port may have closed since the sender last heard from
+            # it: a subscriber that exited, say.  FIXME: report to sender.
+            logging.warning(f"send_message: from {message.source}, "
+                            f"to closed or unknown port "
+                            f"{message.destination}: dropped")
+            return
 
         deliver = DeliverMessage()
         deliver.source = message.source
@@ -409,61 +417,63 @@ class PseudoKernel(darq.Service, SocketListener, TimerListener):
 
         :param client: Client connection that received data
 
-        Handle received message, if buffer contains one."""
-
-        # See if we have a header yet.
-        buffer = client.get_buffer()
-        if buffer.length() < 8:
-            logging.debug(f"{client.name()} "
-                          f"Queued data ({buffer.length()} bytes) too s"
-                          f"mall for header (8 bytes).")
-            return
-
-        message_type = Message.decode_type(buffer.peek(8))
-        message_length = Message.decode_length(buffer.peek(8))
-
-        if message_type == 0 or message_length > buffer.length():
-            # Added more bytes, but total available doesn't yet constitute
-            # a message.  This should only really happen in testing.
-            logging.debug(f"{client.name()} "
-                          f"Queued data ({buffer.length()} bytes) "
-                          f"too small for message {message_type} "
-                          f"which expects {message_length} bytes.")
-            return
-
-        message_bytes = buffer.peek(message_length)
-        buffer.consume(message_length)  # FIXME: merge these two!
-
-        if message_type == MSG_OPEN_PORT_RQST:
-            message = OpenPortRequest()
-            message.decode(message_bytes)
-            self.handle_open_port_request(client, message)
-
-        elif message_type == MSG_CLOSE_PORT_RQST:
-            message = ClosePortRequest()
-            message.decode(message_bytes)
-            self.handle_close_port_request(client, message)
-
-        elif message_type == MSG_SEND_MESSAGE:
-            message = SendMessage()
-            message.decode(message_bytes)
-            self.handle_send_message(client, message)
+        Handle each complete message in the buffer: a single read may
+        deliver several."""
+
+        while True:
+            # See if we have a header yet.
+            buffer = client.get_buffer()
+            if buffer.length() < 8:
+                if buffer.length() > 0:
+                    logging.debug(f"{client.name()} "
+                                  f"Queued data ({buffer.length()} bytes) too s"
+                                  f"mall for header (8 bytes).")
+                return
 
-        elif message_type == MSG_REBOOT:
-            message = Reboot()
-            message.decode(message_bytes)
-            self.handle_reboot(client, message)
+            message_type = Message.decode_type(buffer.peek(8))
+            message_length = Message.decode_length(buffer.peek(8))
 
-        elif message_type == MSG_SHUTDOWN:
-            message = Shutdown()
-            message.decode(message_bytes)
-            self.handle_shutdown(client, message)
+            if message_type == 0 or message_length > buffer.length():
+                # Added more bytes, but total available doesn't yet constitute
+                # a message.  This should only really happen in testing.
+                logging.debug(f"{client.name()} "
+                              f"Queued data ({buffer.length()} bytes) "
+                              f"too small for message {message_type} "
+                              f"which expects {message_length} bytes.")
+                return
 
-        else:
-            logging.warning(f"{client.name()} Received message with "
-                            f"unexpected type code [{message_type}] "
-                            "Ignoring message.")
-        return
+            message_bytes = buffer.peek(message_length)
+            buffer.consume(message_length)  # FIXME: merge these two!
+
+            if message_type == MSG_OPEN_PORT_RQST:
+                message = OpenPortRequest()
+                message.decode(message_bytes)
+                self.handle_open_port_request(client, message)
+
+            elif message_type == MSG_CLOSE_PORT_RQST:
+                message = ClosePortRequest()
+                message.decode(message_bytes)
+                self.handle_close_port_request(client, message)
+
+            elif message_type == MSG_SEND_MESSAGE:
+                message = SendMessage()
+                message.decode(message_bytes)
+                self.handle_send_message(client, message)
+
+            elif message_type == MSG_REBOOT:
+                message = Reboot()
+                message.decode(message_bytes)
+                self.handle_reboot(client, message)
+
+            elif message_type == MSG_SHUTDOWN:
+                message = Shutdown()
+                message.decode(message_bytes)
+                self.handle_shutdown(client, message)
+
+            else:
+                logging.warning(f"{client.name()} Received message with "
+                                f"unexpected type code [{message_type}] "
+                                "Ignoring message.")
 
     def detect_platform(self):
         """Detect host platform."""
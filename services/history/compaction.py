@@ -0,0 +1,359 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# History compaction.
+#
+# As events age, they are merged into coarser summaries, per the
+# retention tiers in doc/history.rst:
+#
+# - repeated READs of an object within a short window become one event
+# - after a week, each object's events of each type are merged by hour
+# - after a month, they are merged by day
+# - optionally, events are deleted altogether after some maximum age
+#
+# A merged event keeps the earliest timestamp of its bucket, and the
+# sum of the merged events' counts, so the rollup tables (which count
+# events as they are added) stay correct.  Expired events are taken out
+# of the rollups as they're deleted.
+#
+# Compaction runs incrementally, on the service's event loop: each step
+# compacts one slice of one tier, in its own short transaction, so
+# requests are served in between.  A slice is at most SLICE_BUCKETS
+# buckets, and ends early, at a bucket boundary, after SLICE_EVENTS
+# events, so a step's transaction stays short however dense the history
+# (though a slice is always at least one bucket).  Each tier records how far it has
+# got (its watermark) in the compaction table, so work is never
+# repeated, and survives restarts.
+
+import logging
+import os
+import sqlite3
+import time
+
+from typing import Optional
+
+import darq
+
+from database import DAY, EVENT_CODES, HistoryDatabase
+
+# Units, in microseconds.
+SECOND = 1000000
+HOUR = 3600 * SECOND
+
+# Most buckets compacted by one step.
+SLICE_BUCKETS = 64
+
+# Events after which a step's slice ends, at the next bucket boundary.
+SLICE_EVENTS = 10000
+
+# Seconds between steps while there is work to do, and when idle.
+BUSY_INTERVAL = 0.1
+IDLE_INTERVAL = 60.0
+
+
+class RetentionPolicy:
+    """History retention configuration.
+
+    All ages and windows are in microseconds."""
+
+    def __init__(self,
+                 read_window: int = 10 * 60 * SECOND,
+                 read_age: int = HOUR,
+                 detail_age: int = 7 * DAY,
+                 hourly_age: int = 30 * DAY,
+                 max_age: Optional[int] = None):
+        """Constructor.
+
+        :param read_window: Repeated READs of an object within a window
+        of this length are merged.
+        :param read_age: Age after which READs are merged.
+        :param detail_age: Age after which events are merged by hour.
+        :param hourly_age: Age after which events are merged by day.
+        :param max_age: Age after which events are deleted; if None,
+        they're kept forever."""
+
+        self.read_window: int = read_window
+        self.read_age: int = read_age
+        self.detail_age: int = detail_age
+        self.hourly_age: int = hourly_age
+        self.max_age: Optional[int] = max_age
+        return
+
+    @staticmethod
+    def from_environment() -> "RetentionPolicy":
+        """Create a policy, with settings from the environment.
+
+        DARQ_HISTORY_DETAIL_DAYS, DARQ_HISTORY_HOURLY_DAYS and
+        DARQ_HISTORY_MAX_DAYS override the tier ages, in days, and
+        DARQ_HISTORY_READ_WINDOW the READ merging window, in seconds."""
+
+        policy = RetentionPolicy()
+
+        value = os.getenv("DARQ_HISTORY_READ_WINDOW")
+        if value:
+            policy.read_window = int(float(value) * SECOND)
+
+        value = os.getenv("DARQ_HISTORY_DETAIL_DAYS")
+        if value:
+            policy.detail_age = int(float(value) * DAY)
+
+        value = os.getenv("DARQ_HISTORY_HOURLY_DAYS")
+        if value:
+            policy.hourly_age = int(float(value) * DAY)
+
+        value = os.getenv("DARQ_HISTORY_MAX_DAYS")
+        if value:
+            policy.max_age = int(float(value) * DAY)
+
+        return policy
+
+
+class Tier:
+    """A compaction tier: events older than 'age' merged into buckets."""
+
+    def __init__(self, name: str, bucket: int, age: int,
+                 event: Optional[int] = None):
+        """Constructor.
+
+        :param name: Tier name, for its watermark.
+        :param bucket: Bucket length, in microseconds.
+        :param age: Age, in microseconds, after which events are merged.
+        :param event: If set, only this event code is merged."""
+
+        self.name: str = name
+        self.bucket: int = bucket
+        self.age: int = age
+        self.event: Optional[int] = event
+        return
+
+
+class Compactor(darq.TimerListener):
+    """Incrementally compacts a History database."""
+
+    def __init__(self, db: HistoryDatabase, policy: RetentionPolicy):
+        """Constructor.
+
+        :param db: History database.
+        :param policy: Retention configuration."""
+
+        self.db = db
+        self.policy = policy
+        self.tiers = [Tier("reads", policy.read_window, policy.read_age,
+                           EVENT_CODES["read"]),
+                      Tier("hourly", HOUR, policy.detail_age),
+                      Tier("daily", DAY, policy.hourly_age)]
+
+        # Step timer, if running.
+        self.timer_id: Optional[int] = None
+
+        # Statistics.
+        self.merged: int = 0
+        self.deleted: int = 0
+        return
+
+    def start(self):
+        """Start compacting in the background."""
+        self.schedule(BUSY_INTERVAL)
+        return
+
+    def stop(self):
+        """Stop compacting."""
+        if self.timer_id is not None:
+            darq.loop().cancel_timer(self.timer_id)
+            self.timer_id = None
+        return
+
+    def schedule(self, interval: float):
+        """(Internal) Set the timer for the next step."""
+        self.timer_id = darq.loop().add_timer(interval, self)
+        return
+
+    def on_timeout(self, timer_id: int, expiry_time: float, actual_time: float):
+        """Run one compaction step, and schedule the next."""
+
+        darq.loop().cancel_timer(timer_id)
+        self.timer_id = None
+        try:
+            busy = self.step()
+        except sqlite3.Error:
+            logging.exception("History compaction step failed")
+            busy = False
+
+        self.schedule(BUSY_INTERVAL if busy else IDLE_INTERVAL)
+        return
+
+    def step(self, now: Optional[int] = None) -> bool:
+        """Compact one slice of the first tier with work to do.
+
+        :param now: Current time, in microseconds since the epoch.
+        :returns: True if there may be more work to do."""
+
+        if now is None:
+            now = time.time_ns() // 1000
+
+        cursor = self.db.db.cursor()
+        busy = False
+
+        if self.policy.max_age is not None:
+            busy = self.expire(cursor, now - self.policy.max_age)
+
+        if not busy:
+            for tier in self.tiers:
+                limit = (now - tier.age) // tier.bucket * tier.bucket
+                start = self.watermark(cursor, tier)
+                if start is None or start >= limit:
+                    continue
+
+                end = self.slice_end(cursor, start,
+                                     min(limit, start + SLICE_BUCKETS * tier.bucket),
+                                     tier.bucket)
+                self.compact(cursor, tier, start, end)
+                cursor.execute("insert or replace into compaction "
+                               "(tier, watermark) values (?, ?)",
+                               (tier.name, end))
+                busy = True
+                break
+
+        self.db.db.commit()
+        cursor.close()
+        return busy
+
+    def watermark(self, cursor: sqlite3.Cursor, tier: Tier) -> Optional[int]:
+        """(Internal) Return the time up to which a tier is compacted.
+
+        A new tier starts at the bucket holding the oldest event; if
+        there are no events, it returns None."""
+
+        cursor.execute("select watermark from compaction where tier = ?",
+                       (tier.name,))
+        row = cursor.fetchone()
+        if row is not None:
+            return row[0]
+
+        cursor.execute("select min(timestamp) from history")
+        oldest = cursor.fetchone()[0]
+        if oldest is None:
+            return None
+        return oldest // tier.bucket * tier.bucket
+
+    def slice_end(self, cursor: sqlite3.Cursor, start: int, end: int,
+                  bucket: int) -> int:
+        """(Internal) Return the end of a step's slice.
+
+        :param cursor: Database cursor.
+        :param start: Slice start time, aligned to a bucket.
+        :param end: Latest end time, aligned to a bucket.
+        :param bucket: Bucket length, in microseconds.
+        :returns: End time: 'end', or an earlier bucket boundary after
+        about SLICE_EVENTS events, but at least one bucket after start."""
+
+        cursor.execute("select timestamp from history "
+                       "where timestamp >= ? and timestamp < ? "
+                       "order by timestamp limit 1 offset ?",
+                       (start, end, SLICE_EVENTS))
+        row = cursor.fetchone()
+        if row is None:
+            return end
+        return max(start + bucket, row[0] // bucket * bucket)
+
+    def compact(self, cursor: sqlite3.Cursor, tier: Tier, start: int, end: int):
+        """(Internal) Merge events within each bucket of a time range.
+
+        :param cursor: Database cursor.
+        :param tier: Compaction tier.
+        :param start: Start time, aligned to a bucket.
+        :param end: End time, aligned to a bucket."""
+
+        event_clause = "" if tier.event is None else "and event = ? "
+        event_args = () if tier.event is None else (tier.event,)
+
+        # Buckets with more than one event of a type, for a subject.
+        cursor.execute("create temp table if not exists merged ("
+                       "timestamp integer, subject text, event integer, "
+                       "count integer)")
+        cursor.execute("delete from temp.merged")
+        cursor.execute("insert into temp.merged "
+                       "select min(timestamp), subject, event, sum(count) "
+                       "from history "
+                       "where timestamp >= ? and timestamp < ? " + event_clause +
+                       "group by timestamp / ?, subject, event "
+                       "having count(*) > 1",
+                       (start, end) + event_args + (tier.bucket,))
+        if cursor.rowcount <= 0:
+            return
+
+        cursor.execute("delete from history "
+                       "where timestamp >= ? and timestamp < ? " + event_clause +
+                       "and (timestamp / ?, subject, event) in "
+                       "(select timestamp / ?, subject, event from temp.merged)",
+                       (start, end) + event_args + (tier.bucket, tier.bucket))
+        removed = cursor.rowcount
+
+        cursor.execute("insert into history (timestamp, subject, event, count) "
+                       "select timestamp, subject, event, count "
+                       "from temp.merged order by timestamp")
+        self.merged += removed - cursor.rowcount
+
+        logging.debug(f"Compacted {tier.name} tier from {start} to {end}: "
+                      f"{removed} events into {cursor.rowcount}")
+        return
+
+    def expire(self, cursor: sqlite3.Cursor, before: int) -> bool:
+        """(Internal) Delete one slice of events older than a time.
+
+        :param cursor: Database cursor.
+        :param before: Delete events before this time.
+        :returns: True if any events were deleted."""
+
+        cursor.execute("select min(timestamp) from history")
+        oldest = cursor.fetchone()[0]
+        if oldest is None or oldest >= before:
+            return False
+
+        end = self.slice_end(cursor, oldest,
+                             min(before, oldest + SLICE_BUCKETS * DAY), 1)
+
+        # Take the events out of the rollups, removing rows left empty.
+        # Subjects' latest event times are unaffected: a subject with
+        # events left has newer ones.
+        cursor.execute("select subject, sum(count) from history "
+                       "where timestamp < ? group by subject",
+                       (end,))
+        subjects = cursor.fetchall()
+        cursor.executemany("update subjects set events = events - ? "
+                           "where subject = ?",
+                           [(count, subject) for subject, count in subjects])
+        cursor.executemany("delete from subjects "
+                           "where subject = ? and events <= 0",
+                           [(subject,) for subject, _ in subjects])
+
+        cursor.execute("select timestamp / ?, subject, event, sum(count) "
+                       "from history where timestamp < ? "
+                       "group by 1, 2, 3",
+                       (DAY, end))
+        days = cursor.fetchall()
+        cursor.executemany("update daily_counts set count = count - ? "
+                           "where day = ? and subject = ? and event = ?",
+                           [(count, day, subject, event)
+                            for day, subject, event, count in days])
+        cursor.executemany("delete from daily_counts "
+                           "where day = ? and subject = ? and event = ? "
+                           "and count <= 0",
+                           [(day, subject, event)
+                            for day, subject, event, _ in days])
+
+        cursor.execute("delete from history where timestamp < ?", (end,))
+        self.deleted += cursor.rowcount
+        return cursor.rowcount > 0
+
+    def stats(self) -> dict:
+        """Return compaction statistics."""
+
+        cursor = self.db.db.cursor()
+        cursor.execute("select tier, watermark from compaction")
+        watermarks = dict(cursor.fetchall())
+        cursor.close()
+
+        return {"merged": self.merged,
+                "deleted": self.deleted,
+                "watermarks": watermarks}
@@ -0,0 +1,522 @@
+# DarqOS
+# Copyright (C) 2020-2024 David Arnold
+
+# History database.
+#
+# Events are stored with integer timestamps, in microseconds since the
+# Unix epoch (UTC), and integer event codes (darq.services.history.Event),
+# so time comparisons are integer comparisons, and rows are small.  Two
+# covering indexes serve the queries:
+#
+# - (timestamp, subject, event, count) for time-ordered pages and periods
+# - (subject, timestamp, event, count) for the history of a single object
+#
+# Because each index contains every column the queries return, SQLite
+# answers them from the index alone, without touching the table.
+#
+# Old events are compacted (see compaction.py): repeated events are
+# merged into one, with a count.  Every row has a count, one unless
+# merged, and queries return it as a fourth column.
+#
+# Pages of events are addressed by keyset: a page continues from the
+# (timestamp, rowid) of the last event seen, which is unique even when
+# events share a timestamp.  The rowid is part of every index entry, so
+# these queries are index range scans too.
+#
+# Aggregate queries are answered from rollup tables, updated as each
+# batch of events is added, rather than by scanning events:
+#
+# - subjects: per subject, its latest event time and event count
+# - daily_counts: per UTC day, subject and event, the event count
+#
+# The schema version is kept in SQLite's user_version, and older
+# databases are migrated when opened.
+
+import heapq
+import logging
+import sqlite3
+
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Optional, Union
+
+# Current schema version.
+SCHEMA_VERSION = 4
+
+# Event codes, by name, as darq.services.history.Event.  Events were
+# once recorded by name; any unknown names are stored as UNKNOWN_EVENT.
+EVENT_CODES = {"created": 1, "read": 2, "modified": 3, "printed": 4}
+UNKNOWN_EVENT = 0
+
+# One day, in microseconds.
+DAY = 86400 * 1000000
+
+# Keys before and beyond any stored event.
+START_KEY = (-2 ** 63, 0)
+END_KEY = (2 ** 63 - 1, 0)
+
+# Unix epoch, as an aware datetime.
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_microseconds(timestamp: Union[int, str, datetime]) -> int:
+    """Convert a timestamp to integer microseconds since the epoch.
+
+    :param timestamp: Integer microseconds, ISO 8601 string, or datetime.
+    Naive values are taken to be UTC."""
+
+    if isinstance(timestamp, int):
+        return timestamp
+
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def to_event_code(event: Union[int, str]) -> int:
+    """Convert an event to its integer code.
+
+    :param event: Event code, or (from older clients) event name."""
+
+    if isinstance(event, int):
+        return event
+    return EVENT_CODES[event]
+
+
+class HistoryDatabase:
+    """SQLite persistence for the History service."""
+
+    def __init__(self, file: str):
+        """Constructor.
+
+        :param file: Database file name."""
+
+        self.db = sqlite3.connect(file)
+        self.migrate()
+        return
+
+    def close(self):
+        """Close the database connection."""
+        self.db.close()
+        self.db = None
+        return
+
+    def migrate(self):
+        """Create the schema, or bring an existing one up to date."""
+
+        cursor = self.db.cursor()
+        cursor.execute("pragma user_version")
+        version = cursor.fetchone()[0]
+
+        if version == 0:
+            cursor.execute("select count(*) from sqlite_master "
+                           "where type = 'table' and name = 'history'")
+            if cursor.fetchone()[0] == 0:
+                self.create_schema(cursor)
+                version = SCHEMA_VERSION
+            else:
+                self.migrate_from_0(cursor)
+                version = 1
+
+        if version == 1:
+            self.migrate_from_1(cursor)
+            version = 2
+
+        if version == 2:
+            self.migrate_from_2(cursor)
+            version = 3
+
+        if version == 3:
+            self.migrate_from_3(cursor)
+
+        cursor.execute(f"pragma user_version = {SCHEMA_VERSION}")
+        self.db.commit()
+        return
+
+    def create_schema(self, cursor: sqlite3.Cursor):
+        """Create the current schema in an empty database."""
+
+        cursor.execute("create table history ("
+                       "timestamp integer not null, "
+                       "subject text not null, "
+                       "event integer not null, "
+                       "count integer not null default 1)")
+        self.create_indexes(cursor)
+        self.create_rollups(cursor)
+        self.create_compaction(cursor)
+        return
+
+    def create_rollups(self, cursor: sqlite3.Cursor):
+        """Create the rollup tables."""
+
+        cursor.execute("create table subjects ("
+                       "subject text not null primary key, "
+                       "last_touched integer not null, "
+                       "events integer not null) without rowid")
+        cursor.execute("create index subjects_by_time "
+                       "on subjects (last_touched, subject)")
+        cursor.execute("create table daily_counts ("
+                       "day integer not null, "
+                       "subject text not null, "
+                       "event integer not null, "
+                       "count integer not null, "
+                       "primary key (day, subject, event)) without rowid")
+        return
+
+    def create_indexes(self, cursor: sqlite3.Cursor):
+        """Create the covering indexes."""
+
+        cursor.execute("create index if not exists history_by_time "
+                       "on history (timestamp, subject, event, count)")
+        cursor.execute("create index if not exists history_by_subject "
+                       "on history (subject, timestamp, event, count)")
+        return
+
+    def create_compaction(self, cursor: sqlite3.Cursor):
+        """Create the compaction progress table."""
+
+        cursor.execute("create table compaction ("
+                       "tier text not null primary key, "
+                       "watermark integer not null) without rowid")
+        return
+
+    def migrate_from_0(self, cursor: sqlite3.Cursor):
+        """Convert text timestamps to integer microseconds, and index."""
+
+        logging.info("Migrating history database to schema version 1")
+
+        self.db.create_function("to_microseconds", 1, to_microseconds,
+                                deterministic=True)
+
+        cursor.execute("create table history_v1 ("
+                       "timestamp integer not null, "
+                       "subject text not null, "
+                       "event text not null)")
+        cursor.execute("insert into history_v1 (timestamp, subject, event) "
+                       "select to_microseconds(timestamp), subject, event "
+                       "from history order by rowid")
+        cursor.execute("drop table history")
+        cursor.execute("alter table history_v1 rename to history")
+        self.create_indexes(cursor)
+        return
+
+    def migrate_from_1(self, cursor: sqlite3.Cursor):
+        """Add the rollup tables, and fill them from existing events."""
+
+        logging.info("Migrating history database to schema version 2")
+
+        self.create_rollups(cursor)
+        cursor.execute("insert into subjects (subject, last_touched, events) "
+                       "select subject, max(timestamp), count(*) "
+                       "from history group by subject")
+        cursor.execute("insert into daily_counts (day, subject, event, count) "
+                       f"select timestamp / {DAY}, subject, event, count(*) "
+                       "from history group by 1, 2, 3")
+        return
+
+    def migrate_from_2(self, cursor: sqlite3.Cursor):
+        """Add event counts, and include them in the indexes."""
+
+        logging.info("Migrating history database to schema version 3")
+
+        cursor.execute("alter table history add column "
+                       "count integer not null default 1")
+        cursor.execute("drop index history_by_time")
+        cursor.execute("drop index history_by_subject")
+        self.create_indexes(cursor)
+        self.create_compaction(cursor)
+        return
+
+    def migrate_from_3(self, cursor: sqlite3.Cursor):
+        """Convert event names to integer codes."""
+
+        logging.info("Migrating history database to schema version 4")
+
+        self.db.create_function("to_event_code", 1,
+                                lambda name: EVENT_CODES.get(name, UNKNOWN_EVENT),
+                                deterministic=True)
+
+        # Rowids are kept, so page cursors remain valid.
+        cursor.execute("create table history_v4 ("
+                       "timestamp integer not null, "
+                       "subject text not null, "
+                       "event integer not null, "
+                       "count integer not null default 1)")
+        cursor.execute("insert into history_v4 "
+                       "(rowid, timestamp, subject, event, count) "
+                       "select rowid, timestamp, subject, to_event_code(event), count "
+                       "from history order by rowid")
+        cursor.execute("drop table history")
+        cursor.execute("alter table history_v4 rename to history")
+        self.create_indexes(cursor)
+
+        cursor.execute("create table daily_counts_v4 ("
+                       "day integer not null, "
+                       "subject text not null, "
+                       "event integer not null, "
+                       "count integer not null, "
+                       "primary key (day, subject, event)) without rowid")
+        cursor.execute("insert into daily_counts_v4 (day, subject, event, count) "
+                       "select day, subject, to_event_code(event), sum(count) "
+                       "from daily_counts group by 1, 2, 3")
+        cursor.execute("drop table daily_counts")
+        cursor.execute("alter table daily_counts_v4 rename to daily_counts")
+        return
+
+    def add_event(self, timestamp: int, subject: str, event: int):
+        """Record an event.
+
+        :param timestamp: Microseconds since the epoch.
+        :param subject: Subject object identifier.
+        :param event: Event code."""
+
+        self.add_events([(timestamp, subject, event)])
+        return
+
+    def add_events(self, events: list):
+        """Record a batch of events, in a single transaction.
+
+        :param events: List of (timestamp, subject, event) tuples, with
+        timestamps in microseconds since the epoch, and event codes."""
+
+        cursor = self.db.cursor()
+        cursor.executemany("insert into history (timestamp, subject, event) "
+                           "values (?, ?, ?)",
+                           events)
+        self.update_rollups(cursor, events)
+        self.db.commit()
+        return
+
+    def update_rollups(self, cursor: sqlite3.Cursor, events: list):
+        """Add a batch of events to the rollup tables.
+
+        :param cursor: Database cursor, within the caller's transaction.
+        :param events: List of (timestamp, subject, event) tuples."""
+
+        # Aggregate the batch first, so each rollup row is written once.
+        touched = {}
+        totals = Counter()
+        daily = Counter()
+        for timestamp, subject, event in events:
+            touched[subject] = max(timestamp, touched.get(subject, timestamp))
+            totals[subject] += 1
+            daily[(timestamp // DAY, subject, event)] += 1
+
+        cursor.executemany("insert into subjects (subject, last_touched, events) "
+                           "values (?, ?, ?) "
+                           "on conflict (subject) do update "
+                           "set last_touched = max(last_touched, excluded.last_touched), "
+                           "events = events + excluded.events",
+                           [(subject, timestamp, totals[subject])
+                            for subject, timestamp in touched.items()])
+        cursor.executemany("insert into daily_counts (day, subject, event, count) "
+                           "values (?, ?, ?, ?) "
+                           "on conflict (day, subject, event) do update "
+                           "set count = count + excluded.count",
+                           [(day, subject, event, count)
+                            for (day, subject, event), count in daily.items()])
+        return
+
+    def get_events_for_period(self, start_time: int, end_time: int) -> list:
+        """Return events in [start_time, end_time), oldest first.
+
+        :param start_time: Microseconds since the epoch.
+        :param end_time: Microseconds since the epoch."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select timestamp, subject, event, count "
+                       "from history "
+                       "where timestamp >= ? "
+                       "  and timestamp < ? "
+                       "order by timestamp",
+                       (start_time, end_time))
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def get_events(self, start_time: int, count: int, older: bool) -> list:
+        """Return up to count events from a starting time.
+
+        :param start_time: Microseconds since the epoch.
+        :param count: Maximum number of events.
+        :param older: If True, events at or before start_time, newest
+        first; otherwise events at or after it, oldest first."""
+
+        cursor = self.db.cursor()
+        if older:
+            cursor.execute("select timestamp, subject, event, count "
+                           "from history "
+                           "where timestamp <= ? "
+                           "order by timestamp desc "
+                           "limit ?",
+                           (start_time, count))
+        else:
+            cursor.execute("select timestamp, subject, event, count "
+                           "from history "
+                           "where timestamp >= ? "
+                           "order by timestamp asc "
+                           "limit ?",
+                           (start_time, count))
+
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def get_page(self, key: tuple[int, int], count: int, older: bool) -> list:
+        """Return up to count events beyond a (timestamp, rowid) key.
+
+        :param key: (timestamp, rowid) position; not itself included.
+        :param count: Maximum number of events.
+        :param older: If True, events before key, newest first;
+        otherwise events after key, oldest first.
+        :returns: List of (timestamp, rowid, subject, event, count)
+        tuples."""
+
+        cursor = self.db.cursor()
+        if older:
+            cursor.execute("select timestamp, rowid, subject, event, count "
+                           "from history "
+                           "where (timestamp, rowid) < (?, ?) "
+                           "order by timestamp desc, rowid desc "
+                           "limit ?",
+                           (key[0], key[1], count))
+        else:
+            cursor.execute("select timestamp, rowid, subject, event, count "
+                           "from history "
+                           "where (timestamp, rowid) > (?, ?) "
+                           "order by timestamp asc, rowid asc "
+                           "limit ?",
+                           (key[0], key[1], count))
+
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def has_events(self, key: tuple[int, int], older: bool) -> bool:
+        """Return True if any event lies beyond a (timestamp, rowid) key.
+
+        :param key: (timestamp, rowid) position.
+        :param older: If True, look before key; otherwise after it."""
+
+        cursor = self.db.cursor()
+        if older:
+            cursor.execute("select 1 from history "
+                           "where (timestamp, rowid) < (?, ?) limit 1",
+                           key)
+        else:
+            cursor.execute("select 1 from history "
+                           "where (timestamp, rowid) > (?, ?) limit 1",
+                           key)
+        row = cursor.fetchone()
+        cursor.close()
+        return row is not None
+
+    def get_subject_events(self, subject: str, count: int,
+                           before: Optional[int] = None) -> list:
+        """Return a subject's events, newest first.
+
+        :param subject: Subject object identifier.
+        :param count: Maximum number of events.
+        :param before: If set, only events before this time."""
+
+        if before is None:
+            before = END_KEY[0]
+
+        cursor = self.db.cursor()
+        cursor.execute("select timestamp, subject, event, count "
+                       "from history "
+                       "where subject = ? and timestamp < ? "
+                       "order by timestamp desc "
+                       "limit ?",
+                       (subject, before, count))
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def get_recent_subjects(self, count: int) -> list:
+        """Return the most recently touched subjects, newest first.
+
+        :param count: Maximum number of subjects.
+        :returns: List of (subject, last_touched, events) tuples."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select subject, last_touched, events "
+                       "from subjects "
+                       "order by last_touched desc "
+                       "limit ?",
+                       (count,))
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def get_top_subjects(self, start_time: int, end_time: int, count: int,
+                         event: Optional[int] = None) -> list:
+        """Return the subjects with most events in a period.
+
+        :param start_time: Microseconds since the epoch.
+        :param end_time: Microseconds since the epoch.
+        :param count: Maximum number of subjects.
+        :param event: If set, count only this event code.
+        :returns: List of (subject, count) tuples, most events first.
+
+        Whole days within the period are counted from the daily rollup,
+        and only the partial days at either end from the events."""
+
+        first_day = -(-start_time // DAY)
+        end_day = end_time // DAY
+        if first_day >= end_day:
+            first_day = end_day = start_time // DAY
+            ranges = [(start_time, end_time)]
+        else:
+            ranges = [(start_time, first_day * DAY), (end_day * DAY, end_time)]
+
+        event_clause = "" if event is None else "and event = ? "
+        event_args = () if event is None else (event,)
+        totals = Counter()
+
+        cursor = self.db.cursor()
+        if first_day < end_day:
+            cursor.execute("select subject, sum(count) "
+                           "from daily_counts "
+                           "where day >= ? and day < ? " + event_clause +
+                           "group by subject",
+                           (first_day, end_day) + event_args)
+            totals.update(dict(cursor.fetchall()))
+
+        for start, end in ranges:
+            if start >= end:
+                continue
+            cursor.execute("select subject, sum(count) "
+                           "from history "
+                           "where timestamp >= ? and timestamp < ? " + event_clause +
+                           "group by subject",
+                           (start, end) + event_args)
+            totals.update(dict(cursor.fetchall()))
+        cursor.close()
+
+        # Most events first; ties by subject, so results are stable.
+        return heapq.nsmallest(count, totals.items(),
+                               key=lambda item: (-item[1], item[0]))
+
+    def get_daily_counts(self, start_day: int, end_day: int) -> list:
+        """Return event counts by type, for each day in a range.
+
+        :param start_day: First day, in days since the epoch.
+        :param end_day: Day after the last, in days since the epoch.
+        :returns: List of (day, event, count) tuples, ordered by day."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select day, event, sum(count) "
+                       "from daily_counts "
+                       "where day >= ? and day < ? "
+                       "group by day, event "
+                       "order by day, event",
+                       (start_day, end_day))
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
@@ -13,7 +13,7 @@ def main():
     events = api.get_events(now, 100, True)
 
     for event in events:
-        print(f"{event[0]}  {event[1]}  {event[2]}")
+        print(f"{event[0]}  {event[1]}  {event[2].name.lower()}")
 
     return
 
@@ -1,12 +1,60 @@
 #! /usr/bin/env python
 # Copyright (C) 2020-2021 David Arnold
 
+import base64
+import logging
+import os
+import struct
+import sys
+
+from typing import Optional
+
 import darq
-from darq.rt.history import Event
 
-from datetime import datetime
-import sqlite3
-import sys
+from compaction import Compactor, RetentionPolicy
+from database import DAY, END_KEY, START_KEY, HistoryDatabase, to_event_code, to_microseconds
+from segments import SegmentDatabase
+
+
+# Maximum number of undelivered events queued per subscriber.
+SUBSCRIBER_QUEUE_LIMIT = 1000
+
+
+class Subscription:
+    """A client's subscription to newly recorded events.
+
+    Events are delivered in batches, without coalescing: a subscriber
+    sees every matching event, unless its queue overflows."""
+
+    def __init__(self, service: darq.Service, port: int,
+                 subjects: Optional[list], events: Optional[list]):
+        """Constructor.
+
+        :param service: History service.
+        :param port: Client port to be notified.
+        :param subjects: Subjects of interest, or None for all.
+        :param events: Event codes of interest, or None for all."""
+
+        self.subjects: Optional[set] = None if subjects is None else set(subjects)
+        self.events: Optional[set] = None if events is None else set(events)
+        self.subscriber = darq.Subscriber(service, port, "events",
+                                          SUBSCRIBER_QUEUE_LIMIT)
+        return
+
+    def matches(self, subject: str, event: int) -> bool:
+        """Return True if an event should be delivered."""
+        return ((self.subjects is None or subject in self.subjects) and
+                (self.events is None or event in self.events))
+
+
+def encode_cursor(key: tuple[int, int]) -> str:
+    """Encode a (timestamp, rowid) key as an opaque cursor string."""
+    return base64.urlsafe_b64encode(struct.pack("<qq", *key)).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[int, int]:
+    """Decode a cursor string to its (timestamp, rowid) key."""
+    return struct.unpack("<qq", base64.urlsafe_b64decode(cursor))
 
 
 class HistoryService(darq.Service):
@@ -14,102 +62,289 @@ class HistoryService(darq.Service):
     The History service records a stream of time-stamped events reported by other
     components in the system.  It can return records of past events by time range
     or count.
+
+    Timestamps are exchanged as integer microseconds since the epoch, and
+    events as integer codes (darq.services.history.Event).  ISO 8601
+    timestamps and event names from older clients are converted on
+    receipt.
     """
 
-    def __init__(self, file: str = None):
-        super().__init__("tcp://*:11002")
+    def __init__(self, file: str = None,
+                 policy: Optional[RetentionPolicy] = None,
+                 backend: str = "sqlite"):
+        """Constructor.
+
+        :param file: Database file name (for "segments", a directory).
+        :param policy: Retention configuration; if None, the defaults,
+        as overridden by the environment.
+        :param backend: Storage backend: "sqlite", or "segments" for
+        the append-only columnar segment store, which doesn't compact."""
+
+        # Initialise runtime.
+        darq.init_callbacks(darq.SelectEventLoop(), self)
+
+        logging.info("Starting History service.")
+
+        # Initialise service.
+        super().__init__(11002)
 
-        if file is None:
-            file = "history.sqlite"
+        if backend == "segments":
+            self.db = SegmentDatabase(file or "history.segments")
+            self.compactor = None
+
+        elif backend == "sqlite":
+            self.db = HistoryDatabase(file or "history.sqlite")
+
+            # Old events are compacted in the background, a slice at a time.
+            if policy is None:
+                policy = RetentionPolicy.from_environment()
+            self.compactor = Compactor(self.db, policy)
+            self.compactor.start()
+
+        else:
+            raise ValueError(f"Unknown history backend: {backend}")
 
-        self.db = sqlite3.connect(file)
-        cursor = self.db.cursor()
-        cursor.execute("create table if not exists history ("
-                       "timestamp datetime not null,"
-                       "subject text not null,"
-                       "event text not null)")
-        self.db.commit()
+        # Event subscriptions, by client port.
+        self.subscriptions: dict[int, Subscription] = {}
 
         self.context = None
         self.socket = None
         self.active = False
+
+        # Open port.
+        darq.open_port(self.port)
         return
 
+    def run(self):
+        return darq.loop().run()
+
     @staticmethod
     def get_name() -> str:
         """Return the service name."""
         return "history"
 
-    def add_event(self, timestamp: datetime, subject: str, event: Event):
-        """Record an event."""
-        cursor = self.db.cursor()
-        cursor.execute("insert into history (timestamp, subject, event) "
-                       "values (?, ?, ?)",
-                       (timestamp, subject, event))
-        self.db.commit()
-        return
+    def get_page(self, cursor: Optional[str], start_time: Optional[int],
+                 count: int, older: bool) -> dict:
+        """Return a page of events, newest first, with its cursors.
+
+        :param cursor: Cursor returned with an earlier page, or None to
+        start from start_time.
+        :param start_time: If no cursor, the newest events at or before
+        this time are returned; if None, the newest events of all.
+        :param count: Maximum number of events.
+        :param older: If True, the page holds events older than cursor;
+        otherwise newer ones.
+        :returns: Reply fields: events, the "next" (older) and "prev"
+        (newer) cursors, and whether events lie beyond each."""
 
-    def get_events_for_period(self, start_time: datetime, end_time: datetime):
-        cursor = self.db.cursor()
-        cursor.execute("select timestamp, subject, event "
-                       "from history "
-                       "where timestamp >= ? "
-                       "  and timestamp < ?",
-                       (start_time, end_time))
-        rows = cursor.fetchall()
-        cursor.close()
-        return rows
-
-    def get_events(self, start_time: datetime, count: int, older: bool):
-        print(f"get_events({start_time}, {count}, {older})")
-
-        cursor = self.db.cursor()
-        if older:
-            cursor.execute("select timestamp, subject, event "
-                           "from history "
-                           "where timestamp <= ? "
-                           "order by timestamp desc "
-                           "limit ?",
-                           (start_time, count))
+        if cursor is not None:
+            key = decode_cursor(cursor)
+        elif start_time is not None:
+            key = (start_time + 1, 0)
+            older = True
         else:
-            cursor.execute("select timestamp, subject, event "
-                           "from history "
-                           "where timestamp >= ? "
-                           "order by timestamp asc "
-                           "limit ?",
-                           (start_time, count))
-
-        rows = cursor.fetchall()
-        cursor.close()
-        return rows
-
-    def handle_request(self, request: dict):
+            key = END_KEY
+            older = True
+
+        rows = self.db.get_page(key, count, older)
+        if not older:
+            rows.reverse()
+
+        if rows:
+            newest = (rows[0][0], rows[0][1])
+            oldest = (rows[-1][0], rows[-1][1])
+        elif older:
+            # Nothing before key: both cursors move to the very start,
+            # so a newer page finds whatever is added later.
+            newest = oldest = START_KEY
+        else:
+            newest = oldest = key
+
+        return {"events": [(timestamp, subject, event, count)
+                           for timestamp, _, subject, event, count in rows],
+                "next": encode_cursor(oldest),
+                "prev": encode_cursor(newest),
+                "more_older": self.db.has_events(oldest, True),
+                "more_newer": self.db.has_events(newest, False)}
+
+    def subscribe(self, port: int, subjects: Optional[list],
+                  events: Optional[list]):
+        """Push newly recorded events to a port.
+
+        :param port: Client port to be notified.
+        :param subjects: Subjects of interest, or None for all.
+        :param events: Event codes of interest, or None for all.
+
+        A port has a single subscription: subscribing again replaces
+        its filter."""
+
+        logging.debug(f"subscribe({port}, {subjects}, {events})")
+
+        subscription = self.subscriptions.get(port)
+        if subscription is not None:
+            subscription.subjects = None if subjects is None else set(subjects)
+            subscription.events = None if events is None else set(events)
+            return
+
+        self.subscriptions[port] = Subscription(self, port, subjects, events)
+        return
+
+    def unsubscribe(self, port: int):
+        """Stop pushing events to a port.
+
+        :param port: Subscribed client port."""
+
+        logging.debug(f"unsubscribe({port})")
+
+        subscription = self.subscriptions.pop(port, None)
+        if subscription is not None:
+            subscription.subscriber.cancel()
+            subscription.subscriber.flush()
+        return
+
+    def notify(self, events: list):
+        """Queue newly recorded events to matching subscribers.
+
+        :param events: List of (timestamp, subject, event) tuples, with
+        integer timestamps and event codes."""
+
+        if not self.subscriptions:
+            return
+
+        for timestamp, subject, event in events:
+            message = None
+            for subscription in self.subscriptions.values():
+                if not subscription.matches(subject, event):
+                    continue
+
+                if message is None:
+                    message = {"timestamp": timestamp,
+                               "subject": subject,
+                               "event": event}
+                subscription.subscriber.post(message)
+        return
+
+    def handle_request(self, reply_port: int, request: dict):
         """Handle requests."""
 
         method = request.get("method")
         if method == "add_event":
-            self.add_event(request["timestamp"],
-                           request["subject"],
-                           request["event"])
-            self.send_reply(request, result=True)
+            event = (to_microseconds(request["timestamp"]),
+                     request["subject"],
+                     to_event_code(request["event"]))
+            self.db.add_event(*event)
+            self.send_reply(reply_port, request, result=True)
+            self.notify([event])
+
+        elif method == "add_events":
+            # Sent without waiting for a reply: only reply if asked.
+            events = [(to_microseconds(timestamp), subject, to_event_code(event))
+                      for timestamp, subject, event in request["events"]]
+            self.db.add_events(events)
+            if "xid" in request:
+                self.send_reply(reply_port, request, result=True)
+            self.notify(events)
+
+        elif method == "subscribe":
+            events = request.get("events")
+            if events is not None:
+                events = [to_event_code(event) for event in events]
+            self.subscribe(reply_port, request.get("subjects"), events)
+            self.send_reply(reply_port, request, result=True)
+
+        elif method == "unsubscribe":
+            self.unsubscribe(reply_port)
+            self.send_reply(reply_port, request, result=True)
 
         elif method == "get_events":
-            rows = self.get_events(request["start_time"],
-                                   request["count"],
-                                   request["older"])
-            self.send_reply(request, result=True, events=rows)
+            rows = self.db.get_events(to_microseconds(request["start_time"]),
+                                      request["count"],
+                                      request["older"])
+            self.send_reply(reply_port, request, result=True, events=rows)
+
+        elif method == "get_page":
+            start_time = request.get("start_time")
+            if start_time is not None:
+                start_time = to_microseconds(start_time)
+            page = self.get_page(request.get("cursor"),
+                                 start_time,
+                                 request["count"],
+                                 request.get("older", True))
+            self.send_reply(reply_port, request, result=True, **page)
+
+        elif method == "get_subject_events":
+            before = request.get("before")
+            if before is not None:
+                before = to_microseconds(before)
+            rows = self.db.get_subject_events(request["subject"],
+                                              request["count"],
+                                              before)
+            self.send_reply(reply_port, request, result=True, events=rows)
+
+        elif method == "get_recent_subjects":
+            rows = self.db.get_recent_subjects(request["count"])
+            self.send_reply(reply_port, request, result=True, subjects=rows)
+
+        elif method == "get_top_subjects":
+            event = request.get("event")
+            if event is not None:
+                event = to_event_code(event)
+            rows = self.db.get_top_subjects(to_microseconds(request["start_time"]),
+                                            to_microseconds(request["end_time"]),
+                                            request["count"],
+                                            event)
+            self.send_reply(reply_port, request, result=True, subjects=rows)
+
+        elif method == "get_daily_counts":
+            start_day = to_microseconds(request["start_time"]) // DAY
+            end_day = -(-to_microseconds(request["end_time"]) // DAY)
+            rows = self.db.get_daily_counts(start_day, end_day)
+            counts = [(day * DAY, event, count) for day, event, count in rows]
+            self.send_reply(reply_port, request, result=True, counts=counts)
+
+        elif method == "stats":
+            self.send_reply(reply_port, request, result=True,
+                            stats={"backend": type(self.db).__name__,
+                                   "compaction": self.compactor.stats()
+                                   if self.compactor else None})
 
         elif method == "get_events_for_period":
-            rows = self.get_events_for_period(request["start_time"],
-                                              request["end_time"])
-            self.send_reply(request, result=True, events=rows)
+            rows = self.db.get_events_for_period(
+                to_microseconds(request["start_time"]),
+                to_microseconds(request["end_time"]))
+            self.send_reply(reply_port, request, result=True, events=rows)
 
         else:
-            super().handle_request(request)
+            super().handle_request(reply_port, request)
+        return
+
+    def handle_shutdown(self):
+        if self.compactor is not None:
+            self.compactor.stop()
+        self.db.close()
+
+        super().handle_shutdown()
+
+        logging.info("History Service shutdown handled successfully.")
         return
 
 
 if __name__ == "__main__":
-    service = HistoryService()
+    if os.getenv("INVOCATION_ID") is not None:
+        # Running under systemd
+        logging.basicConfig(stream=sys.stdout,
+                            format='%(levelname)8s %(message)s',
+                            level=logging.DEBUG)
+    else:
+        # Likely being run manually
+        logging.basicConfig(stream=sys.stderr,
+                            format='%(asctime)s p-Kernel %(levelname)8s %(message)s',
+                            level=logging.DEBUG)
+
+    backend = os.getenv("DARQ_HISTORY_BACKEND", "sqlite")
+
+    service = HistoryService(backend=backend)
     result = service.run()
+
+    logging.info("Exiting history service.")
     sys.exit(result)
@@ -0,0 +1,565 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Columnar segment store for History.
+#
+# An alternative to the SQLite backend, for what History mostly is: an
+# append-only, time-ordered log.  Events are stored in a directory:
+#
+# - subjects.dict: dictionary of subject names, one per line; a name's
+#   line number is its integer code.
+# - segment-NNNNNNNN.seg: sealed segments, each holding up to
+#   SEGMENT_ROWS events as packed columns, sorted by (timestamp, seq).
+# - active.log: events not yet in a sealed segment, as packed rows.
+#
+# A sealed segment file is:
+#
+#   header      HEADER, padded to HEADER_SIZE bytes
+#   timestamps  int64[rows], microseconds since the epoch
+#   seqs        int64[rows], arrival sequence numbers
+#   subjects    uint32[rows], subject codes
+#   events      uint16[rows], Event codes, padded to 8 bytes
+#   index       int64[ceil(rows / stride)], every stride'th timestamp
+#   subject set uint32[unique], sorted codes of subjects present
+#
+# in native (little-endian) byte order.  Segments are memory-mapped,
+# and the columns used in place.  A time lookup is a binary search of
+# the sparse index, then of one stride of timestamps, and range queries
+# then read the columns sequentially.  The subject set lets per-subject
+# queries skip segments without that subject.
+#
+# Events are keyed by (timestamp, seq), where seq is a service-wide
+# arrival counter, so keys are unique and stable for cursors.  Sealing
+# writes the segment, then empties the log; if the process stops in
+# between, the log's records are already sealed, which their seqs show,
+# and they're dropped when it's next opened.  Events
+# normally arrive in time order, but one arriving late is inserted in
+# place in the active segment; segments may then overlap slightly in
+# time, so queries merge the segments' results.
+#
+# This backend doesn't compact: segments are immutable once sealed.
+
+import array
+import bisect
+import heapq
+import itertools
+import logging
+import mmap
+import os
+import struct
+import sys
+
+from collections import Counter
+from typing import Iterator, Optional
+
+from database import DAY, END_KEY
+
+# Events per sealed segment.
+SEGMENT_ROWS = 65536
+
+# Timestamps per sparse index entry.
+INDEX_STRIDE = 1024
+
+# Segment file header: magic, format version, flags, rows, index
+# stride, minimum and maximum timestamp, maximum seq, number of unique
+# subjects.
+MAGIC = b"DQHS"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<4sHHIIqqqI")
+HEADER_SIZE = 64
+
+# Active log record: timestamp, seq, subject code, event code.
+LOG_RECORD = struct.Struct("<qqIH")
+
+
+class SegmentFormatError(Exception):
+    """A segment file is damaged, or in an unknown format."""
+    pass
+
+
+class Dictionary:
+    """Append-only string dictionary, mapping names to integer codes."""
+
+    def __init__(self, path: str):
+        """Constructor.
+
+        :param path: Dictionary file name; created if absent."""
+
+        self.names: list[str] = []
+        self.codes: dict[str, int] = {}
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    self.codes[line[:-1]] = len(self.names)
+                    self.names.append(line[:-1])
+
+        self.file = open(path, "a", encoding="utf-8")
+        return
+
+    def close(self):
+        self.file.close()
+        return
+
+    def lookup(self, name: str) -> Optional[int]:
+        """Return the code for a name, or None if it's not present."""
+        return self.codes.get(name)
+
+    def encode(self, name: str) -> int:
+        """Return the code for a name, adding it if necessary.
+
+        New names are written, but not synced: call sync() before
+        recording anything that uses them."""
+
+        code = self.codes.get(name)
+        if code is None:
+            code = len(self.names)
+            self.codes[name] = code
+            self.names.append(name)
+            self.file.write(name + "\n")
+        return code
+
+    def sync(self):
+        """Flush new names to disc."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return
+
+
+class Segment:
+    """A sealed, memory-mapped segment of events."""
+
+    def __init__(self, path: str):
+        """Constructor.
+
+        :param path: Segment file name."""
+
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, _, self.rows, self.stride, self.min_timestamp,
+         self.max_timestamp, self.max_seq, unique) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise SegmentFormatError(path)
+
+        view = memoryview(self.map)
+        self.views = []
+
+        def column(offset: int, count: int, code: str):
+            end = offset + count * struct.calcsize(code)
+            if end > len(view):
+                raise SegmentFormatError(path)
+            v = view[offset:end].cast(code)
+            self.views.append(v)
+            return v, end
+
+        offset = HEADER_SIZE
+        self.timestamps, offset = column(offset, self.rows, "q")
+        self.seqs, offset = column(offset, self.rows, "q")
+        self.subjects, offset = column(offset, self.rows, "I")
+        self.events, offset = column(offset, self.rows, "H")
+        offset = -(-offset // 8) * 8
+        self.index, offset = column(offset, -(-self.rows // self.stride), "q")
+        self.subject_set, offset = column(offset, unique, "I")
+        self.views.append(view)
+        return
+
+    def close(self):
+        # Views must be released before the map can be closed.
+        for view in self.views:
+            view.release()
+        self.map.close()
+        self.file.close()
+        return
+
+    def lower_bound(self, timestamp: int) -> int:
+        """Return the position of the first event at or after a time."""
+
+        block = bisect.bisect_left(self.index, timestamp)
+        lo = max(0, (block - 1) * self.stride)
+        hi = min(self.rows, block * self.stride)
+        return bisect.bisect_left(self.timestamps, timestamp, lo, hi)
+
+    def has_subject(self, code: int) -> bool:
+        """Return True if the segment has events for a subject code."""
+        i = bisect.bisect_left(self.subject_set, code)
+        return i < len(self.subject_set) and self.subject_set[i] == code
+
+    @staticmethod
+    def write(path: str, active: "ActiveSegment"):
+        """Write an active segment's events as a sealed segment file.
+
+        :param path: Segment file name.
+        :param active: Events to be written."""
+
+        rows = len(active.timestamps)
+        index = active.timestamps[::INDEX_STRIDE]
+        subject_set = sorted(set(active.subjects))
+
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, rows, INDEX_STRIDE,
+                             active.timestamps[0], active.timestamps[-1],
+                             max(active.seqs), len(subject_set))
+
+        events = array.array("H", active.events).tobytes()
+        padding = b'\0' * (-(HEADER_SIZE + 22 * rows) % 8)
+
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header.ljust(HEADER_SIZE, b'\0'))
+            f.write(array.array("q", active.timestamps).tobytes())
+            f.write(array.array("q", active.seqs).tobytes())
+            f.write(array.array("I", active.subjects).tobytes())
+            f.write(events + padding)
+            f.write(array.array("q", index).tobytes())
+            f.write(array.array("I", subject_set).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+        return
+
+
+class ActiveSegment:
+    """The in-memory segment receiving new events.
+
+    Columns are plain lists, kept sorted by (timestamp, seq), with the
+    same interface as a sealed Segment's for queries."""
+
+    def __init__(self):
+        self.timestamps: list[int] = []
+        self.seqs: list[int] = []
+        self.subjects: list[int] = []
+        self.events: list[int] = []
+        return
+
+    @property
+    def rows(self) -> int:
+        return len(self.timestamps)
+
+    @property
+    def min_timestamp(self) -> int:
+        return self.timestamps[0] if self.timestamps else END_KEY[0]
+
+    def append(self, timestamp: int, seq: int, subject: int, event: int):
+        """Add an event, in (timestamp, seq) order."""
+
+        if not self.timestamps or timestamp >= self.timestamps[-1]:
+            i = len(self.timestamps)
+        else:
+            # Late arrival: seq is the highest yet, so it follows any
+            # events with the same timestamp.
+            i = bisect.bisect_right(self.timestamps, timestamp)
+
+        self.timestamps.insert(i, timestamp)
+        self.seqs.insert(i, seq)
+        self.subjects.insert(i, subject)
+        self.events.insert(i, event)
+        return
+
+    def lower_bound(self, timestamp: int) -> int:
+        """Return the position of the first event at or after a time."""
+        return bisect.bisect_left(self.timestamps, timestamp)
+
+    def has_subject(self, code: int) -> bool:
+        return code in self.subjects
+
+
+def position(segment, key: tuple[int, int]) -> int:
+    """Return the position of the first event at or after a key.
+
+    :param segment: Segment or ActiveSegment.
+    :param key: (timestamp, seq) key."""
+
+    timestamp, seq = key
+    i = segment.lower_bound(timestamp)
+    while (i < segment.rows and segment.timestamps[i] == timestamp and
+           segment.seqs[i] < seq):
+        i += 1
+    return i
+
+
+def scan(segment, start: int, end: int, older: bool) -> Iterator[tuple]:
+    """Yield (timestamp, seq, subject, event) rows of a segment.
+
+    :param segment: Segment or ActiveSegment.
+    :param start: First position.
+    :param end: Position after the last.
+    :param older: If True, yield from end backwards."""
+
+    positions = range(end - 1, start - 1, -1) if older else range(start, end)
+    for i in positions:
+        yield (segment.timestamps[i], segment.seqs[i],
+               segment.subjects[i], segment.events[i])
+
+
+def sort_key(row: tuple) -> tuple:
+    return row[0], row[1]
+
+
+class SegmentDatabase:
+    """Columnar segment store for the History service.
+
+    This has the same query interface as HistoryDatabase, with seq in
+    place of rowid in (timestamp, rowid) keys."""
+
+    def __init__(self, path: str):
+        """Constructor.
+
+        :param path: Directory for the store; created if absent."""
+
+        if sys.byteorder != "little":
+            raise NotImplementedError("Segment store requires a little-endian host")
+
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+
+        # Format 1 stores dictionary-encoded event names.
+        if os.path.exists(os.path.join(path, "events.dict")):
+            raise SegmentFormatError(f"{path}: segment store format 1")
+
+        self.subject_names = Dictionary(os.path.join(path, "subjects.dict"))
+
+        self.segments: list[Segment] = []
+        for name in sorted(os.listdir(path)):
+            if name.startswith("segment-") and name.endswith(".seg"):
+                self.segments.append(Segment(os.path.join(path, name)))
+
+        self.next_seq: int = 1 + max((s.max_seq for s in self.segments), default=0)
+
+        # Replay events not yet sealed into a segment, ignoring any
+        # incomplete trailing record, and any already sealed.
+        self.active = ActiveSegment()
+        log_path = os.path.join(path, "active.log")
+        if os.path.exists(log_path):
+            with open(log_path, "rb") as f:
+                data = f.read()
+            complete = len(data) - len(data) % LOG_RECORD.size
+            sealed = self.next_seq - 1
+            records = [record for record in LOG_RECORD.iter_unpack(data[:complete])
+                       if record[1] > sealed]
+            for record in records:
+                self.active.append(*record)
+                self.next_seq = max(self.next_seq, record[1] + 1)
+            if len(records) * LOG_RECORD.size != complete:
+                logging.warning(f"Discarding sealed records in {log_path}")
+                with open(log_path, "wb") as f:
+                    f.write(b''.join(LOG_RECORD.pack(*r) for r in records))
+                    os.fsync(f.fileno())
+            elif complete != len(data):
+                logging.warning(f"Discarding incomplete record in {log_path}")
+                os.truncate(log_path, complete)
+        self.log = open(log_path, "ab")
+
+        # Per-subject last event time and event count, by subject code.
+        # Built on first use.
+        self.last_touched: Optional[dict[int, int]] = None
+        self.subject_counts: Optional[Counter] = None
+        return
+
+    def close(self):
+        """Close the store."""
+
+        self.log.close()
+        for segment in self.segments:
+            segment.close()
+        self.subject_names.close()
+        return
+
+    def all_segments(self) -> list:
+        """Return the sealed segments, and the active segment."""
+        return self.segments + [self.active]
+
+    def add_event(self, timestamp: int, subject: str, event: int):
+        """Record an event."""
+        self.add_events([(timestamp, subject, event)])
+        return
+
+    def add_events(self, events: list):
+        """Record a batch of events.
+
+        :param events: List of (timestamp, subject, event) tuples, with
+        timestamps in microseconds since the epoch, and event codes."""
+
+        records = []
+        for timestamp, subject, event in events:
+            records.append((timestamp, self.next_seq,
+                            self.subject_names.encode(subject),
+                            event))
+            self.next_seq += 1
+
+        # Names must be durable before the records that use them.
+        self.subject_names.sync()
+
+        self.log.write(b''.join(LOG_RECORD.pack(*r) for r in records))
+        self.log.flush()
+        os.fsync(self.log.fileno())
+
+        for record in records:
+            self.active.append(*record)
+            if self.last_touched is not None:
+                timestamp, _, subject, _ = record
+                self.last_touched[subject] = max(timestamp,
+                                                 self.last_touched.get(subject, timestamp))
+                self.subject_counts[subject] += 1
+
+        if self.active.rows >= SEGMENT_ROWS:
+            self.seal()
+        return
+
+    def seal(self):
+        """Write the active segment to a new sealed segment."""
+
+        if self.active.rows == 0:
+            return
+
+        path = os.path.join(self.path, f"segment-{len(self.segments):08d}.seg")
+        Segment.write(path, self.active)
+        self.segments.append(Segment(path))
+
+        self.active = ActiveSegment()
+        self.log.truncate(0)
+        self.log.seek(0)
+        logging.debug(f"Sealed history segment {path}")
+        return
+
+    def rows(self, segment_rows: Iterator[tuple], count: Optional[int]) -> list:
+        """(Internal) Decode up to count rows to (timestamp, seq, subject,
+        event, count) tuples."""
+
+        subjects = self.subject_names.names
+        return [(timestamp, seq, subjects[subject], event, 1)
+                for timestamp, seq, subject, event
+                in itertools.islice(segment_rows, count)]
+
+    def merged(self, key: tuple[int, int], older: bool,
+               subject: Optional[int] = None) -> Iterator[tuple]:
+        """(Internal) Iterate over events beyond a key, in key order,
+        across all segments.
+
+        :param key: (timestamp, seq) key; not itself included.
+        :param older: If True, events before key, newest first.
+        :param subject: If set, only events for this subject code."""
+
+        iterators = []
+        for segment in self.all_segments():
+            if segment.rows == 0:
+                continue
+            if subject is not None and not segment.has_subject(subject):
+                continue
+
+            if older:
+                rows = scan(segment, 0, position(segment, key), True)
+            else:
+                rows = scan(segment, position(segment, (key[0], key[1] + 1)),
+                            segment.rows, False)
+            if subject is not None:
+                rows = (row for row in rows if row[2] == subject)
+            iterators.append(rows)
+
+        return heapq.merge(*iterators, key=sort_key, reverse=older)
+
+    def get_events_for_period(self, start_time: int, end_time: int) -> list:
+        """Return events in [start_time, end_time), oldest first."""
+
+        rows = itertools.takewhile(lambda row: row[0] < end_time,
+                                   self.merged((start_time, -1), False))
+        return [(t, s, e, c) for t, _, s, e, c in self.rows(rows, None)]
+
+    def get_events(self, start_time: int, count: int, older: bool) -> list:
+        """Return up to count events from a starting time."""
+
+        if older:
+            rows = self.merged((start_time + 1, 0), True)
+        else:
+            rows = self.merged((start_time, -1), False)
+        return [(t, s, e, c) for t, _, s, e, c in self.rows(rows, count)]
+
+    def get_page(self, key: tuple[int, int], count: int, older: bool) -> list:
+        """Return up to count events beyond a (timestamp, seq) key.
+
+        :returns: List of (timestamp, seq, subject, event, count) tuples."""
+
+        return self.rows(self.merged(key, older), count)
+
+    def has_events(self, key: tuple[int, int], older: bool) -> bool:
+        """Return True if any event lies beyond a (timestamp, seq) key."""
+
+        for segment in self.all_segments():
+            if older and position(segment, key) > 0:
+                return True
+            if not older and position(segment, (key[0], key[1] + 1)) < segment.rows:
+                return True
+        return False
+
+    def get_subject_events(self, subject: str, count: int,
+                           before: Optional[int] = None) -> list:
+        """Return a subject's events, newest first."""
+
+        code = self.subject_names.lookup(subject)
+        if code is None:
+            return []
+
+        if before is None:
+            before = END_KEY[0]
+        rows = self.merged((before, 0), True, code)
+        return [(t, s, e, c) for t, _, s, e, c in self.rows(rows, count)]
+
+    def get_recent_subjects(self, count: int) -> list:
+        """Return the most recently touched subjects, newest first.
+
+        :returns: List of (subject, last_touched, events) tuples."""
+
+        if self.last_touched is None:
+            self.last_touched = {}
+            self.subject_counts = Counter()
+            for segment in self.all_segments():
+                self.subject_counts.update(segment.subjects)
+                # Rows are in time order, so the last wins.
+                latest = dict(zip(segment.subjects, segment.timestamps))
+                for code, timestamp in latest.items():
+                    if timestamp > self.last_touched.get(code, timestamp - 1):
+                        self.last_touched[code] = timestamp
+
+        names = self.subject_names.names
+        recent = heapq.nlargest(count, self.last_touched.items(),
+                                key=lambda item: item[1])
+        return [(names[code], timestamp, self.subject_counts[code])
+                for code, timestamp in recent]
+
+    def get_top_subjects(self, start_time: int, end_time: int, count: int,
+                         event: Optional[int] = None) -> list:
+        """Return the subjects with most events in a period.
+
+        :returns: List of (subject, count) tuples, most events first."""
+
+        totals = Counter()
+        for segment in self.all_segments():
+            lo = segment.lower_bound(start_time)
+            hi = segment.lower_bound(end_time)
+            if event is None:
+                totals.update(segment.subjects[lo:hi])
+            else:
+                totals.update(s for s, e in zip(segment.subjects[lo:hi],
+                                                segment.events[lo:hi])
+                              if e == event)
+
+        names = self.subject_names.names
+        top = heapq.nsmallest(count, totals.items(),
+                              key=lambda item: (-item[1], names[item[0]]))
+        return [(names[subject], n) for subject, n in top]
+
+    def get_daily_counts(self, start_day: int, end_day: int) -> list:
+        """Return event counts by type, for each day in a range.
+
+        :returns: List of (day, event, count) tuples, ordered by day."""
+
+        result = []
+        for day in range(start_day, end_day):
+            counts = Counter()
+            for segment in self.all_segments():
+                lo = segment.lower_bound(day * DAY)
+                hi = segment.lower_bound((day + 1) * DAY)
+                counts.update(segment.events[lo:hi])
+            result.extend(sorted((day, event, n)
+                                 for event, n in counts.items()))
+        return result
@@ -0,0 +1,190 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Parallel bulk index build.
+#
+# Indexing a large imported library one object at a time, on the
+# service's thread, would take hours on a small machine, so the bulk
+# build mode (main.py --build) spreads the work over every core, using
+# a process pool: tokenising is pure Python, so threads wouldn't help.
+#
+# The objects are split into tasks of TASK_DOCUMENTS.  For each task, a
+# worker process fetches the objects' content from Storage, tokenises
+# it into an in-memory segment, and writes that out as a partial
+# segment (sorted by term, as every segment is) whenever it holds
+# PARTIAL_BYTES of text, so a worker's memory is bounded whatever the
+# size of the objects.  If the similarity index is enabled, the worker
+# also embeds the objects' text.  The partial segments are then merged,
+# also in the pool, by a multiway merge of consecutive runs of them,
+# into one final segment per worker, and finally the final segments,
+# and any embeddings, are installed in the index.
+#
+# Partial and final segments are named like any other, so the files of
+# an interrupted build are removed when the index is next opened.
+#
+# Workers are started afresh ("spawn"), rather than forked, so that
+# they don't share the parent's connection to the p-Kernel: each opens
+# its own Storage client when it's first needed.
+
+import logging
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, Optional
+
+import darq
+
+from database import IndexDatabase
+from segments import ActiveSegment, Segment, merge_segments
+from similarity import numpy
+from text import decode_text, term_frequencies
+
+# Objects per worker task.
+TASK_DOCUMENTS = 10000
+
+# Bytes of text a worker tokenises before writing a partial segment.
+PARTIAL_BYTES = 16 * 1024 * 1024
+
+# Worker process's Storage client, once opened.
+_storage = None
+
+
+def fetch_objects(object_ids: list) -> Iterator[tuple]:
+    """Yield (object identifier, text) for objects whose content is text.
+
+    Objects not stored, or whose content isn't UTF-8, are skipped."""
+
+    global _storage
+    if _storage is None:
+        darq.init(darq.SelectEventLoop())
+        _storage = darq.storage_api()
+
+    for object_id in object_ids:
+        value, version = _storage.get_versioned(object_id)
+        text = decode_text(value) if version else None
+        if text is not None:
+            yield object_id, text
+    return
+
+
+def build_partials(directory: str, task: int, object_ids: list,
+                   fetch: Callable, embedder=None) -> tuple:
+    """(Worker) Fetch and tokenise objects into partial segments.
+
+    :param directory: Index directory name.
+    :param task: Task number, naming the partial segments.
+    :param object_ids: Objects to index.
+    :param fetch: Function yielding (object identifier, text).
+    :param embedder: Similarity index embedder, or None.
+    :returns: (partial segment file names, in order, and (object
+    identifiers, vectors) if embedding, else None)."""
+
+    paths = []
+    segment = ActiveSegment()
+    size = 0
+    embedded, vectors = [], []
+    for object_id, text in fetch(object_ids):
+        frequencies, length = term_frequencies(text)
+        segment.add(object_id, frequencies, length)
+        size += len(text)
+        if embedder is not None:
+            embedded.append(object_id)
+            vectors.append(embedder.embed([text]))
+        if size >= PARTIAL_BYTES:
+            paths.append(write_partial(directory, task, len(paths), segment))
+            segment = ActiveSegment()
+            size = 0
+
+    if segment.documents > 0:
+        paths.append(write_partial(directory, task, len(paths), segment))
+    if not vectors:
+        return paths, None
+    return paths, (embedded, numpy.concatenate(vectors))
+
+
+def write_partial(directory: str, task: int, number: int,
+                  segment: ActiveSegment) -> str:
+    """(Worker) Write a partial segment; return its file name."""
+
+    path = os.path.join(directory, f"segment-build-{task:06d}-{number:03d}.seg")
+    segment.write(path)
+    return path
+
+
+def merge_partials(path: str, partials: list):
+    """(Worker) Merge partial segments into a final segment.
+
+    :param path: Final segment file name.
+    :param partials: Partial segment file names, in order; removed
+    once merged."""
+
+    if len(partials) == 1:
+        os.rename(partials[0], path)
+        return
+
+    sources = [Segment(partial) for partial in partials]
+    merge_segments(path, [(source, frozenset()) for source in sources])
+    for source in sources:
+        source.remove()
+    return
+
+
+def build(db: IndexDatabase, object_ids: list, workers: Optional[int] = None,
+          fetch: Callable = fetch_objects) -> dict:
+    """Index many objects at once, in parallel.
+
+    The objects' documents replace any they had before.
+
+    :param db: Index database.
+    :param object_ids: Objects to index.
+    :param workers: Number of worker processes; default, one per core.
+    :param fetch: Function yielding (object identifier, text) for a
+    list of objects, run in the workers: it must be picklable.
+    :returns: Build statistics."""
+
+    workers = workers or os.cpu_count() or 1
+    object_ids = list(dict.fromkeys(object_ids))
+    tasks = [object_ids[i:i + TASK_DOCUMENTS]
+             for i in range(0, len(object_ids), TASK_DOCUMENTS)]
+
+    start = time.perf_counter()
+    context = multiprocessing.get_context("spawn")
+    embedder = None if db.similarity is None else db.similarity.embedder
+    with ProcessPoolExecutor(workers, mp_context=context) as pool:
+        futures = [pool.submit(build_partials, db.path, task, ids, fetch, embedder)
+                   for task, ids in enumerate(tasks)]
+        partials, embeddings = [], []
+        for future in futures:
+            written, embedded = future.result()
+            partials.extend(written)
+            if embedded is not None:
+                embeddings.append(embedded)
+        tokenised = time.perf_counter()
+
+        # Merge consecutive runs of partials, one per worker.
+        count = min(workers, len(partials))
+        runs = [partials[len(partials) * k // count:len(partials) * (k + 1) // count]
+                for k in range(count)]
+        paths = [db.new_segment_path() for _ in runs]
+        for future in [pool.submit(merge_partials, path, run)
+                       for path, run in zip(paths, runs)]:
+            future.result()
+    merged = time.perf_counter()
+
+    documents = db.install_build(paths, embeddings)
+    elapsed = time.perf_counter() - start
+    stats = {"objects": len(object_ids),
+             "documents": documents,
+             "workers": workers,
+             "partials": len(partials),
+             "segments": len(paths),
+             "tokenise_seconds": tokenised - start,
+             "merge_seconds": merged - tokenised,
+             "seconds": elapsed}
+
+    logging.info(f"Built index of {documents} documents with {workers} workers "
+                 f"in {elapsed:.1f}s ({documents / elapsed:.0f} documents/s): "
+                 f"{len(partials)} partial segments merged into {len(paths)}")
+    return stats
@@ -0,0 +1,675 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Full-text index.
+#
+# The index is stored in a directory:
+#
+# - segment-NNNNNNNN.seg: sealed segments (see segments.py), each with
+#   an optional NAME.del file of deleted documents.
+# - manifest.json: the current list of segments.
+# - labels.json: completion labels (see darq.services.index), as of the
+#   last flush.
+# - active.log: changes since the last flush, as NDJSON, replayed into
+#   the active segment and labels on startup.
+# - vectors.*: the optional similarity index (see similarity.py), as of
+#   the last flush.
+#
+# Adding an object's text replaces any previous text: the old document
+# is marked deleted, and a new one added to the active segment.  When
+# the active segment reaches FLUSH_DOCUMENTS (or the service is idle),
+# it's written as a new sealed segment, the deletions are written, and
+# finally the manifest is replaced, which commits the flush; the log is
+# then emptied.  Files not in the manifest are leftovers of an
+# interrupted flush or merge, and are removed on startup.
+#
+# Segments accumulate, so from time to time several are merged into one
+# (see merge.py).  Segments are grouped into tiers by size, each tier
+# MERGE_FACTOR times larger than the last, and MERGE_FACTOR segments of
+# a tier are merged into one of the next; a segment with many deleted
+# documents is rewritten on its own.  Each document is so rewritten
+# about log(documents / FLUSH_DOCUMENTS) / log(MERGE_FACTOR) times.
+#
+# Results are ranked by Okapi BM25.  Document frequencies count only
+# live documents, so scores don't drift as updates leave deleted
+# documents' postings behind until they're merged away.
+
+import bisect
+import heapq
+import logging
+import math
+import os
+
+from collections import defaultdict
+from operator import itemgetter
+from typing import Optional
+
+import orjson
+
+from darq.services.index import CompletionIndex, fuzzy_edits, fuzzy_matches
+
+from segments import ActiveSegment, Segment
+from similarity import SimilarityIndex
+from text import term_frequencies, tokenize
+
+MANIFEST_VERSION = 1
+
+# Documents in the active segment before it's flushed.
+FLUSH_DOCUMENTS = 10000
+
+# Segments of a size tier merged at once.
+MERGE_FACTOR = 8
+
+# Fraction of a segment's documents deleted before it's rewritten.
+MAX_DELETED_FRACTION = 0.3
+
+# BM25 parameters: term frequency saturation, and length normalisation.
+K1 = 1.2
+B = 0.75
+
+# Most words a fuzzy query word is expanded to: those needing fewest
+# edits, then the most frequent.
+MAX_EXPANSIONS = 50
+
+
+def live_frequency(documents: list, deleted: set) -> int:
+    """Return the number of documents in a posting list not deleted.
+
+    :param documents: Posting list's document numbers, ascending.
+    :param deleted: Segment's deleted document numbers."""
+
+    if not deleted:
+        return len(documents)
+
+    if len(deleted) < len(documents):
+        # Fewer deletions than postings: look each one up.
+        found = 0
+        for d in deleted:
+            i = bisect.bisect_left(documents, d)
+            if i < len(documents) and documents[i] == d:
+                found += 1
+        return len(documents) - found
+
+    return sum(1 for d in documents if d not in deleted)
+
+
+class MergeJob:
+    """A merge of several segments into one.
+
+    The merge is written from a snapshot of the sources' deletions, so
+    that documents deleted meanwhile can be deleted from the result."""
+
+    def __init__(self, sources: list, path: str):
+        """Constructor.
+
+        :param sources: Segments to be merged.
+        :param path: New segment file name."""
+
+        self.sources: list[Segment] = sources
+        self.snapshots: list[frozenset] = [frozenset(s.deleted) for s in sources]
+        self.path: str = path
+
+        # New document numbers, per source, once written.
+        self.numbers: Optional[list] = None
+        return
+
+
+class IndexDatabase:
+    """Full-text inverted index of objects' text."""
+
+    def __init__(self, path: str, embedder=None):
+        """Constructor.
+
+        :param path: Directory for the index; created if absent.
+        :param embedder: Embedder for the similarity index (see
+        similarity.load_embedder()), or None for no similarity index."""
+
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+
+        manifest = {"version": MANIFEST_VERSION, "segments": [], "next_segment": 1}
+        manifest_path = os.path.join(path, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "rb") as f:
+                manifest = orjson.loads(f.read())
+        self.next_segment: int = manifest["next_segment"]
+
+        self.segments: list[Segment] = [Segment(os.path.join(path, name))
+                                        for name in manifest["segments"]]
+
+        # Remove leftovers of an interrupted flush or merge.
+        names = set(manifest["segments"])
+        for name in os.listdir(path):
+            if name.startswith("segment-") and name.split(".")[0] + ".seg" not in names:
+                logging.info(f"Removing stale index file {name}")
+                os.remove(os.path.join(path, name))
+
+        # Object embeddings, if enabled.
+        self.similarity: Optional[SimilarityIndex] = None
+        if embedder is not None:
+            self.similarity = SimilarityIndex(path, embedder)
+
+        # Location of each object's current document: (segment, number).
+        self.locations: dict[str, tuple] = {}
+
+        # Live documents, and their total length, for BM25.
+        self.documents: int = 0
+        self.total_length: int = 0
+
+        for segment in self.segments:
+            for document in range(segment.documents):
+                if document not in segment.deleted:
+                    self.locate(segment.object_id(document), segment, document)
+
+        self.active = ActiveSegment()
+        self.merges: int = 0
+
+        # Completion labels, and whether they've changed since the last
+        # flush.
+        self.labels = CompletionIndex()
+        self.labels_dirty = False
+        labels_path = os.path.join(path, "labels.json")
+        if os.path.exists(labels_path):
+            with open(labels_path, "rb") as f:
+                for entry, kind, label, weight in orjson.loads(f.read()):
+                    self.labels.set(entry, kind, label, weight)
+
+        # Replay changes since the last flush, ignoring any incomplete
+        # trailing record.
+        log_path = os.path.join(path, "active.log")
+        if os.path.exists(log_path):
+            with open(log_path, "rb") as f:
+                for line in f:
+                    try:
+                        record = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        logging.warning("Ignoring incomplete index log record")
+                        break
+                    if record[0] == "add":
+                        self.apply_add(record[1], record[2])
+                    elif record[0] == "delete":
+                        self.apply_delete(record[1])
+                    elif record[0] == "label":
+                        self.labels.set(*record[1:])
+                        self.labels_dirty = True
+                    else:
+                        self.labels.remove(record[1])
+                        self.labels_dirty = True
+        self.log = open(log_path, "ab")
+        self.labels.warm()
+
+        logging.info(f"Index has {self.documents} documents "
+                     f"in {len(self.segments)} segments")
+        return
+
+    def close(self):
+        self.flush()
+        self.log.close()
+        if self.similarity is not None:
+            self.similarity.close()
+        for segment in self.segments:
+            segment.close()
+        return
+
+    def locate(self, object_id: str, segment, document: int):
+        """(Internal) Record an object's current document.
+
+        Any previous document for the object is deleted."""
+
+        self.apply_delete(object_id)
+        self.locations[object_id] = (segment, document)
+        self.documents += 1
+        self.total_length += segment.lengths[document]
+        return
+
+    def apply_add(self, object_id: str, text: str):
+        """(Internal) Add an object's text to the active segment."""
+
+        frequencies, length = term_frequencies(text)
+        document = self.active.add(object_id, frequencies, length)
+        self.locate(object_id, self.active, document)
+        if self.similarity is not None:
+            self.similarity.add(object_id, text)
+        return
+
+    def apply_delete(self, object_id: str) -> bool:
+        """(Internal) Delete an object's document, if it has one."""
+
+        location = self.locations.pop(object_id, None)
+        if location is None:
+            return False
+
+        segment, document = location
+        segment.delete(document)
+        self.documents -= 1
+        self.total_length -= segment.lengths[document]
+        if self.similarity is not None:
+            self.similarity.remove(object_id)
+        return True
+
+    def add(self, object_id: str, text: str):
+        """Index an object's text, replacing any previous text.
+
+        :param object_id: Object identifier.
+        :param text: Object's text."""
+
+        self.log.write(orjson.dumps(["add", object_id, text]) + b"\n")
+        self.apply_add(object_id, text)
+        return
+
+    def delete(self, object_id: str) -> bool:
+        """Remove an object from the index.
+
+        :returns: True if it was indexed."""
+
+        if object_id not in self.locations:
+            return False
+
+        self.log.write(orjson.dumps(["delete", object_id]) + b"\n")
+        return self.apply_delete(object_id)
+
+    def set_label(self, entry: str, kind: str, label: str, weight: float):
+        """Add or replace a completion label."""
+
+        self.log.write(orjson.dumps(["label", entry, kind, label, weight]) + b"\n")
+        self.labels.set(entry, kind, label, weight)
+        self.labels_dirty = True
+        return
+
+    def remove_label(self, entry: str) -> bool:
+        """Remove a completion label.
+
+        :returns: True if it was present."""
+
+        if entry not in self.labels.entries:
+            return False
+
+        self.log.write(orjson.dumps(["unlabel", entry]) + b"\n")
+        self.labels_dirty = True
+        return self.labels.remove(entry)
+
+    def get_labels(self, after: Optional[str], count: int) -> list:
+        """Return a batch of completion labels, in entry order.
+
+        :param after: If set, only entries after this.
+        :param count: Maximum number of labels.
+        :returns: List of [entry, kind, label, weight]."""
+
+        entries = sorted(self.labels.entries)
+        start = 0 if after is None else bisect.bisect_right(entries, after)
+        return [[entry, *self.labels.entries[entry]]
+                for entry in entries[start:start + count]]
+
+    def write_labels(self):
+        """(Internal) Write the completion labels, if changed."""
+
+        if not self.labels_dirty:
+            return
+
+        path = os.path.join(self.path, "labels.json")
+        labels = [[entry, *value] for entry, value in self.labels.entries.items()]
+        with open(path + ".tmp", "wb") as f:
+            f.write(orjson.dumps(labels))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+        self.labels_dirty = False
+        return
+
+    def sync(self):
+        """Flush logged changes to the operating system."""
+        self.log.flush()
+        return
+
+    def is_full(self) -> bool:
+        """Return True if the active segment should be flushed."""
+        return self.active.documents >= FLUSH_DOCUMENTS
+
+    def is_dirty(self) -> bool:
+        """Return True if there are changes to flush."""
+        return (self.active.documents > 0 or self.labels_dirty or
+                any(s.dirty for s in self.segments) or
+                (self.similarity is not None and self.similarity.dirty))
+
+    def new_segment_path(self) -> str:
+        """(Internal) Allocate a file name for a new segment."""
+
+        name = f"segment-{self.next_segment:08d}.seg"
+        self.next_segment += 1
+        return os.path.join(self.path, name)
+
+    def write_manifest(self):
+        """(Internal) Replace the manifest, committing segment changes."""
+
+        manifest = {"version": MANIFEST_VERSION,
+                    "segments": [segment.name for segment in self.segments],
+                    "next_segment": self.next_segment}
+
+        path = os.path.join(self.path, "manifest.json")
+        with open(path + ".tmp", "wb") as f:
+            f.write(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+        return
+
+    def flush(self):
+        """Write the active segment, deletions and labels to disc."""
+
+        if not self.is_dirty():
+            return
+
+        active = self.active
+        if active.live > 0:
+            path = self.new_segment_path()
+            numbers = active.write(path)
+            segment = Segment(path)
+            for document, object_id in enumerate(active.object_ids):
+                if numbers[document] >= 0:
+                    self.locations[object_id] = (segment, numbers[document])
+            self.segments.append(segment)
+
+        for segment in self.segments:
+            segment.write_deletions()
+        self.write_labels()
+        if self.similarity is not None:
+            self.similarity.flush()
+        self.write_manifest()
+
+        self.log.truncate(0)
+        self.log.seek(0)
+        self.active = ActiveSegment()
+
+        logging.debug(f"Flushed {active.live} documents; "
+                      f"{len(self.segments)} segments")
+        return
+
+    def plan_merge(self) -> Optional[MergeJob]:
+        """Choose segments to merge, if any should be.
+
+        :returns: Merge job, or None."""
+
+        tiers = defaultdict(list)
+        for segment in self.segments:
+            ratio = max(1.0, segment.documents / FLUSH_DOCUMENTS)
+            tiers[int(math.log(ratio, MERGE_FACTOR))].append(segment)
+
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= MERGE_FACTOR:
+                return MergeJob(tiers[tier][:MERGE_FACTOR], self.new_segment_path())
+
+        for segment in self.segments:
+            if len(segment.deleted) > segment.documents * MAX_DELETED_FRACTION:
+                return MergeJob([segment], self.new_segment_path())
+        return None
+
+    def install_merge(self, job: MergeJob):
+        """Replace a merge's sources with its result.
+
+        :param job: Completed merge job."""
+
+        merged = Segment(job.path)
+
+        # Documents deleted since the merge started.
+        for source, snapshot, numbers in zip(job.sources, job.snapshots, job.numbers):
+            for document in source.deleted - snapshot:
+                if numbers[document] >= 0:
+                    merged.delete(numbers[document])
+
+        # Objects' documents have moved.
+        sources = {id(source): numbers for source, numbers in zip(job.sources, job.numbers)}
+        for document in range(merged.documents):
+            object_id = merged.object_id(document)
+            segment, old = self.locations.get(object_id, (None, None))
+            if id(segment) in sources and sources[id(segment)][old] == document:
+                self.locations[object_id] = (merged, document)
+
+        position = self.segments.index(job.sources[0])
+        self.segments = [s for s in self.segments if s not in job.sources]
+        self.segments.insert(min(position, len(self.segments)), merged)
+
+        merged.write_deletions()
+        self.write_manifest()
+        for source in job.sources:
+            source.remove()
+
+        self.merges += 1
+        logging.info(f"Merged {len(job.sources)} segments into {merged.name} "
+                     f"({merged.live} documents)")
+        return
+
+    def install_build(self, paths: list, embeddings: list = ()) -> int:
+        """Add bulk-built segments (see build.py) to the index.
+
+        Their documents replace any the objects had before.
+
+        :param paths: Segment file names, from new_segment_path().
+        :param embeddings: List of (object identifiers, vectors) for the
+        similarity index, if enabled.
+        :returns: Number of documents added."""
+
+        # Changes in the active segment would be replayed over the
+        # build on restart, so they're written first.
+        self.flush()
+
+        documents = 0
+        for path in paths:
+            segment = Segment(path)
+            for document in range(segment.documents):
+                self.locate(segment.object_id(document), segment, document)
+            self.segments.append(segment)
+            documents += segment.documents
+
+        if self.similarity is not None:
+            for object_ids, vectors in embeddings:
+                self.similarity.add_vectors(object_ids, vectors)
+            self.similarity.flush()
+
+        for segment in self.segments:
+            segment.write_deletions()
+        self.write_manifest()
+
+        logging.info(f"Installed {len(paths)} built segments "
+                     f"({documents} documents)")
+        return documents
+
+    def abandon_merge(self, job: MergeJob):
+        """Discard a failed merge's output."""
+
+        for suffix in ("", ".tmp", ".postings"):
+            if os.path.exists(job.path + suffix):
+                os.remove(job.path + suffix)
+        return
+
+    def search(self, query: str, limit: int, match_all: bool = False,
+               fuzzy: bool = False) -> list:
+        """Return the objects best matching a query.
+
+        :param query: Query text.
+        :param limit: Maximum number of results.
+        :param match_all: If True, only objects containing every term
+        of the query match; otherwise, any term.
+        :param fuzzy: If True, terms also match terms a few edits away.
+        :returns: List of (object identifier, score), best first."""
+
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or self.documents == 0:
+            return []
+
+        segments = self.segments + [self.active]
+        if fuzzy:
+            return self.search_fuzzy(segments, terms, limit, match_all)
+        postings = [[segment.postings(term) for segment in segments] for term in terms]
+
+        # Document frequencies count only live documents: every update
+        # deletes a document, and leaves its postings until merged away.
+        frequencies = [sum(live_frequency(p[0], segment.deleted)
+                           for p, segment in zip(lists, segments) if p is not None)
+                       for lists in postings]
+        if match_all and 0 in frequencies:
+            return []
+
+        # Score the rarest terms first: with match_all, each later term
+        # only updates objects that matched all those before.
+        n = self.documents
+        c1 = K1 * (1 - B)
+        c2 = K1 * B * n / self.total_length if self.total_length else 0.0
+        scores = [{} for _ in segments]
+        ordered = sorted(range(len(terms)), key=frequencies.__getitem__)
+
+        for rank, t in enumerate(ordered):
+            df = frequencies[t]
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5)) * (K1 + 1)
+
+            for k, segment in enumerate(segments):
+                p = postings[t][k]
+                previous = scores[k]
+                lengths = segment.lengths
+
+                if match_all and rank > 0:
+                    current = {}
+                    if p is not None:
+                        for d, f in zip(*p):
+                            if d in previous:
+                                current[d] = previous[d] + idf * f / (f + c1 + c2 * lengths[d])
+                    scores[k] = current
+                    continue
+
+                if p is None:
+                    continue
+                deleted = segment.deleted
+                if not previous:
+                    scores[k] = {d: idf * f / (f + c1 + c2 * lengths[d])
+                                 for d, f in zip(*p) if d not in deleted}
+                    continue
+                for d, f in zip(*p):
+                    if d not in deleted:
+                        previous[d] = previous.get(d, 0.0) + idf * f / (f + c1 + c2 * lengths[d])
+
+        return self.best(segments, scores, limit)
+
+    def expand(self, segments: list, term: str) -> list:
+        """(Internal) Return the terms a fuzzy query term matches.
+
+        :returns: List of (term, edits), including any exact match."""
+
+        edits = fuzzy_edits(term)
+        if edits == 0:
+            return [(term, 0)]
+
+        found = {}
+        for segment in segments:
+            for match, distance in fuzzy_matches(segment.sorted_terms(), term, edits):
+                found[match] = distance
+
+        if len(found) > MAX_EXPANSIONS:
+            frequencies = {match: sum(segment.frequency(match) for segment in segments)
+                           for match in found}
+            return heapq.nsmallest(MAX_EXPANSIONS, found.items(),
+                                   key=lambda m: (m[1], -frequencies[m[0]]))
+        return list(found.items())
+
+    def search_fuzzy(self, segments: list, terms: list, limit: int,
+                     match_all: bool) -> list:
+        """(Internal) Search, matching terms a few edits away.
+
+        Each query term is expanded to the indexed terms within the edits
+        allowed for its length.  A document scores, for each query term,
+        the best BM25 score of the expansions it contains, scaled down by
+        the fraction of the query term's characters edited."""
+
+        n = self.documents
+        c1 = K1 * (1 - B)
+        c2 = K1 * B * n / self.total_length if self.total_length else 0.0
+
+        # Each query term's score, per segment, per document.
+        term_scores = []
+        for term in terms:
+            scores = [{} for _ in segments]
+            for match, edits in self.expand(segments, term):
+                postings = [segment.postings(match) for segment in segments]
+                df = sum(live_frequency(p[0], segment.deleted)
+                         for p, segment in zip(postings, segments) if p is not None)
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5)) * (K1 + 1) \
+                    * (1 - edits / len(term))
+
+                for k, segment in enumerate(segments):
+                    p = postings[k]
+                    if p is None:
+                        continue
+                    best = scores[k]
+                    deleted = segment.deleted
+                    lengths = segment.lengths
+                    for d, f in zip(*p):
+                        if d not in deleted:
+                            score = idf * f / (f + c1 + c2 * lengths[d])
+                            if score > best.get(d, 0.0):
+                                best[d] = score
+            term_scores.append(scores)
+
+        # Combine, the rarest terms first, as for search().
+        term_scores.sort(key=lambda scores: sum(map(len, scores)))
+        totals = term_scores[0]
+        for scores in term_scores[1:]:
+            for k, total in enumerate(totals):
+                more = scores[k]
+                if match_all:
+                    totals[k] = {d: score + more[d] for d, score in total.items() if d in more}
+                else:
+                    for d, score in more.items():
+                        total[d] = total.get(d, 0.0) + score
+
+        return self.best(segments, totals, limit)
+
+    def best(self, segments: list, scores: list, limit: int) -> list:
+        """(Internal) Return the best scoring objects.
+
+        :param segments: Segments searched.
+        :param scores: Scores, per segment, by document.
+        :param limit: Maximum number of results.
+        :returns: List of (object identifier, score), best first."""
+
+        # The best of each segment, then the best of those.
+        best = []
+        for k, segment_scores in enumerate(scores):
+            best.extend((score, k, d) for d, score in
+                        heapq.nlargest(limit, segment_scores.items(), key=itemgetter(1)))
+        best = heapq.nlargest(limit, best)
+        return [(segments[k].object_id(d), score) for score, k, d in best]
+
+    def similar(self, limit: int, object_id: Optional[str] = None,
+                text: Optional[str] = None) -> list:
+        """Return the objects most similar to an object, or to a text.
+
+        The similarity index must be enabled.
+
+        :param limit: Maximum number of results.
+        :param object_id: Object to match, which isn't itself returned.
+        :param text: Text to match, if no object is given.
+        :returns: List of (object identifier, cosine similarity), most
+        similar first."""
+
+        if object_id is None:
+            return self.similarity.search(self.similarity.embed(text), limit)[0]
+
+        vector = self.similarity.vector(object_id)
+        if vector is None:
+            return []
+        results = self.similarity.search(vector, limit + 1)[0]
+        return [result for result in results if result[0] != object_id][:limit]
+
+    def stats(self) -> dict:
+        """Return index statistics."""
+
+        stats = {"documents": self.documents,
+                 "labels": len(self.labels),
+                 "pending": self.active.documents,
+                 "merges": self.merges,
+                 "segments": [{"name": s.name,
+                               "documents": s.documents,
+                               "deleted": len(s.deleted),
+                               "bytes": s.size()}
+                              for s in self.segments]}
+        if self.similarity is not None:
+            stats["similarity"] = self.similarity.stats()
+        return stats
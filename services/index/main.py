@@ -1,18 +1,306 @@
+#! /usr/bin/env python
 # DarqOS
-# Copyright (C) 2022 David Arnold
+# Copyright (C) 2022-2024 David Arnold
 
+# Index Service
+
+import argparse
+import logging
+import os
+import sys
+
+from typing import Optional
 
 import darq
 
+from build import build
+from database import IndexDatabase
+from merge import Merger
+from pipeline import Indexer
+from similarity import load_embedder
+
+# Default maximum number of search results.
+DEFAULT_SEARCH_LIMIT = 20
+
+# Default maximum number of completions.
+DEFAULT_COMPLETIONS = 10
+
+# Default maximum number of similar objects.
+DEFAULT_SIMILAR_LIMIT = 10
+
+# Maximum number of undelivered label changes queued per watcher.
+LABELS_QUEUE_LIMIT = 1000
+
+# Seconds after a change before the active segment is flushed, if it
+# doesn't fill first.
+FLUSH_INTERVAL = 10.0
+
+
+class IndexService(darq.Service, darq.TimerListener):
+    """System-wide full-text search.
+
+    Objects register their text with the service, under their object
+    identifier, and re-register it when it changes; searches return the
+    best-matching objects, ranked by BM25.  Objects changed since are
+    also re-indexed by the service itself, following the History
+    service's events.
+
+    The service also keeps labels (type names, object labels, etc) for
+    completion as the user types, and pushes changes to them to
+    watching clients, which complete from their own copy.
+
+    Optionally, it also finds objects similar to an object, or a text,
+    by comparing embeddings of their text."""
+
+    def __init__(self, path: str = None, embedder: str = "hashed"):
+        """Constructor.
+
+        :param path: Index directory name.
+        :param embedder: Similarity index embedder specification (see
+        similarity.load_embedder()), or "none"."""
+
+        # Initialise runtime.
+        darq.init_callbacks(darq.SelectEventLoop(), self)
+
+        logging.info("Starting Index service.")
+
+        # Initialise service.
+        super().__init__(11005)
 
-class IndexService(darq.Service):
+        self.db = IndexDatabase(path or "index", load_embedder(embedder))
 
-    def __init__(self):
-        super().__init__()
+        # Segments are merged in the background.
+        self.merger = Merger(self.db)
+        self.merger.start()
+
+        # Flush timer, if running.
+        self.timer_id: Optional[int] = None
+
+        # Label change subscriptions, by client port.
+        self.label_watchers: dict[int, darq.Subscriber] = {}
+
+        self.context = None
+        self.socket = None
+        self.active = False
+
+        # Open port.
+        darq.open_port(self.port)
+
+        # Changed objects are re-indexed from their history events.
+        self.indexer = Indexer(self, self.db.path)
+        darq.loop().add_deferred(self.indexer.start)
         return
 
+    def run(self):
+        return darq.loop().run()
+
     @staticmethod
     def get_name() -> str:
         """Return the service name."""
         return "index"
 
+    def changed(self):
+        """(Internal) Note a change: flush now, or soon."""
+
+        self.db.sync()
+        if self.db.is_full():
+            self.flush()
+        elif self.timer_id is None:
+            self.timer_id = darq.loop().add_timer(FLUSH_INTERVAL, self)
+        return
+
+    def flush(self):
+        """Flush the active segment, and start any merge needed."""
+
+        if self.timer_id is not None:
+            darq.loop().cancel_timer(self.timer_id)
+            self.timer_id = None
+
+        self.db.flush()
+        self.merger.start()
+        return
+
+    def notify_label(self, entry: str, value: Optional[tuple]):
+        """(Internal) Queue a label change for watching clients.
+
+        :param entry: Entry identifier.
+        :param value: New (kind, label, weight), or None if removed."""
+
+        if not self.label_watchers:
+            return
+
+        event = {"entry": entry}
+        if value is not None:
+            event["kind"], event["label"], event["weight"] = value
+        for subscriber in self.label_watchers.values():
+            subscriber.post(event, entry)
+        return
+
+    def on_timeout(self, timer_id: int, expiry_time: float, actual_time: float):
+        """Flush changes once the flush interval expires."""
+        darq.loop().cancel_timer(timer_id)
+        self.timer_id = None
+        self.flush()
+        return
+
+    def handle_request(self, reply_port: int, request: dict):
+        """Handle requests."""
+
+        method = request.get("method")
+        if method == "add":
+            self.db.add(request["object"], request["text"])
+            self.changed()
+            self.send_reply(reply_port, request, result=True)
+
+        elif method == "add_many":
+            for object_id, text in request["documents"]:
+                self.db.add(object_id, text)
+            self.changed()
+            self.send_reply(reply_port, request, result=True,
+                            count=len(request["documents"]))
+
+        elif method == "delete":
+            deleted = self.db.delete(request["object"])
+            if deleted:
+                self.changed()
+            self.send_reply(reply_port, request, result=deleted)
+
+        elif method == "search":
+            results = self.db.search(request["query"],
+                                     request.get("limit", DEFAULT_SEARCH_LIMIT),
+                                     request.get("match_all", False),
+                                     request.get("fuzzy", False))
+            self.send_reply(reply_port, request, result=True,
+                            results=results)
+
+        elif method == "similar":
+            if self.db.similarity is None:
+                self.send_reply(reply_port, request, result=False,
+                                description="Similarity index not enabled")
+            else:
+                results = self.db.similar(request.get("limit", DEFAULT_SIMILAR_LIMIT),
+                                          request.get("object"), request.get("text"))
+                self.send_reply(reply_port, request, result=True,
+                                results=results)
+
+        elif method == "set_labels":
+            for entry, kind, label, weight in request["labels"]:
+                self.db.set_label(entry, kind, label, weight)
+                self.notify_label(entry, (kind, label, weight))
+            self.changed()
+            self.send_reply(reply_port, request, result=True)
+
+        elif method == "remove_label":
+            removed = self.db.remove_label(request["entry"])
+            if removed:
+                self.notify_label(request["entry"], None)
+                self.changed()
+            self.send_reply(reply_port, request, result=removed)
+
+        elif method == "complete":
+            completions = self.db.labels.complete(request["prefix"],
+                                                  request.get("limit", DEFAULT_COMPLETIONS),
+                                                  request.get("kinds"),
+                                                  request.get("fuzzy", False))
+            self.send_reply(reply_port, request, result=True,
+                            completions=completions)
+
+        elif method == "get_labels":
+            count = request["count"]
+            labels = self.db.get_labels(request.get("after"), count + 1)
+            self.send_reply(reply_port, request, result=True,
+                            labels=labels[:count], more=len(labels) > count)
+
+        elif method == "watch_labels":
+            if reply_port not in self.label_watchers:
+                self.label_watchers[reply_port] = darq.Subscriber(
+                    self, reply_port, "labels", LABELS_QUEUE_LIMIT)
+            self.send_reply(reply_port, request, result=True)
+
+        elif method == "unwatch_labels":
+            subscriber = self.label_watchers.pop(reply_port, None)
+            if subscriber is not None:
+                subscriber.cancel()
+                subscriber.flush()
+            self.send_reply(reply_port, request, result=subscriber is not None)
+
+        elif method == "flush":
+            self.flush()
+            self.send_reply(reply_port, request, result=True)
+
+        elif method == "stats":
+            stats = self.db.stats()
+            stats["merging"] = self.merger.is_running()
+            stats["pipeline"] = self.indexer.stats()
+            self.send_reply(reply_port, request, result=True, stats=stats)
+
+        else:
+            super().handle_request(reply_port, request)
+        return
+
+    def handle_shutdown(self):
+        for subscriber in self.label_watchers.values():
+            subscriber.cancel()
+        self.indexer.close()
+        if self.timer_id is not None:
+            darq.loop().cancel_timer(self.timer_id)
+            self.timer_id = None
+        self.merger.close()
+        self.db.close()
+
+        super().handle_shutdown()
+
+        logging.info("Index Service shutdown handled successfully.")
+        return
+
+
+def build_main(args) -> int:
+    """Bulk-build the index from a list of objects, then exit.
+
+    The service must not be running on the same index meanwhile."""
+
+    if args.build == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(args.build) as f:
+            lines = f.read().splitlines()
+    object_ids = [line.strip() for line in lines if line.strip()]
+
+    db = IndexDatabase(args.path or "index", load_embedder(args.embedder))
+    build(db, object_ids, args.workers)
+    db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    if os.getenv("INVOCATION_ID") is not None:
+        # Running under systemd
+        logging.basicConfig(stream=sys.stdout,
+                            format='%(levelname)8s %(message)s',
+                            level=logging.DEBUG)
+    else:
+        # Likely being run manually
+        logging.basicConfig(stream=sys.stderr,
+                            format='%(asctime)s p-Kernel %(levelname)8s %(message)s',
+                            level=logging.DEBUG)
+
+    parser = argparse.ArgumentParser(description="Index service")
+    parser.add_argument("--path", help="index directory")
+    parser.add_argument("--embedder", default="hashed",
+                        help="similarity index embedder: hashed[:DIMENSIONS], "
+                             "MODULE:NAME for a local model, or none")
+    parser.add_argument("--build", metavar="FILE",
+                        help="bulk-build the index from the objects listed "
+                             "in FILE (or - for stdin), one per line, and exit")
+    parser.add_argument("--workers", type=int,
+                        help="bulk build worker processes (default: one per core)")
+    args = parser.parse_args()
+
+    if args.build is not None:
+        sys.exit(build_main(args))
+
+    service = IndexService(args.path, args.embedder)
+    result = service.run()
+
+    logging.info("Exiting index service.")
+    sys.exit(result)
@@ -0,0 +1,123 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Background segment merging.
+#
+# Merging segments reads and rewrites every document in them, which
+# for large segments takes seconds, so it runs on a worker thread.  The
+# thread only reads the source segments, which are immutable, and
+# writes the new segment's file: the service keeps querying and updating
+# the index meanwhile.  When the merge is written, a byte is written to
+# a socket pair watched by the event loop, which then installs the new
+# segment, on the loop thread (as for the Storage service's worker pool).
+#
+# Only one merge runs at a time; another is planned after each merge,
+# and after each flush.
+
+import logging
+import socket
+import threading
+
+from typing import Optional
+
+import darq
+
+from database import IndexDatabase, MergeJob
+from segments import merge_segments
+
+
+class Merger(darq.SocketListener):
+    """Merges index segments on a worker thread."""
+
+    def __init__(self, db: IndexDatabase):
+        """Constructor.
+
+        :param db: Index database."""
+
+        self.db = db
+        self.job: Optional[MergeJob] = None
+        self.thread: Optional[threading.Thread] = None
+        self.error: Optional[Exception] = None
+        self.closing = False
+
+        # Wake-up socket pair: the worker writes, the event loop reads.
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        darq.loop().add_socket(self.wake_reader, self)
+        return
+
+    def is_running(self) -> bool:
+        """Return True if a merge is in progress."""
+        return self.thread is not None
+
+    def start(self):
+        """Start a merge, if one is needed and none is running."""
+
+        if self.thread is not None or self.closing:
+            return
+
+        self.job = self.db.plan_merge()
+        if self.job is None:
+            return
+
+        logging.debug(f"Merging {[s.name for s in self.job.sources]}")
+        self.error = None
+        self.thread = threading.Thread(target=self._run,
+                                       name="index-merge",
+                                       daemon=True)
+        self.thread.start()
+        return
+
+    def _run(self):
+        """(Internal) Worker thread main function."""
+
+        job = self.job
+        try:
+            job.numbers = merge_segments(job.path,
+                                         list(zip(job.sources, job.snapshots)))
+        except Exception as e:
+            logging.exception("Index merge failed")
+            self.error = e
+
+        self.wake_writer.send(b'\0')
+        return
+
+    def on_readable(self, sock: socket.socket):
+        """Install a completed merge, on the event loop thread."""
+
+        try:
+            while sock.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+
+        if self.thread is None:
+            return
+        self.thread.join()
+        self.thread = None
+
+        job, self.job = self.job, None
+        if self.error is None:
+            self.db.install_merge(job)
+        else:
+            self.db.abandon_merge(job)
+            return
+
+        self.start()
+        return
+
+    def on_writeable(self, sock: socket.socket):
+        pass
+
+    def close(self):
+        """Wait for any merge in progress to be installed, and stop."""
+
+        self.closing = True
+        if self.thread is not None:
+            self.thread.join()
+            self.on_readable(self.wake_reader)
+
+        darq.loop().cancel_socket(self.wake_reader)
+        self.wake_reader.close()
+        self.wake_writer.close()
+        return
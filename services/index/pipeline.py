@@ -0,0 +1,265 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Incremental indexing.
+#
+# The Indexer keeps the index up to date as objects change, following
+# the History service's CREATED and MODIFIED events, rather than
+# relying on every writer to re-register its text.  History is used in
+# preference to Storage's change notifications because it can be
+# replayed: the Indexer checkpoints the time of the oldest event it has
+# not yet applied, and on restart reads the history from there, so it
+# resumes where it stopped instead of re-indexing everything.
+#
+# Objects are often written several times in quick succession (an
+# editor saving, say), so changes are debounced per object: an object
+# is re-indexed once it has been quiet for DEBOUNCE seconds, or at most
+# MAX_DELAY seconds after its first unindexed change, however busy.
+# Due objects are fetched from Storage and re-indexed BATCH_SIZE at a
+# time, each batch then synced, as for requests, before the checkpoint
+# moves past it.
+#
+# Objects are indexed if their content is UTF-8 text; others, and
+# objects since deleted, are removed from the index.
+
+import logging
+import os
+import time
+
+from typing import Optional
+
+import orjson
+
+import darq
+
+from darq.services.history import Event, History, from_microseconds, to_microseconds
+
+from text import decode_text
+
+# Seconds without a change before an object is re-indexed.
+DEBOUNCE = 2.0
+
+# Maximum seconds an object's re-indexing is put off by further changes.
+MAX_DELAY = 30.0
+
+# Number of objects fetched and indexed per batch.
+BATCH_SIZE = 100
+
+# Number of events read per request when catching up.
+REPLAY_BATCH = 1000
+
+
+class Indexer(darq.TimerListener):
+    """Re-indexes objects as they change."""
+
+    def __init__(self, service, path: str):
+        """Constructor.
+
+        :param service: Index service: its database is updated, and its
+        changed() called after each batch.
+        :param path: Index directory name, for the checkpoint file."""
+
+        self.service = service
+        self.db = service.db
+        self.path = os.path.join(path, "checkpoint.json")
+
+        self.history = History.api()
+        self.storage = darq.storage_api()
+
+        # Objects waiting to be indexed: subject -> [time of first
+        # unindexed event (microseconds), monotonic time first seen,
+        # monotonic time last seen].  Dictionary order is first seen.
+        self.pending: dict[str, list] = {}
+
+        # Time of the oldest event not known to be applied, and of the
+        # latest event seen, in microseconds since the epoch.
+        self.position: int = 0
+        self.latest: int = 0
+
+        # Objects indexed and removed, since starting.
+        self.indexed = 0
+        self.removed = 0
+
+        # Batch timer, if running.
+        self.timer_id: Optional[int] = None
+        self.closing = False
+
+        self.load_checkpoint()
+        return
+
+    def start(self):
+        """Follow new events, and catch up with those since the checkpoint.
+
+        This makes requests of the History service, so it's called from
+        the event loop once the Index service is running, rather than
+        while it's being constructed."""
+
+        self.history.subscribe(self.on_events,
+                               events=[Event.CREATED, Event.MODIFIED])
+        self.replay()
+        return
+
+    def close(self):
+        """Stop indexing.
+
+        Objects still pending are left for replay on restart."""
+
+        self.closing = True
+        if self.timer_id is not None:
+            darq.loop().cancel_timer(self.timer_id)
+            self.timer_id = None
+        return
+
+    def stats(self) -> dict:
+        """Return pipeline statistics."""
+
+        return {"pending": len(self.pending),
+                "position": self.position,
+                "indexed": self.indexed,
+                "removed": self.removed}
+
+    def load_checkpoint(self):
+        """(Internal) Read the checkpoint, if there is one."""
+
+        try:
+            with open(self.path, "rb") as f:
+                checkpoint = orjson.loads(f.read())
+        except FileNotFoundError:
+            return
+
+        self.position = self.latest = checkpoint["position"]
+        return
+
+    def save_checkpoint(self):
+        """(Internal) Write the checkpoint, if it has moved.
+
+        The position is the first event time of the oldest pending
+        object, or, if none, the latest event seen: events at that time
+        are replayed again on restart, which is harmless, since
+        re-indexing an object is idempotent."""
+
+        if self.pending:
+            position = min(entry[0] for entry in self.pending.values())
+        else:
+            position = self.latest
+        if position == self.position:
+            return
+
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(orjson.dumps({"position": position}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.path + ".tmp", self.path)
+        self.position = position
+        return
+
+    def replay(self):
+        """(Internal) Queue the objects changed since the checkpoint."""
+
+        # The first page ends with the newest event before the
+        # checkpoint; its cursor then leads through every event since,
+        # a page at a time, in (timestamp, rowid) order, so events
+        # sharing a time are neither skipped nor read twice.
+        page = self.history.get_page(1, from_microseconds(self.position - 1))
+        while True:
+            page = self.history.prev_page(page.prev_cursor, REPLAY_BATCH)
+            for timestamp, subject, event, _ in page.events:
+                if event in (Event.CREATED, Event.MODIFIED):
+                    self.note(subject, to_microseconds(timestamp))
+
+            if not page.has_prev:
+                break
+
+        logging.info(f"Index pipeline: {len(self.pending)} objects "
+                     f"changed since checkpoint")
+        return
+
+    def on_events(self, events: list, overflow: bool):
+        """(Internal) Handle events pushed by the History service."""
+
+        if self.closing:
+            return
+
+        for event in events:
+            self.note(event["subject"], to_microseconds(event["timestamp"]))
+
+        # Events were dropped: read them back from the history.
+        if overflow:
+            logging.warning("Index pipeline: event overflow; replaying")
+            self.replay()
+        return
+
+    def note(self, subject: str, timestamp: int):
+        """(Internal) Queue an object for indexing.
+
+        :param subject: Changed object's identifier.
+        :param timestamp: Time of change, in microseconds."""
+
+        now = time.monotonic()
+        entry = self.pending.get(subject)
+        if entry is None:
+            self.pending[subject] = [timestamp, now, now]
+        else:
+            entry[0] = min(entry[0], timestamp)
+            entry[2] = now
+        self.latest = max(self.latest, timestamp)
+
+        if self.timer_id is None and not self.closing:
+            self.timer_id = darq.loop().add_timer(DEBOUNCE, self)
+        return
+
+    def due(self, now: float) -> list:
+        """(Internal) Return up to a batch of objects due for indexing."""
+
+        batch = []
+        for subject, (_, first, last) in self.pending.items():
+            if now - last >= DEBOUNCE or now - first >= MAX_DELAY:
+                batch.append(subject)
+                if len(batch) == BATCH_SIZE:
+                    break
+        return batch
+
+    def on_timeout(self, timer_id: int, expiry_time: float, actual_time: float):
+        """Index a batch of due objects, and reschedule."""
+
+        darq.loop().cancel_timer(timer_id)
+        self.timer_id = None
+        batch = self.due(time.monotonic())
+        if batch:
+            self.index(batch)
+        if self.closing or not self.pending:
+            return
+
+        # Events arriving while fetching may have started the timer.
+        if self.timer_id is not None:
+            darq.loop().cancel_timer(self.timer_id)
+
+        # Run again immediately if more objects are due, otherwise when
+        # the next one will be.
+        now = time.monotonic()
+        delay = min(min(last + DEBOUNCE, first + MAX_DELAY)
+                    for _, first, last in self.pending.values()) - now
+        self.timer_id = darq.loop().add_timer(max(delay, 0.0), self)
+        return
+
+    def index(self, batch: list):
+        """(Internal) Fetch and re-index a batch of objects."""
+
+        # Objects are dequeued before fetching: a change arriving while
+        # fetching queues the object again, since the content fetched
+        # might predate it.
+        entries = {subject: self.pending.pop(subject) for subject in batch}
+        for subject in entries:
+            value, version = self.storage.get_versioned(subject)
+            text = decode_text(value) if version else None
+
+            if text is not None:
+                self.db.add(subject, text)
+                self.indexed += 1
+            elif self.db.delete(subject):
+                self.removed += 1
+
+        self.service.changed()
+        self.save_checkpoint()
+        logging.debug(f"Index pipeline: indexed {len(entries)} objects")
+        return
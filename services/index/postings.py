@@ -0,0 +1,98 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Posting list encoding.
+#
+# A term's posting list is the documents containing it, as segment-local
+# document numbers in ascending order, each with the term's frequency in
+# that document.  Lists are stored delta-encoded, as unsigned LEB128
+# varints: seven bits per byte, least significant first, with the high
+# bit set on all but the last byte.  An encoded list is:
+#
+#   varint     size of the gaps, in bytes
+#   varints    gaps: the first document number, then the difference
+#              between each document number and the one before
+#   varints    frequencies, in the same order
+#
+# Gaps and frequencies are kept apart, rather than interleaved, because
+# of how they're decoded: for the long lists of common terms, the gaps
+# are nearly all small, and frequencies almost always are, so each part
+# is usually a run of single-byte varints, which is decoded by list()
+# and itertools.accumulate(), at C speed, rather than a byte at a time.
+
+import itertools
+
+
+def encode_varints(values, out: bytearray):
+    """Append varints to a buffer."""
+
+    for value in values:
+        while value > 0x7f:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+    return
+
+
+def decode_varints(data) -> list:
+    """Decode a sequence of varints.
+
+    :param data: Encoded values: bytes, or a memoryview of them."""
+
+    # Fast path: all single-byte varints.
+    if not data or max(data) < 0x80:
+        return list(data)
+
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = 0
+            shift = 0
+    return values
+
+
+def encode_postings(postings: list) -> bytes:
+    """Encode a posting list.
+
+    :param postings: List of (document, frequency), in document order.
+    :returns: Encoded list."""
+
+    gaps = bytearray()
+    previous = 0
+    for document, _ in postings:
+        encode_varints((document - previous,), gaps)
+        previous = document
+
+    out = bytearray()
+    encode_varints((len(gaps),), out)
+    out += gaps
+    encode_varints((frequency for _, frequency in postings), out)
+    return bytes(out)
+
+
+def decode_postings(data) -> tuple:
+    """Decode a posting list.
+
+    :param data: Encoded list: bytes, or a memoryview of them.
+    :returns: (documents, frequencies), as parallel lists."""
+
+    size = 0
+    shift = 0
+    offset = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        size |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+
+    documents = list(itertools.accumulate(decode_varints(data[offset:offset + size])))
+    frequencies = decode_varints(data[offset + size:])
+    return documents, frequencies
@@ -0,0 +1,450 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Inverted index segments.
+#
+# The index is a set of immutable segments, each an inverted index over
+# a batch of documents, plus an in-memory active segment receiving new
+# ones.  Documents are numbered from zero within their segment.
+#
+# A sealed segment file is:
+#
+#   header         HEADER, padded to HEADER_SIZE bytes
+#   postings ends  uint64[terms], end offset of each term's postings
+#   lengths        uint32[documents], document lengths, in terms
+#   object ends    uint32[documents], end offset of each object id
+#   term ends      uint32[terms], end offset of each term
+#   frequencies    uint32[terms], number of documents with each term
+#   object ids     UTF-8, concatenated
+#   terms          UTF-8, concatenated, in code point order
+#   postings       encoded posting lists (see postings.py), in term order
+#
+# in native (little-endian) byte order.  Segments are memory-mapped, and
+# the columns used in place: a term is found by binary search of the
+# terms, and only its postings are read.
+#
+# Updating or deleting a document marks it deleted in its segment; the
+# deleted document numbers are kept in a sidecar file, NAME.del, as
+# uint32s.  Deleted documents are dropped when segments are merged.
+
+import array
+import bisect
+import heapq
+import logging
+import mmap
+import os
+import shutil
+import struct
+
+from collections import Counter
+from typing import Iterator, Optional
+
+from postings import decode_postings, encode_postings
+
+# Segment file header: magic, format version, flags, documents, terms.
+MAGIC = b"DQIX"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHHII")
+HEADER_SIZE = 64
+
+
+class SegmentFormatError(Exception):
+    """A segment file is damaged, or in an unknown format."""
+    pass
+
+
+class Terms:
+    """A segment's sorted terms, as a sequence of bytes, for bisect."""
+
+    def __init__(self, blob: memoryview, ends: memoryview):
+        self.blob = blob
+        self.ends = ends
+        return
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, i: int) -> bytes:
+        start = self.ends[i - 1] if i > 0 else 0
+        return bytes(self.blob[start:self.ends[i]])
+
+
+class TermTexts:
+    """A segment's sorted terms, as a sequence of str."""
+
+    def __init__(self, terms: Terms):
+        self.terms = terms
+        return
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __getitem__(self, i: int) -> str:
+        ends = self.terms.ends
+        return str(self.terms.blob[ends[i - 1] if i > 0 else 0:ends[i]], "utf-8")
+
+
+class Segment:
+    """A sealed, memory-mapped index segment."""
+
+    def __init__(self, path: str):
+        """Constructor.
+
+        :param path: Segment file name."""
+
+        self.path = path
+        self.name = os.path.basename(path)
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, self.documents, term_count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise SegmentFormatError(path)
+
+        view = memoryview(self.map)
+        self.views = []
+
+        def column(offset: int, size: int, code: str = "B"):
+            end = offset + size * struct.calcsize(code)
+            if end > len(view):
+                raise SegmentFormatError(path)
+            v = view[offset:end].cast(code)
+            self.views.append(v)
+            return v, end
+
+        offset = HEADER_SIZE
+        self.postings_ends, offset = column(offset, term_count, "Q")
+        self.lengths, offset = column(offset, self.documents, "I")
+        self.object_ends, offset = column(offset, self.documents, "I")
+        self.term_ends, offset = column(offset, term_count, "I")
+        self.frequencies, offset = column(offset, term_count, "I")
+        self.object_blob, offset = column(offset, self.object_ends[-1] if self.documents else 0)
+        term_blob, offset = column(offset, self.term_ends[-1] if term_count else 0)
+        self.postings_blob, offset = column(offset, self.postings_ends[-1] if term_count else 0)
+        self.views.append(view)
+
+        self.terms = Terms(term_blob, self.term_ends)
+
+        # Deleted document numbers, and whether they've changed since
+        # they were last written.
+        self.deleted: set[int] = set()
+        self.dirty = False
+        if os.path.exists(path + ".del"):
+            with open(path + ".del", "rb") as f:
+                self.deleted = set(array.array("I", f.read()))
+        return
+
+    def close(self):
+        # Views must be released before the map can be closed.
+        for view in self.views:
+            view.release()
+        self.map.close()
+        self.file.close()
+        return
+
+    @property
+    def live(self) -> int:
+        """Number of documents not deleted."""
+        return self.documents - len(self.deleted)
+
+    def size(self) -> int:
+        """Return the file size, in bytes."""
+        return len(self.map)
+
+    def find(self, term: str) -> Optional[int]:
+        """Return the position of a term, or None if it's not present."""
+
+        key = term.encode()
+        i = bisect.bisect_left(self.terms, key)
+        if i < len(self.terms) and self.terms[i] == key:
+            return i
+        return None
+
+    def sorted_terms(self) -> "TermTexts":
+        """Return the terms, as a sorted sequence of str."""
+        return TermTexts(self.terms)
+
+    def frequency(self, term: str) -> int:
+        """Return the number of documents containing a term."""
+
+        i = self.find(term)
+        return 0 if i is None else self.frequencies[i]
+
+    def encoded_postings(self, i: int) -> memoryview:
+        """Return the encoded postings of the term at a position."""
+
+        start = self.postings_ends[i - 1] if i > 0 else 0
+        return self.postings_blob[start:self.postings_ends[i]]
+
+    def postings(self, term: str) -> Optional[tuple]:
+        """Return a term's (documents, frequencies), or None."""
+
+        i = self.find(term)
+        if i is None:
+            return None
+        return decode_postings(self.encoded_postings(i))
+
+    def object_id(self, document: int) -> str:
+        """Return the object identifier of a document."""
+
+        start = self.object_ends[document - 1] if document > 0 else 0
+        return str(self.object_blob[start:self.object_ends[document]], "utf-8")
+
+    def all_terms(self) -> Iterator[tuple]:
+        """Yield (term, encoded postings) for every term, in order."""
+
+        for i in range(len(self.terms)):
+            yield str(self.terms[i], "utf-8"), self.encoded_postings(i)
+
+    def delete(self, document: int):
+        """Mark a document deleted."""
+        self.deleted.add(document)
+        self.dirty = True
+        return
+
+    def write_deletions(self):
+        """Write the deleted documents' sidecar file, if changed."""
+
+        if not self.dirty:
+            return
+
+        tmp = self.path + ".del.tmp"
+        with open(tmp, "wb") as f:
+            f.write(array.array("I", sorted(self.deleted)).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path + ".del")
+        self.dirty = False
+        return
+
+    def remove(self):
+        """Close, and delete the segment's files."""
+
+        self.close()
+        for path in (self.path, self.path + ".del"):
+            if os.path.exists(path):
+                os.remove(path)
+        return
+
+
+class ActiveSegment:
+    """The in-memory segment receiving new documents.
+
+    It has the same query interface as a sealed Segment."""
+
+    def __init__(self):
+        self.object_ids: list[str] = []
+        self.lengths: list[int] = []
+
+        # Postings, by term: (documents, frequencies).
+        self.index: dict[str, tuple[list, list]] = {}
+
+        # Sorted terms, made when first needed.
+        self.term_list: Optional[list[str]] = None
+
+        self.deleted: set[int] = set()
+        return
+
+    @property
+    def documents(self) -> int:
+        return len(self.object_ids)
+
+    @property
+    def live(self) -> int:
+        return len(self.object_ids) - len(self.deleted)
+
+    def add(self, object_id: str, frequencies: Counter, length: int) -> int:
+        """Add a document.
+
+        :param object_id: Object identifier.
+        :param frequencies: Occurrences of each term.
+        :param length: Number of terms.
+        :returns: Document number."""
+
+        document = len(self.object_ids)
+        self.object_ids.append(object_id)
+        self.lengths.append(length)
+
+        for term, frequency in frequencies.items():
+            postings = self.index.get(term)
+            if postings is None:
+                postings = self.index[term] = ([], [])
+                self.term_list = None
+            postings[0].append(document)
+            postings[1].append(frequency)
+        return document
+
+    def sorted_terms(self) -> list[str]:
+        if self.term_list is None:
+            self.term_list = sorted(self.index)
+        return self.term_list
+
+    def frequency(self, term: str) -> int:
+        postings = self.index.get(term)
+        return 0 if postings is None else len(postings[0])
+
+    def postings(self, term: str) -> Optional[tuple]:
+        return self.index.get(term)
+
+    def object_id(self, document: int) -> str:
+        return self.object_ids[document]
+
+    def delete(self, document: int):
+        self.deleted.add(document)
+        return
+
+    def write(self, path: str) -> list:
+        """Write the live documents as a sealed segment.
+
+        :param path: Segment file name.
+        :returns: New document number of each document, or -1 if it
+        was deleted."""
+
+        writer = SegmentWriter(path)
+        numbers = []
+        for document, object_id in enumerate(self.object_ids):
+            if document in self.deleted:
+                numbers.append(-1)
+            else:
+                numbers.append(writer.add_document(object_id, self.lengths[document]))
+
+        for term in sorted(self.index):
+            documents, frequencies = self.index[term]
+            postings = [(numbers[d], f) for d, f in zip(documents, frequencies)
+                        if numbers[d] >= 0]
+            if postings:
+                writer.add_term(term, encode_postings(postings), len(postings))
+
+        writer.finish()
+        return numbers
+
+
+class SegmentWriter:
+    """Writes a sealed segment file.
+
+    Documents are added first, then terms, in order.  Postings are
+    written to a temporary file as they're added, so only the term and
+    document tables are held in memory."""
+
+    def __init__(self, path: str):
+        """Constructor.
+
+        :param path: Segment file name."""
+
+        self.path = path
+        self.lengths = array.array("I")
+        self.object_ends = array.array("I")
+        self.object_blob = bytearray()
+        self.postings_ends = array.array("Q")
+        self.term_ends = array.array("I")
+        self.frequencies = array.array("I")
+        self.term_blob = bytearray()
+
+        self.postings_file = open(path + ".postings", "w+b")
+        self.postings_size = 0
+        return
+
+    def add_document(self, object_id: str, length: int) -> int:
+        """Add a document.
+
+        :returns: Its document number."""
+
+        self.object_blob += object_id.encode()
+        self.object_ends.append(len(self.object_blob))
+        self.lengths.append(length)
+        return len(self.lengths) - 1
+
+    def add_term(self, term: str, postings, frequency: int):
+        """Add a term, after any before it in order.
+
+        :param term: Term.
+        :param postings: Encoded posting list.
+        :param frequency: Number of documents in the list."""
+
+        self.term_blob += term.encode()
+        self.term_ends.append(len(self.term_blob))
+        self.frequencies.append(frequency)
+        self.postings_file.write(postings)
+        self.postings_size += len(postings)
+        self.postings_ends.append(self.postings_size)
+        return
+
+    def finish(self):
+        """Write the segment file."""
+
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, 0,
+                             len(self.lengths), len(self.term_ends))
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header.ljust(HEADER_SIZE, b'\0'))
+            for column in (self.postings_ends, self.lengths, self.object_ends,
+                           self.term_ends, self.frequencies):
+                f.write(column.tobytes())
+            f.write(self.object_blob)
+            f.write(self.term_blob)
+            self.postings_file.seek(0)
+            shutil.copyfileobj(self.postings_file, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.postings_file.close()
+        os.remove(self.path + ".postings")
+        os.rename(tmp, self.path)
+        return
+
+
+def merge_segments(path: str, sources: list) -> list:
+    """Write the live documents of several segments as one.
+
+    This only reads the sources' files, so it may run on another thread
+    while the sources are queried.
+
+    :param path: New segment file name.
+    :param sources: List of (Segment, deleted documents), in order.
+    :returns: For each source, a list of the new document number of
+    each of its documents, or -1 if it was dropped."""
+
+    writer = SegmentWriter(path)
+    numbers = []
+    for segment, deleted in sources:
+        numbers.append([-1 if document in deleted else
+                        writer.add_document(segment.object_id(document),
+                                            segment.lengths[document])
+                        for document in range(segment.documents)])
+
+    # Merge the sources' sorted term lists, through a heap of each
+    # source's next term, so that many sources merge as fast as few.
+    iterators = [segment.all_terms() for segment, _ in sources]
+    heap = []
+    for i, iterator in enumerate(iterators):
+        head = next(iterator, None)
+        if head is not None:
+            heap.append((head[0], i, head[1]))
+    heapq.heapify(heap)
+
+    while heap:
+        term = heap[0][0]
+        postings = []
+        while heap and heap[0][0] == term:
+            # Sources are numbered consecutively, and popped in order,
+            # so their documents stay in order.
+            _, i, encoded = heap[0]
+            documents, frequencies = decode_postings(encoded)
+            mapping = numbers[i]
+            postings.extend((mapping[d], f) for d, f in zip(documents, frequencies)
+                            if mapping[d] >= 0)
+
+            head = next(iterators[i], None)
+            if head is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (head[0], i, head[1]))
+
+        if postings:
+            writer.add_term(term, encode_postings(postings), len(postings))
+
+    writer.finish()
+    logging.debug(f"Merged {len(sources)} segments into {os.path.basename(path)}: "
+                  f"{len(writer.lengths)} documents, {len(writer.term_ends)} terms")
+    return numbers
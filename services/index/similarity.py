@@ -0,0 +1,525 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Vector similarity index.
+#
+# Finds "documents like this one": each object's text is embedded as a
+# fixed-size vector, and objects are ranked by the cosine similarity of
+# their vectors.  It's optional, needing NumPy, and runs on the CPU,
+# with no network access.  Embeddings are made by an embedder: hashed
+# term features (HashedEmbedder) by default, or a local model, loaded
+# by name (see load_embedder()).
+#
+# The vectors are stored, normalised, as rows of a memory-mapped float32
+# matrix, so cosine similarity is a dot product, and many rows are
+# scored at once by a matrix product.  vectors.json records the embedder
+# and the object of each row, and is replaced on each flush, which
+# commits the rows written since.  Rows aren't rewritten until after the
+# flush that frees them, so the committed rows always hold the committed
+# vectors, whatever happens meanwhile.
+#
+# A small collection is searched exhaustively.  Once it has
+# IVF_MIN_OBJECTS, an inverted file (IVF) index is built: the vectors
+# are clustered by k-means, into about sqrt(n) clusters, and a search
+# only scores the vectors of the clusters whose centroids are nearest
+# the query.  Gathering scattered rows costs more than scoring them, so
+# clustering copies the vectors to a new matrix, in cluster order, and
+# each cluster's vectors are scored in place.  Vectors added later are
+# appended, and assigned to their nearest cluster; the clusters are
+# rebuilt once as many have been added as were clustered.  The matrix,
+# vectors-GENERATION.f32, and the clusters, vectors-GENERATION.npz, are
+# named for the clustering's generation, which vectors.json records.
+
+import importlib
+import logging
+import math
+import os
+import zlib
+
+from collections import Counter
+from typing import Optional
+
+import orjson
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from text import tokenize
+
+SIMILARITY_VERSION = 1
+
+# Default embedding size.
+DIMENSIONS = 256
+
+# Rows allocated when the matrix is created; it doubles as it fills.
+INITIAL_ROWS = 1024
+
+# Rows scored per matrix product, bounding the memory used by a search.
+BLOCK_ROWS = 65536
+
+# Objects before an IVF index is built.
+IVF_MIN_OBJECTS = 20000
+
+# Fraction of the IVF clusters searched.
+IVF_PROBE_FRACTION = 0.1
+
+# k-means training: sample vectors per cluster, and iterations.
+TRAIN_PER_CLUSTER = 32
+TRAIN_ITERATIONS = 8
+
+
+class HashedEmbedder:
+    """Embeds text as hashed term features.
+
+    Each term is hashed to a dimension, and a sign, and its log-scaled
+    frequency accumulated there.  Needs no model, and texts sharing
+    many terms have similar vectors, but it knows nothing of meaning."""
+
+    def __init__(self, dimensions: int = DIMENSIONS):
+        self.dimensions = dimensions
+        self.name = f"hashed:{dimensions}"
+        return
+
+    def embed(self, texts: list):
+        """Return the texts' embeddings, as a float32 array of rows."""
+
+        vectors = numpy.zeros((len(texts), self.dimensions), numpy.float32)
+        for i, text in enumerate(texts):
+            row = vectors[i]
+            for term, count in Counter(tokenize(text)).items():
+                code = zlib.crc32(term.encode())
+                weight = 1.0 + math.log(count)
+                row[code % self.dimensions] += weight if code & 0x80000000 else -weight
+        return vectors
+
+
+def load_embedder(spec: str):
+    """Return the embedder named by a specification, or None.
+
+    :param spec: "hashed", or "hashed:DIMENSIONS", for hashed features;
+    "MODULE:NAME" for a local model, made by calling NAME, in MODULE,
+    with no arguments; or "none".
+
+    An embedder has a name, recorded to detect a change of model, a
+    number of dimensions, and an embed(texts) method, returning a
+    NumPy array of one row per text.  It must be picklable, for the
+    bulk build's worker processes."""
+
+    if spec == "none":
+        return None
+    if numpy is None:
+        logging.warning("NumPy not installed: similarity search disabled")
+        return None
+
+    name, _, argument = spec.partition(":")
+    if name == "hashed":
+        return HashedEmbedder(int(argument) if argument else DIMENSIONS)
+    return getattr(importlib.import_module(name), argument)()
+
+
+def normalized(vectors):
+    """Return vectors scaled to unit length (zero vectors unchanged)."""
+
+    norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / numpy.maximum(norms, 1e-12)).astype(numpy.float32)
+
+
+def nearest(vectors, centroids):
+    """Return the index of the nearest centroid to each vector."""
+
+    result = numpy.empty(len(vectors), numpy.int32)
+    for start in range(0, len(vectors), BLOCK_ROWS // 16):
+        block = vectors[start:start + BLOCK_ROWS // 16]
+        result[start:start + len(block)] = numpy.argmax(block @ centroids.T, axis=1)
+    return result
+
+
+class SimilarityIndex:
+    """Object embeddings, searched by cosine similarity."""
+
+    def __init__(self, path: str, embedder):
+        """Constructor.
+
+        :param path: Index directory name.
+        :param embedder: Embedder, from load_embedder()."""
+
+        self.path = path
+        self.embedder = embedder
+        self.dimensions: int = embedder.dimensions
+        self.rows_path = os.path.join(path, "vectors.json")
+
+        # Object of each row, or None if free.
+        self.object_ids: list[Optional[str]] = []
+
+        # Clustering rewrites the matrix, so it's versioned: the matrix
+        # and clusters files are named for their generation.
+        self.generation: int = 0
+        clustered = False
+
+        if os.path.exists(self.rows_path):
+            with open(self.rows_path, "rb") as f:
+                saved = orjson.loads(f.read())
+            if saved["embedder"] == embedder.name:
+                self.object_ids = saved["rows"]
+                self.generation = saved["generation"]
+                clustered = saved["clustered"]
+            else:
+                logging.warning(f"Embedder changed from {saved['embedder']}: "
+                                f"discarding similarity index")
+
+        # Remove other generations' files: leftovers of an interrupted
+        # clustering, or a discarded index.
+        current = {os.path.basename(self.matrix_path(self.generation)),
+                   os.path.basename(self.clusters_path(self.generation))}
+        for name in os.listdir(path):
+            if name.startswith("vectors-") and name not in current:
+                os.remove(os.path.join(path, name))
+
+        # Row of each object.
+        self.rows: dict[str, int] = {object_id: row for row, object_id
+                                     in enumerate(self.object_ids)
+                                     if object_id is not None}
+
+        # IVF clusters: centroids; the range of rows of each cluster, as
+        # clustered, from bounds[c] to bounds[c + 1]; each row's cluster;
+        # and the rows added to each cluster since (possibly including
+        # rows since freed, or reused).
+        self.centroids = None
+        self.bounds = None
+        self.assignments = None
+        self.extras: list[list[int]] = []
+        self.trained: int = 0
+
+        capacity = INITIAL_ROWS
+        while capacity < len(self.object_ids):
+            capacity *= 2
+        self.matrix = None
+        self.live = numpy.zeros(0, bool)
+        self.map(self.generation, capacity)
+        for row in self.rows.values():
+            self.live[row] = True
+
+        if clustered:
+            with numpy.load(self.clusters_path(self.generation)) as saved:
+                self.install_clusters(saved["centroids"], saved["bounds"])
+
+        # Free rows, and rows freed since the last flush, which aren't
+        # reused until it commits.  Rows in the clusters' ranges aren't
+        # reused at all, until they're next rebuilt.
+        self.free: list[int] = [row for row, object_id in enumerate(self.object_ids)
+                                if object_id is None and row >= self.trained]
+        self.released: list[int] = []
+
+        # Files of the previous generation, removed on commit.
+        self.obsolete: list[str] = []
+        self.dirty = False
+        return
+
+    def __len__(self):
+        return len(self.rows)
+
+    def matrix_path(self, generation: int) -> str:
+        return os.path.join(self.path, f"vectors-{generation:06d}.f32")
+
+    def clusters_path(self, generation: int) -> str:
+        return os.path.join(self.path, f"vectors-{generation:06d}.npz")
+
+    def map(self, generation: int, capacity: int):
+        """(Internal) Map a generation's matrix, with room for capacity rows."""
+
+        if self.matrix is not None:
+            self.matrix.flush()
+            del self.matrix
+
+        path = self.matrix_path(generation)
+        size = capacity * self.dimensions * 4
+        with open(path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self.matrix = numpy.memmap(path, numpy.float32, "r+",
+                                   shape=(capacity, self.dimensions))
+        self.live = numpy.concatenate(
+            [self.live, numpy.zeros(capacity - len(self.live), bool)])
+        if self.assignments is not None:
+            self.assignments = numpy.concatenate(
+                [self.assignments, numpy.full(capacity - len(self.assignments), -1, numpy.int32)])
+        return
+
+    def allocate(self) -> int:
+        """(Internal) Return a row for a new vector."""
+
+        if self.free:
+            return self.free.pop()
+
+        row = len(self.object_ids)
+        self.object_ids.append(None)
+        if row >= len(self.matrix):
+            self.map(self.generation, len(self.matrix) * 2)
+        return row
+
+    def add(self, object_id: str, text: str):
+        """Embed an object's text, replacing any previous vector."""
+
+        self.add_vectors([object_id], self.embedder.embed([text]))
+        return
+
+    def add_vectors(self, object_ids: list, vectors):
+        """Add objects' vectors, replacing any previous ones.
+
+        :param object_ids: Object identifiers.
+        :param vectors: Their embeddings, as an array of rows."""
+
+        vectors = normalized(numpy.asarray(vectors, numpy.float32))
+        rows = []
+        for object_id, vector in zip(object_ids, vectors):
+            self.remove(object_id)
+            row = self.allocate()
+            self.matrix[row] = vector
+            self.live[row] = True
+            self.object_ids[row] = object_id
+            self.rows[object_id] = row
+            rows.append(row)
+
+        if self.centroids is not None and rows:
+            self.assign(numpy.array(rows), vectors)
+        self.dirty = True
+        return
+
+    def remove(self, object_id: str) -> bool:
+        """Remove an object's vector.
+
+        :returns: True if it had one."""
+
+        row = self.rows.pop(object_id, None)
+        if row is None:
+            return False
+
+        self.live[row] = False
+        self.object_ids[row] = None
+        if row >= self.trained:
+            self.released.append(row)
+        self.dirty = True
+        return True
+
+    def vector(self, object_id: str):
+        """Return an object's (normalised) vector, or None."""
+
+        row = self.rows.get(object_id)
+        return None if row is None else numpy.array(self.matrix[row])
+
+    def embed(self, text: str):
+        """Return the normalised embedding of a text."""
+        return normalized(self.embedder.embed([text]))[0]
+
+    def search(self, queries, limit: int) -> list:
+        """Return the objects most similar to each of several vectors.
+
+        :param queries: Query vectors, as an array of rows.
+        :param limit: Maximum number of results per query.
+        :returns: For each query, a list of (object identifier,
+        cosine similarity), most similar first."""
+
+        queries = normalized(numpy.asarray(queries, numpy.float32).reshape(-1, self.dimensions))
+        if self.centroids is not None:
+            return [self.search_clusters(query, limit) for query in queries]
+
+        # Exhaustive: score a block of rows against every query at once,
+        # keeping each query's best rows so far.
+        count = len(self.object_ids)
+        best_scores = numpy.full((len(queries), 0), -numpy.inf, numpy.float32)
+        best_rows = numpy.zeros((len(queries), 0), numpy.int64)
+        for start in range(0, count, BLOCK_ROWS):
+            end = min(start + BLOCK_ROWS, count)
+            scores = queries @ self.matrix[start:end].T
+            scores[:, ~self.live[start:end]] = -numpy.inf
+            rows = numpy.broadcast_to(numpy.arange(start, end), scores.shape)
+            best_scores = numpy.concatenate([best_scores, scores], axis=1)
+            best_rows = numpy.concatenate([best_rows, rows], axis=1)
+            if best_scores.shape[1] > limit:
+                top = numpy.argpartition(-best_scores, limit - 1, axis=1)[:, :limit]
+                best_scores = numpy.take_along_axis(best_scores, top, axis=1)
+                best_rows = numpy.take_along_axis(best_rows, top, axis=1)
+
+        return [self.results(rows, scores) for rows, scores in zip(best_rows, best_scores)]
+
+    def search_clusters(self, query, limit: int) -> list:
+        """(Internal) Search the clusters nearest to a query vector."""
+
+        probes = max(1, round(len(self.centroids) * IVF_PROBE_FRACTION))
+        chosen = numpy.argpartition(-(self.centroids @ query), probes - 1)[:probes]
+
+        # Each cluster's range is scored in place; rows added since are
+        # gathered.
+        row_parts, score_parts = [], []
+        for cluster in chosen:
+            start, end = self.bounds[cluster], self.bounds[cluster + 1]
+            if end > start:
+                live = self.live[start:end]
+                row_parts.append(numpy.arange(start, end)[live])
+                score_parts.append((self.matrix[start:end] @ query)[live])
+
+        extras = [numpy.asarray(self.extras[c], numpy.int64) for c in chosen]
+        rows = numpy.concatenate(extras)
+        if len(rows):
+            clusters = numpy.repeat(chosen, [len(e) for e in extras])
+            rows = rows[self.live[rows] & (self.assignments[rows] == clusters)]
+            row_parts.append(rows)
+            score_parts.append(self.matrix[rows] @ query)
+
+        if not row_parts:
+            return []
+        rows = numpy.concatenate(row_parts)
+        scores = numpy.concatenate(score_parts)
+        if len(rows) > limit:
+            top = numpy.argpartition(-scores, limit - 1)[:limit]
+            rows, scores = rows[top], scores[top]
+        return self.results(rows, scores)
+
+    def results(self, rows, scores) -> list:
+        """(Internal) Return (object identifier, score), best first."""
+
+        order = numpy.argsort(-scores, kind="stable")
+        return [(self.object_ids[rows[i]], float(scores[i])) for i in order
+                if scores[i] > -numpy.inf]
+
+    def assign(self, rows, vectors=None):
+        """(Internal) Add rows to their nearest clusters."""
+
+        if vectors is None:
+            vectors = self.matrix[rows]
+        for row, cluster in zip(rows.tolist(), nearest(vectors, self.centroids).tolist()):
+            self.assignments[row] = cluster
+            self.extras[cluster].append(row)
+        return
+
+    def install_clusters(self, centroids, bounds):
+        """(Internal) Use a clustering, assigning rows added since."""
+
+        self.centroids = centroids
+        self.bounds = bounds
+        self.trained = int(bounds[-1])
+        self.assignments = numpy.full(len(self.matrix), -1, numpy.int32)
+        self.assignments[:self.trained] = numpy.repeat(
+            numpy.arange(len(centroids), dtype=numpy.int32), numpy.diff(bounds))
+        self.extras = [[] for _ in range(len(centroids))]
+
+        later = self.trained + numpy.flatnonzero(self.live[self.trained:len(self.object_ids)])
+        for start in range(0, len(later), BLOCK_ROWS):
+            self.assign(later[start:start + BLOCK_ROWS])
+        return
+
+    def train(self):
+        """(Internal) Cluster the vectors, by spherical k-means.
+
+        The live vectors are copied to a new generation of the matrix,
+        in cluster order, so each cluster's rows are contiguous."""
+
+        live_rows = numpy.flatnonzero(self.live[:len(self.object_ids)])
+        count = max(1, int(math.sqrt(len(live_rows))))
+        rng = numpy.random.default_rng(0)
+        sample = self.matrix[numpy.sort(rng.choice(live_rows,
+                                                   min(len(live_rows), count * TRAIN_PER_CLUSTER),
+                                                   replace=False))]
+        centroids = sample[rng.choice(len(sample), count, replace=False)]
+        for _ in range(TRAIN_ITERATIONS):
+            clusters = nearest(sample, centroids)
+            sums = numpy.zeros_like(centroids)
+            numpy.add.at(sums, clusters, sample)
+
+            # Empty clusters keep their centroid.
+            empty = numpy.bincount(clusters, minlength=count) == 0
+            sums[empty] = centroids[empty]
+            centroids = normalized(sums)
+
+        clusters = numpy.concatenate(
+            [nearest(self.matrix[live_rows[start:start + BLOCK_ROWS]], centroids)
+             for start in range(0, len(live_rows), BLOCK_ROWS)])
+        order = numpy.argsort(clusters, kind="stable")
+        bounds = numpy.searchsorted(clusters[order], numpy.arange(count + 1))
+        order = live_rows[order]
+
+        # Write the new generation.
+        generation = self.generation + 1
+        capacity = INITIAL_ROWS
+        while capacity < len(order):
+            capacity *= 2
+        old, old_ids = self.matrix, self.object_ids
+        self.matrix = None
+        self.live = numpy.zeros(0, bool)
+        self.assignments = None
+        self.map(generation, capacity)
+        for start in range(0, len(order), BLOCK_ROWS):
+            chunk = order[start:start + BLOCK_ROWS]
+            self.matrix[start:start + len(chunk)] = old[chunk]
+        self.matrix.flush()
+
+        path = self.clusters_path(generation)
+        with open(path + ".tmp", "wb") as f:
+            numpy.savez(f, centroids=centroids, bounds=bounds)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+
+        self.obsolete += [self.matrix_path(self.generation),
+                          self.clusters_path(self.generation)]
+        self.generation = generation
+        self.object_ids = [old_ids[row] for row in order.tolist()]
+        self.rows = {object_id: row for row, object_id in enumerate(self.object_ids)}
+        self.live[:len(order)] = True
+        self.free = []
+        self.released = []
+        del old
+        self.install_clusters(centroids, bounds)
+        self.dirty = True
+        logging.info(f"Clustered {len(order)} vectors into {count} clusters")
+        return
+
+    def flush(self):
+        """Write the vectors, and commit them."""
+
+        if not self.dirty:
+            return
+
+        # (Re)build the clusters once there are enough vectors, and when
+        # as many rows have been added since as were clustered.
+        if (len(self.rows) >= IVF_MIN_OBJECTS and
+                len(self.object_ids) >= 2 * self.trained):
+            self.train()
+
+        self.matrix.flush()
+        saved = {"version": SIMILARITY_VERSION,
+                 "embedder": self.embedder.name,
+                 "dimensions": self.dimensions,
+                 "generation": self.generation,
+                 "clustered": self.centroids is not None,
+                 "rows": self.object_ids}
+        with open(self.rows_path + ".tmp", "wb") as f:
+            f.write(orjson.dumps(saved))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.rows_path + ".tmp", self.rows_path)
+
+        for path in self.obsolete:
+            if os.path.exists(path):
+                os.remove(path)
+        self.obsolete = []
+        self.free.extend(self.released)
+        self.released = []
+        self.dirty = False
+        return
+
+    def close(self):
+        self.flush()
+        del self.matrix
+        self.matrix = None
+        return
+
+    def stats(self) -> dict:
+        """Return similarity index statistics."""
+
+        return {"objects": len(self.rows),
+                "embedder": self.embedder.name,
+                "dimensions": self.dimensions,
+                "clusters": 0 if self.centroids is None else len(self.centroids)}
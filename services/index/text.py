@@ -0,0 +1,49 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Text tokenisation.
+#
+# Text is normalised (Unicode NFKC, then case-folded), and split into
+# terms at anything that isn't a letter or digit.  Both indexed content
+# and queries go through the same function, so they always agree.
+#
+# There's no stemming or stop word list: they're language-specific,
+# and BM25's inverse document frequency already discounts common words.
+
+import re
+import unicodedata
+
+from collections import Counter
+from typing import Optional
+
+# Terms longer than this, in characters, aren't indexed: they're
+# usually encoded data rather than words.
+MAX_TERM_LENGTH = 64
+
+TERM_PATTERN = re.compile(r"[^\W_]+")
+
+
+def tokenize(text: str) -> list:
+    """Return the terms of a text, in order."""
+
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return [term for term in TERM_PATTERN.findall(text)
+            if len(term) <= MAX_TERM_LENGTH]
+
+
+def term_frequencies(text: str) -> tuple:
+    """Return a text's term frequencies, and its length.
+
+    :returns: (Counter of term to occurrences, number of terms)."""
+
+    terms = tokenize(text)
+    return Counter(terms), len(terms)
+
+
+def decode_text(content: bytes) -> Optional[str]:
+    """Return an object's content as text, or None if it isn't UTF-8."""
+
+    try:
+        return content.decode()
+    except UnicodeDecodeError:
+        return None
@@ -0,0 +1,331 @@
+# DarqOS
+# Copyright (C) 2021-2024 David Arnold
+
+# Metadata database.
+#
+# Metadata is stored as entity/attribute/value rows: an object's
+# identifier, an attribute name, the value's type, and the value.  The
+# value column holds the natural SQLite representation of each type
+# (see VALUE_TYPES), so integers, reals, datetimes (as microseconds
+# since the epoch) and booleans compare numerically, and strings
+# compare as text.
+#
+# The table's primary key, (object, name), serves reads and updates of
+# an object's attributes.  A covering index on (name, value, type,
+# object) is, in effect, a secondary index per attribute: a comparison
+# on one attribute is a single range scan of the index, yielding the
+# matching objects without reading the table.
+#
+# Bulk imports are staged in a temporary table, without indexes, and
+# merged in one transaction at the end.  A large import drops the value
+# index first, and rebuilds it once, which is much faster than updating
+# it for every row.
+#
+# The schema version is kept in SQLite's user_version, and older
+# databases are migrated when opened.
+
+import base64
+import logging
+import sqlite3
+
+from typing import Iterable, Optional
+
+# Current schema version.
+SCHEMA_VERSION = 1
+
+# An import of at least this fraction of the existing rows rebuilds the
+# value index, rather than updating it.
+REBUILD_FRACTION = 0.2
+
+# Value type codes, as darq.services.metadata.ValueType.
+INTEGER = 1
+REAL = 2
+TEXT = 3
+BOOLEAN = 4
+DATETIME = 5
+BYTES = 6
+
+VALUE_TYPES = {INTEGER, REAL, TEXT, BOOLEAN, DATETIME, BYTES}
+
+# Types compared with each other: integers and reals are both numbers.
+COMPARABLE_TYPES = {INTEGER: (INTEGER, REAL),
+                    REAL: (INTEGER, REAL),
+                    TEXT: (TEXT,),
+                    BOOLEAN: (BOOLEAN,),
+                    DATETIME: (DATETIME,),
+                    BYTES: (BYTES,)}
+
+
+def decode_value(value: list) -> tuple:
+    """Convert a value from a request to its stored (type, value).
+
+    :param value: [type, value] pair.  Bytes are base64-encoded, and
+    datetimes are integer microseconds since the epoch."""
+
+    if not isinstance(value, (list, tuple)) or len(value) != 2:
+        raise ValueError(f"Malformed value: {value!r}")
+
+    value_type, data = value
+    if value_type not in VALUE_TYPES:
+        raise ValueError(f"Unknown value type: {value_type!r}")
+
+    if value_type == BYTES:
+        data = base64.b64decode(data)
+    elif value_type == BOOLEAN:
+        data = int(bool(data))
+    elif value_type == REAL:
+        data = float(data)
+    elif value_type == TEXT:
+        data = str(data)
+    else:
+        data = int(data)
+    return value_type, data
+
+
+def encode_value(value_type: int, data) -> list:
+    """Convert a stored (type, value) to a [type, value] pair for a reply."""
+
+    if value_type == BYTES:
+        data = base64.b64encode(data).decode()
+    elif value_type == BOOLEAN:
+        data = bool(data)
+    return [value_type, data]
+
+
+class MetadataDatabase:
+    """SQLite persistence for the Metadata service."""
+
+    def __init__(self, file: str):
+        """Constructor.
+
+        :param file: Database file name."""
+
+        self.db = sqlite3.connect(file)
+        self.migrate()
+        return
+
+    def close(self):
+        """Close the database connection."""
+        self.db.close()
+        self.db = None
+        return
+
+    def migrate(self):
+        """Create the schema, or bring an existing one up to date."""
+
+        cursor = self.db.cursor()
+        cursor.execute("pragma user_version")
+        version = cursor.fetchone()[0]
+
+        if version == 0:
+            # The original key/value table was never usable (its
+            # queries named another table), so it holds nothing.
+            cursor.execute("drop table if exists metastorage")
+            self.create_schema(cursor)
+
+        cursor.execute(f"pragma user_version = {SCHEMA_VERSION}")
+        self.db.commit()
+        return
+
+    def create_schema(self, cursor: sqlite3.Cursor):
+        """Create the current schema in an empty database."""
+
+        logging.info("Creating metadata database schema")
+
+        cursor.execute("create table attributes ("
+                       "object text not null, "
+                       "name text not null, "
+                       "type integer not null, "
+                       "value, "
+                       "primary key (object, name)) without rowid")
+        self.create_indexes(cursor)
+        return
+
+    def create_indexes(self, cursor: sqlite3.Cursor):
+        """Create the value index."""
+
+        cursor.execute("create index if not exists attributes_by_value "
+                       "on attributes (name, value, type, object)")
+        return
+
+    def set_attributes(self, object_id: str, attributes: dict):
+        """Set some of an object's attributes, replacing existing values.
+
+        :param object_id: Object identifier.
+        :param attributes: Dictionary of name to (type, value)."""
+
+        self.set_objects([(object_id, attributes)])
+        return
+
+    def set_objects(self, objects: Iterable[tuple]):
+        """Set attributes of many objects, in a single transaction.
+
+        :param objects: Iterable of (object identifier, attributes)
+        pairs, where attributes maps names to (type, value)."""
+
+        cursor = self.db.cursor()
+        cursor.executemany("insert or replace into attributes "
+                           "(object, name, type, value) values (?, ?, ?, ?)",
+                           ((object_id, name, value_type, value)
+                            for object_id, attributes in objects
+                            for name, (value_type, value) in attributes.items()))
+        self.db.commit()
+        cursor.close()
+        return
+
+    def get_attribute(self, object_id: str, name: str) -> Optional[tuple]:
+        """Return an object's attribute, as (type, value), or None."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select type, value from attributes "
+                       "where object = ? and name = ?",
+                       (object_id, name))
+        row = cursor.fetchone()
+        cursor.close()
+        return row
+
+    def get_attributes(self, object_id: str) -> dict:
+        """Return all of an object's attributes.
+
+        :returns: Dictionary of name to (type, value)."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select name, type, value from attributes "
+                       "where object = ?",
+                       (object_id,))
+        attributes = {name: (value_type, value)
+                      for name, value_type, value in cursor.fetchall()}
+        cursor.close()
+        return attributes
+
+    def delete_attribute(self, object_id: str, name: str) -> bool:
+        """Delete an object's attribute.
+
+        :returns: True if it existed."""
+
+        cursor = self.db.cursor()
+        cursor.execute("delete from attributes where object = ? and name = ?",
+                       (object_id, name))
+        deleted = cursor.rowcount > 0
+        self.db.commit()
+        cursor.close()
+        return deleted
+
+    def delete_object(self, object_id: str) -> int:
+        """Delete all of an object's attributes.
+
+        :returns: Number of attributes deleted."""
+
+        cursor = self.db.cursor()
+        cursor.execute("delete from attributes where object = ?",
+                       (object_id,))
+        deleted = cursor.rowcount
+        self.db.commit()
+        cursor.close()
+        return deleted
+
+    def create_staging(self, table: str):
+        """Create an empty staging table for a bulk import.
+
+        :param table: Table name, unique to the import."""
+
+        cursor = self.db.cursor()
+        cursor.execute(f"create temp table {table} ("
+                       "object text not null, "
+                       "name text not null, "
+                       "type integer not null, "
+                       "value)")
+        self.db.commit()
+        cursor.close()
+        return
+
+    def stage(self, table: str, records: list) -> int:
+        """Add records to a staging table.
+
+        :param table: Staging table name.
+        :param records: List of (object identifier, attributes) pairs,
+        where attributes maps names to (type, value).
+        :returns: Number of attributes staged."""
+
+        cursor = self.db.cursor()
+        cursor.executemany(f"insert into temp.{table} (object, name, type, value) "
+                           "values (?, ?, ?, ?)",
+                           ((object_id, name, value_type, value)
+                            for object_id, attributes in records
+                            for name, (value_type, value) in attributes.items()))
+        staged = cursor.rowcount
+        self.db.commit()
+        cursor.close()
+        return staged
+
+    def merge_staging(self, table: str):
+        """Merge a staging table into the store, and drop it.
+
+        Staged attributes replace existing values; if an attribute was
+        staged more than once, the last wins."""
+
+        cursor = self.db.cursor()
+        cursor.execute(f"select count(*) from temp.{table}")
+        staged = cursor.fetchone()[0]
+        cursor.execute("select count(*) from attributes")
+        existing = cursor.fetchone()[0]
+
+        # One transaction, so the index is never left dropped.
+        rebuild = staged >= existing * REBUILD_FRACTION
+        cursor.execute("begin")
+        if rebuild:
+            cursor.execute("drop index attributes_by_value")
+
+        cursor.execute("insert or replace into attributes (object, name, type, value) "
+                       "select object, name, type, value "
+                       f"from temp.{table} order by rowid")
+
+        if rebuild:
+            self.create_indexes(cursor)
+        cursor.execute(f"drop table temp.{table}")
+        self.db.commit()
+        cursor.close()
+
+        logging.info(f"Merged {staged} attributes into {existing}"
+                     f"{', rebuilding index' if rebuild else ''}")
+        return
+
+    def drop_staging(self, table: str):
+        """Discard a staging table."""
+
+        cursor = self.db.cursor()
+        cursor.execute(f"drop table if exists temp.{table}")
+        self.db.commit()
+        cursor.close()
+        return
+
+    def get_rows(self, after: Optional[tuple], count: int) -> list:
+        """Return attribute rows in (object, name) order, for export.
+
+        :param after: (object, name) of the last row returned, or None
+        to start at the beginning.
+        :param count: Maximum number of rows.
+        :returns: List of (object, name, type, value) tuples."""
+
+        cursor = self.db.cursor()
+        if after is None:
+            cursor.execute("select object, name, type, value from attributes "
+                           "order by object, name limit ?",
+                           (count,))
+        else:
+            cursor.execute("select object, name, type, value from attributes "
+                           "where (object, name) > (?, ?) "
+                           "order by object, name limit ?",
+                           (after[0], after[1], count))
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def count_objects(self) -> int:
+        """Return the number of objects with any attributes."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select count(distinct object) from attributes")
+        count = cursor.fetchone()[0]
+        cursor.close()
+        return count
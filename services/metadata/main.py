@@ -1,158 +1,308 @@
 #! /usr/bin/env python
 # DarqOS
-# Copyright (C) 2021-2022 David Arnold
+# Copyright (C) 2021-2024 David Arnold
 
 # Metadata Service
 
 import base64
-import sqlite3
+import itertools
+import logging
+import os
 import sys
 
+from typing import Optional
+
 import darq
 
+from database import MetadataDatabase, decode_value, encode_value
+from query import Planner
+from records import RecordError, RecordReader, write_header, write_record
 
-class MetadataService(darq.Service):
-    """A simple persistent metadata collections store."""
+# Default maximum number of objects returned by a search.
+DEFAULT_SEARCH_LIMIT = 1000
 
-    def __init__(self, file: str = None):
-        super().__init__("tcp://*:11004")
+# Default number of attribute rows per export chunk.
+DEFAULT_EXPORT_ROWS = 5000
 
-        if file is None:
-            file = "Metadata.sqlite"
 
-        self.db = sqlite3.connect(file)
-        cursor = self.db.cursor()
-        cursor.execute("create table if not exists metastorage ("
-                       "key text not null primary key, "
-                       "value blob)")
-        self.db.commit()
+class Import:
+    """A bulk import in progress.
 
-        self.context = None
-        self.socket = None
-        self.active = False
+    Records arrive as a stream of chunks, and are staged as they're
+    parsed; they're merged into the store when the import ends."""
 
-        return
+    def __init__(self, db: MetadataDatabase, stream: int, format: str):
+        """Constructor.
 
-    @staticmethod
-    def get_name() -> str:
-        """Return the service name."""
-        return "metadata"
+        :param db: Metadata database.
+        :param stream: Import stream identifier.
+        :param format: Record format: "ndjson" or "binary"."""
 
-    def set(self, key: str, value):
-        """Set the value for a key.
+        self.db = db
+        self.reader = RecordReader(format)
+        self.table = f"import_{stream}"
+        self.records: int = 0
+        self.attributes: int = 0
 
-        :param key: Key string.
-        :param value: Value data."""
+        # Reason the stream can't be read, if it can't.
+        self.failure: Optional[str] = None
 
-        print(f"set({key}, {value})")
+        db.create_staging(self.table)
+        return
+
+    def stage(self, records: list):
+        """(Internal) Stage parsed records."""
+        self.records += len(records)
+        self.attributes += self.db.stage(self.table, records)
+        return
 
-        cursor = self.db.cursor()
-        cursor.execute("insert into storage values (?, ?)",
-                       (key, value))
-        self.db.commit()
+    def feed(self, data: bytes):
+        """Parse and stage the next chunk of the stream."""
+
+        if self.failure is not None:
+            return
+        try:
+            self.stage(self.reader.feed(data))
+        except RecordError as e:
+            self.failure = str(e)
         return
 
-    def update(self, key: str, value):
-        """Update the value for a key.
+    def finish(self) -> dict:
+        """Merge the staged records into the store.
 
-        :param key: Key string.
-        :param value: Value data.
+        :returns: Reply fields: counts of records, attributes and
+        malformed records skipped, and the first few errors."""
 
-        If 'key' is not already set, return an error."""
+        if self.failure is None:
+            self.stage(self.reader.close())
+            self.db.merge_staging(self.table)
+        else:
+            self.db.drop_staging(self.table)
 
-        print(f"update({key}, {value})")
+        return {"records": self.records,
+                "attributes": self.attributes,
+                "errors": self.reader.errors,
+                "messages": self.reader.messages}
 
-        cursor = self.db.cursor()
-        cursor.execute("update storage set value = ? where key = ?",
-                       (value, key))
-        self.db.commit()
+    def cancel(self):
+        """Discard the import."""
+        self.db.drop_staging(self.table)
         return
 
-    def exists(self, key: str) -> bool:
-        """Check whether key is set.
 
-        :param key: String eky.
-        :returns: True if set, False otherwise."""
+class MetadataService(darq.Service):
+    """A persistent store of typed attributes for objects.
 
-        cursor = self.db.cursor()
-        cursor.execute("select count(key) from storage where key = ?", (key,))
-        row = cursor.fetchone()
-        cursor.close()
+    Each object, identified by its object identifier, has a set of
+    named, typed attribute values.  Objects can be searched for by
+    combinations of conditions on their attributes.
 
-        key_exists = True
-        if row is None:
-            key_exists = False
-        if row[0] != 1:
-            key_exists = False
+    Values are exchanged as [type, value] pairs, with type codes as in
+    darq.services.metadata.ValueType."""
 
-        print(f"exists({key}) -> {key_exists}")
-        return key_exists
+    def __init__(self, file: str = None):
+        """Constructor.
 
-    def get(self, key: str):
-        """Returns the value for key.
+        :param file: Database file name."""
 
-        :param key: String key."""
+        # Initialise runtime.
+        darq.init_callbacks(darq.SelectEventLoop(), self)
 
-        cursor = self.db.cursor()
-        cursor.execute("select value from storage where key = ?", (key,))
-        row = cursor.fetchone()
-        cursor.close()
-        if row is None:
-            print(f"get({key}) -> None")
-            return None
-        value = row[0]
+        logging.info("Starting Metadata service.")
 
-        print(f"get({key}) -> {value}")
-        return value
+        # Initialise service.
+        super().__init__(11004)
 
-    def delete(self, key: str):
-        """Deletes the value for key."""
+        self.db = MetadataDatabase(file or "metadata.sqlite")
+        self.planner = Planner(self.db)
 
-        print(f"delete({key})")
+        # Bulk imports in progress, by stream identifier.
+        self.imports: dict[int, Import] = {}
+        self.next_stream: int = 1
 
-        cursor = self.db.cursor()
-        cursor.execute("delete from storage where key = ?", (key,))
-        self.db.commit()
+        self.context = None
+        self.socket = None
+        self.active = False
+
+        # Open port.
+        darq.open_port(self.port)
         return
 
-    def handle_request(self, request: dict):
-        """Handle requests."""
+    def run(self):
+        return darq.loop().run()
 
-        method = request.get("method")
-        if method == "set":
-            self.set(request["key"], base64.b64decode(request["value"]))
-            self.send_reply(request, result=True)
-            return
+    @staticmethod
+    def get_name() -> str:
+        """Return the service name."""
+        return "metadata"
 
-        elif method == "update":
-            self.update(request["key"], base64.b64decode(request["value"]))
-            self.send_reply(request, result=True)
-            return
+    @staticmethod
+    def decode_attributes(attributes: dict) -> dict:
+        """Convert attributes from a request to stored (type, value)s."""
+        return {name: decode_value(value) for name, value in attributes.items()}
 
-        elif method == "exists":
-            rpc_result = self.exists(request["key"])
-            self.send_reply(request, result=rpc_result)
-            return
+    @staticmethod
+    def encode_attributes(attributes: dict) -> dict:
+        """Convert stored attributes to [type, value] pairs for a reply."""
+        return {name: encode_value(*value) for name, value in attributes.items()}
+
+    def search(self, query: list, limit: int, after: str = None) -> dict:
+        """Return the objects matching a query, in identifier order.
+
+        :param query: Query, as a tree of lists; see query.py.
+        :param limit: Maximum number of objects.
+        :param after: If set, only objects after this identifier.
+        :returns: Reply fields: objects, and whether there were more."""
+
+        objects = self.planner.search(query, limit + 1, after)
+        return {"objects": objects[:limit],
+                "more": len(objects) > limit}
+
+    def export(self, format: str, cursor: Optional[list], count: int) -> dict:
+        """Return the next chunk of an export stream.
+
+        :param format: Record format: "ndjson" or "binary".
+        :param cursor: Cursor returned with the previous chunk, or None
+        to start at the beginning.
+        :param count: Approximate maximum number of attribute rows.
+        :returns: Reply fields: the chunk, base64-encoded, and the cursor
+        for the next chunk, which is None after the last."""
+
+        if format not in ("ndjson", "binary"):
+            raise ValueError(f"Unknown record format: {format!r}")
+
+        count = max(1, count)
+        rows = self.db.get_rows(tuple(cursor) if cursor else None, count)
+
+        # Keep objects whole: unless it's all there is, leave the last
+        # object, which might continue, for the next chunk.
+        more = len(rows) == count
+        if more and rows[0][0] != rows[-1][0]:
+            last = rows[-1][0]
+            while rows[-1][0] == last:
+                rows.pop()
+
+        parts = [write_header(format)] if cursor is None else []
+        for object_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+            parts.append(write_record(format, object_id,
+                                      [row[1:] for row in group]))
+
+        return {"data": base64.b64encode(b"".join(parts)).decode(),
+                "next": list(rows[-1][:2]) if more else None}
+
+    def handle_request(self, reply_port: int, request: dict):
+        """Handle requests."""
 
-        elif method == "get":
-            value = self.get(request["key"])
-            self.send_reply(
-                request,
-                result=value is not None,
-                value=base64.b64encode(value).decode() if value else '')
-            return
+        method = request.get("method")
+        try:
+            if method == "set":
+                self.db.set_attributes(request["object"],
+                                       {request["name"]: decode_value(request["value"])})
+                self.send_reply(reply_port, request, result=True)
+
+            elif method == "set_many":
+                self.db.set_attributes(request["object"],
+                                       self.decode_attributes(request["attributes"]))
+                self.send_reply(reply_port, request, result=True)
+
+            elif method == "get":
+                value = self.db.get_attribute(request["object"], request["name"])
+                self.send_reply(reply_port, request,
+                                result=value is not None,
+                                value=encode_value(*value) if value else None)
+
+            elif method == "get_all":
+                attributes = self.db.get_attributes(request["object"])
+                self.send_reply(reply_port, request, result=True,
+                                attributes=self.encode_attributes(attributes))
+
+            elif method == "delete":
+                deleted = self.db.delete_attribute(request["object"], request["name"])
+                self.send_reply(reply_port, request, result=deleted)
+
+            elif method == "delete_all":
+                deleted = self.db.delete_object(request["object"])
+                self.send_reply(reply_port, request, result=True, deleted=deleted)
+
+            elif method == "search":
+                reply = self.search(request["query"],
+                                    request.get("limit", DEFAULT_SEARCH_LIMIT),
+                                    request.get("after"))
+                self.send_reply(reply_port, request, result=True, **reply)
+
+            elif method == "explain":
+                plan = self.planner.explain(request["query"])
+                self.send_reply(reply_port, request, result=True, plan=plan)
+
+            elif method == "import_begin":
+                stream = self.next_stream
+                self.next_stream += 1
+                self.imports[stream] = Import(self.db, stream, request["format"])
+                self.send_reply(reply_port, request, result=True, stream=stream)
+
+            elif method == "import_chunk":
+                # Usually sent without waiting for a reply: only reply if asked.
+                session = self.imports.get(request["stream"])
+                if session is not None:
+                    session.feed(base64.b64decode(request["data"]))
+                if "xid" in request:
+                    self.send_reply(reply_port, request, result=session is not None)
+
+            elif method == "import_end":
+                session = self.imports.pop(request["stream"], None)
+                if session is None:
+                    raise ValueError(f"Unknown import stream: {request['stream']}")
+                counts = session.finish()
+                if session.failure is not None:
+                    self.send_reply(reply_port, request, result=False,
+                                    description=session.failure, **counts)
+                else:
+                    self.send_reply(reply_port, request, result=True, **counts)
+
+            elif method == "import_cancel":
+                session = self.imports.pop(request["stream"], None)
+                if session is not None:
+                    session.cancel()
+                self.send_reply(reply_port, request, result=session is not None)
+
+            elif method == "export":
+                reply = self.export(request.get("format", "ndjson"),
+                                    request.get("cursor"),
+                                    request.get("count", DEFAULT_EXPORT_ROWS))
+                self.send_reply(reply_port, request, result=True, **reply)
+
+            else:
+                super().handle_request(reply_port, request)
+
+        except ValueError as e:
+            logging.debug(f"Rejected {method} request: {e}")
+            self.send_reply(reply_port, request, result=False,
+                            description=str(e))
+        return
 
-        elif method == "delete":
-            self.delete(request["key"])
-            self.send_reply(request, result=True)
-            return
+    def handle_shutdown(self):
+        self.db.close()
 
-        else:
-            super().handle_request(request)
+        super().handle_shutdown()
+
+        logging.info("Metadata Service shutdown handled successfully.")
         return
 
 
 if __name__ == "__main__":
+    if os.getenv("INVOCATION_ID") is not None:
+        # Running under systemd
+        logging.basicConfig(stream=sys.stdout,
+                            format='%(levelname)8s %(message)s',
+                            level=logging.DEBUG)
+    else:
+        # Likely being run manually
+        logging.basicConfig(stream=sys.stderr,
+                            format='%(asctime)s p-Kernel %(levelname)8s %(message)s',
+                            level=logging.DEBUG)
+
     service = MetadataService()
     result = service.run()
+
+    logging.info("Exiting metadata service.")
     sys.exit(result)
@@ -0,0 +1,408 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Metadata queries.
+#
+# A query is a tree of lists, as sent by the client:
+#
+#   ["eq", name, value]           attribute equals value
+#   ["lt"|"le"|"gt"|"ge", name, value]
+#                                 attribute compares with value
+#   ["between", name, low, high]  low <= attribute < high
+#   ["prefix", name, text]        text attribute starts with text
+#   ["exists", name]              object has the attribute
+#   ["and", query, ...]           all sub-queries match
+#   ["or", query, ...]            any sub-query matches
+#
+# where values are [type, value] pairs.  Comparisons match only values
+# of comparable types: numbers (integer or real) with numbers, and
+# otherwise values of the same type.
+#
+# Every condition on a single attribute is one range scan of the
+# (name, value) index.  The planner estimates how many objects each
+# condition matches, by counting index entries up to PROBE_LIMIT, and
+# evaluates a conjunction by scanning only the most selective condition.
+# If every condition matches more than PROBE_LIMIT, they're counted
+# again, up to ten times as many, and so on, until one is known to be
+# most selective (or MAX_PROBE_LIMIT is reached).
+#
+# The resulting candidates are then checked against each remaining
+# condition, most selective first: by primary key lookups if there are
+# few candidates, or else by scanning that condition too, and taking
+# the intersection.  A disjunction is the union of its sub-queries.
+#
+# Searches return a page of objects, in identifier order, after a given
+# identifier.  Every scan, probe and lookup is bounded by that
+# identifier, and a query of a single condition is paged in SQL (the
+# index yields an equality's objects already in order).
+
+import heapq
+import sqlite3
+
+from typing import Optional
+
+from database import BOOLEAN, BYTES, COMPARABLE_TYPES, DATETIME, INTEGER, \
+    MetadataDatabase, REAL, TEXT, decode_value
+
+# Index entries counted to estimate a condition's selectivity, at
+# first, and at most.
+PROBE_LIMIT = 10000
+MAX_PROBE_LIMIT = 1000000
+
+# Order of preference between conditions with equal estimates.
+OPERATOR_RANK = {"eq": 0, "prefix": 1, "between": 2,
+                 "lt": 3, "le": 3, "gt": 3, "ge": 3, "exists": 4}
+
+# Bounds on the index's value column enclosing each type, by SQLite's
+# ordering of storage classes: numbers, then text, then blobs.
+TYPE_BOUNDS = {INTEGER: ("value < ''", None),
+               REAL: ("value < ''", None),
+               BOOLEAN: ("value < ''", None),
+               DATETIME: ("value < ''", None),
+               TEXT: ("value >= ''", "value < x''"),
+               BYTES: ("value >= x''", None)}
+
+
+class QueryError(ValueError):
+    """A query is malformed."""
+    pass
+
+
+class Condition:
+    """A condition on one attribute: a range scan of the value index."""
+
+    def __init__(self, op: str, name: str, clauses: list, args: list,
+                 text: str):
+        """Constructor.
+
+        :param op: Query operator.
+        :param name: Attribute name.
+        :param clauses: SQL conditions on the value and type columns.
+        :param args: Arguments for the SQL conditions.
+        :param text: Description, for query plans."""
+
+        self.op = op
+        self.name = name
+        self.where = " and ".join(["name = ?"] + clauses)
+        self.args = tuple([name] + args)
+        self.text = text
+
+        # Objects matching, counted up to 'probed'.
+        self.estimate: Optional[int] = None
+        self.probed: int = 0
+        return
+
+    def get_estimate(self, planner: "Planner", limit: int = PROBE_LIMIT) -> int:
+        """Return the number of objects matching, up to limit."""
+
+        if self.estimate is None or (self.estimate >= self.probed and limit > self.probed):
+            self.estimate = planner.probe(self, limit)
+            self.probed = limit
+        return min(self.estimate, limit)
+
+    def sort_key(self, planner: "Planner", limit: int = PROBE_LIMIT) -> tuple:
+        return self.get_estimate(planner, limit), OPERATOR_RANK[self.op]
+
+    def scan(self, planner: "Planner") -> set:
+        """Return the objects matching, from the index."""
+        return planner.scan(self)
+
+    def page(self, planner: "Planner", limit: int) -> list:
+        """Return the first objects matching, in order."""
+        return planner.page(self, limit)
+
+    def filter(self, planner: "Planner", candidates: set) -> set:
+        """Return those candidates matching."""
+
+        # Scanning the index is cheaper than looking up each candidate
+        # if fewer objects match than there are candidates.
+        limit = min(len(candidates), MAX_PROBE_LIMIT)
+        if self.get_estimate(planner, limit) < limit:
+            return candidates & self.scan(planner)
+        return planner.lookup(self, candidates)
+
+    def explain(self, planner: "Planner", action: str, depth: int) -> list:
+        self.get_estimate(planner)
+        estimate = self.estimate
+        count = f"{estimate}+" if estimate >= self.probed else str(estimate)
+        return [f"{'  ' * depth}{action} {self.text} (~{count})"]
+
+
+class Conjunction:
+    """Objects matching all of a list of sub-queries."""
+
+    def __init__(self, terms: list):
+        self.terms = terms
+        return
+
+    def get_estimate(self, planner: "Planner", limit: int = PROBE_LIMIT) -> int:
+        return min(term.get_estimate(planner, limit) for term in self.terms)
+
+    def sort_key(self, planner: "Planner", limit: int = PROBE_LIMIT) -> tuple:
+        return min(term.sort_key(planner, limit) for term in self.terms)
+
+    def ordered(self, planner: "Planner") -> list:
+        """Return the terms, most selective first."""
+
+        # Probe deeper while even the most selective term exceeds the limit.
+        limit = PROBE_LIMIT
+        while (limit < MAX_PROBE_LIMIT and
+               min(term.get_estimate(planner, limit) for term in self.terms) >= limit):
+            limit *= 10
+
+        return sorted(self.terms, key=lambda term: term.sort_key(planner, limit))
+
+    def scan(self, planner: "Planner") -> set:
+        driver, *rest = self.ordered(planner)
+        return self.filter_terms(planner, rest, driver.scan(planner))
+
+    def page(self, planner: "Planner", limit: int) -> list:
+        return heapq.nsmallest(limit, self.scan(planner))
+
+    def filter(self, planner: "Planner", candidates: set) -> set:
+        return self.filter_terms(planner, self.ordered(planner), candidates)
+
+    @staticmethod
+    def filter_terms(planner: "Planner", terms: list, candidates: set) -> set:
+        for term in terms:
+            if not candidates:
+                break
+            candidates = term.filter(planner, candidates)
+        return candidates
+
+    def explain(self, planner: "Planner", action: str, depth: int) -> list:
+        driver, *rest = self.ordered(planner)
+        lines = [f"{'  ' * depth}{action} and"]
+        lines.extend(driver.explain(planner, "scan", depth + 1))
+        for term in rest:
+            lines.extend(term.explain(planner, "filter", depth + 1))
+        return lines
+
+
+class Disjunction:
+    """Objects matching any of a list of sub-queries."""
+
+    def __init__(self, terms: list):
+        self.terms = terms
+        return
+
+    def get_estimate(self, planner: "Planner", limit: int = PROBE_LIMIT) -> int:
+        return min(limit,
+                   sum(term.get_estimate(planner, limit) for term in self.terms))
+
+    def sort_key(self, planner: "Planner", limit: int = PROBE_LIMIT) -> tuple:
+        return self.get_estimate(planner, limit), max(OPERATOR_RANK.values())
+
+    def scan(self, planner: "Planner") -> set:
+        result = set()
+        for term in self.terms:
+            result |= term.scan(planner)
+        return result
+
+    def page(self, planner: "Planner", limit: int) -> list:
+        return heapq.nsmallest(limit, self.scan(planner))
+
+    def filter(self, planner: "Planner", candidates: set) -> set:
+        result = set()
+        for term in self.terms:
+            result |= term.filter(planner, candidates - result)
+        return result
+
+    def explain(self, planner: "Planner", action: str, depth: int) -> list:
+        lines = [f"{'  ' * depth}{action} or"]
+        for term in self.terms:
+            lines.extend(term.explain(planner, action, depth + 1))
+        return lines
+
+
+def parse(query: list):
+    """Convert a query, as received, to a tree of query terms.
+
+    :param query: Query, as a tree of lists.
+    :raises QueryError: If the query is malformed."""
+
+    if not isinstance(query, (list, tuple)) or not query:
+        raise QueryError(f"Malformed query: {query!r}")
+
+    op = query[0]
+    if op in ("and", "or"):
+        if len(query) < 2:
+            raise QueryError(f"Empty '{op}' query")
+        terms = [parse(term) for term in query[1:]]
+        if len(terms) == 1:
+            return terms[0]
+        return Conjunction(terms) if op == "and" else Disjunction(terms)
+
+    if op not in OPERATOR_RANK:
+        raise QueryError(f"Unknown query operator: {op!r}")
+
+    if len(query) < 2 or not isinstance(query[1], str):
+        raise QueryError(f"Malformed '{op}' query: {query!r}")
+    name = query[1]
+
+    try:
+        if op == "exists":
+            return Condition(op, name, [], [], f"{name} exists")
+
+        if op == "prefix":
+            text = str(query[2])
+            clauses = ["type = ?", TYPE_BOUNDS[TEXT][0], TYPE_BOUNDS[TEXT][1]]
+            args = [TEXT]
+            if text:
+                clauses = ["type = ?", "value >= ?", "value < ?"]
+                args = [TEXT, text, text[:-1] + chr(ord(text[-1]) + 1)]
+            return Condition(op, name, clauses, args, f"{name} prefix {text!r}")
+
+        if op == "between":
+            low_type, low = decode_value(query[2])
+            high_type, high = decode_value(query[3])
+            if high_type not in COMPARABLE_TYPES[low_type]:
+                raise QueryError(f"Incomparable bounds: {query!r}")
+            clauses, args = type_clause(low_type)
+            return Condition(op, name,
+                             ["value >= ?", "value < ?"] + clauses,
+                             [low, high] + args,
+                             f"{name} between {low!r}, {high!r}")
+
+        value_type, value = decode_value(query[2])
+        clauses, args = type_clause(value_type)
+        if op == "eq":
+            clauses = ["value = ?"] + clauses
+        else:
+            sql_op = {"lt": "<", "le": "<=", "gt": ">", "ge": ">="}[op]
+            lower, upper = TYPE_BOUNDS[value_type]
+            bound = lower if op in ("lt", "le") else upper
+            clauses = [f"value {sql_op} ?"] + ([bound] if bound else []) + clauses
+        return Condition(op, name, clauses, [value] + args,
+                         f"{name} {op} {value!r}")
+
+    except (IndexError, TypeError, ValueError) as e:
+        if isinstance(e, QueryError):
+            raise
+        raise QueryError(f"Malformed '{op}' query: {query!r}: {e}")
+
+
+def type_clause(value_type: int) -> tuple:
+    """Return the SQL condition, and arguments, for values comparable
+    with a type."""
+
+    types = COMPARABLE_TYPES[value_type]
+    return [f"type in ({', '.join('?' * len(types))})"], list(types)
+
+
+class Planner:
+    """Evaluates queries against a metadata database."""
+
+    def __init__(self, db: MetadataDatabase):
+        """Constructor.
+
+        :param db: Metadata database."""
+
+        self.db = db
+        self.cursor: Optional[sqlite3.Cursor] = None
+
+        # Lower bound (exclusive) on the identifiers of objects found.
+        self.after: Optional[str] = None
+
+        # Candidates currently in the temporary candidates table.
+        self.loaded: Optional[set] = None
+        return
+
+    def search(self, query: list, limit: Optional[int] = None,
+               after: Optional[str] = None) -> list:
+        """Return the objects matching a query, sorted.
+
+        :param query: Query, as a tree of lists.
+        :param limit: If set, the maximum number of objects.
+        :param after: If set, only objects after this identifier."""
+
+        term = parse(query)
+        self.cursor = self.db.db.cursor()
+        self.after = after
+        try:
+            if limit is None:
+                return sorted(term.scan(self))
+            return term.page(self, limit)
+        finally:
+            self.finish()
+
+    def explain(self, query: list) -> list:
+        """Return a description of a query's plan, one line per step.
+
+        :param query: Query, as a tree of lists."""
+
+        term = parse(query)
+        self.cursor = self.db.db.cursor()
+        try:
+            return term.explain(self, "scan", 0)
+        finally:
+            self.finish()
+
+    def finish(self):
+        """(Internal) Release resources used by a query."""
+
+        if self.loaded is not None:
+            self.cursor.execute("delete from temp.candidates")
+            self.loaded = None
+        self.cursor.close()
+        self.cursor = None
+        self.after = None
+        return
+
+    def where(self, condition: Condition) -> tuple:
+        """(Internal) Return the SQL condition, and arguments, for a
+        condition's objects within the search's bounds."""
+
+        if self.after is None:
+            return condition.where, condition.args
+        return f"{condition.where} and object > ?", condition.args + (self.after,)
+
+    def probe(self, condition: Condition, limit: int) -> int:
+        """Count the index entries matching a condition, up to limit."""
+
+        where, args = self.where(condition)
+        self.cursor.execute("select count(*) from ("
+                            "select 1 from attributes indexed by attributes_by_value "
+                            f"where {where} limit ?)",
+                            args + (limit,))
+        return self.cursor.fetchone()[0]
+
+    def scan(self, condition: Condition) -> set:
+        """Return the objects matching a condition, from the value index."""
+
+        where, args = self.where(condition)
+        self.cursor.execute("select object "
+                            "from attributes indexed by attributes_by_value "
+                            f"where {where}",
+                            args)
+        return {row[0] for row in self.cursor}
+
+    def page(self, condition: Condition, limit: int) -> list:
+        """Return the first objects matching a condition, in order,
+        from the value index."""
+
+        where, args = self.where(condition)
+        self.cursor.execute("select object "
+                            "from attributes indexed by attributes_by_value "
+                            f"where {where} order by object limit ?",
+                            args + (limit,))
+        return [row[0] for row in self.cursor]
+
+    def lookup(self, condition: Condition, candidates: set) -> set:
+        """Return the candidates matching a condition, looking up each
+        candidate's attribute by primary key."""
+
+        if self.loaded is not candidates:
+            self.cursor.execute("create temp table if not exists candidates ("
+                                "object text primary key) without rowid")
+            self.cursor.execute("delete from temp.candidates")
+            self.cursor.executemany("insert into temp.candidates values (?)",
+                                    ((c,) for c in candidates))
+            self.loaded = candidates
+
+        self.cursor.execute("select c.object from temp.candidates as c "
+                            "cross join attributes "
+                            "where attributes.object = c.object and "
+                            f"{condition.where}",
+                            condition.args)
+        return {row[0] for row in self.cursor}
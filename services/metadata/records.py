@@ -0,0 +1,282 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Metadata record streams, for bulk import and export.
+#
+# A record is one object's attributes.  Two stream formats are
+# supported:
+#
+# - "ndjson": one JSON object per line,
+#
+#     {"object": "...", "attributes": {"title": "Dune", "year": 1965}}
+#
+#   where strings, integers, reals and booleans are plain JSON values,
+#   and any value may be a [type, value] pair, as in requests (exports
+#   use pairs for datetimes and bytes).
+#
+# - "binary": the magic bytes "DQMD", a version number (uint16), then
+#   packed records, little-endian:
+#
+#     uint16  object identifier length, in bytes
+#     uint16  number of attributes
+#     bytes   object identifier, UTF-8
+#     then, for each attribute:
+#       uint8   name length, in bytes
+#       uint8   value type
+#       bytes   name, UTF-8
+#       value:  int64 (integer, boolean, datetime), float64 (real), or
+#               uint32 length and bytes (text, as UTF-8, and bytes)
+#
+# so object identifiers are limited to 65,535 bytes, and attribute
+# names to 255.
+#
+# Streams arrive in arbitrarily sized pieces, so the readers buffer any
+# incomplete trailing record until the rest arrives.
+
+import struct
+
+from typing import Optional
+
+import orjson
+
+from database import BOOLEAN, BYTES, DATETIME, INTEGER, REAL, TEXT, \
+    decode_value, encode_value
+
+FORMATS = ("ndjson", "binary")
+
+BINARY_MAGIC = b"DQMD"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sH")
+
+RECORD_HEADER = struct.Struct("<HH")
+ATTRIBUTE_HEADER = struct.Struct("<BB")
+INT64 = struct.Struct("<q")
+FLOAT64 = struct.Struct("<d")
+LENGTH = struct.Struct("<I")
+
+
+class RecordError(ValueError):
+    """A record is malformed."""
+    pass
+
+
+def from_json(value) -> tuple:
+    """Convert a JSON attribute value to its stored (type, value)."""
+
+    # bool is a subclass of int, so must be checked first.
+    if isinstance(value, bool):
+        return BOOLEAN, int(value)
+    if isinstance(value, int):
+        return INTEGER, value
+    if isinstance(value, float):
+        return REAL, value
+    if isinstance(value, str):
+        return TEXT, value
+    return decode_value(value)
+
+
+def to_json(value_type: int, value):
+    """Convert a stored (type, value) to a JSON attribute value."""
+
+    if value_type in (INTEGER, REAL, TEXT):
+        return value
+    if value_type == BOOLEAN:
+        return bool(value)
+    return encode_value(value_type, value)
+
+
+class RecordReader:
+    """Parses a record stream, a piece at a time."""
+
+    def __init__(self, format: str):
+        """Constructor.
+
+        :param format: Stream format: "ndjson" or "binary"."""
+
+        if format not in FORMATS:
+            raise ValueError(f"Unknown record format: {format!r}")
+
+        self.format = format
+        self.buffer = bytearray()
+        self.started = format != "binary"
+
+        # Malformed records skipped, and the first few reasons.
+        self.errors: int = 0
+        self.messages: list[str] = []
+        return
+
+    def error(self, message: str):
+        """(Internal) Note a malformed record."""
+        self.errors += 1
+        if len(self.messages) < 10:
+            self.messages.append(message)
+        return
+
+    def feed(self, data: bytes) -> list:
+        """Add the next piece of the stream.
+
+        :param data: Stream bytes.
+        :returns: List of complete (object, attributes) records, where
+        attributes maps names to stored (type, value)."""
+
+        self.buffer += data
+        if self.format == "ndjson":
+            return self.read_ndjson()
+        return self.read_binary()
+
+    def close(self) -> list:
+        """End the stream.
+
+        :returns: Any final record."""
+
+        records = []
+        if self.format == "ndjson" and self.buffer.strip():
+            self.buffer += b"\n"
+            records = self.read_ndjson()
+
+        if self.buffer.strip():
+            self.error(f"Incomplete final record ({len(self.buffer)} bytes)")
+        self.buffer.clear()
+        return records
+
+    def read_ndjson(self) -> list:
+        """(Internal) Parse the complete lines in the buffer."""
+
+        end = self.buffer.rfind(b"\n")
+        if end < 0:
+            return []
+
+        records = []
+        for line in bytes(self.buffer[:end]).split(b"\n"):
+            if not line.strip():
+                continue
+            try:
+                record = orjson.loads(line)
+                attributes = {str(name): from_json(value)
+                              for name, value in record["attributes"].items()}
+                records.append((str(record["object"]), attributes))
+            except (orjson.JSONDecodeError, KeyError, TypeError,
+                    AttributeError, ValueError) as e:
+                self.error(f"Malformed record: {line[:80]!r}: {e}")
+
+        del self.buffer[:end + 1]
+        return records
+
+    def read_binary(self) -> list:
+        """(Internal) Parse the complete records in the buffer."""
+
+        offset = 0
+        if not self.started:
+            if len(self.buffer) < BINARY_HEADER.size:
+                return []
+            magic, version = BINARY_HEADER.unpack_from(self.buffer)
+            if magic != BINARY_MAGIC or version != BINARY_VERSION:
+                raise RecordError("Not a binary metadata record stream")
+            offset = BINARY_HEADER.size
+            self.started = True
+
+        records = []
+        view = memoryview(self.buffer)
+        try:
+            while True:
+                result = read_binary_record(view, offset)
+                if result is None:
+                    break
+                record, offset = result
+                records.append(record)
+        finally:
+            view.release()
+
+        del self.buffer[:offset]
+        return records
+
+
+def read_binary_record(buffer: memoryview, offset: int) -> Optional[tuple]:
+    """Parse one binary record.
+
+    :returns: ((object, attributes), offset of next record), or None if
+    the buffer doesn't hold the whole record."""
+
+    end = len(buffer)
+    if offset + RECORD_HEADER.size > end:
+        return None
+    length, count = RECORD_HEADER.unpack_from(buffer, offset)
+    offset += RECORD_HEADER.size
+
+    if offset + length > end:
+        return None
+    object_id = str(buffer[offset:offset + length], "utf-8")
+    offset += length
+
+    attributes = {}
+    for _ in range(count):
+        if offset + ATTRIBUTE_HEADER.size > end:
+            return None
+        length, value_type = ATTRIBUTE_HEADER.unpack_from(buffer, offset)
+        offset += ATTRIBUTE_HEADER.size
+
+        if offset + length > end:
+            return None
+        name = str(buffer[offset:offset + length], "utf-8")
+        offset += length
+
+        if value_type in (INTEGER, BOOLEAN, DATETIME, REAL):
+            if offset + 8 > end:
+                return None
+            packer = FLOAT64 if value_type == REAL else INT64
+            value = packer.unpack_from(buffer, offset)[0]
+            offset += 8
+
+        elif value_type in (TEXT, BYTES):
+            if offset + LENGTH.size > end:
+                return None
+            length = LENGTH.unpack_from(buffer, offset)[0]
+            offset += LENGTH.size
+            if offset + length > end:
+                return None
+            value = bytes(buffer[offset:offset + length])
+            if value_type == TEXT:
+                value = value.decode("utf-8")
+            offset += length
+
+        else:
+            raise RecordError(f"Unknown value type {value_type} for {object_id}")
+
+        attributes[name] = (value_type, value)
+
+    return (object_id, attributes), offset
+
+
+def write_record(format: str, object_id: str, attributes: list) -> bytes:
+    """Encode a record.
+
+    :param format: Stream format: "ndjson" or "binary".
+    :param object_id: Object identifier.
+    :param attributes: List of (name, type, value), as stored.
+    :returns: Encoded record."""
+
+    if format == "ndjson":
+        return orjson.dumps({"object": object_id,
+                             "attributes": {name: to_json(value_type, value)
+                                            for name, value_type, value in attributes}}) + b"\n"
+
+    object_bytes = object_id.encode()
+    parts = [RECORD_HEADER.pack(len(object_bytes), len(attributes)), object_bytes]
+    for name, value_type, value in attributes:
+        name_bytes = name.encode()
+        parts.append(ATTRIBUTE_HEADER.pack(len(name_bytes), value_type))
+        parts.append(name_bytes)
+        if value_type == REAL:
+            parts.append(FLOAT64.pack(value))
+        elif value_type in (TEXT, BYTES):
+            data = value.encode() if value_type == TEXT else value
+            parts.append(LENGTH.pack(len(data)))
+            parts.append(data)
+        else:
+            parts.append(INT64.pack(value))
+    return b"".join(parts)
+
+
+def write_header(format: str) -> bytes:
+    """Return the bytes starting a stream."""
+    return BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION) if format == "binary" else b""
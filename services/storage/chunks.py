@@ -0,0 +1,285 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Content-addressed chunk store.
+#
+# Values are split into variable-sized chunks at content-defined
+# boundaries, found using a rolling "gear" hash (as in FastCDC).  Because
+# the boundaries depend only on nearby bytes, an edit to one part of a
+# value changes only the chunks around it: the rest hash identically,
+# and are shared with the previous version of the value, and with any
+# other value containing the same bytes.
+#
+# Each chunk is stored once, keyed by its SHA-256 digest.  Chunk data
+# is never rewritten once stored: reference counts live in a separate
+# table, so sharing or releasing a chunk only touches that small row.
+
+import hashlib
+import logging
+import random
+import sqlite3
+from collections import Counter
+
+# Chunk size limits, in bytes.
+MIN_CHUNK_SIZE = 2 * 1024
+AVG_CHUNK_SIZE = 8 * 1024
+MAX_CHUNK_SIZE = 64 * 1024
+
+# Boundary masks.  Below the average size a stricter mask (more bits)
+# makes a cut less likely; above it a looser mask makes it more likely.
+# This "normalised chunking" keeps chunk sizes close to the average.
+MASK_SMALL = 0x0000d9f003530000
+MASK_LARGE = 0x0000d90003530000
+
+MASK_64 = 0xffffffffffffffff
+
+# Per-byte random values for the gear hash.  The seed is fixed: changing
+# it would change every chunk boundary, and defeat deduplication against
+# already-stored data.
+_gear_random = random.Random(0x64617271)
+GEAR = [_gear_random.getrandbits(64) for _ in range(256)]
+
+
+def chunk_boundaries(data: bytes) -> list[int]:
+    """Find content-defined chunk boundaries.
+
+    :param data: Value to be chunked.
+    :returns: List of chunk end offsets; the last is always len(data)."""
+
+    boundaries = []
+    length = len(data)
+    start = 0
+
+    while start < length:
+        remaining = length - start
+        if remaining <= MIN_CHUNK_SIZE:
+            boundaries.append(length)
+            break
+
+        # Bytes before the minimum size can never be a boundary, so
+        # skip hashing them altogether.
+        normal = start + min(AVG_CHUNK_SIZE, remaining)
+        end = start + min(MAX_CHUNK_SIZE, remaining)
+        i = start + MIN_CHUNK_SIZE
+        h = 0
+        cut = end
+
+        while i < normal:
+            h = ((h << 1) + GEAR[data[i]]) & MASK_64
+            i += 1
+            if h & MASK_SMALL == 0:
+                cut = i
+                break
+        else:
+            while i < end:
+                h = ((h << 1) + GEAR[data[i]]) & MASK_64
+                i += 1
+                if h & MASK_LARGE == 0:
+                    cut = i
+                    break
+
+        boundaries.append(cut)
+        start = cut
+
+    return boundaries
+
+
+def split(data: bytes) -> list[tuple[bytes, bytes]]:
+    """Split a value into content-defined chunks.
+
+    :param data: Value to be chunked.
+    :returns: List of (digest, chunk) pairs, in order."""
+
+    chunks = []
+    view = memoryview(data)
+    start = 0
+    for end in chunk_boundaries(data):
+        chunk = bytes(view[start:end])
+        chunks.append((hashlib.sha256(chunk).digest(), chunk))
+        start = end
+    return chunks
+
+
+class ChunkStore:
+    """Deduplicating, reference-counted chunk storage for values.
+
+    The store shares the Storage service's SQLite database, and all its
+    methods operate within the caller's transaction: the caller is
+    responsible for committing."""
+
+    def __init__(self, db: sqlite3.Connection, readonly: bool = False):
+        """Constructor.
+
+        :param db: Open database connection.
+        :param readonly: If True, the connection is read-only, and the
+        tables must already exist."""
+
+        self.db = db
+
+        # Chunks written, and chunks found already stored, since startup.
+        self.chunks_written: int = 0
+        self.chunks_reused: int = 0
+        self.bytes_written: int = 0
+        self.bytes_reused: int = 0
+
+        if readonly:
+            return
+
+        cursor = self.db.cursor()
+        cursor.execute("create table if not exists chunks ("
+                       "hash blob not null primary key, "
+                       "data blob not null)")
+        cursor.execute("create table if not exists chunk_refs ("
+                       "hash blob not null primary key, "
+                       "refs integer not null) without rowid")
+        cursor.execute("create table if not exists chunk_map ("
+                       "key text not null, "
+                       "seq integer not null, "
+                       "hash blob not null, "
+                       "size integer not null, "
+                       "primary key (key, seq)) without rowid")
+        cursor.close()
+        return
+
+    def hashes(self, cursor: sqlite3.Cursor, key: str) -> list[bytes]:
+        """Return the ordered list of chunk hashes for a key.
+
+        :param cursor: Database cursor.
+        :param key: Storage key."""
+
+        cursor.execute("select hash from chunk_map where key = ? "
+                       "order by seq", (key,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def put(self, cursor: sqlite3.Cursor, key: str, value: bytes):
+        """Store a value for a key, replacing any previous value.
+
+        :param cursor: Database cursor.
+        :param key: Storage key.
+        :param value: Value data."""
+
+        old = self.hashes(cursor, key)
+        new = split(value)
+        new_hashes = [h for h, _ in new]
+
+        # Store data only for chunks not already present.  'insert or
+        # ignore' never touches an existing row.
+        added = Counter(new_hashes) - Counter(old)
+        for digest, chunk in new:
+            if digest not in added:
+                self.chunks_reused += 1
+                self.bytes_reused += len(chunk)
+                continue
+
+            cursor.execute("insert or ignore into chunks (hash, data) "
+                           "values (?, ?)", (digest, chunk))
+            if cursor.rowcount > 0:
+                self.chunks_written += 1
+                self.bytes_written += len(chunk)
+            else:
+                self.chunks_reused += 1
+                self.bytes_reused += len(chunk)
+
+        self._add_refs(cursor, added)
+        self._release(cursor, Counter(old) - Counter(new_hashes))
+
+        # Rewrite only the map entries whose chunk changed.
+        for seq, (digest, chunk) in enumerate(new):
+            if seq < len(old) and old[seq] == digest:
+                continue
+            cursor.execute("insert or replace into chunk_map "
+                           "(key, seq, hash, size) values (?, ?, ?, ?)",
+                           (key, seq, digest, len(chunk)))
+        if len(old) > len(new):
+            cursor.execute("delete from chunk_map where key = ? and seq >= ?",
+                           (key, len(new)))
+        return
+
+    def get(self, cursor: sqlite3.Cursor, key: str) -> bytes:
+        """Reassemble the value for a key.
+
+        :param cursor: Database cursor.
+        :param key: Storage key.
+        :returns: Value data (empty if the key has no chunks)."""
+
+        cursor.execute("select chunks.data from chunk_map "
+                       "join chunks on chunks.hash = chunk_map.hash "
+                       "where chunk_map.key = ? "
+                       "order by chunk_map.seq", (key,))
+        return b''.join(row[0] for row in cursor.fetchall())
+
+    def delete(self, cursor: sqlite3.Cursor, key: str):
+        """Release the chunks of a key's value.
+
+        :param cursor: Database cursor.
+        :param key: Storage key."""
+
+        old = self.hashes(cursor, key)
+        if not old:
+            return
+
+        cursor.execute("delete from chunk_map where key = ?", (key,))
+        self._release(cursor, Counter(old))
+        return
+
+    def _add_refs(self, cursor: sqlite3.Cursor, counts: Counter):
+        """(Internal) Increment chunk reference counts."""
+        cursor.executemany("insert into chunk_refs (hash, refs) values (?, ?) "
+                           "on conflict (hash) do update "
+                           "set refs = refs + excluded.refs",
+                           counts.items())
+        return
+
+    def _release(self, cursor: sqlite3.Cursor, counts: Counter):
+        """(Internal) Decrement chunk reference counts, and delete chunks
+        that are no longer referenced."""
+
+        if not counts:
+            return
+
+        cursor.executemany("update chunk_refs set refs = refs - ? "
+                           "where hash = ?",
+                           [(n, h) for h, n in counts.items()])
+
+        unreferenced = []
+        for digest in counts:
+            cursor.execute("select refs from chunk_refs where hash = ?",
+                           (digest,))
+            row = cursor.fetchone()
+            if row is not None and row[0] <= 0:
+                unreferenced.append((digest,))
+
+        if unreferenced:
+            cursor.executemany("delete from chunk_refs where hash = ?",
+                               unreferenced)
+            cursor.executemany("delete from chunks where hash = ?",
+                               unreferenced)
+            logging.debug(f"Released {len(unreferenced)} chunks")
+        return
+
+    def stats(self) -> dict:
+        """Return deduplication statistics.
+
+        The dedup ratio is the total size of all chunked values divided
+        by the size of the distinct chunks actually stored."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select count(*), count(distinct key), "
+                       "coalesce(sum(size), 0) from chunk_map")
+        references, keys, logical_bytes = cursor.fetchone()
+        cursor.execute("select count(*), coalesce(sum(length(data)), 0) "
+                       "from chunks")
+        chunks, stored_bytes = cursor.fetchone()
+        cursor.close()
+
+        return {"keys": keys,
+                "chunks": chunks,
+                "chunk_references": references,
+                "logical_bytes": logical_bytes,
+                "stored_bytes": stored_bytes,
+                "dedup_ratio": logical_bytes / stored_bytes if stored_bytes else 1.0,
+                "average_chunk_size": stored_bytes / chunks if chunks else 0,
+                "chunks_written": self.chunks_written,
+                "chunks_reused": self.chunks_reused,
+                "bytes_written": self.bytes_written,
+                "bytes_reused": self.bytes_reused}
@@ -0,0 +1,268 @@
+# DarqOS
+# Copyright (C) 2019-2024 David Arnold
+
+# Storage database.
+#
+# One of these wraps each SQLite connection used by the Storage service.
+# The service's worker pool has a single read-write instance, and any
+# number of read-only instances; each is only ever used by the thread
+# that opened it.
+
+import logging
+import sqlite3
+
+from chunks import ChunkStore
+
+
+class StorageDatabase:
+    """SQLite persistence for the Storage service."""
+
+    def __init__(self, file: str, readonly: bool = False,
+                 chunked: bool = False):
+        """Constructor.
+
+        :param file: Database file name.
+        :param readonly: If True, open a read-only connection, and
+        assume the schema is already in place.
+        :param chunked: If True, store new values as deduplicated,
+        content-defined chunks."""
+
+        self.readonly = readonly
+        self.chunked = chunked
+
+        if readonly:
+            self.db = sqlite3.connect(f"file:{file}?mode=ro", uri=True)
+            self.chunks = ChunkStore(self.db, readonly=True)
+            return
+
+        self.db = sqlite3.connect(file)
+        cursor = self.db.cursor()
+
+        # Write-ahead logging lets readers run alongside the writer.
+        cursor.execute("pragma journal_mode=wal")
+
+        cursor.execute("create table if not exists storage ("
+                       "key text not null primary key, "
+                       "value blob, "
+                       "version integer not null default 1)")
+
+        # Databases created before keys were versioned lack the column.
+        cursor.execute("pragma table_info(storage)")
+        columns = [row[1] for row in cursor.fetchall()]
+        if "version" not in columns:
+            cursor.execute("alter table storage add column "
+                           "version integer not null default 1")
+
+        # Service-wide version sequence.  Existing databases continue
+        # from their highest stored version.
+        cursor.execute("create table if not exists sequence ("
+                       "name text not null primary key, "
+                       "value integer not null)")
+        cursor.execute("insert or ignore into sequence (name, value) "
+                       "select 'version', coalesce(max(version), 0) "
+                       "from storage")
+
+        # Chunked values have a NULL value column, and their data in the
+        # chunk store.  The store is always opened, so values written
+        # while chunking was enabled remain readable if it's disabled.
+        self.chunks = ChunkStore(self.db)
+        self.db.commit()
+        return
+
+    def close(self):
+        """Close the database connection."""
+        self.db.close()
+        self.db = None
+        return
+
+    def set(self, key: str, value) -> int:
+        """Set the value for a key.
+
+        :param key: Key string.
+        :param value: Value data.
+        :returns: Version number of the new value, or zero if 'key' is
+        already set."""
+
+        logging.debug(f"set({key})")
+        ok, version = self.cas(key, 0, value)
+        return version if ok else 0
+
+    def update(self, key: str, value) -> int:
+        """Update the value for a key.
+
+        :param key: Key string.
+        :param value: Value data.
+        :returns: Version number of the new value, or zero if 'key' is
+        not already set."""
+
+        logging.debug(f"update({key})")
+
+        cursor = self.db.cursor()
+        if self.current_version(cursor, key) == 0:
+            cursor.close()
+            return 0
+
+        version = self.write_value(cursor, key, value, True)
+        self.db.commit()
+        return version
+
+    def cas(self, key: str, expected_version: int, value) -> tuple[bool, int]:
+        """Set the value for a key, if its version is as expected.
+
+        :param key: Key string.
+        :param expected_version: Version the caller last read, or zero
+        to require that 'key' is not set.
+        :param value: Value data.
+        :returns: (success, version) tuple: on success the new version
+        number, otherwise the current version (zero if not set)."""
+
+        logging.debug(f"cas({key}, {expected_version})")
+
+        cursor = self.db.cursor()
+        current = self.current_version(cursor, key)
+        if current != expected_version:
+            cursor.close()
+            return False, current
+
+        version = self.write_value(cursor, key, value, current != 0)
+        self.db.commit()
+        return True, version
+
+    def current_version(self, cursor: sqlite3.Cursor, key: str) -> int:
+        """Return the version number of a key, or zero if it's not set.
+
+        :param cursor: Database cursor.
+        :param key: Key string."""
+
+        cursor.execute("select version from storage where key = ?", (key,))
+        row = cursor.fetchone()
+        return row[0] if row is not None else 0
+
+    def next_version(self, cursor: sqlite3.Cursor) -> int:
+        """Allocate a version number.
+
+        :param cursor: Database cursor, within the caller's transaction.
+
+        Versions come from a single service-wide sequence, so a key that
+        is deleted and set again never reuses an earlier version number,
+        and a stale compare-and-swap can't succeed by coincidence."""
+
+        cursor.execute("update sequence set value = value + 1 "
+                       "where name = 'version'")
+        cursor.execute("select value from sequence where name = 'version'")
+        return cursor.fetchone()[0]
+
+    def write_value(self, cursor: sqlite3.Cursor, key: str, value,
+                    exists: bool) -> int:
+        """Write a new version of a key's value.
+
+        :param cursor: Database cursor, within the caller's transaction.
+        :param key: Key string.
+        :param value: Value data.
+        :param exists: True if 'key' is already set.
+        :returns: New version number."""
+
+        version = self.next_version(cursor)
+        stored = self.store_value(cursor, key, value)
+        if exists:
+            cursor.execute("update storage set value = ?, version = ? "
+                           "where key = ?", (stored, version, key))
+        else:
+            cursor.execute("insert into storage (key, value, version) "
+                           "values (?, ?, ?)", (key, stored, version))
+        return version
+
+    def exists(self, key: str) -> bool:
+        """Check whether key is set.
+
+        :param key: String eky.
+        :returns: True if set, False otherwise."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select count(key) from storage where key = ?", (key,))
+        row = cursor.fetchone()
+        cursor.close()
+
+        key_exists = True
+        if row is None:
+            key_exists = False
+        if row[0] != 1:
+            key_exists = False
+
+        logging.debug(f"exists({key}) -> {key_exists}")
+        return key_exists
+
+    def get(self, key: str):
+        """Returns the value and version for key.
+
+        :param key: String key.
+        :returns: (value, version) tuple, or None if not set."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select value, version from storage where key = ?",
+                       (key,))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.close()
+            logging.debug(f"get({key}) -> None")
+            return None
+        value, version = row
+
+        if value is None:
+            value = self.chunks.get(cursor, key)
+        cursor.close()
+
+        logging.debug(f"get({key}) -> version {version}")
+        return value, version
+
+    def delete(self, key: str, expected_version: int = 0) -> tuple[bool, int]:
+        """Deletes the value for key.
+
+        :param key: Key string.
+        :param expected_version: If non-zero, delete only if the key's
+        current version matches.
+        :returns: (success, version) tuple: the deleted version on
+        success, otherwise the current version (zero if not set)."""
+
+        logging.debug(f"delete({key}, {expected_version})")
+
+        cursor = self.db.cursor()
+        current = self.current_version(cursor, key)
+        if current == 0 or expected_version not in (0, current):
+            cursor.close()
+            return False, current
+
+        cursor.execute("delete from storage where key = ?", (key,))
+        self.chunks.delete(cursor, key)
+        self.db.commit()
+        return True, current
+
+    def store_value(self, cursor: sqlite3.Cursor, key: str, value):
+        """Write a value to the chunk store, if enabled.
+
+        :param cursor: Database cursor, within the caller's transaction.
+        :param key: Key string.
+        :param value: Value data.
+        :returns: Value for the storage table's value column."""
+
+        if self.chunked:
+            self.chunks.put(cursor, key, value)
+            return None
+
+        # Release any chunks from an earlier, chunked, value.
+        self.chunks.delete(cursor, key)
+        return value
+
+    def stats(self) -> dict:
+        """Return storage statistics."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select count(key), "
+                       "coalesce(sum(length(value)), 0) from storage")
+        keys, unchunked_bytes = cursor.fetchone()
+        cursor.close()
+
+        return {"keys": keys,
+                "unchunked_bytes": unchunked_bytes,
+                "chunked": self.chunked,
+                "chunks": self.chunks.stats()}
@@ -17,11 +17,64 @@
 import base64
 import logging
 import os
-import sqlite3
 import sys
 
+from typing import Optional
+
 import darq
 
+from database import StorageDatabase
+from pool import WorkerPool
+
+
+# Maximum number of undelivered change events queued per watching client.
+WATCH_QUEUE_LIMIT = 1000
+
+# Default number of read-only database worker threads.
+DEFAULT_READERS = 2
+
+
+class Watcher:
+    """A client's change notification subscription.
+
+    A client watches any number of exact keys and key prefixes.  Change
+    events for matching keys are coalesced by key, so a burst of writes
+    to one key sends only its latest version."""
+
+    def __init__(self, service: darq.Service, port: int, limit: int):
+        """Constructor.
+
+        :param service: Storage service.
+        :param port: Client port to be notified.
+        :param limit: Maximum number of queued events."""
+
+        # Watched exact keys.
+        self.keys: set[str] = set()
+
+        # Watched key prefixes.  The empty prefix matches every key.
+        self.prefixes: set[str] = set()
+
+        # Batched delivery to the client.
+        self.subscriber = darq.Subscriber(service, port, "changed", limit)
+        return
+
+    def is_empty(self) -> bool:
+        """Return True if nothing is watched."""
+        return not self.keys and not self.prefixes
+
+    def matches(self, key: str) -> bool:
+        """Return True if changes to key should be reported.
+
+        :param key: Changed key."""
+
+        if key in self.keys:
+            return True
+
+        for prefix in self.prefixes:
+            if key.startswith(prefix):
+                return True
+        return False
+
 
 class StorageService(darq.Service):
     """A simple persistent key:value store.
@@ -31,10 +84,14 @@ class StorageService(darq.Service):
     Large values should probably be memory-mapped and paged into working
     set as required, rather than being completely loaded all at once."""
 
-    def __init__(self, file: str = None):
+    def __init__(self, file: str = None, chunked: bool = False,
+                 readers: int = DEFAULT_READERS):
         """Constructor.
 
-        :param file: Specify a file name for the blob starage."""
+        :param file: Specify a file name for the blob starage.
+        :param chunked: If True, store new values as deduplicated,
+        content-defined chunks.
+        :param readers: Number of read-only database worker threads."""
 
         # Initialise runtime.
         darq.init_callbacks(darq.SelectEventLoop(), self)
@@ -47,17 +104,22 @@ class StorageService(darq.Service):
         if file is None:
             file = "storage.sqlite"
 
-        self.db = sqlite3.connect(file)
-        cursor = self.db.cursor()
-        cursor.execute("create table if not exists storage ("
-                       "key text not null primary key, "
-                       "value blob)")
-        self.db.commit()
+        # Database work runs on worker threads, so a slow query or fsync
+        # never stalls the event loop.  Replies are sent as each request
+        # completes, so they may be out of order: clients match them to
+        # requests using their xid.
+        self.pool = WorkerPool(
+            lambda: StorageDatabase(file, chunked=chunked),
+            lambda: StorageDatabase(file, readonly=True),
+            readers)
 
         self.context = None
         self.socket = None
         self.active = False
 
+        # Change notification subscriptions, by client port.
+        self.watchers: dict[int, Watcher] = {}
+
         # Open port.
         darq.open_port(self.port)
         return
@@ -70,123 +132,199 @@ class StorageService(darq.Service):
         """Return the service name."""
         return "storage"
 
-    def set(self, key: str, value):
-        """Set the value for a key.
-
-        :param key: Key string.
-        :param value: Value data."""
-
-        print(f"set({key}, {value})")
-
-        cursor = self.db.cursor()
-        cursor.execute("insert into storage values (?, ?)",
-                       (key, value))
-        self.db.commit()
-        return
-
-    def update(self, key: str, value):
-        """Update the value for a key.
+    def watch(self, port: int, key: str, prefix: bool = False):
+        """Send change notifications for a key, or key prefix, to a port.
 
-        :param key: Key string.
-        :param value: Value data.
+        :param port: Client port to be notified.
+        :param key: Key, or key prefix, to watch.
+        :param prefix: If True, watch all keys starting with 'key'."""
 
-        If 'key' is not already set, return an error."""
+        logging.debug(f"watch({port}, {key}, {prefix})")
 
-        logging.debug(f"update({key}, {value})")
+        watcher = self.watchers.get(port)
+        if watcher is None:
+            watcher = Watcher(self, port, WATCH_QUEUE_LIMIT)
+            self.watchers[port] = watcher
 
-        cursor = self.db.cursor()
-        cursor.execute("update storage set value = ? where key = ?",
-                       (value, key))
-        self.db.commit()
+        if prefix:
+            watcher.prefixes.add(key)
+        else:
+            watcher.keys.add(key)
         return
 
-    def exists(self, key: str) -> bool:
-        """Check whether key is set.
+    def unwatch(self, port: int, key: Optional[str] = None,
+                prefix: bool = False):
+        """Cancel change notifications to a port.
 
-        :param key: String eky.
-        :returns: True if set, False otherwise."""
+        :param port: Watching client port.
+        :param key: Key, or key prefix, to stop watching; if None, cancel
+        all of the port's watches.
+        :param prefix: If True, 'key' is a prefix."""
 
-        cursor = self.db.cursor()
-        cursor.execute("select count(key) from storage where key = ?", (key,))
-        row = cursor.fetchone()
-        cursor.close()
+        logging.debug(f"unwatch({port}, {key}, {prefix})")
 
-        key_exists = True
-        if row is None:
-            key_exists = False
-        if row[0] != 1:
-            key_exists = False
-
-        logging.debug(f"exists({key}) -> {key_exists}")
-        return key_exists
-
-    def get(self, key: str):
-        """Returns the value for key.
+        watcher = self.watchers.get(port)
+        if watcher is None:
+            return
 
-        :param key: String key."""
+        if key is None:
+            watcher.keys.clear()
+            watcher.prefixes.clear()
+        elif prefix:
+            watcher.prefixes.discard(key)
+        else:
+            watcher.keys.discard(key)
 
-        cursor = self.db.cursor()
-        cursor.execute("select value from storage where key = ?", (key,))
-        row = cursor.fetchone()
-        cursor.close()
-        if row is None:
-            print(f"get({key}) -> None")
-            return None
-        value = row[0]
+        if watcher.is_empty():
+            watcher.subscriber.cancel()
+            watcher.subscriber.flush()
+            del self.watchers[port]
+        return
 
-        logging.debug(f"get({key}) -> {value}")
-        return value
+    def notify(self, key: str, version: int, op: str):
+        """Queue change notifications for a key to its watchers.
 
-    def delete(self, key: str):
-        """Deletes the value for key."""
+        :param key: Changed key.
+        :param version: Version number following the change; for a
+        delete, the deleted version.
+        :param op: Change operation: "set", "update" or "delete"."""
 
-        logging.debug(f"delete({key})")
+        event = None
+        for watcher in self.watchers.values():
+            if not watcher.matches(key):
+                continue
 
-        cursor = self.db.cursor()
-        cursor.execute("delete from storage where key = ?", (key,))
-        self.db.commit()
+            if event is None:
+                event = {"key": key, "version": version, "op": op}
+            watcher.subscriber.post(event, key)
         return
 
-    def handle_request(self, request: dict):
+    def handle_request(self, reply_port: int, request: dict):
         """Handle requests."""
 
         method = request.get("method")
         if method == "set":
-            self.set(request["key"], base64.b64decode(request["value"]))
-            self.send_reply(request, result=True)
+            def done(version):
+                if version > 0:
+                    self.notify(request["key"], version, "set")
+                self.send_reply(reply_port, request,
+                                result=version > 0, version=version)
+
+            self.submit(reply_port, request, done, True, StorageDatabase.set,
+                        request["key"], base64.b64decode(request["value"]))
             return
 
         elif method == "update":
-            self.update(request["key"], base64.b64decode(request["value"]))
-            self.send_reply(request, result=True)
+            def done(version):
+                if version > 0:
+                    self.notify(request["key"], version, "update")
+                self.send_reply(reply_port, request,
+                                result=version > 0, version=version)
+
+            self.submit(reply_port, request, done, True, StorageDatabase.update,
+                        request["key"], base64.b64decode(request["value"]))
             return
 
         elif method == "exists":
-            rpc_result = self.exists(request["key"])
-            self.send_reply(request, result=rpc_result)
+            def done(rpc_result):
+                self.send_reply(reply_port, request, result=rpc_result)
+
+            self.submit(reply_port, request, done, False, StorageDatabase.exists,
+                        request["key"])
             return
 
         elif method == "get":
-            value = self.get(request["key"])
-            self.send_reply(
-                request,
-                result=value is not None,
-                value=base64.b64encode(value).decode() if value else '')
+            def done(row):
+                value, version = row if row is not None else (None, 0)
+                self.send_reply(
+                    reply_port,
+                    request,
+                    result=row is not None,
+                    value=base64.b64encode(value).decode() if value else '',
+                    version=version)
+
+            self.submit(reply_port, request, done, False, StorageDatabase.get,
+                        request["key"])
+            return
+
+        elif method == "cas":
+            expected_version = request["expected_version"]
+
+            def done(rpc_result):
+                ok, version = rpc_result
+                if ok:
+                    self.notify(request["key"], version,
+                                "update" if expected_version else "set")
+                self.send_reply(reply_port, request, result=ok, version=version)
+
+            self.submit(reply_port, request, done, True, StorageDatabase.cas,
+                        request["key"], expected_version,
+                        base64.b64decode(request["value"]))
             return
 
         elif method == "delete":
-            self.delete(request["key"])
-            self.send_reply(request, result=True)
+            def done(rpc_result):
+                ok, version = rpc_result
+                if ok:
+                    self.notify(request["key"], version, "delete")
+                self.send_reply(reply_port, request, result=ok, version=version)
+
+            self.submit(reply_port, request, done, True, StorageDatabase.delete,
+                        request["key"], request.get("expected_version", 0))
+            return
+
+        elif method == "stats":
+            # Runs on the writer, which holds the chunk write counters.
+            def done(stats):
+                stats["pending_jobs"] = self.pool.pending()
+                self.send_reply(reply_port, request, result=True, stats=stats)
+
+            self.submit(reply_port, request, done, True, StorageDatabase.stats)
+            return
+
+        elif method == "watch":
+            self.watch(reply_port, request["key"], request.get("prefix", False))
+            self.send_reply(reply_port, request, result=True)
             return
 
+        elif method == "unwatch":
+            self.unwatch(reply_port,
+                         request.get("key"),
+                         request.get("prefix", False))
+            self.send_reply(reply_port, request, result=True)
+            return
+
+        else:
+            super().handle_request(reply_port, request)
+        return
+
+    def submit(self, reply_port: int, request: dict, done, write: bool,
+               function, *args):
+        """Queue database work for a request.
+
+        :param reply_port: Port number for reply.
+        :param request: Decoded request, for the reply's method and xid.
+        :param done: Called with the result, on the event loop thread.
+        :param write: True if the work modifies the database.
+        :param function: StorageDatabase method to run.
+        :param args: Arguments for function."""
+
+        def callback(result, error):
+            if error is not None:
+                self.send_reply(reply_port, request,
+                                result=False, description=str(error))
+                return
+            done(result)
+
+        if write:
+            self.pool.write(function, *args, callback=callback)
         else:
-            super().handle_request(request)
+            self.pool.read(function, *args, callback=callback)
         return
 
     def handle_shutdown(self):
-        # Clean up database connection.
-        self.db.close()
-        self.db = None
+        # Finish queued work, and close database connections.
+        self.pool.close()
 
         super().handle_shutdown()
 
@@ -208,7 +346,10 @@ if __name__ == "__main__":
 
     logging.info("Starting storage service.")
 
-    service = StorageService()
+    # Content-defined chunking is opt-in until it has seen more use.
+    chunked = os.getenv("DARQ_STORAGE_CHUNKED", "") not in ("", "0")
+
+    service = StorageService(chunked=chunked)
     result = service.run()
 
     logging.info("Exiting storage service.")
@@ -0,0 +1,199 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# SQLite worker pool.
+#
+# SQLite calls block: a slow query, or the fsync at the end of a
+# transaction, would stall the service's event loop, and with it every
+# other request.  Instead, database work runs on a small pool of
+# threads, each with its own connection:
+#
+# - A single writer thread, with the only read-write connection.  All
+#   writes are serialised through it, which is all SQLite allows anyway,
+#   and keeps version allocation simple.
+# - Zero or more reader threads, sharing a queue, with read-only
+#   connections.  In WAL mode, readers don't block the writer, nor the
+#   writer them, and each sees the last committed state.
+#
+# When a job completes, its result is queued, and a byte is written to
+# a socket pair whose other end is watched by the darq event loop.  The
+# loop then runs the job's callback, on the loop thread, so callbacks
+# can use the rest of the darq API safely.
+
+import logging
+import queue
+import socket
+import threading
+import typing
+
+import darq
+
+
+# Job callback: callback(result, error).  Exactly one of them is None.
+Callback = typing.Callable[[typing.Any, typing.Optional[Exception]], None]
+
+
+class Job:
+    """A unit of database work."""
+
+    def __init__(self, function: typing.Callable, args: tuple,
+                 callback: Callback):
+        """Constructor.
+
+        :param function: Called as function(database, *args).
+        :param args: Additional arguments for function.
+        :param callback: Completion callback."""
+        self.function = function
+        self.args = args
+        self.callback = callback
+        self.result = None
+        self.error: typing.Optional[Exception] = None
+
+
+class WorkerPool(darq.SocketListener):
+    """Runs database jobs on worker threads, completing on the event loop."""
+
+    def __init__(self,
+                 open_writer: typing.Callable[[], typing.Any],
+                 open_reader: typing.Callable[[], typing.Any],
+                 readers: int = 2):
+        """Constructor.
+
+        :param open_writer: Returns the writer's database object; called
+        on the writer thread, before any reader is started.
+        :param open_reader: Returns a reader's database object; called
+        on each reader thread.
+        :param readers: Number of reader threads.  If zero, reads are
+        queued to the writer thread."""
+
+        self.open_writer = open_writer
+        self.open_reader = open_reader
+
+        self.write_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.read_queue: queue.SimpleQueue = \
+            self.write_queue if readers == 0 else queue.SimpleQueue()
+        self.completions: queue.SimpleQueue = queue.SimpleQueue()
+
+        # Wake-up socket pair: workers write, the event loop reads.
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        darq.loop().add_socket(self.wake_reader, self)
+
+        # Statistics.
+        self.submitted: int = 0
+        self.completed: int = 0
+
+        # Start the writer first: it creates or migrates the schema that
+        # the readers expect to find.
+        ready = threading.Event()
+        self.threads: list[threading.Thread] = [
+            threading.Thread(target=self._run,
+                             args=(self.write_queue, open_writer, ready),
+                             name="storage-writer",
+                             daemon=True)]
+        self.threads[0].start()
+        ready.wait()
+
+        for i in range(readers):
+            ready = threading.Event()
+            thread = threading.Thread(target=self._run,
+                                      args=(self.read_queue, open_reader, ready),
+                                      name=f"storage-reader-{i}",
+                                      daemon=True)
+            thread.start()
+            ready.wait()
+            self.threads.append(thread)
+        return
+
+    def write(self, function: typing.Callable, *args, callback: Callback):
+        """Queue a job for the writer thread.
+
+        :param function: Called as function(database, *args).
+        :param args: Additional arguments for function.
+        :param callback: Called on the event loop thread on completion."""
+        self.submitted += 1
+        self.write_queue.put(Job(function, args, callback))
+        return
+
+    def read(self, function: typing.Callable, *args, callback: Callback):
+        """Queue a read-only job for any reader thread.
+
+        :param function: Called as function(database, *args).
+        :param args: Additional arguments for function.
+        :param callback: Called on the event loop thread on completion."""
+        self.submitted += 1
+        self.read_queue.put(Job(function, args, callback))
+        return
+
+    def pending(self) -> int:
+        """Return the number of submitted, but uncompleted, jobs."""
+        return self.submitted - self.completed
+
+    def close(self):
+        """Stop the worker threads, once queued jobs are done."""
+
+        # One stop marker per thread.
+        self.write_queue.put(None)
+        for _ in self.threads[1:]:
+            self.read_queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        # Deliver any remaining completions.
+        self.on_readable(self.wake_reader)
+
+        darq.loop().cancel_socket(self.wake_reader)
+        self.wake_reader.close()
+        self.wake_writer.close()
+        return
+
+    def _run(self, jobs: queue.SimpleQueue, open_database, ready: threading.Event):
+        """(Internal) Worker thread main function."""
+
+        database = open_database()
+        ready.set()
+
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+
+            try:
+                job.result = job.function(database, *job.args)
+            except Exception as e:
+                logging.exception(f"Storage job {job.function.__name__} failed")
+                job.error = e
+
+            self.completions.put(job)
+            try:
+                self.wake_writer.send(b'\0')
+            except BlockingIOError:
+                # Socket buffer is full: the loop has wake-ups pending.
+                pass
+
+        database.close()
+        return
+
+    def on_readable(self, sock: socket.socket):
+        """Run callbacks for completed jobs, on the event loop thread."""
+
+        try:
+            while sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while True:
+            try:
+                job = self.completions.get_nowait()
+            except queue.Empty:
+                break
+
+            self.completed += 1
+            job.callback(job.result, job.error)
+        return
+
+    def on_writeable(self, sock: socket.socket):
+        pass
@@ -13,23 +13,33 @@
 # adaptor.
 
 
+import collections
 import logging
 import sys
 import typing
 
 from urllib.parse import urlparse
-from datetime import datetime
 
 from PyQt5 import QtCore
 from PyQt5.QtGui import QKeySequence, QIcon, QScreen
-from PyQt5.QtWidgets import QAction, QShortcut, QApplication, QWidget, QPushButton, QMenu, QHBoxLayout, QVBoxLayout, QLineEdit, QLabel, QToolButton, QToolBar, QTableWidget, QTableWidgetItem, QGroupBox, QMainWindow
+from PyQt5.QtWidgets import QAction, QShortcut, QApplication, QWidget, QPushButton, QMenu, QHBoxLayout, QVBoxLayout, QLineEdit, QLabel, QToolButton, QToolBar, QTableWidget, QTableWidgetItem, QGroupBox, QMainWindow, QCompleter
 
 import qdarktheme
 
 #from darq.type.text import TextTypeView
 import darq
 
-from darq.services.history import History
+from darq.services.history import History, HistoryPage
+from darq.services.index import CompletionMirror, Index
+
+# Events per page of history.
+HISTORY_PAGE_SIZE = 100
+
+# Maximum number of pages of history held by the object selector.
+HISTORY_MAX_PAGES = 3
+
+# Completions shown under an omnibox.
+OMNIBOX_COMPLETIONS = 10
 
 
 class Type:
@@ -147,17 +157,86 @@ class TypeCacheModel:
         return res
 
 
+class OmniboxCompleter:
+    """Type-ahead completion for an omnibox.
+
+    Completions come from the terminal's mirror of the Index service's
+    labels, so each keystroke is answered locally, well within a frame.
+    Typos are tolerated: "txt" suggests "Text", after any exact matches.
+    Completion runs once the keystrokes already queued are handled, for
+    the text as it is then: a burst of typing is completed once, and a
+    completion for text since changed is never shown."""
+
+    def __init__(self, field: QLineEdit, completions: CompletionMirror,
+                 kinds: typing.Optional[list] = None):
+        """Constructor.
+
+        :param field: Omnibox text field.
+        :param completions: Completion label mirror.
+        :param kinds: Kinds of label to complete, or None for all."""
+
+        self.field = field
+        self.completions = completions
+        self.kinds = kinds
+
+        # Latest completions: (entry, kind, label, weight).
+        self.results: list = []
+        self.pending = False
+
+        self.model = QtCore.QStringListModel()
+        self.completer = QCompleter(self.model, field)
+        self.completer.setCompletionMode(QCompleter.CompletionMode.UnfilteredPopupCompletion)
+        self.completer.setWidget(field)
+        self.completer.activated[str].connect(self.on_activated)
+        field.textEdited.connect(self.on_edited)
+        return
+
+    def on_edited(self, text: str):
+        """Schedule completion of the edited text."""
+
+        if not self.pending:
+            self.pending = True
+            QtCore.QTimer.singleShot(0, self.on_complete)
+        return
+
+    def on_complete(self):
+        """Complete the field's current text."""
+
+        self.pending = False
+        text = self.field.text()
+        self.results = self.completions.complete(text, OMNIBOX_COMPLETIONS,
+                                                 self.kinds, fuzzy=True) \
+            if text.strip() else []
+
+        self.model.setStringList([label for _, _, label, _ in self.results])
+        if self.results:
+            self.completer.complete()
+        else:
+            self.completer.popup().hide()
+        return
+
+    def on_activated(self, label: str):
+        self.field.setText(label)
+        return
+
+
 class ObjectFactory(QWidget):
     """Enables creation of new type instances."""
 
-    def __init__(self, *args):
-        """Constructor."""
+    def __init__(self, completions: CompletionMirror, *args):
+        """Constructor.
+
+        :param completions: Completion label mirror."""
         super().__init__(*args)
 
         # Cache.
         self.types = TypeCacheModel()
         self.init_types()
 
+        # Publish type names for completion.
+        completions.api.set_labels((f"type:{t.name}", "type", t.name, 1.0)
+                                   for t in self.types.types.values())
+
         # Set size and position.
         screen = QScreen.availableGeometry(QApplication.primaryScreen())
         self.resize(int(screen.width() * 0.7), int(screen.height() * 0.7))
@@ -196,6 +275,7 @@ class ObjectFactory(QWidget):
         self.omnitext.setTextMargins(20, 20, 20, 20)
         self.omnibox.addWidget(self.omnitext)
         self.layout.addLayout(self.omnibox)
+        self.completer = OmniboxCompleter(self.omnitext, completions, ["type"])
 
         # Unfiltered types, MRU order (?)
         self.object_table = QVBoxLayout()
@@ -249,8 +329,98 @@ class ObjectFactory(QWidget):
         return
 
 
+class EventWindow:
+    """A sliding window onto the event history.
+
+    The window holds a bounded run of adjacent pages of events, newest
+    first.  Scrolling past either end fetches the neighbouring page,
+    and drops a page from the other end, so however far back the user
+    scrolls, only max_pages pages are ever held."""
+
+    def __init__(self, history: History, page_size: int, max_pages: int):
+        self.history = history
+        self.page_size: int = page_size
+        self.max_pages: int = max(2, max_pages)
+        self.pages: typing.Deque[HistoryPage] = collections.deque()
+        return
+
+    def events(self) -> list:
+        """Return the events in the window, newest first."""
+        return [event for page in self.pages for event in page.events]
+
+    def reset(self):
+        """Reload the window with the newest events."""
+        self.pages.clear()
+        self.pages.append(self.history.get_page(self.page_size))
+        return
+
+    def refresh(self) -> typing.Optional[int]:
+        """Bring the window up to date with the newest events.
+
+        Unless many events have been added since it was last shown, the
+        window is extended with just the new ones.
+
+        :returns: Number of events added at the start of the window, or
+        None if it was reloaded."""
+
+        if not self.pages or self.pages[0].has_prev:
+            self.reset()
+            return None
+
+        page = self.history.prev_page(self.pages[0].prev_cursor, self.page_size)
+        if page.has_prev:
+            self.reset()
+            return None
+
+        if len(page) > 0:
+            self.pages.appendleft(page)
+            while len(self.pages) > self.max_pages:
+                self.pages.pop()
+        return len(page)
+
+    def scroll_older(self) -> typing.Optional[int]:
+        """Extend the window with older events.
+
+        :returns: Number of events dropped from the start of the window,
+        or None if there were no older events."""
+
+        if not self.pages or not self.pages[-1].has_next:
+            return None
+
+        page = self.history.next_page(self.pages[-1].next_cursor, self.page_size)
+        if len(page) == 0:
+            return None
+        self.pages.append(page)
+
+        dropped = 0
+        while len(self.pages) > self.max_pages:
+            dropped += len(self.pages.popleft())
+        return dropped
+
+    def scroll_newer(self) -> typing.Optional[int]:
+        """Extend the window with newer events.
+
+        :returns: Number of events added at the start of the window, or
+        None if there were no newer events."""
+
+        if not self.pages or not self.pages[0].has_prev:
+            return None
+
+        page = self.history.prev_page(self.pages[0].prev_cursor, self.page_size)
+        if len(page) == 0:
+            return None
+        self.pages.appendleft(page)
+
+        while len(self.pages) > self.max_pages:
+            self.pages.pop()
+        return len(page)
+
+
 class ObjectSelector(QWidget):
-    def __init__(self, *args):
+    def __init__(self, completions: CompletionMirror, *args):
+        """Constructor.
+
+        :param completions: Completion label mirror."""
         super().__init__(*args)
 
         # Set size & position.
@@ -277,6 +447,7 @@ class ObjectSelector(QWidget):
         self.omnitext.setTextMargins(20, 20, 20, 20)
         self.omnibox.addWidget(self.omnitext)
         self.layout.addLayout(self.omnibox)
+        self.completer = OmniboxCompleter(self.omnitext, completions)
 
         # Here I'm going to start with the list of objects from
         # the history service.  This will need to be completely
@@ -289,39 +460,100 @@ class ObjectSelector(QWidget):
         # the type implementation to have a method to get a description
         # of the object in a type-specific way?
 
-        self.object_table = QTableWidget(10, 4, self)
+        self.object_table = QTableWidget(0, 4, self)
         self.object_table.setHorizontalHeaderLabels(("Date / Time", "Type", "Event", "Object"))
         self.object_table.verticalHeader().setVisible(False)
         self.object_table.setContentsMargins(20, 20, 20, 20)
-        for r in range(10):
-            for c in (0, 1, 2, 3):
-                item = QTableWidgetItem()
-                item.setText(["datetime", "type", "event", "description of object"][c])
-                self.object_table.setItem(r, c, item)
         self.layout.addWidget(self.object_table)
 
         self.setLayout(self.layout)
         self.hide()
 
+        # History is fetched a page at a time as the table scrolls, and
+        # only a few pages are kept.  The table scrolls per item, so the
+        # scroll bar's value is the top row index.
         self.history = History.api()
+        self.events = EventWindow(self.history, HISTORY_PAGE_SIZE, HISTORY_MAX_PAGES)
+        self.loading = False
+        self.object_table.verticalScrollBar().valueChanged.connect(self.on_scroll)
+
+        # New events are pushed by the History service, so the list stays
+        # current while shown, without polling.
+        self.refresh_pending = False
+        self.history.subscribe(self.on_history_events)
         return
 
-    def show(self):
+    def on_history_events(self, events: list, overflow: bool):
+        """Note newly recorded events, and refresh the list if shown."""
 
-        # FIXME: needs a lot more work here ...
-        # Populate history list
-        self.object_table.clearContents()
+        # Refresh outside the notification handler, so the refresh's
+        # own requests aren't issued from within message delivery.
+        if self.isVisible() and not self.refresh_pending:
+            self.refresh_pending = True
+            QtCore.QTimer.singleShot(0, self.on_refresh)
+        return
 
-        now = datetime.utcnow()
-        history = self.history.get_events(now, 100, True)
+    def on_refresh(self):
+        """Bring the shown list up to date, keeping its scroll position."""
 
-        r = 0
-        for event in history:
+        self.refresh_pending = False
+        if not self.isVisible():
+            return
+
+        # Keep the same events in view, unless showing the newest.
+        top_row = self.object_table.verticalScrollBar().value()
+        added = self.events.refresh()
+        if added is None or top_row == 0:
+            top_row = 0
+        else:
+            top_row += added
+        self.populate(top_row)
+        return
+
+    def populate(self, top_row: int):
+        """Fill the table from the event window.
+
+        :param top_row: Row to scroll to."""
+
+        self.loading = True
+        events = self.events.events()
+        self.object_table.clearContents()
+        self.object_table.setRowCount(len(events))
+
+        for r, event in enumerate(events):
             for c in range(4):
                 item = QTableWidgetItem()
-                item.setText([event[0], "type", event[2], event[1]][c])
+                item.setText([event[0].isoformat(), "type",
+                              event[2].name.lower(), event[1]][c])
                 self.object_table.setItem(r, c, item)
-            r += 1
+
+        self.object_table.verticalScrollBar().setValue(max(0, top_row))
+        self.loading = False
+        return
+
+    def on_scroll(self, value: int):
+        """Fetch more history when the table is scrolled to either end."""
+
+        if self.loading:
+            return
+
+        scroll_bar = self.object_table.verticalScrollBar()
+        if value >= scroll_bar.maximum():
+            dropped = self.events.scroll_older()
+            if dropped is not None:
+                self.populate(value - dropped)
+
+        elif value <= scroll_bar.minimum():
+            added = self.events.scroll_newer()
+            if added is not None:
+                self.populate(value + added)
+        return
+
+    def show(self):
+        # Populate history list, fetching only events added since it
+        # was last shown.
+        self.events.refresh()
+        self.populate(0)
 
         super().show()
         return
@@ -398,15 +630,19 @@ class UI(QWidget):
     def __init__(self, *args):
         super().__init__(*args)
 
+        # Omnibox completions, from a local copy of the Index service's
+        # labels, kept up to date as they change.
+        self.completions = CompletionMirror(Index.api())
+
         # Create new objects with Sys-n
-        self.factory = ObjectFactory()
+        self.factory = ObjectFactory(self.completions)
         self.factory_shortcut = QShortcut(QKeySequence("Ctrl+n"), self)
         self.factory_shortcut.setContext(
             QtCore.Qt.ShortcutContext.ApplicationShortcut)
         self.factory_shortcut.activated.connect(self.on_factory)
 
         # Select an existing object with Sys-s
-        self.selector = ObjectSelector()
+        self.selector = ObjectSelector(self.completions)
         self.selector_shortcut = QShortcut(QKeySequence("Ctrl+s"), self)
         self.selector_shortcut.setContext(
             QtCore.Qt.ShortcutContext.ApplicationShortcut)
@@ -0,0 +1,138 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Action resolution.
+#
+# Performing an action on an object needs the tool (or lens) for the
+# object's type and the action.  Tools register for a type and the
+# actions they support, and a tool for a type also handles its
+# subtypes, unless a more specific tool is registered: the tool for a
+# (type, action) is the one registered for the type itself, or else for
+# its nearest supertype, working outwards through the conformance graph
+# a level at a time.  Ties, between tools for the same type, or for
+# supertypes at the same distance, are broken by name, and UTI, so the
+# result doesn't depend on the order of registration.
+#
+# Registrations are indexed by (type, action), and by action the types
+# with a tool for it, so that a type with no tool for an action among
+# its supertypes is dismissed by one set intersection.  Resolutions are
+# cached until the next change to the types or tools, when the
+# generation number is also advanced, for clients' caches (see
+# darq.services.type).
+
+from typing import Iterable, Optional
+
+from conformance import ConformanceGraph
+
+
+class ActionResolver:
+    """Index of tool registrations, by type and action."""
+
+    def __init__(self, graph: ConformanceGraph):
+        """Constructor.
+
+        :param graph: Type conformance graph."""
+
+        self.graph = graph
+
+        # Tools, by name.
+        self.tools: dict[str, dict] = {}
+
+        # Names of the tools for each (UTI, action), sorted.
+        self.handlers: dict[tuple, list] = {}
+
+        # UTIs with tools for each action.
+        self.types_by_action: dict[str, set] = {}
+
+        # Resolved tool names (or None), by (UTI, action).
+        self.resolved: dict[tuple, Optional[str]] = {}
+
+        # Incremented on every change affecting resolutions.
+        self.generation: int = 0
+        return
+
+    def load(self, tools: Iterable[dict]):
+        """Replace the registered tools."""
+
+        self.tools.clear()
+        self.handlers.clear()
+        self.types_by_action.clear()
+        for tool in tools:
+            self.add_tool(tool)
+        self.invalidate()
+        return
+
+    def add_tool(self, tool: dict):
+        """Register a tool, replacing any with the same name."""
+
+        self.remove_tool(tool["name"])
+        self.tools[tool["name"]] = tool
+        for action in tool["actions"]:
+            names = self.handlers.setdefault((tool["uti"], action), [])
+            names.append(tool["name"])
+            names.sort()
+            self.types_by_action.setdefault(action, set()).add(tool["uti"])
+        self.invalidate()
+        return
+
+    def remove_tool(self, name: str) -> bool:
+        """Deregister a tool.
+
+        :returns: True if it was registered."""
+
+        tool = self.tools.pop(name, None)
+        if tool is None:
+            return False
+
+        for action in tool["actions"]:
+            key = (tool["uti"], action)
+            self.handlers[key].remove(name)
+            if not self.handlers[key]:
+                del self.handlers[key]
+                self.types_by_action[action].discard(tool["uti"])
+        self.invalidate()
+        return True
+
+    def invalidate(self):
+        """Discard cached resolutions, after a change to the types or
+        tools."""
+
+        self.resolved.clear()
+        self.generation += 1
+        return
+
+    def resolve(self, uti: str, action: str) -> Optional[dict]:
+        """Return the tool for an action on a type, or None."""
+
+        key = (uti, action)
+        if key not in self.resolved:
+            self.resolved[key] = self.search(uti, action)
+
+        name = self.resolved[key]
+        return None if name is None else self.tools[name]
+
+    def search(self, uti: str, action: str) -> Optional[str]:
+        """(Internal) Find the name of the tool for an action on a type."""
+
+        candidates = self.types_by_action.get(action)
+        if not candidates:
+            return None
+        supertypes = self.graph.supertypes.get(uti, {uti})
+        if supertypes.isdisjoint(candidates):
+            return None
+
+        level, seen = [uti], {uti}
+        while level:
+            for t in sorted(level):
+                names = self.handlers.get((t, action))
+                if names:
+                    return names[0]
+
+            parents = []
+            for t in level:
+                for parent in self.graph.parents.get(t, ()):
+                    if parent not in seen:
+                        seen.add(parent)
+                        parents.append(parent)
+            level = parents
+        return None
@@ -0,0 +1,176 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Type conformance graph.
+#
+# Types conform to zero or more parent types, forming a directed
+# acyclic graph.  Finding a lens or tool for an object asks whether its
+# type conforms to others, so rather than walking the graph for each
+# question, the graph keeps its transitive closure: for each type, the
+# set of types it conforms to (its supertypes, including itself), and
+# the set of types conforming to it (its subtypes, also including
+# itself).  Conformance is then a single set lookup, and a type's
+# subtypes are enumerated directly.
+#
+# Type hierarchies are shallow, so a type has few supertypes, and the
+# closure's size is roughly the number of types times the hierarchy's
+# depth.  Python sets of UTIs are both smaller, at that density, and
+# faster to probe than bitsets held in (arbitrary length) integers.
+#
+# Changing a type's parents changes only the supertypes of it and its
+# subtypes: they're recomputed, parents first, from their parents'
+# supertypes, which are unaffected, and the subtype sets of the
+# supertypes lost and gained are updated to match.  Adding a parent
+# that is already a subtype would make a cycle, and is refused.
+#
+# A type named as a parent needn't be registered (yet): it's a node in
+# the graph like any other, without parents of its own.
+
+from typing import Iterable
+
+
+class ConformanceGraph:
+    """Type conformance, with its transitive closure."""
+
+    def __init__(self):
+        """Constructor."""
+
+        # Direct parents, by UTI.
+        self.parents: dict[str, tuple] = {}
+
+        # Direct children, by UTI.
+        self.children: dict[str, set] = {}
+
+        # Types conformed to, including the type itself, by UTI.
+        self.supertypes: dict[str, set] = {}
+
+        # Types conforming, including the type itself, by UTI.
+        self.subtypes: dict[str, set] = {}
+        return
+
+    def __len__(self) -> int:
+        return len(self.parents)
+
+    def __contains__(self, uti: str) -> bool:
+        return uti in self.parents
+
+    def load(self, types: Iterable[tuple]):
+        """Replace the graph.
+
+        :param types: Iterable of (UTI, parent UTIs), in any order.
+        :raises ValueError: if the types' conformance has a cycle."""
+
+        self.__init__()
+        for uti, parents in types:
+            self.node(uti)
+            self.parents[uti] = tuple(dict.fromkeys(parents))
+            for parent in self.parents[uti]:
+                self.node(parent)
+                self.children[parent].add(uti)
+
+        # Compute supertypes, each after those of its parents, and
+        # subtypes from them.
+        pending = {t: len(parents) for t, parents in self.parents.items()}
+        ready = [t for t, count in pending.items() if count == 0]
+        while ready:
+            t = ready.pop()
+            supertypes = self.supertypes[t]
+            for parent in self.parents[t]:
+                supertypes |= self.supertypes[parent]
+            for supertype in supertypes:
+                if supertype != t:
+                    self.subtypes[supertype].add(t)
+
+            for child in self.children[t]:
+                pending[child] -= 1
+                if pending[child] == 0:
+                    ready.append(child)
+
+        cycle = sorted(t for t, count in pending.items() if count > 0)
+        if cycle:
+            raise ValueError(f"Conformance cycle among {', '.join(cycle)}")
+        return
+
+    def node(self, uti: str):
+        """(Internal) Add a type, without parents, if not present."""
+
+        if uti not in self.parents:
+            self.parents[uti] = ()
+            self.children[uti] = set()
+            self.supertypes[uti] = {uti}
+            self.subtypes[uti] = {uti}
+        return
+
+    def set_parents(self, uti: str, parents: Iterable[str]):
+        """Set the types a type directly conforms to.
+
+        :param uti: Type's UTI; added if not present.
+        :param parents: Parents' UTIs; any not present are added.
+        :raises ValueError: if a parent conforms to the type."""
+
+        self.node(uti)
+        parents = tuple(dict.fromkeys(parents))
+        affected = set(self.subtypes[uti])
+        for parent in parents:
+            if parent in affected:
+                raise ValueError(f"Type {uti} cannot conform to {parent}, "
+                                 f"which conforms to it")
+
+        for parent in self.parents[uti]:
+            self.children[parent].discard(uti)
+        for parent in parents:
+            self.node(parent)
+            self.children[parent].add(uti)
+        self.parents[uti] = parents
+
+        # Recompute the supertypes of the type and its subtypes, each
+        # after those of its parents.
+        pending = {t: sum(p in affected for p in self.parents[t]) for t in affected}
+        ready = [t for t, count in pending.items() if count == 0]
+        while ready:
+            t = ready.pop()
+            supertypes = {t}
+            for parent in self.parents[t]:
+                supertypes |= self.supertypes[parent]
+            old = self.supertypes[t]
+            for lost in old - supertypes:
+                self.subtypes[lost].discard(t)
+            for gained in supertypes - old:
+                self.subtypes[gained].add(t)
+            self.supertypes[t] = supertypes
+
+            for child in self.children[t]:
+                pending[child] -= 1
+                if pending[child] == 0:
+                    ready.append(child)
+        return
+
+    def remove(self, uti: str):
+        """Remove a type's parents, and the type itself, unless it is
+        some other type's parent."""
+
+        if uti not in self.parents:
+            return
+        self.set_parents(uti, ())
+        if not self.children[uti]:
+            del self.parents[uti]
+            del self.children[uti]
+            del self.supertypes[uti]
+            del self.subtypes[uti]
+        return
+
+    def conforms(self, uti: str, parent: str) -> bool:
+        """Return True if a type is, or conforms to, another."""
+
+        supertypes = self.supertypes.get(uti)
+        return uti == parent if supertypes is None else parent in supertypes
+
+    def all_supertypes(self, uti: str) -> set:
+        """Return the UTIs of all types a type conforms to."""
+
+        return self.supertypes.get(uti, {uti}) - {uti}
+
+    def all_subtypes(self, uti: str) -> set:
+        """Return the UTIs of all types conforming to a type."""
+
+        return self.subtypes.get(uti, {uti}) - {uti}
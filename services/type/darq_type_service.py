@@ -1,16 +1,23 @@
 # darqos
-# Copyright (C) 2022-2023 David Arnold
+# Copyright (C) 2022-2024 David Arnold
 
 from darq.services import storage
-from darq.runtime.type import Type
 
-import orjson
+import argparse
+import logging
 import os
+import shutil
 import sys
+import tempfile
+
+from typing import Iterable, List
 
 import darq
 
-KEY = "darq.typeservice.db"
+from actions import ActionResolver
+from conformance import ConformanceGraph
+from database import TypeDatabase
+from pool import DEFAULT_SIZE, WarmPool
 
 
 # FIXME: clarify relationship between this and darq.runtime.type.Type
@@ -25,6 +32,7 @@ class TypeDefinition:
         self.name = ''
         self.description = ''
         self.implementation = ''
+        self.conforms_to: List[str] = []
         return
 
     def get_uti(self) -> str:
@@ -43,63 +51,136 @@ class TypeDefinition:
         """Return the storage URL for the type implementation."""
         return self.implementation
 
+    def get_conformed_types(self) -> List[str]:
+        """Return the UTIs of the types to which this type conforms."""
+        return self.conforms_to
+
     @staticmethod
     def from_dict(d):
         """Create a type description from a dictionary."""
         td = TypeDefinition()
         td.uti = d.get("uti")
-        td.name = d.get("name")
-        td.description = d.get("description")
-        td.implementation = d.get("implementation")
+        td.name = d.get("name") or ""
+        td.description = d.get("description") or ""
+        td.implementation = d.get("implementation") or ""
+        td.conforms_to = list(d.get("conforms_to") or [])
         return td
 
+    def to_dict(self) -> dict:
+        """Return a dictionary describing this type."""
+        return {"uti": self.uti,
+                "name": self.name,
+                "description": self.description,
+                "implementation": self.implementation,
+                "conforms_to": self.conforms_to}
+
 
 class TypeService(darq.Service):
+    """The registry of types known to the system.
 
-    def __init__(self):
-        """Constructor."""
+    Types are kept in an SQLite database (see database.py), indexed by
+    UTI, by short name, and by the types they conform to, and each
+    registration writes only the types it registers.  The conformance
+    graph, with its transitive closure, is held in memory (see
+    conformance.py), as is the index of tools by type and action (see
+    actions.py).
+
+    Clients caching resolutions watch for changes: each change to the
+    types or tools sends watchers the new generation number.
+
+    Type implementations are run by a pool of pre-started worker
+    processes (see pool.py)."""
+
+    def __init__(self, file: str = None, pool_size: int = DEFAULT_SIZE,
+                 preload: Iterable[str] = None):
+        """Constructor.
+
+        :param file: Database file name.
+        :param pool_size: Number of warm implementation processes.
+        :param preload: Modules imported by implementation processes
+        while warming up; default, pool.DEFAULT_PRELOAD."""
 
-        # FIXME: use fixed port number for now.  What to do here?
         darq.init_callbacks(darq.SelectEventLoop(), self)
 
-        darq.log(darq.Facility.SERVICE, darq.Level.INFO,
-                 "Starting Type service.")
+        logging.info("Starting Type service.")
 
-        super().__init__()
+        super().__init__(11006)
 
-        # Look up database.
-        self._db = {}
+        # The registry was previously a single Storage value, rewritten
+        # on every change, but it could never be written (its types
+        # weren't serialisable), so there's nothing to bring across.
+        self.db = TypeDatabase(file or "types.sqlite")
         self._storage = storage.api()
-        buf = self._storage.get(KEY)
 
-        if len(buf) > 0:
-            typedefs = orjson.loads(buf)
-            for type_data in typedefs:
-                typedef = TypeDefinition.from_dict(type_data)
-                self._db[typedef.get_uti()] = typedef
+        self.graph = ConformanceGraph()
+        self.graph.load((d["uti"], d["conforms_to"]) for d in self.db.all_types())
+
+        self.resolver = ActionResolver(self.graph)
+        self.resolver.load(self.db.all_tools())
+
+        # Change notification subscribers, by client port.
+        self.watchers: dict[int, darq.Subscriber] = {}
 
         darq.open_port(self.port)
+
+        # Implementations are copied from Storage to this private
+        # directory to be run.
+        self.implementations = tempfile.mkdtemp(prefix="darq-types-")
+        self.pool = WarmPool(pool_size, preload)
+        self.pool.start()
         return
 
+    def run(self):
+        return darq.loop().run()
+
     @staticmethod
     def get_name() -> str:
         """Return the service name."""
         return "type"
 
-    def persist(self):
-        """Save in-memory database to persistent storage."""
+    @staticmethod
+    def check_type(d: dict) -> dict:
+        """Check a type dictionary from a request.
 
-        buf = orjson.dumps(self._db.items())
-        self._storage.set(KEY, buf)
-        return
+        :raises ValueError: if it's malformed."""
 
-    def register(self, uti: str, name: str, description: str, url: str):
+        if not isinstance(d, dict) or not isinstance(d.get("uti"), str) or not d["uti"]:
+            raise ValueError(f"Malformed type: {d!r}")
+        conforms_to = d.get("conforms_to") or []
+        if not isinstance(conforms_to, list) or \
+                not all(isinstance(parent, str) for parent in conforms_to):
+            raise ValueError(f"Malformed conformance for {d['uti']}: {conforms_to!r}")
+        if d["uti"] in conforms_to:
+            raise ValueError(f"Type {d['uti']} cannot conform to itself")
+        return d
+
+    @staticmethod
+    def check_tool(d: dict) -> dict:
+        """Check a tool dictionary from a request.
+
+        :raises ValueError: if it's malformed."""
+
+        if not isinstance(d, dict) or \
+                not all(isinstance(d.get(k), str) and d[k] for k in ("name", "uti")):
+            raise ValueError(f"Malformed tool: {d!r}")
+        actions = d.get("actions")
+        if not isinstance(actions, list) or \
+                not all(isinstance(action, str) for action in actions):
+            raise ValueError(f"Malformed actions for {d['name']}: {actions!r}")
+        return {"name": d["name"],
+                "uti": d["uti"],
+                "actions": list(dict.fromkeys(actions)),
+                "implementation": d.get("implementation") or ""}
+
+    def register(self, uti: str, name: str, description: str = "",
+                 url: str = "", conforms_to: Iterable[str] = ()):
         """Register the factory implementation for a type.
 
-        :param uti:
-        :param name:
-        :param description:
-        :param url: Storage URL for type implementation"""
+        :param uti: Uniform Type Identifier.
+        :param name: Short, user-visible name.
+        :param description: Description of the type.
+        :param url: Storage URL for type implementation.
+        :param conforms_to: UTIs of the types this type conforms to."""
 
         td = TypeDefinition()
         td.uti = uti
@@ -108,40 +189,124 @@ class TypeService(darq.Service):
 
         # FIXME: should this be a host OS path, for now?
         td.implementation = url
+        td.conforms_to = list(conforms_to)
 
-        self._db[uti] = td
-        self.persist()
+        self.register_many([td])
         return
 
-    def deregister(self, uti: str):
-        """Deregister the factory implementation for a type."""
+    def register_many(self, types: Iterable[TypeDefinition]) -> int:
+        """Register many types, in a single transaction.
+
+        :returns: Number of types registered.
+        :raises ValueError: if a type would conform to itself."""
+
+        types = list(types)
+        try:
+            for td in types:
+                self.graph.set_parents(td.uti, td.conforms_to)
+        except ValueError:
+            # Undo the types already applied.
+            self.graph.load((d["uti"], d["conforms_to"]) for d in self.db.all_types())
+            raise
+
+        count = self.db.register_types(td.to_dict() for td in types)
+        logging.debug(f"Registered {count} types")
+        self.changed()
+        return count
+
+    def deregister(self, uti: str) -> bool:
+        """Deregister the factory implementation for a type.
+
+        :returns: True if the type was registered."""
 
-        del self._db[uti]
-        self.persist()
+        self.graph.remove(uti)
+        deregistered = self.db.deregister_type(uti)
+        self.changed()
+        return deregistered
+
+    def register_tool(self, tool: dict):
+        """Register a tool (or lens), replacing any with the same name.
+
+        :param tool: Tool dictionary: name, uti, actions, and
+        implementation."""
+
+        self.db.register_tool(tool)
+        self.resolver.add_tool(tool)
+        self.changed()
         return
 
-    def create(self, uti: str):
-        """Create a new instance of a type."""
+    def deregister_tool(self, name: str) -> bool:
+        """Deregister a tool.
 
-        td = self._db.get(uti)
-        if td is None:
-            raise KeyError("No such type")
+        :returns: True if it was registered."""
 
-        buf = self._storage.get(td.implementation)
+        self.db.deregister_tool(name)
+        deregistered = self.resolver.remove_tool(name)
+        self.changed()
+        return deregistered
 
-        path = f"/tmp/{td.uti}"
-        f = open(path)
-        f.write(buf)
-        f.close()
+    def changed(self):
+        """Discard cached resolutions, and notify watchers."""
 
-        # FIXME: timing attach here: overwrite temporary file, given known name.
+        self.resolver.invalidate()
+        for subscriber in self.watchers.values():
+            subscriber.post({"generation": self.resolver.generation},
+                            key="generation")
+        return
 
-        pid = os.fork()
-        if pid == 0:
-            os.execv("python", [path])
+    def watch(self, port: int):
+        """Notify a port of changes to the types or tools."""
 
+        logging.debug(f"watch({port})")
+        if port not in self.watchers:
+            self.watchers[port] = darq.Subscriber(self, port, "changed")
         return
 
+    def unwatch(self, port: int):
+        """Stop notifying a port of changes."""
+
+        logging.debug(f"unwatch({port})")
+        subscriber = self.watchers.pop(port, None)
+        if subscriber is not None:
+            subscriber.cancel()
+            subscriber.flush()
+        return
+
+    def get(self, uti: str):
+        """Return a type's definition, or None if not registered."""
+
+        d = self.db.get_type(uti)
+        return None if d is None else TypeDefinition.from_dict(d)
+
+    def create(self, uti: str) -> tuple[int, bool]:
+        """Create a new instance of a type.
+
+        :returns: (process identifier of the type implementation, True
+        if it was started by a warm worker)."""
+
+        td = self.get(uti)
+        if td is None:
+            raise KeyError("No such type")
+
+        path = self.implementation_path(td)
+        return self.pool.run(path, [uti])
+
+    def implementation_path(self, td: TypeDefinition) -> str:
+        """Return the file name of a copy of a type's implementation."""
+
+        buf, version = self._storage.get_versioned(td.implementation)
+        if version == 0:
+            raise ValueError(f"No implementation for {td.uti}")
+
+        # Named by version, so an updated implementation is copied
+        # afresh, but an unchanged one only once.
+        path = os.path.join(self.implementations, f"{td.uti}-{version}.py")
+        if not os.path.exists(path):
+            with open(path + ".tmp", "wb") as f:
+                f.write(buf)
+            os.rename(path + ".tmp", path)
+        return path
+
     def open(self, object_id: str):
         """Open an existing instance of a type."""
 
@@ -149,118 +314,236 @@ class TypeService(darq.Service):
 
         pass
 
-    def handle_request(self, request: dict):
+    def handle_request(self, reply_port: int, request: dict):
 
         method = request.get("method")
-        if method == "register":
-            self.register()
-
-        elif method == "deregister":
-            self.deregister()
+        try:
+            if method == "register":
+                td = TypeDefinition.from_dict(self.check_type(request))
+                self.register_many([td])
+                self.send_reply(reply_port, request, result=True)
+
+            elif method == "register_many":
+                types = [TypeDefinition.from_dict(self.check_type(d))
+                         for d in request["types"]]
+                count = self.register_many(types)
+                self.send_reply(reply_port, request, result=True, count=count)
+
+            elif method == "deregister":
+                deregistered = self.deregister(request["uti"])
+                self.send_reply(reply_port, request, result=deregistered)
+
+            elif method == "get":
+                d = self.db.get_type(request["uti"])
+                self.send_reply(reply_port, request, result=d is not None, type=d)
+
+            elif method == "find":
+                types = self.db.find_by_name(request["name"])
+                self.send_reply(reply_port, request, result=True, types=types)
+
+            elif method == "subtypes":
+                subtypes = self.db.children(request["uti"])
+                self.send_reply(reply_port, request, result=True, types=subtypes)
+
+            elif method == "all_subtypes":
+                subtypes = sorted(self.graph.all_subtypes(request["uti"]))
+                self.send_reply(reply_port, request, result=True, types=subtypes)
+
+            elif method == "supertypes":
+                supertypes = sorted(self.graph.all_supertypes(request["uti"]))
+                self.send_reply(reply_port, request, result=True, types=supertypes)
+
+            elif method == "conforms":
+                conforms = self.graph.conforms(request["uti"], request["parent"])
+                self.send_reply(reply_port, request, result=conforms)
+
+            elif method == "register_tool":
+                self.register_tool(self.check_tool(request))
+                self.send_reply(reply_port, request, result=True)
+
+            elif method == "deregister_tool":
+                deregistered = self.deregister_tool(request["name"])
+                self.send_reply(reply_port, request, result=deregistered)
+
+            elif method == "resolve":
+                tool = self.resolver.resolve(request["uti"], request["action"])
+                self.send_reply(reply_port, request, result=tool is not None,
+                                tool=tool, generation=self.resolver.generation)
+
+            elif method == "tools":
+                self.send_reply(reply_port, request, result=True,
+                                tools=list(self.resolver.tools.values()))
+
+            elif method == "watch":
+                self.watch(reply_port)
+                self.send_reply(reply_port, request, result=True,
+                                generation=self.resolver.generation)
+
+            elif method == "unwatch":
+                self.unwatch(reply_port)
+                self.send_reply(reply_port, request, result=True)
+
+            elif method == "list":
+                self.send_reply(reply_port, request, result=True,
+                                types=self.db.all_types())
+
+            elif method == "create":
+                pid, warm = self.create(request["uti"])
+                self.send_reply(reply_port, request, result=True, pid=pid, warm=warm)
+
+            elif method == "stats":
+                self.send_reply(reply_port, request, result=True,
+                                stats={"types": self.db.count(),
+                                       "tools": len(self.resolver.tools),
+                                       "pool": self.pool.stats()})
+
+            elif method == "open":
+                self.open(request["object_id"])
+                self.send_reply(reply_port, request, result=True)
+
+            else:
+                super().handle_request(reply_port, request)
+
+        except (KeyError, ValueError) as e:
+            logging.debug(f"Rejected {method} request: {e}")
+            self.send_reply(reply_port, request, result=False,
+                            description=str(e))
+        return
 
-        elif method == "create":
-            self.create()
+    def handle_shutdown(self):
+        for subscriber in self.watchers.values():
+            subscriber.cancel()
+        self.pool.close()
+        shutil.rmtree(self.implementations, ignore_errors=True)
+        self.db.close()
 
-        elif method == "open":
-            self.open()
+        super().handle_shutdown()
 
-        else:
-            super().handle_request(request)
+        logging.info("Type Service shutdown handled successfully.")
         return
 
-    def handle_shutdown(self):
-        darq.log(darq.Facility.SERVICE, darq.Level.INFO,
-                 "Type Service handled shutdown request.")
-        return
+
+# The 'hard-wired' types: (UTI, name, UTIs of types conformed to).
+# FIXME: add implementations of useful types here
+# FIXME: add any DarqOS-specific types here too
+BUILTIN_TYPES = [
+    ("public.item", "Item", []),
+    ("public.content", "Content", []),
+    ("public.composite-content", "Composite Content", ["public.content"]),
+    ("public.data", "Data", ["public.item"]),
+    ("public.database", "Database", ["public.item"]),
+    ("public.calendar-event", "Calendar Event", ["public.item"]),
+    ("public.message", "Message", ["public.item"]),
+    ("public.presentation", "Presentation", ["public.composite-content"]),
+    ("public.contact", "Contact", ["public.item"]),
+    ("public.archive", "Archive", ["public.data"]),
+    ("public.disk-image", "Disk Image", ["public.archive"]),
+    ("public.text", "Text", ["public.data", "public.content"]),
+    ("public.plain-text", "Plain Text", ["public.text"]),
+    ("public.utf8-plain-text", "UTF-8 Text", ["public.plain-text"]),
+    ("public.utf16-external-plain-text", "UTF-16 Text with BOM", ["public.plain-text"]),
+    ("public.utf16-plain-text", "UTF-16 Text LE", ["public.plain-text"]),
+    ("public.rtf", "Rich Text (RTF)", ["public.text"]),
+    ("public.html", "HTML", ["public.text"]),
+    ("public.xml", "XML", ["public.text"]),
+    ("public.source-code", "Source Code", ["public.plain-text"]),
+    ("public.c-source", "C Source Code", ["public.source-code"]),
+    ("public.objective-c-source", "ObjC Source Code", ["public.source-code"]),
+    ("public.c-plus-plus-source", "C++ Source Code", ["public.source-code"]),
+    ("public.objective-c-plus-plus-source-code", "ObjC++ Source Code", ["public.source-code"]),
+    ("public.c-header", "C Header", ["public.source-code"]),
+    ("public.c-plus-plus-header", "C++ Header", ["public.source-code"]),
+    ("com.sun.java-source", "Java Source Code", ["public.source-code"]),
+    ("public.script", "Script", ["public.source-code"]),
+    ("public.assembly-source", "Assembly Source Code", ["public.source-code"]),
+    ("com.netscape.javascript-source", "JavaScript Source Code", ["public.script"]),
+    ("public.shell-script", "Shell Script", ["public.script"]),
+    ("public.csh-script", "C-Shell Script", ["public.shell-script"]),
+    ("public.perl-script", "PERL Script", ["public.script"]),
+    ("public.python-script", "Python Script", ["public.script"]),
+    ("public.ruby-script", "Ruby Script", ["public.script"]),
+    ("public.php-script", "PHP Script", ["public.script"]),
+    ("com.sun.java-web-start", "Java Web Start", ["public.xml"]),
+    ("com.apple.applescript.text", "AppleScript Text", ["public.script"]),
+    ("com.apple.applescript.script", "AppleScript", ["public.data"]),
+    ("public.object-code", "Object Code", ["public.data"]),
+    ("com.apple.mach-o-binary", "Mach-O Binary", ["public.data"]),
+    ("com.apple.pef-binary", "PEF (CFM-based) Binary", ["public.data"]),
+    ("com.microsoft.windows-executable", "Microsoft Windows Application", ["public.data"]),
+    ("com.microsoft.windows-dynamic-link-library", "Microsoft Dynamic Link Library", ["public.data"]),
+    ("com.sun.java-class", "Java Class", ["public.data"]),
+    ("com.sun.java-archive", "Java Archive", ["public.archive"]),
+    ("com.apple.quartz-composer-composition", "Quartz Composer Composition", ["public.data"]),
+    ("org.gnu.gnu-tar-archive", "GNU tar Archive", ["public.archive"]),
+    ("public.tar-archive", "tar Archive", ["org.gnu.gnu-tar-archive"]),
+    ("org.gnu.gnu-zip-archive", "Gzip Archive", ["public.archive"]),
+    ("org.gnu.gnu-zip-tar-archive", "Gzip tar Archive", ["org.gnu.gnu-zip-archive"]),
+    ("com.apple.binhex-archive", "BinHex Archive", ["public.archive"]),
+    ("com.apple.macbinary-archive", "MacBinary Archive", ["public.archive"]),
+    ("public.url", "Uniform Resource Locator", ["public.data"]),
+    ("public.file-url", "File URL", ["public.url"]),
+    ("public.url-name", "URL Name", ["public.utf8-plain-text"]),
+    ("public.vcard", "vCard", ["public.text", "public.contact"]),
+    ("public.image", "Image", ["public.data", "public.content"]),
+    ("public.fax", "Fax", ["public.image"]),
+    ("public.jpeg", "JPEG Image", ["public.image"]),
+    ("public.jpeg-2000", "JPEG-2000 Image", ["public.image"]),
+    ("public.tiff", "TIFF Image", ["public.image"]),
+    ("public.camera-raw-image", "Base type for RAW images", ["public.image"]),
+    ("com.apple.pict", "PICT Image", ["public.image"]),
+    ("com.apple.macpaint-image", "MacPaint Image", ["public.image"]),
+    ("public.png", "PNG Image", ["public.image"]),
+    ("public.xbitmap-image", "XBM Image", ["public.image"]),
+    ("com.apple.quicktime-image", "QuickTime Image", ["public.image"]),
+    ("com.apple.icns", "macOS Icon Image", ["public.image"]),
+]
 
 
 def initialize(service: TypeService):
-    """Populate the 'hard-wired' types."""
-
-    reg = service.register
-
-    # FIXME: add implementations of useful types here
-    # FIXME: add any DarqOS-specific types here too
-
-    t = reg("public.item", "Item")
-    t = reg("public.content", "Content")
-    t = reg("public.composite-content", "Composite Content")
-    t = reg("public.data", "Data")
-    t = reg("public.database", "Database")
-    t = reg("public.calendar-event", "Calendar Event")
-    t = reg("public.message", "Message")
-    t = reg("public.presentation")
-    t = reg("public.contact", "Contact")
-    t = reg("public.archive", "Archive")
-    t = reg("public.disk-image", "Disk Image")
-    t = reg("public.text", "Text")
-    t = reg("public.plain-text", "Plain Text")
-    t = reg("public.utf8-plain-text", "UTF-8 Text")
-    t = reg("public.utf16-external-plain-text", "UTF-16 Text with BOM")
-    t = reg("public.utf16-plain-text", "UTF-16 Text LE")
-    t = reg("public.rtf", "Rich Text (RTF)")
-    t = reg("public.html", "HTML")
-    t = reg("public.xml", "XML")
-    t = reg("public.source-code", "Source Code")
-    t = reg("public.c-source", "C Source Code")
-    t = reg("public.objective-c-source", "ObjC Source Code")
-    t = reg("public.c-plus-plus-source", "C++ SOurce Code")
-    t = reg("public.objective-c-plus-plus-source-code", "ObjC++ Source Code")
-    t = reg("public.c-header", "C Header")
-    t = reg("public.c-plus-plus-header", "C++ Header")
-    t = reg("com.sun.java-source", "Java Source Code")
-    t = reg("public.script", "Script")
-    t = reg("public.assembly-source", "Assembly Source Code")
-    t = reg("com.netscape.javascript-source", "JavaScript Source Code")
-    t = reg("public.shell-script", "Shell Script")
-    t = reg("public.csh-script", "C-Shell Script")
-    t = reg("public.perl-script", "PERL Script")
-    t = reg("public.python-script", "Python Script")
-    t = reg("public.ruby-script", "Ruby Script")
-    t = reg("public.php-script", "PHP Script")
-    t = reg("com.sun.java-web-start", "Java Web Start")
-    t = reg("com.apple.applescript.text", "AppleScript Text")
-    t = reg("com.apple.applescript.script", "AppleScript")
-    t = reg("public.object-code", "Object Code")
-    t = reg("com.apple.mach-o-binary", "Mach-O Binary")
-    t = reg("com.apple.pef-binary", "PEF (CFM-based) Binary")
-    t = reg("com.microsoft.windows-executable", "Microsoft Windows Application")
-    t = reg("com.microsoft.windows-dynamic-link-library", "Microsoft Dynamic Link Library")
-    t = reg("com.sun.java-class", "Java Class")
-    t = reg("com.sun.java-archive", "Java Archive")
-    t = reg("com.apple.quartz-composer-composition", "Quartz Composer Composition")
-    t = reg("org.gnu.gnu-tar-archive", "GNU tar Archive")
-    t = reg("public.tar-archive", "tar Archive")
-    t = reg("org.gnu.gnu-zip-archive", "gip Archive")
-    t = reg("org.gnu.gnu-zip-tar-archive", "Gzip tar Archive")
-    t = reg("com.apple.binhex-archive", "BinHex Archive")
-    t = reg("com.apple.macbinary-archive", "MacBinary Archive")
-    t = reg("public.url", "Uniform Resource Locator")
-    t = reg("public.file-url", "File URL")
-    t = reg("public.url-name", "URL Name")
-    t = reg("public.vcard", "vCard")
-    t = reg("public.image", "Image")
-    t = reg("public.fax", "Fax")
-    t = reg("public.jpeg", "JPEG Image")
-    t = reg("public.jpeg-2000", "JPEG-2000 Image")
-    t = reg("public.tiff", "TIFF Image")
-    t = reg("public.camera-raw-image", "Base type for RAW images")
-    t = reg("com.apple.pict", "PICT Image")
-    t = reg("com.apple.macpaint-image", "MacPaint Image")
-    t = reg("public.png", "PNG Image")
-    t = reg("public.xbitmap-image", "XBM Image")
-    t = reg("com.apple.quicktime-image", "QuickTime Image")
-    t = reg("com.apple.icns", "macOS Icon Image")
+    """Populate the 'hard-wired' types, in a single transaction."""
 
+    types = []
+    for uti, name, conforms_to in BUILTIN_TYPES:
+        td = TypeDefinition()
+        td.uti = uti
+        td.name = name
+        td.conforms_to = conforms_to
+        types.append(td)
+
+    service.register_many(types)
     return
 
 
 def main():
-    service = TypeService()
-    #initialize(service)
+    parser = argparse.ArgumentParser(description="Type service")
+    parser.add_argument("--path", help="type database file")
+    parser.add_argument("--pool-size", type=int, default=DEFAULT_SIZE,
+                        help="warm type implementation processes kept ready "
+                             "(0 starts every implementation cold)")
+    parser.add_argument("--preload", action="append", metavar="MODULE",
+                        help="module imported by implementation processes "
+                             "while warming up (repeatable; default PyQt5.QtWidgets)")
+    args = parser.parse_args()
+
+    service = TypeService(args.path, args.pool_size, args.preload)
+    if service.db.count() == 0:
+        initialize(service)
     result = service.run()
+
+    logging.info("Exiting type service.")
     sys.exit(result)
 
 
 if __name__ == "__main__":
+    if os.getenv("INVOCATION_ID") is not None:
+        # Running under systemd
+        logging.basicConfig(stream=sys.stdout,
+                            format='%(levelname)8s %(message)s',
+                            level=logging.DEBUG)
+    else:
+        # Likely being run manually
+        logging.basicConfig(stream=sys.stderr,
+                            format='%(asctime)s p-Kernel %(levelname)8s %(message)s',
+                            level=logging.DEBUG)
+
     main()
@@ -0,0 +1,271 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Type registry database.
+#
+# Each registered type is a row of the types table, keyed by its UTI,
+# so registering or deregistering a type writes only that type's rows,
+# and many types can be registered in a single transaction.  An index
+# on name finds types by their short name.
+#
+# The types a type conforms to (its parents) are rows of the
+# conformance table, keyed by (type, parent).  Conformance is declared
+# by the conforming type, so a type's rows are replaced when it is
+# registered, and deleted when it is deregistered, but a parent can be
+# deregistered, or not yet registered, while its subtypes remain.  An
+# index on (parent, type) finds the types directly conforming to a
+# parent.
+#
+# Tools (and lenses) are rows of the tools table, one per type and
+# action they handle, keyed by (type, action, tool name), with an index
+# by name to replace or remove a tool's rows.
+#
+# The schema version is kept in SQLite's user_version, and older
+# databases are migrated when opened.
+
+import logging
+import sqlite3
+
+from typing import Iterable, Optional
+
+# Current schema version.
+SCHEMA_VERSION = 2
+
+
+class TypeDatabase:
+    """SQLite persistence for the Type service.
+
+    Types are exchanged as dictionaries, with keys "uti", "name",
+    "description", "implementation", and "conforms_to", a list of
+    parent UTIs.  Tools are dictionaries with keys "name", "uti",
+    "actions", a list of action names, and "implementation"."""
+
+    def __init__(self, file: str):
+        """Constructor.
+
+        :param file: Database file name."""
+
+        self.db = sqlite3.connect(file)
+        self.migrate()
+        return
+
+    def close(self):
+        """Close the database connection."""
+        self.db.close()
+        self.db = None
+        return
+
+    def migrate(self):
+        """Create the schema, or bring an existing one up to date."""
+
+        cursor = self.db.cursor()
+        cursor.execute("pragma user_version")
+        version = cursor.fetchone()[0]
+
+        if version == 0:
+            self.create_schema(cursor)
+        elif version == 1:
+            self.create_tools(cursor)
+
+        cursor.execute(f"pragma user_version = {SCHEMA_VERSION}")
+        self.db.commit()
+        return
+
+    def create_schema(self, cursor: sqlite3.Cursor):
+        """Create the current schema in an empty database."""
+
+        logging.info("Creating type database schema")
+
+        cursor.execute("create table types ("
+                       "uti text not null primary key, "
+                       "name text not null, "
+                       "description text not null, "
+                       "implementation text not null) without rowid")
+        cursor.execute("create index types_by_name on types (name)")
+
+        cursor.execute("create table conformance ("
+                       "uti text not null, "
+                       "parent text not null, "
+                       "primary key (uti, parent)) without rowid")
+        cursor.execute("create index conformance_by_parent "
+                       "on conformance (parent, uti)")
+        self.create_tools(cursor)
+        return
+
+    def create_tools(self, cursor: sqlite3.Cursor):
+        """Create the tools table (schema version 2)."""
+
+        cursor.execute("create table tools ("
+                       "uti text not null, "
+                       "action text not null, "
+                       "name text not null, "
+                       "implementation text not null, "
+                       "primary key (uti, action, name)) without rowid")
+        cursor.execute("create index tools_by_name on tools (name)")
+        return
+
+    def register_types(self, types: Iterable[dict]) -> int:
+        """Register types, replacing any existing definitions, in a
+        single transaction.
+
+        :param types: Iterable of type dictionaries.
+        :returns: Number of types registered."""
+
+        types = list(types)
+        cursor = self.db.cursor()
+        cursor.executemany("insert or replace into types "
+                           "(uti, name, description, implementation) "
+                           "values (?, ?, ?, ?)",
+                           ((t["uti"], t.get("name") or "",
+                             t.get("description") or "",
+                             t.get("implementation") or "")
+                            for t in types))
+        cursor.executemany("delete from conformance where uti = ?",
+                           ((t["uti"],) for t in types))
+        cursor.executemany("insert or ignore into conformance (uti, parent) "
+                           "values (?, ?)",
+                           ((t["uti"], parent)
+                            for t in types
+                            for parent in t.get("conforms_to") or ()))
+        self.db.commit()
+        cursor.close()
+        return len(types)
+
+    def deregister_type(self, uti: str) -> bool:
+        """Deregister a type.
+
+        :returns: True if it was registered."""
+
+        cursor = self.db.cursor()
+        cursor.execute("delete from types where uti = ?", (uti,))
+        deleted = cursor.rowcount > 0
+        cursor.execute("delete from conformance where uti = ?", (uti,))
+        self.db.commit()
+        cursor.close()
+        return deleted
+
+    def get_type(self, uti: str) -> Optional[dict]:
+        """Return a type's definition, or None if not registered."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select uti, name, description, implementation "
+                       "from types where uti = ?",
+                       (uti,))
+        row = cursor.fetchone()
+        cursor.close()
+        return None if row is None else self.make_type(row)
+
+    def find_by_name(self, name: str) -> list:
+        """Return the definitions of types with a short name."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select uti, name, description, implementation "
+                       "from types where name = ? order by uti",
+                       (name,))
+        rows = cursor.fetchall()
+        cursor.close()
+        return [self.make_type(row) for row in rows]
+
+    def parents(self, uti: str) -> list:
+        """Return the UTIs a type directly conforms to."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select parent from conformance where uti = ? "
+                       "order by parent",
+                       (uti,))
+        parents = [parent for parent, in cursor.fetchall()]
+        cursor.close()
+        return parents
+
+    def children(self, parent: str) -> list:
+        """Return the UTIs of types directly conforming to a type."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select uti from conformance where parent = ? "
+                       "order by uti",
+                       (parent,))
+        children = [uti for uti, in cursor.fetchall()]
+        cursor.close()
+        return children
+
+    def all_types(self) -> list:
+        """Return the definitions of all registered types."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select uti, parent from conformance")
+        parents = {}
+        for uti, parent in cursor.fetchall():
+            parents.setdefault(uti, []).append(parent)
+
+        cursor.execute("select uti, name, description, implementation "
+                       "from types order by uti")
+        types = [{"uti": uti,
+                  "name": name,
+                  "description": description,
+                  "implementation": implementation,
+                  "conforms_to": sorted(parents.get(uti, ()))}
+                 for uti, name, description, implementation in cursor.fetchall()]
+        cursor.close()
+        return types
+
+    def register_tool(self, tool: dict):
+        """Register a tool, replacing any existing registration."""
+
+        cursor = self.db.cursor()
+        cursor.execute("delete from tools where name = ?", (tool["name"],))
+        cursor.executemany("insert or ignore into tools "
+                           "(uti, action, name, implementation) "
+                           "values (?, ?, ?, ?)",
+                           ((tool["uti"], action, tool["name"],
+                             tool.get("implementation") or "")
+                            for action in tool["actions"]))
+        self.db.commit()
+        cursor.close()
+        return
+
+    def deregister_tool(self, name: str) -> bool:
+        """Deregister a tool.
+
+        :returns: True if it was registered."""
+
+        cursor = self.db.cursor()
+        cursor.execute("delete from tools where name = ?", (name,))
+        deleted = cursor.rowcount > 0
+        self.db.commit()
+        cursor.close()
+        return deleted
+
+    def all_tools(self) -> list:
+        """Return the registrations of all tools."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select name, uti, implementation, action from tools "
+                       "order by name, action")
+        tools = {}
+        for name, uti, implementation, action in cursor.fetchall():
+            tool = tools.setdefault(name, {"name": name,
+                                           "uti": uti,
+                                           "actions": [],
+                                           "implementation": implementation})
+            tool["actions"].append(action)
+        cursor.close()
+        return list(tools.values())
+
+    def count(self) -> int:
+        """Return the number of registered types."""
+
+        cursor = self.db.cursor()
+        cursor.execute("select count(*) from types")
+        count = cursor.fetchone()[0]
+        cursor.close()
+        return count
+
+    def make_type(self, row: tuple) -> dict:
+        """(Internal) Return a type dictionary for a types table row."""
+
+        uti, name, description, implementation = row
+        return {"uti": uti,
+                "name": name,
+                "description": description,
+                "implementation": implementation,
+                "conforms_to": self.parents(uti)}
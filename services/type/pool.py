@@ -0,0 +1,233 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Warm pool of type implementation processes.
+#
+# Starting a type implementation from scratch means starting Python,
+# and importing the darq runtime and Qt, which takes seconds on a small
+# machine, before the implementation itself runs.  Instead, the pool
+# keeps a number of worker processes (see worker.py) started ahead of
+# time, each waiting, warmed up, for an implementation to run.  Running
+# one hands it to an idle worker, and starts another to replace it.
+#
+# Each worker has a control socket: the worker says it's ready on it,
+# and is sent its job on it.  The pool watches the sockets of workers
+# it hasn't yet handed out, so a worker that dies, while warming up or
+# idle, is noticed (as end of file) and replaced.  A worker that dies
+# before it's ready is replaced only after a delay, so that a broken
+# configuration doesn't spin.
+#
+# If no worker is ready, the implementation is started cold: a new
+# worker is sent its job straight away, and runs it once it has warmed
+# up.  A pool of size zero always starts implementations cold.
+
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from typing import Iterable, Optional
+
+import orjson
+
+import darq
+
+# Default number of idle workers.
+DEFAULT_SIZE = 2
+
+# Default modules imported by workers while warming up, in addition to
+# the darq runtime.
+DEFAULT_PRELOAD = ["PyQt5.QtWidgets"]
+
+# Seconds to wait before replacing a worker that failed to start.
+RESPAWN_DELAY = 5.0
+
+# Worker script.
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+
+
+class Worker:
+    """A worker process, not yet handed out."""
+
+    def __init__(self, process: subprocess.Popen, control: socket.socket):
+        self.process = process
+        self.control = control
+        self.ready: bool = False
+        self.started: float = time.monotonic()
+        return
+
+
+class WarmPool(darq.SocketListener, darq.TimerListener):
+    """Pre-started processes for running type implementations."""
+
+    def __init__(self, size: int = DEFAULT_SIZE,
+                 preload: Optional[Iterable[str]] = None,
+                 connect: bool = True):
+        """Constructor.
+
+        :param size: Number of idle workers to keep ready.
+        :param preload: Modules imported by workers while warming up;
+        default, DEFAULT_PRELOAD.
+        :param connect: If True, workers connect to the p-Kernel while
+        warming up."""
+
+        self.size: int = size
+        self.preload: list = list(DEFAULT_PRELOAD if preload is None else preload)
+        self.connect: bool = connect
+
+        # Workers not yet handed out, by control socket.
+        self.workers: dict[socket.socket, Worker] = {}
+
+        # Processes handed out, until they exit.
+        self.running: list[subprocess.Popen] = []
+
+        # Replacement timer, if one is running.
+        self.timer_id: Optional[int] = None
+        self.closing: bool = False
+
+        # Statistics.
+        self.warm_starts: int = 0
+        self.cold_starts: int = 0
+        self.failures: int = 0
+        self.warmup_seconds: float = 0.0
+        return
+
+    def start(self):
+        """Start workers, until the pool is full."""
+
+        while len(self.workers) < self.size:
+            self.spawn(watch=True)
+        return
+
+    def close(self):
+        """Stop the idle workers."""
+
+        self.closing = True
+        if self.timer_id is not None:
+            darq.loop().cancel_timer(self.timer_id)
+            self.timer_id = None
+
+        # Closing its control socket tells a worker to exit.
+        for sock, worker in self.workers.items():
+            darq.loop().cancel_socket(sock)
+            sock.close()
+        self.workers.clear()
+        return
+
+    def spawn(self, watch: bool) -> Worker:
+        """(Internal) Start a worker process.
+
+        :param watch: If True, watch the worker's control socket."""
+
+        control, remote = socket.socketpair()
+        command = [sys.executable, WORKER, "--control", str(remote.fileno())]
+        for name in self.preload:
+            command.extend(("--preload", name))
+        if self.connect:
+            command.append("--connect")
+
+        process = subprocess.Popen(command, pass_fds=(remote.fileno(),))
+        remote.close()
+
+        worker = Worker(process, control)
+        if watch:
+            self.workers[control] = worker
+            darq.loop().add_socket(control, self)
+        return worker
+
+    def run(self, path: str, argv: Iterable[str] = ()) -> tuple[int, bool]:
+        """Run a type implementation.
+
+        :param path: Implementation file name.
+        :param argv: Implementation's arguments.
+        :returns: (process identifier, True if started warm)."""
+
+        self.reap()
+
+        worker = next((w for w in self.workers.values() if w.ready), None)
+        warm = worker is not None
+        if warm:
+            darq.loop().cancel_socket(worker.control)
+            del self.workers[worker.control]
+            self.warm_starts += 1
+        else:
+            worker = self.spawn(watch=False)
+            self.cold_starts += 1
+
+        job = {"path": path, "argv": list(argv)}
+        worker.control.sendall(orjson.dumps(job) + b"\n")
+        worker.control.close()
+        self.running.append(worker.process)
+
+        if not self.closing and self.timer_id is None:
+            self.start()
+        return worker.process.pid, warm
+
+    def reap(self):
+        """(Internal) Collect the exit status of finished processes."""
+
+        self.running = [p for p in self.running if p.poll() is None]
+        return
+
+    def on_readable(self, sock: socket.socket):
+        """Handle a worker's readiness, or exit."""
+
+        worker = self.workers.get(sock)
+        if worker is None:
+            return
+
+        try:
+            data = sock.recv(64)
+        except OSError:
+            data = b""
+
+        if data and not worker.ready:
+            worker.ready = True
+            self.warmup_seconds = time.monotonic() - worker.started
+            logging.debug(f"Type worker {worker.process.pid} ready "
+                          f"in {self.warmup_seconds:.2f}s")
+            return
+
+        # End of file: the worker has died.
+        darq.loop().cancel_socket(sock)
+        del self.workers[sock]
+        sock.close()
+        worker.process.wait()
+        if worker.ready:
+            logging.warning(f"Idle type worker {worker.process.pid} exited "
+                            f"with status {worker.process.returncode}")
+            self.start()
+        else:
+            logging.warning(f"Type worker {worker.process.pid} failed to start "
+                            f"(status {worker.process.returncode})")
+            self.failures += 1
+            if self.timer_id is None and not self.closing:
+                self.timer_id = darq.loop().add_timer(RESPAWN_DELAY, self)
+        return
+
+    def on_writeable(self, sock: socket.socket):
+        return
+
+    def on_timeout(self, timer_id: int, expiry_time: float, actual_time: float):
+        """Replace workers that failed to start."""
+
+        darq.loop().cancel_timer(self.timer_id)
+        self.timer_id = None
+        if not self.closing:
+            self.start()
+        return
+
+    def stats(self) -> dict:
+        """Return pool statistics."""
+
+        self.reap()
+        return {"size": self.size,
+                "ready": sum(w.ready for w in self.workers.values()),
+                "starting": sum(not w.ready for w in self.workers.values()),
+                "running": len(self.running),
+                "warm_starts": self.warm_starts,
+                "cold_starts": self.cold_starts,
+                "failures": self.failures,
+                "warmup_seconds": self.warmup_seconds}
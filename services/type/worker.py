@@ -0,0 +1,72 @@
+# DarqOS
+# Copyright (C) 2024 David Arnold
+
+# Type implementation worker.
+#
+# Started by the Type service's warm pool (see pool.py), a worker pays
+# the costs of starting a type implementation ahead of time: the
+# interpreter's own startup, importing the darq runtime (and with it,
+# Qt), importing any other modules configured for preloading, and
+# connecting to the p-Kernel.  It then tells the pool it's ready, on
+# its control socket, and waits there for a job: the file name of a
+# type implementation, which it runs as its __main__ module, in place
+# of the worker.
+#
+# If the control socket is closed without a job, the pool has no more
+# use for the worker, and it exits.
+
+import argparse
+import importlib
+import logging
+import runpy
+import socket
+import sys
+
+import orjson
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Type implementation worker")
+    parser.add_argument("--control", type=int, required=True,
+                        help="control socket file descriptor")
+    parser.add_argument("--preload", action="append", default=[],
+                        help="module to import while warming up")
+    parser.add_argument("--connect", action="store_true",
+                        help="connect to the p-Kernel while warming up")
+    args = parser.parse_args()
+
+    control = socket.socket(fileno=args.control)
+
+    import darq
+    for name in args.preload:
+        importlib.import_module(name)
+
+    darq.init(darq.SelectEventLoop())
+    if args.connect:
+        darq.kernel.connect()
+
+    try:
+        control.sendall(b"ready\n")
+    except OSError:
+        # A cold start: the job was sent without waiting for this.
+        pass
+
+    try:
+        line = control.makefile("rb").readline()
+    except OSError:
+        line = b""
+    control.close()
+    if not line:
+        return 0
+
+    job = orjson.loads(line)
+    sys.argv = [job["path"]] + job.get("argv", [])
+    runpy.run_path(job["path"], run_name="__main__")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr,
+                        format='%(asctime)s type-worker %(levelname)8s %(message)s',
+                        level=logging.INFO)
+    sys.exit(main())
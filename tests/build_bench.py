@@ -0,0 +1,134 @@
+#! /usr/bin/env python3
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Bulk index build benchmark.
+#
+# Builds an index of a synthetic corpus, as for index_bench.py, with the
+# parallel bulk build, using 1, 2, 4, ... workers up to the number of
+# cores, and reports the speedup over one worker.  The corpus is first
+# stored in Storage, and the workers fetch it from there, as they do
+# for the service (so the p-Kernel and Storage service must be running);
+# it's deleted again afterwards, unless --keep is given.  The index is
+# checked against one built a document at a time, as the service does.
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "index"))
+
+import darq
+
+from build import build
+from database import IndexDatabase
+
+WORDS = 50000
+
+_vocabulary = None
+
+
+def vocabulary() -> tuple[list, list]:
+    """Return words, and cumulative Zipf weights, most frequent first."""
+
+    global _vocabulary
+    if _vocabulary is None:
+        rng = random.Random(1)
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        words = list(dict.fromkeys("".join(rng.choices(letters, k=rng.randrange(3, 10)))
+                                   for _ in range(WORDS)))
+        weights = [1 / (rank + 1) ** 1.1 for rank in range(len(words))]
+        _vocabulary = words, list(itertools.accumulate(weights))
+    return _vocabulary
+
+
+def document(object_id: str) -> str:
+    """Return an object's text."""
+
+    words, weights = vocabulary()
+    rng = random.Random(object_id)
+    return " ".join(rng.choices(words, cum_weights=weights, k=rng.randrange(20, 300)))
+
+
+def store(storage, object_ids: list) -> float:
+    """Store the objects' text, if not already stored; return seconds."""
+
+    start = time.perf_counter()
+    for object_id in object_ids:
+        value = document(object_id).encode()
+        stored, version = storage.get_versioned(object_id)
+        if stored != value:
+            storage.cas(object_id, version, value)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--documents", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="most workers tried")
+    parser.add_argument("--keep", action="store_true",
+                        help="leave the corpus in Storage, for another run")
+    args = parser.parse_args()
+
+    darq.init(darq.SelectEventLoop())
+    storage = darq.storage_api()
+    object_ids = [f"build-bench-{i:08d}" for i in range(args.documents)]
+    elapsed = store(storage, object_ids)
+    print(f"stored {args.documents} objects in {elapsed:.1f}s")
+    words, _ = vocabulary()
+    queries = [words[5], words[500], words[-10], f"{words[300]} {words[700]}"]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        expected = IndexDatabase(os.path.join(tmpdir, "serial"))
+        for object_id in object_ids[:10000]:
+            expected.add(object_id, document(object_id))
+            if expected.is_full():
+                expected.flush()
+        elapsed = time.perf_counter() - start
+        print(f"serial: {10000 / elapsed:.0f} documents/s")
+
+        counts = [1]
+        while counts[-1] * 2 <= args.workers:
+            counts.append(counts[-1] * 2)
+        if counts[-1] != args.workers:
+            counts.append(args.workers)
+
+        print(f"{'workers':>8} {'tokenise':>9} {'merge':>7} {'total':>7} "
+              f"{'docs/s':>8} {'speedup':>8}")
+        baseline = None
+        for workers in counts:
+            db = IndexDatabase(os.path.join(tmpdir, f"build-{workers}"))
+            stats = build(db, object_ids, workers)
+            baseline = baseline or stats["seconds"]
+            print(f"{workers:>8} {stats['tokenise_seconds']:>8.1f}s "
+                  f"{stats['merge_seconds']:>6.1f}s {stats['seconds']:>6.1f}s "
+                  f"{args.documents / stats['seconds']:>8.0f} "
+                  f"{baseline / stats['seconds']:>7.2f}x")
+
+            # Same results as building one document at a time, over the
+            # same documents.
+            if workers == counts[0]:
+                check = IndexDatabase(os.path.join(tmpdir, "check"))
+                build(check, object_ids[:10000], workers)
+                for query in queries:
+                    assert ({o: round(s, 6) for o, s in check.search(query, 1000)} ==
+                            {o: round(s, 6) for o, s in expected.search(query, 1000)}), query
+                check.close()
+            db.close()
+        expected.close()
+
+    if not args.keep:
+        for object_id in object_ids:
+            storage.delete(object_id)
+    return
+
+
+if __name__ == "__main__":
+    main()
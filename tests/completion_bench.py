@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Completion benchmark.
+#
+# Builds a completion index of synthetic labels, of the kinds the
+# omnibox completes (type names, object labels, and knowledge base
+# entries), then simulates typing: each query is typed a character at a
+# time, and every keystroke is completed, as the terminal does.  Reports
+# the per-keystroke latency, against a linear scan of all the labels,
+# and the time budget of one frame.  The queries are then typed again,
+# with a typo, and completed fuzzily, again against a linear scan.
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from darq.services.index import COMPLETION_EDITS, CompletionIndex, completion_keys, fuzzy_edits, normalize
+
+# Per-keystroke budget: one frame at 60Hz, in milliseconds.
+FRAME = 16.7
+
+
+def labels(args) -> list:
+    """Return labels: (entry, kind, label, weight)."""
+
+    rng = random.Random(1)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = list(dict.fromkeys("".join(rng.choices(letters, k=rng.randrange(3, 10)))
+                               for _ in range(args.words)))
+    cumulative = list(itertools.accumulate(1 / (rank + 1) ** 1.1
+                                           for rank in range(len(words))))
+
+    def phrase(low: int, high: int) -> str:
+        return " ".join(rng.choices(words, cum_weights=cumulative,
+                                    k=rng.randrange(low, high))).title()
+
+    result = []
+    for i in range(args.types):
+        result.append((f"type:{i}", "type", phrase(1, 3), rng.random()))
+    for i in range(args.objects):
+        result.append((f"object:{i}", "object", phrase(2, 8), rng.random()))
+    for i in range(args.entries):
+        result.append((f"kb:{i}", "kb", phrase(1, 5), rng.random()))
+    return result
+
+
+def prefix_distance(key: str, query: str, edits: int) -> int:
+    """Return the fewest edits from the query to a prefix of key."""
+
+    previous2 = None
+    previous = list(range(len(query) + 1))
+    best = previous[-1]
+    for i in range(1, len(key) + 1):
+        row = [i] + [0] * len(query)
+        for j in range(1, len(query) + 1):
+            row[j] = min(previous[j] + 1, row[j - 1] + 1,
+                         previous[j - 1] + (key[i - 1] != query[j - 1]))
+            if i > 1 and j > 1 and key[i - 1] == query[j - 2] and key[i - 2] == query[j - 1]:
+                row[j] = min(row[j], previous2[j - 2] + 1)
+        best = min(best, row[-1])
+        if min(row) > edits:
+            break
+        previous2, previous = previous, row
+    return best
+
+
+class LinearScan:
+    """Baseline: scan every label's words for the prefix."""
+
+    def __init__(self, entries: list):
+        self.entries = [(weight, -len(label), entry, kind, label, completion_keys(label))
+                        for entry, kind, label, weight in entries]
+        return
+
+    def complete(self, prefix: str, limit: int) -> list:
+        prefix = normalize(prefix)
+        matches = [e for e in self.entries
+                   if any(key.startswith(prefix) for key in e[5])]
+        matches.sort(reverse=True)
+        return [(entry, kind, label, weight)
+                for weight, _, entry, kind, label, _ in matches[:limit]]
+
+    def complete_fuzzy(self, prefix: str, limit: int) -> list:
+        prefix = normalize(prefix)
+        edits = min(fuzzy_edits(prefix), COMPLETION_EDITS)
+        matches = []
+        for e in self.entries:
+            distance = min((prefix_distance(key, prefix, edits) for key in e[5]
+                            if key[0] == prefix[0]), default=edits + 1)
+            if distance <= edits:
+                matches.append((-distance, e))
+        matches.sort(reverse=True)
+        return [(entry, kind, label, weight)
+                for _, (weight, _, entry, kind, label, _) in matches[:limit]]
+
+
+def keystrokes(rng: random.Random, entries: list, count: int, typo: bool = False) -> list:
+    """Return typed prefixes: each query's, one character at a time."""
+
+    prefixes = []
+    for _ in range(count):
+        words = rng.choice(entries)[2].split()
+        query = " ".join(words[:rng.randrange(1, min(len(words), 2) + 1)])
+        if typo:
+            # Drop a character.
+            i = rng.randrange(len(query))
+            query = query[:i] + query[i + 1:]
+        prefixes.extend(query[:n] for n in range(1, len(query) + 1))
+    return prefixes
+
+
+def measure(complete, prefixes: list, limit: int) -> tuple:
+    """Return median, 99th percentile, and worst latency, in milliseconds."""
+
+    samples = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        complete(prefix, limit)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return (samples[len(samples) // 2] * 1000,
+            samples[len(samples) * 99 // 100] * 1000,
+            samples[-1] * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--types", type=int, default=2000)
+    parser.add_argument("--objects", type=int, default=80000)
+    parser.add_argument("--entries", type=int, default=20000)
+    parser.add_argument("--words", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    entries = labels(args)
+    rng = random.Random(2)
+    prefixes = keystrokes(rng, entries, args.queries)
+
+    start = time.perf_counter()
+    index = CompletionIndex()
+    for entry, kind, label, weight in entries:
+        index.set(entry, kind, label, weight)
+    index.warm()
+    elapsed = time.perf_counter() - start
+    print(f"{len(entries)} labels: indexed in {elapsed:.1f}s; "
+          f"{len(prefixes)} keystrokes")
+
+    scan = LinearScan(entries)
+    for prefix in prefixes[:50]:
+        assert ([e[0] for e in index.complete(prefix, args.limit)] ==
+                [e[0] for e in scan.complete(prefix, args.limit)]), prefix
+
+    print(f"{'':>12} {'median':>8} {'p99':>8} {'max':>8}  (ms; frame {FRAME})")
+    typos = keystrokes(rng, entries, args.queries, typo=True)
+    for prefix in typos[:20]:
+        assert ([e[0] for e in index.complete(prefix, args.limit, fuzzy=True)] ==
+                [e[0] for e in scan.complete_fuzzy(prefix, args.limit)]), prefix
+
+    def fuzzy(prefix: str, limit: int) -> list:
+        return index.complete(prefix, limit, fuzzy=True)
+
+    for name, complete, sample in (("index", index.complete, prefixes),
+                                   ("linear scan", scan.complete, prefixes[::20]),
+                                   ("fuzzy", fuzzy, typos),
+                                   ("fuzzy scan", scan.complete_fuzzy, typos[::100])):
+        median, p99, worst = measure(complete, sample, args.limit)
+        print(f"{name:>12} {median:>8.3f} {p99:>8.3f} {worst:>8.3f}")
+
+    start = time.perf_counter()
+    for entry, kind, label, weight in rng.sample(entries, 1000):
+        index.set(entry, kind, label + " Renamed", weight)
+    elapsed = time.perf_counter() - start
+    print(f"1000 labels changed in {elapsed * 1000:.1f}ms")
+    return
+
+
+if __name__ == "__main__":
+    main()
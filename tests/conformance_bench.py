@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Type conformance benchmark.
+#
+# Builds a synthetic conformance graph, of levels of types each
+# conforming to one to three types, mostly from the level above, and
+# times conformance tests using the graph's transitive closure against
+# walking the parents for each, which they are checked against;
+# enumerating the subtypes of the most general types; and the
+# incremental updates for registering, re-parenting and deregistering
+# types.
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "type"))
+
+from conformance import ConformanceGraph
+
+
+def hierarchy(args) -> list:
+    """Return (UTI, parent UTIs), parents before their subtypes."""
+
+    rng = random.Random(1)
+    levels = [[f"org.example.type-{i:06d}" for i in range(args.roots)]]
+    count = args.roots
+    while count < args.types:
+        size = min(len(levels[-1]) * args.fanout, args.types - count)
+        levels.append([f"org.example.type-{i:06d}" for i in range(count, count + size)])
+        count += size
+
+    types = [(uti, []) for uti in levels[0]]
+    for level in range(1, len(levels)):
+        for uti in levels[level]:
+            parents = set()
+            for _ in range(rng.choice((1, 1, 1, 2, 2, 3))):
+                # Mostly the level above, sometimes a more general one.
+                above = level - 1 if rng.random() < 0.8 else rng.randrange(level)
+                parents.add(rng.choice(levels[above]))
+            types.append((uti, sorted(parents)))
+    return types
+
+
+def walk(parents: dict, uti: str, parent: str) -> bool:
+    """Return True if a type conforms to another, by walking its parents."""
+
+    pending, seen = [uti], {uti}
+    while pending:
+        t = pending.pop()
+        if t == parent:
+            return True
+        for p in parents.get(t, ()):
+            if p not in seen:
+                seen.add(p)
+                pending.append(p)
+    return False
+
+
+def timed(function, items: list) -> float:
+    """Return the mean time, in microseconds, of calling a function on
+    each item."""
+
+    start = time.perf_counter()
+    for item in items:
+        function(*item)
+    return (time.perf_counter() - start) * 1e6 / len(items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--types", type=int, default=5000)
+    parser.add_argument("--roots", type=int, default=10)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=100000)
+    args = parser.parse_args()
+
+    types = hierarchy(args)
+    parents = dict(types)
+
+    graph = ConformanceGraph()
+    start = time.perf_counter()
+    graph.load(types)
+    elapsed = time.perf_counter() - start
+    closure = sum(len(s) for s in graph.supertypes.values())
+    depth = max(len(s) for s in graph.supertypes.values())
+    print(f"{len(types)} types loaded in {elapsed * 1000:.0f}ms: "
+          f"{closure} closure pairs, at most {depth} supertypes")
+
+    reversed_graph = ConformanceGraph()
+    start = time.perf_counter()
+    reversed_graph.load(reversed(types))
+    elapsed = time.perf_counter() - start
+    print(f"{len(types)} types loaded, subtypes first, in {elapsed * 1000:.0f}ms")
+    assert reversed_graph.supertypes == graph.supertypes
+    assert reversed_graph.subtypes == graph.subtypes
+
+    rng = random.Random(2)
+    utis = [uti for uti, _ in types]
+    queries = []
+    for _ in range(args.queries):
+        uti = rng.choice(utis)
+        if rng.random() < 0.5:
+            queries.append((uti, rng.choice(utis)))
+        else:
+            queries.append((uti, rng.choice(sorted(graph.supertypes[uti]))))
+
+    print(f"{'':>20} {'µs':>8}")
+    print(f"{'conforms (closure)':>20} {timed(graph.conforms, queries):>8.3f}")
+    print(f"{'conforms (walk)':>20} "
+          f"{timed(lambda a, b: walk(parents, a, b), queries[:args.queries // 10]):>8.3f}")
+    for a, b in queries[:args.queries // 10]:
+        assert graph.conforms(a, b) == walk(parents, a, b), (a, b)
+
+    roots = [(uti,) for uti in utis[:args.roots]]
+    print(f"{'all_subtypes (root)':>20} {timed(graph.all_subtypes, roots):>8.1f}  "
+          f"({sum(len(graph.all_subtypes(uti)) for uti, in roots) / len(roots):.0f} types)")
+
+    # Incremental updates.
+    added = [(f"org.example.new-{i:06d}", rng.sample(utis, 2)) for i in range(1000)]
+    print(f"{'register (leaf)':>20} {timed(graph.set_parents, added):>8.1f}")
+
+    middle = [(rng.choice(utis[args.roots:len(utis) // 20]),) for _ in range(100)]
+    reparented = [(uti, [rng.choice(utis[:args.roots])]) for uti, in middle]
+    subtypes = sum(len(graph.all_subtypes(uti)) for uti, in middle) / len(middle)
+    print(f"{'re-parent (middle)':>20} {timed(graph.set_parents, reparented):>8.1f}  "
+          f"({subtypes:.0f} subtypes)")
+    for uti, new_parents in reparented:
+        parents[uti] = new_parents
+
+    removed = [(uti,) for uti, _ in added]
+    print(f"{'deregister (leaf)':>20} {timed(graph.remove, removed):>8.1f}")
+
+    # Same closure as building afresh.
+    check = ConformanceGraph()
+    check.load(parents.items())
+    assert check.supertypes == graph.supertypes
+    assert check.subtypes == graph.subtypes
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#! /usr/bin/env python3
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Fuzzy search benchmark.
+#
+# Indexes a synthetic corpus, as for index_bench.py, then looks up
+# misspelt words: typos of words from the corpus, of every frequency.
+# Times finding the dictionary terms within the allowed edits, by
+# walking the term dictionary, against a linear scan computing the edit
+# distance to every term, then times complete fuzzy searches.
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "index"))
+
+from darq.services.index import fuzzy_edits, fuzzy_matches
+from database import IndexDatabase
+from segments import merge_segments
+
+
+def distance(a: str, b: str) -> int:
+    """Return the edit distance, with transpositions, between two words."""
+
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        row = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            row[j] = min(previous[j] + 1, row[j - 1] + 1,
+                         previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], previous2[j - 2] + 1)
+        previous2, previous = previous, row
+    return previous[-1]
+
+
+def linear_scan(terms: list, query: str, edits: int) -> list:
+    """Baseline: the edit distance to every term of similar length."""
+
+    return [(term, d) for term in terms
+            if abs(len(term) - len(query)) <= edits
+            and (d := distance(term, query)) <= edits]
+
+
+def typo(rng: random.Random, word: str) -> str:
+    """Return a word with one random edit."""
+
+    i = rng.randrange(len(word))
+    letter = rng.choice("abcdefghijklmnopqrstuvwxyz")
+    edit = rng.randrange(4)
+    if edit == 0:
+        return word[:i] + word[i + 1:]
+    if edit == 1:
+        return word[:i] + letter + word[i:]
+    if edit == 2:
+        return word[:i] + letter + word[i + 1:]
+    return word[:i] + word[i + 1:i + 2] + word[i:i + 1] + word[i + 2:]
+
+
+def percentiles(samples: list) -> tuple:
+    """Return median, 99th percentile and worst, in milliseconds."""
+
+    samples.sort()
+    return (samples[len(samples) // 2] * 1000,
+            samples[len(samples) * 99 // 100] * 1000,
+            samples[-1] * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--documents", type=int, default=20000)
+    parser.add_argument("--words", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = list(dict.fromkeys("".join(rng.choices(letters, k=rng.randrange(3, 10)))
+                               for _ in range(args.words)))
+    weights = list(itertools.accumulate(1 / (rank + 1) ** 1.1 for rank in range(len(words))))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = IndexDatabase(os.path.join(tmpdir, "index"))
+        for i in range(args.documents):
+            text = " ".join(rng.choices(words, cum_weights=weights, k=rng.randrange(20, 300)))
+            db.add(f"object-{i:08d}", text)
+            if db.is_full():
+                db.flush()
+        db.flush()
+        while (job := db.plan_merge()) is not None:
+            job.numbers = merge_segments(job.path, list(zip(job.sources, job.snapshots)))
+            db.install_merge(job)
+
+        segment = max(db.segments, key=lambda s: len(s.terms))
+        terms = [term for term, _ in segment.all_terms()]
+        queries = [typo(rng, rng.choice(terms)) for _ in range(args.queries)]
+        queries = [q for q in queries if fuzzy_edits(q)]
+        print(f"{args.documents} documents, {len(terms)} terms in the largest segment; "
+              f"{len(queries)} misspelt words")
+
+        walk, scan = [], []
+        for query in queries:
+            edits = fuzzy_edits(query)
+            start = time.perf_counter()
+            found = fuzzy_matches(segment.sorted_terms(), query, edits)
+            walk.append(time.perf_counter() - start)
+
+            if len(scan) < 20:
+                start = time.perf_counter()
+                expected = linear_scan(terms, query, edits)
+                scan.append(time.perf_counter() - start)
+                assert sorted(found) == sorted(expected), query
+
+        searches = []
+        for query in queries:
+            start = time.perf_counter()
+            db.search(query, 20, fuzzy=True)
+            searches.append(time.perf_counter() - start)
+
+        print(f"{'':>14} {'median':>8} {'p99':>8} {'max':>8}  (ms)")
+        for name, samples in (("dictionary", walk),
+                              ("linear scan", scan),
+                              ("fuzzy search", searches)):
+            median, p99, worst = percentiles(samples)
+            print(f"{name:>14} {median:>8.2f} {p99:>8.2f} {worst:>8.2f}")
+
+        db.close()
+    return
+
+
+if __name__ == "__main__":
+    main()
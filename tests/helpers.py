@@ -0,0 +1,82 @@
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Test support.
+
+import contextlib
+import importlib
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def load_service(service: str, *names: str) -> list:
+    """Import modules from a service's directory.
+
+    Services import their sibling modules by plain name, and several
+    have modules of the same name (database, segments, pool), so any
+    of those already imported, from another service, are forgotten
+    first.  Classes keep a reference to their own module, so those
+    imported earlier still work.
+
+    :param service: Service directory name, within services.
+    :param names: Module names.
+    :returns: List of modules, in the order named."""
+
+    directory = os.path.join(ROOT, "services", service)
+    sys.path.insert(0, directory)
+    try:
+        for name in os.listdir(directory):
+            if name.endswith(".py"):
+                sys.modules.pop(name[:-3], None)
+        return [importlib.import_module(name) for name in names]
+    finally:
+        sys.path.remove(directory)
+
+
+@contextlib.contextmanager
+def running(directory: str, *services: tuple):
+    """Run the p-Kernel, and some services, for the duration.
+
+    Each service is started once the one before it has opened its port.
+
+    :param directory: Working directory, for databases and logs.
+    :param services: (service directory name, port) pairs; each runs
+    its main.py."""
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    processes = []
+
+    def start(name: str, script: str):
+        with open(os.path.join(directory, f"{name}.log"), "wb") as log:
+            processes.append(subprocess.Popen([sys.executable, script], cwd=directory,
+                                              env=env, stdout=log, stderr=log))
+
+    def wait_for(text: str):
+        deadline = time.time() + 20
+        while True:
+            with open(os.path.join(directory, "kernel.log")) as f:
+                if text in f.read():
+                    return
+            if time.time() > deadline or any(p.poll() is not None for p in processes):
+                raise RuntimeError(f"Timed out waiting for {text!r}")
+            time.sleep(0.05)
+
+    try:
+        start("kernel", os.path.join(ROOT, "kernel", "main.py"))
+        wait_for("Entering main loop.")
+        for name, port in services:
+            start(name, os.path.join(ROOT, "services", name, "main.py"))
+            wait_for(f"open_port({port}) succeeded")
+        yield
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# History backend comparison benchmark.
+#
+# Ingests the same synthetic events into the SQLite backend and the
+# columnar segment store, in batches as the History client sends them,
+# then times the service's queries against each, and reports their
+# sizes on disc.
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "history"))
+
+from database import DAY, END_KEY, EVENT_CODES, HistoryDatabase
+from segments import SegmentDatabase
+
+EVENTS = [EVENT_CODES[name] for name in
+          ["created", "read", "read", "read", "modified", "printed"]]
+
+# One hour, in microseconds.
+HOUR = 3600 * 1000000
+
+
+def generate(args) -> list:
+    """Return synthetic (timestamp, subject, event) batches."""
+
+    rng = random.Random(1)
+    timestamp = 1700000000 * 1000000
+    batches = []
+    batch = []
+    for i in range(args.events):
+        timestamp += rng.randrange(1, 2 * args.interval)
+        batch.append((timestamp,
+                      f"object-{rng.randrange(args.subjects)}",
+                      rng.choice(EVENTS)))
+        if len(batch) == args.batch:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def disc_size(path: str) -> int:
+    """Return the total size of a file, or of a directory's files."""
+
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name))
+               for name in os.listdir(path))
+
+
+def measure(function, args, repeat: int) -> float:
+    """Return the median latency of a query, in milliseconds."""
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2] * 1000
+
+
+def run(db, path: str, batches: list, args) -> dict:
+    """Ingest events, then time each query."""
+
+    start = time.perf_counter()
+    for batch in batches:
+        db.add_events(batch)
+    ingest = args.events / (time.perf_counter() - start)
+
+    first = batches[0][0][0]
+    last = batches[-1][-1][0]
+    middle = (first + last) // 2
+
+    results = {
+        "ingest (ev/s)": ingest,
+        "size (MB)": disc_size(path) / 1e6,
+        "page newest": measure(db.get_page, (END_KEY, args.page, True), args.repeat),
+        "page middle": measure(db.get_page, ((middle, 0), args.page, True), args.repeat),
+        "one hour": measure(db.get_events_for_period, (middle, middle + HOUR), args.repeat),
+        "subject": measure(db.get_subject_events, ("object-1", args.page, None), args.repeat),
+        "top, 1 week": measure(db.get_top_subjects, (middle, middle + 7 * DAY, 10), args.repeat),
+        "daily, 30 days": measure(db.get_daily_counts,
+                                  (middle // DAY, middle // DAY + 30), args.repeat),
+    }
+    db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=1000000)
+    parser.add_argument("--subjects", type=int, default=10000)
+    parser.add_argument("--interval", type=int, default=1000000,
+                        help="mean microseconds between events")
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--page", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    batches = generate(args)
+    print(f"{args.events} events, {args.subjects} subjects, "
+          f"batches of {args.batch}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sqlite_path = os.path.join(tmpdir, "history.sqlite")
+        segments_path = os.path.join(tmpdir, "history.segments")
+
+        sqlite = run(HistoryDatabase(sqlite_path), sqlite_path, batches, args)
+        segments = run(SegmentDatabase(segments_path), segments_path, batches, args)
+
+    print(f"{'':>16} {'sqlite':>10} {'segments':>10}  (ms, unless noted)")
+    for name in sqlite:
+        print(f"{name:>16} {sqlite[name]:>10.2f} {segments[name]:>10.2f}")
+    return
+
+
+if __name__ == "__main__":
+    main()
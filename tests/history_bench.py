@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# History query latency benchmark.
+#
+# Populates a History database with a large number of synthetic events,
+# then times the service's queries against it: paging from a point in
+# time (as the terminal's ObjectSelector does), a one-hour period, and
+# the most recent events for a single subject.  The same queries are
+# then repeated with the indexes dropped, for comparison with the old,
+# unindexed, schema.
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "history"))
+
+from database import EVENT_CODES, HistoryDatabase
+
+EVENTS = list(EVENT_CODES.values())
+
+# One hour, in microseconds.
+HOUR = 3600 * 1000000
+
+
+def populate(db: HistoryDatabase, args) -> tuple[int, int]:
+    """Insert synthetic events, oldest first.
+
+    :returns: (first, last) timestamps."""
+
+    rng = random.Random(1)
+    start = 1700000000 * 1000000
+    timestamp = start
+    cursor = db.db.cursor()
+
+    batch = []
+    for i in range(args.events):
+        timestamp += rng.randrange(1, 2 * args.interval)
+        batch.append((timestamp,
+                      f"object-{rng.randrange(args.subjects)}",
+                      rng.choice(EVENTS)))
+        if len(batch) == 100000:
+            cursor.executemany("insert into history (timestamp, subject, event) "
+                               "values (?, ?, ?)", batch)
+            batch.clear()
+
+    cursor.executemany("insert into history (timestamp, subject, event) "
+                       "values (?, ?, ?)", batch)
+    db.db.commit()
+    return start, timestamp
+
+
+def subject_events(db: HistoryDatabase, subject: str, count: int) -> list:
+    """Return a subject's most recent events."""
+    cursor = db.db.cursor()
+    cursor.execute("select timestamp, subject, event from history "
+                   "where subject = ? order by timestamp desc limit ?",
+                   (subject, count))
+    return cursor.fetchall()
+
+
+def measure(function, args, repeat: int) -> float:
+    """Return the median latency of a query, in milliseconds."""
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2] * 1000
+
+
+def run(db: HistoryDatabase, first: int, last: int, args) -> dict:
+    """Time each query."""
+
+    middle = (first + last) // 2
+    return {
+        "page (newest)": measure(db.get_events, (last, args.page, True), args.repeat),
+        "page (middle)": measure(db.get_events, (middle, args.page, False), args.repeat),
+        "one hour": measure(db.get_events_for_period, (middle, middle + HOUR), args.repeat),
+        "subject": measure(subject_events, (db, "object-1", args.page), args.repeat),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=10000000)
+    parser.add_argument("--subjects", type=int, default=100000)
+    parser.add_argument("--interval", type=int, default=1000000,
+                        help="mean microseconds between events")
+    parser.add_argument("--page", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-unindexed", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = HistoryDatabase(os.path.join(tmpdir, "history.sqlite"))
+
+        start = time.perf_counter()
+        first, last = populate(db, args)
+        print(f"{args.events} events, {args.subjects} subjects, "
+              f"populated in {time.perf_counter() - start:.1f}s")
+
+        indexed = run(db, first, last, args)
+
+        unindexed = None
+        if not args.skip_unindexed:
+            db.db.execute("drop index history_by_time")
+            db.db.execute("drop index history_by_subject")
+            unindexed = run(db, first, last, args)
+
+        print(f"{'query':>14} {'indexed':>10} {'unindexed':>10}  (ms)")
+        for name, latency in indexed.items():
+            other = f"{unindexed[name]:>10.2f}" if unindexed else f"{'-':>10}"
+            print(f"{name:>14} {latency:>10.2f} {other}")
+
+        db.close()
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#! /usr/bin/env python3
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# History ingest rate benchmark.
+#
+# Records events in the History database in batches of varying sizes,
+# and reports the sustained ingest rate.  A batch size of one is the
+# old behaviour: a transaction, and so an fsync, for every event.
+# Larger batches correspond to the History client's buffering, where
+# each batch becomes a single add_events request and transaction.
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "history"))
+
+from database import EVENT_CODES, HistoryDatabase
+
+EVENTS = list(EVENT_CODES.values())
+
+
+def run(path: str, batch_size: int, args) -> float:
+    """Ingest events in batches; return events per second."""
+
+    db = HistoryDatabase(path)
+    rng = random.Random(1)
+    timestamp = 1700000000 * 1000000
+
+    events = []
+    for _ in range(args.events):
+        timestamp += rng.randrange(1, 1000)
+        events.append((timestamp,
+                       f"object-{rng.randrange(args.subjects)}",
+                       rng.choice(EVENTS)))
+
+    start = time.perf_counter()
+    for i in range(0, len(events), batch_size):
+        db.add_events(events[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+
+    db.close()
+    return args.events / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--subjects", type=int, default=1000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        default=[1, 10, 100, 1000])
+    args = parser.parse_args()
+
+    print(f"{args.events} events, {args.subjects} subjects")
+    print(f"{'batch':>8} {'events/s':>12}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for batch_size in args.batch_sizes:
+            path = os.path.join(tmpdir, f"history-{batch_size}.sqlite")
+            rate = run(path, batch_size, args)
+            print(f"{batch_size:>8} {rate:>12.0f}")
+    return
+
+
+if __name__ == "__main__":
+    main()
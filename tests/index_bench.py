@@ -0,0 +1,140 @@
+#! /usr/bin/env python3
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Full-text index benchmark.
+#
+# Indexes a synthetic corpus, with word frequencies following Zipf's
+# law as in natural language, flushing and merging segments as the
+# service does (but merging on this thread), then times queries of
+# terms of different frequencies.  Finally, some documents are
+# replaced, and the queries repeated against the mix of segments.
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "index"))
+
+from database import IndexDatabase
+from segments import merge_segments
+
+
+def vocabulary(args) -> tuple[list, list]:
+    """Return words, and cumulative Zipf weights, most frequent first."""
+
+    rng = random.Random(1)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = list(dict.fromkeys("".join(rng.choices(letters, k=rng.randrange(3, 10)))
+                               for _ in range(args.words)))
+    weights = [1 / (rank + 1) ** 1.1 for rank in range(len(words))]
+    return words, list(itertools.accumulate(weights))
+
+
+def document(rng: random.Random, words: list, weights: list) -> str:
+    """Return a document's text."""
+    return " ".join(rng.choices(words, cum_weights=weights, k=rng.randrange(20, 300)))
+
+
+def merge_all(db: IndexDatabase) -> int:
+    """Run the merges the service would run; return how many."""
+
+    merges = 0
+    while True:
+        job = db.plan_merge()
+        if job is None:
+            return merges
+        job.numbers = merge_segments(job.path, list(zip(job.sources, job.snapshots)))
+        db.install_merge(job)
+        merges += 1
+
+
+def measure(db: IndexDatabase, query: str, match_all: bool, repeat: int) -> tuple:
+    """Return median and worst latency, in milliseconds, and result count."""
+
+    samples = []
+    results = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = db.search(query, 20, match_all)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2] * 1000, samples[-1] * 1000, len(results)
+
+
+def report(db: IndexDatabase, words: list, repeat: int):
+    """Time a set of queries."""
+
+    queries = [
+        ("rare term", words[-10], False),
+        ("mid term", words[500], False),
+        ("common term", words[5], False),
+        ("2 mid terms, any", f"{words[300]} {words[700]}", False),
+        ("2 mid terms, all", f"{words[300]} {words[700]}", True),
+        ("common + rare, all", f"{words[3]} {words[-20]}", True),
+        ("3 common terms, any", f"{words[1]} {words[2]} {words[3]}", False),
+    ]
+
+    print(f"{'query':>22} {'median':>8} {'max':>8}  (ms)")
+    for name, query, match_all in queries:
+        median, worst, count = measure(db, query, match_all, repeat)
+        print(f"{name:>22} {median:>8.2f} {worst:>8.2f}")
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--documents", type=int, default=100000)
+    parser.add_argument("--words", type=int, default=50000)
+    parser.add_argument("--updates", type=int, default=10000,
+                        help="documents replaced after the initial build")
+    parser.add_argument("--repeat", type=int, default=9)
+    args = parser.parse_args()
+
+    words, weights = vocabulary(args)
+    rng = random.Random(2)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = IndexDatabase(os.path.join(tmpdir, "index"))
+
+        start = time.perf_counter()
+        merges = 0
+        for i in range(args.documents):
+            db.add(f"object-{i:08d}", document(rng, words, weights))
+            if db.is_full():
+                db.flush()
+                merges += merge_all(db)
+        db.flush()
+        merges += merge_all(db)
+        elapsed = time.perf_counter() - start
+
+        size = sum(s["bytes"] for s in db.stats()["segments"])
+        print(f"{args.documents} documents: indexed in {elapsed:.1f}s "
+              f"({args.documents / elapsed:.0f} documents/s), {merges} merges, "
+              f"{len(db.segments)} segments, {size / 1e6:.1f} MB")
+        report(db, words, args.repeat)
+
+        start = time.perf_counter()
+        for _ in range(args.updates):
+            i = rng.randrange(args.documents)
+            db.add(f"object-{i:08d}", document(rng, words, weights))
+            if db.is_full():
+                db.flush()
+        db.flush()
+        elapsed = time.perf_counter() - start
+        deleted = sum(s["deleted"] for s in db.stats()["segments"])
+        print(f"\n{args.updates} documents replaced in {elapsed:.1f}s; "
+              f"{len(db.segments)} segments, {deleted} deleted documents")
+        report(db, words, args.repeat)
+
+        db.close()
+    return
+
+
+if __name__ == "__main__":
+    main()
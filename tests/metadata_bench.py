@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Metadata query benchmark.
+#
+# Populates a Metadata database with a large collection of synthetic
+# objects, each with a handful of typed attributes, then times searches
+# combining conditions of very different selectivity.  Each conjunction
+# is timed as planned (scanning its most selective condition), and, for
+# comparison, scanning its first condition as written, which is how a
+# planner without estimates would evaluate it.
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "metadata"))
+
+from database import BOOLEAN, DATETIME, INTEGER, MetadataDatabase, TEXT
+from query import Conjunction, Planner, parse
+
+KINDS = ["document", "image", "message", "book", "contact",
+         "event", "note", "audio", "video", "archive"]
+WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot",
+         "golf", "hotel", "india", "juliet", "kilo", "lima"]
+
+# One day, in microseconds.
+DAY = 86400 * 1000000
+
+
+def populate(db: MetadataDatabase, args):
+    """Insert synthetic objects."""
+
+    rng = random.Random(1)
+    start = 1500000000 * 1000000
+    batch = []
+    for i in range(args.objects):
+        attributes = {
+            "kind": (TEXT, rng.choice(KINDS)),
+            "title": (TEXT, f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}"),
+            "year": (INTEGER, rng.randrange(1900, 2025)),
+            "modified": (DATETIME, start + rng.randrange(3650 * DAY)),
+            "tag": (TEXT, f"tag-{rng.randrange(args.tags)}"),
+        }
+        if rng.random() < 0.01:
+            attributes["starred"] = (BOOLEAN, 1)
+        batch.append((f"object-{i:08d}", attributes))
+        if len(batch) == 10000:
+            db.set_objects(batch)
+            batch.clear()
+    db.set_objects(batch)
+    return
+
+
+def first_term(planner: Planner, query: list) -> list:
+    """Evaluate a conjunction by scanning its first condition."""
+
+    term = parse(query)
+    assert isinstance(term, Conjunction)
+    planner.cursor = planner.db.db.cursor()
+    try:
+        driver, *rest = term.terms
+        return sorted(Conjunction.filter_terms(planner, rest, driver.scan(planner)))
+    finally:
+        planner.finish()
+
+
+def measure(function, args, repeat: int) -> tuple[float, int]:
+    """Return the median latency, in milliseconds, and result size."""
+
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2] * 1000, len(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--objects", type=int, default=1000000)
+    parser.add_argument("--tags", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    queries = {
+        "tag": ["eq", "tag", [TEXT, "tag-42"]],
+        "year range": ["between", "year", [INTEGER, 1990], [INTEGER, 2000]],
+        "title prefix": ["prefix", "title", "golf hotel"],
+        "kind & tag": ["and",
+                       ["eq", "kind", [TEXT, "book"]],
+                       ["eq", "tag", [TEXT, "tag-42"]]],
+        "kind & year & starred": ["and",
+                                  ["eq", "kind", [TEXT, "image"]],
+                                  ["ge", "year", [INTEGER, 2000]],
+                                  ["exists", "starred"]],
+        "year & (tag | tag)": ["and",
+                               ["lt", "year", [INTEGER, 2000]],
+                               ["or",
+                                ["eq", "tag", [TEXT, "tag-1"]],
+                                ["eq", "tag", [TEXT, "tag-2"]]]],
+        "kind & title prefix": ["and",
+                                ["eq", "kind", [TEXT, "note"]],
+                                ["prefix", "title", "kilo lima 99"]],
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = MetadataDatabase(os.path.join(tmpdir, "metadata.sqlite"))
+
+        start = time.perf_counter()
+        populate(db, args)
+        elapsed = time.perf_counter() - start
+        print(f"{args.objects} objects, {args.tags} tags: "
+              f"populated in {elapsed:.1f}s")
+
+        planner = Planner(db)
+        print(f"{'query':>24} {'objects':>8} {'planned':>10} {'first term':>11}  (ms)")
+        for name, query in queries.items():
+            planned, count = measure(planner.search, (query,), args.repeat)
+            if query[0] == "and":
+                naive = f"{measure(first_term, (planner, query), args.repeat)[0]:>11.2f}"
+            else:
+                naive = f"{'':>11}"
+            print(f"{name:>24} {count:>8} {planned:>10.2f} {naive}")
+
+        db.close()
+    return
+
+
+if __name__ == "__main__":
+    main()
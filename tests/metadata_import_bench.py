@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Metadata bulk import benchmark.
+#
+# Generates an NDJSON record stream for a synthetic photo library, and
+# loads it as the service does for an import: parsed a chunk at a time,
+# staged, and merged once at the end, with the value index rebuilt.
+# For comparison, a sample of the records is loaded one set_many
+# request (and so one transaction) per record, as before.  Finally, the
+# store is exported, a chunk at a time, in both formats.
+
+import argparse
+import io
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+import orjson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "metadata"))
+
+from database import MetadataDatabase
+from records import RecordReader, write_header, write_record
+
+CAMERAS = ["X100V", "EOS R6", "Pixel 7", "iPhone 13", "A7 IV"]
+
+
+def generate(args) -> bytes:
+    """Return an NDJSON stream of photo records."""
+
+    rng = random.Random(1)
+    start = 1500000000 * 1000000
+    lines = []
+    for i in range(args.records):
+        attributes = {
+            "name": f"IMG_{i:06d}.JPG",
+            "camera": rng.choice(CAMERAS),
+            "taken": [5, start + rng.randrange(10 ** 14)],
+            "width": rng.choice([4000, 6000, 4032]),
+            "height": rng.choice([3000, 4000, 3024]),
+            "iso": rng.choice([100, 200, 400, 800, 1600, 3200]),
+            "rating": rng.randrange(6),
+            "favourite": rng.random() < 0.05,
+        }
+        lines.append(orjson.dumps({"object": f"photo-{i:08d}",
+                                   "attributes": attributes}))
+    return b"\n".join(lines) + b"\n"
+
+
+def bulk_import(db: MetadataDatabase, stream: bytes, chunk_size: int) -> int:
+    """Import a stream in chunks; return the number of records."""
+
+    reader = RecordReader("ndjson")
+    db.create_staging("import_1")
+    records = 0
+    for offset in range(0, len(stream), chunk_size):
+        batch = reader.feed(stream[offset:offset + chunk_size])
+        db.stage("import_1", batch)
+        records += len(batch)
+    db.stage("import_1", reader.close())
+    db.merge_staging("import_1")
+    return records
+
+
+def export(db: MetadataDatabase, format: str, count: int) -> int:
+    """Export the store in chunks; return the number of bytes."""
+
+    out = io.BytesIO()
+    out.write(write_header(format))
+    after = None
+    while True:
+        rows = db.get_rows(after, count)
+        if not rows:
+            break
+        after = rows[-1][:2]
+        for object_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+            out.write(write_record(format, object_id, [row[1:] for row in group]))
+    return out.tell()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=50000)
+    parser.add_argument("--sample", type=int, default=500,
+                        help="records loaded one request at a time")
+    parser.add_argument("--chunk-size", type=int, default=32 * 1024)
+    args = parser.parse_args()
+
+    stream = generate(args)
+    print(f"{args.records} records, {len(stream) / 1e6:.1f} MB of NDJSON")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = MetadataDatabase(os.path.join(tmpdir, "single.sqlite"))
+        records = RecordReader("ndjson").feed(stream)[:args.sample]
+        start = time.perf_counter()
+        for object_id, attributes in records:
+            db.set_attributes(object_id, attributes)
+        elapsed = time.perf_counter() - start
+        db.close()
+        print(f"{'one request per record':>24}: {len(records) / elapsed:>9.0f} records/s")
+
+        db = MetadataDatabase(os.path.join(tmpdir, "bulk.sqlite"))
+        start = time.perf_counter()
+        count = bulk_import(db, stream, args.chunk_size)
+        elapsed = time.perf_counter() - start
+        print(f"{'bulk import':>24}: {count / elapsed:>9.0f} records/s "
+              f"({elapsed:.2f}s)")
+
+        for format in ("ndjson", "binary"):
+            start = time.perf_counter()
+            size = export(db, format, 5000)
+            elapsed = time.perf_counter() - start
+            print(f"{'export ' + format:>24}: {count / elapsed:>9.0f} records/s "
+                  f"({size / 1e6:.1f} MB)")
+        db.close()
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#! /usr/bin/env python3
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Type implementation start benchmark.
+#
+# Times how long a type implementation takes to start running, from
+# the Type service's request: cold, starting a new process, as a pool
+# of size zero does, and warm, handed to one of the pool's pre-started
+# workers.  The implementation imports the darq runtime, as a real one
+# would, then reports that it has started on a Unix socket.  With
+# --connect, workers connect to the p-Kernel while warming up, and the
+# implementation makes a Storage request before reporting, so the
+# p-Kernel and Storage service must be running.
+
+import argparse
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "type"))
+
+import darq
+
+from pool import DEFAULT_PRELOAD, WarmPool
+
+IMPLEMENTATION = """\
+import socket
+import sys
+
+import darq
+
+if sys.argv[2] == "rpc":
+    darq.storage_api().exists("pool-bench")
+socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM).sendto(b"started", sys.argv[1])
+"""
+
+
+def measure(pool: WarmPool, path: str, argv: list, listener: socket.socket,
+            trials: int) -> list:
+    """Return the start latency of each trial, in milliseconds."""
+
+    samples = []
+    for _ in range(trials):
+        # Let the pool refill, so that each warm start finds a worker.
+        while pool.stats()["ready"] < pool.size:
+            darq.loop().next()
+
+        start = time.perf_counter()
+        pool.run(path, argv)
+        listener.recv(16)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--trials", type=int, default=10)
+    parser.add_argument("--size", type=int, default=2, help="warm pool size")
+    parser.add_argument("--preload", action="append", metavar="MODULE",
+                        help=f"module imported while warming up "
+                             f"(default {', '.join(DEFAULT_PRELOAD)})")
+    parser.add_argument("--connect", action="store_true",
+                        help="connect workers to the p-Kernel, and make a "
+                             "Storage request from the implementation")
+    args = parser.parse_args()
+
+    darq.init(darq.SelectEventLoop())
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "implementation.py")
+        with open(path, "w") as f:
+            f.write(IMPLEMENTATION)
+
+        address = os.path.join(tmpdir, "started.sock")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        listener.bind(address)
+
+        print(f"{'':>6} {'median':>8} {'mean':>8} {'max':>8}  (ms)")
+        for name, size in (("cold", 0), ("warm", args.size)):
+            pool = WarmPool(size, args.preload, args.connect)
+            pool.start()
+            argv = [address, "rpc" if args.connect else "none"]
+            samples = measure(pool, path, argv, listener, args.trials)
+            print(f"{name:>6} {statistics.median(samples):>8.1f} "
+                  f"{statistics.mean(samples):>8.1f} {max(samples):>8.1f}")
+            stats = pool.stats()
+            pool.close()
+        print(f"worker warm-up: {stats['warmup_seconds'] * 1000:.0f}ms")
+        listener.close()
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#! /usr/bin/env python3
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Similarity search benchmark.
+#
+# Embeds a synthetic corpus of topical documents, each drawing most of
+# its words from one of a number of topics, with hashed term features,
+# then times finding the documents most similar to others: exhaustively,
+# one query at a time and in batches, and with the IVF index, whose
+# recall of the exhaustive results is also reported.  Needs NumPy.
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "index"))
+
+import similarity
+
+from similarity import HashedEmbedder, SimilarityIndex
+
+
+def corpus(args) -> list:
+    """Return (object identifier, text) for each document."""
+
+    rng = random.Random(1)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = list(dict.fromkeys("".join(rng.choices(letters, k=rng.randrange(3, 10)))
+                               for _ in range(args.words)))
+    weights = list(itertools.accumulate(1 / (rank + 1) ** 1.1 for rank in range(len(words))))
+    topics = [rng.sample(words, 200) for _ in range(args.topics)]
+
+    documents = []
+    for i in range(args.documents):
+        topic = rng.choice(topics)
+        length = rng.randrange(20, 300)
+        text = (rng.choices(words, cum_weights=weights, k=length // 2) +
+                rng.choices(topic, k=length - length // 2))
+        documents.append((f"object-{i:08d}", " ".join(text)))
+    return documents
+
+
+def measure(function, queries: list) -> tuple:
+    """Return median and worst latency, in milliseconds, and results."""
+
+    samples, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(function(query))
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2] * 1000, samples[-1] * 1000, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--documents", type=int, default=100000)
+    parser.add_argument("--words", type=int, default=50000)
+    parser.add_argument("--topics", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    documents = corpus(args)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index = SimilarityIndex(tmpdir, HashedEmbedder())
+        start = time.perf_counter()
+        for object_id, text in documents:
+            index.add(object_id, text)
+        elapsed = time.perf_counter() - start
+        print(f"{len(documents)} documents embedded in {elapsed:.1f}s "
+              f"({len(documents) / elapsed:.0f}/s)")
+
+        rng = random.Random(2)
+        queries = [index.vector(object_id)
+                   for object_id, _ in rng.sample(documents, args.queries)]
+
+        print(f"{'':>12} {'median':>8} {'max':>8}  (ms)")
+        median, worst, exact = measure(lambda q: index.search(q, args.limit)[0], queries)
+        print(f"{'exhaustive':>12} {median:>8.2f} {worst:>8.2f}")
+
+        start = time.perf_counter()
+        batched = index.search(similarity.numpy.stack(queries), args.limit)
+        elapsed = (time.perf_counter() - start) * 1000 / len(queries)
+        print(f"{'batched':>12} {elapsed:>8.2f} {'':>8}  (per query)")
+        assert [[o for o, _ in r] for r in batched] == [[o for o, _ in r] for r in exact]
+
+        start = time.perf_counter()
+        index.train()
+        elapsed = time.perf_counter() - start
+        median, worst, approximate = measure(lambda q: index.search(q, args.limit)[0], queries)
+        recall = sum(len({o for o, _ in a} & {o for o, _ in e})
+                     for a, e in zip(approximate, exact)) / sum(len(e) for e in exact)
+        print(f"{'ivf':>12} {median:>8.2f} {worst:>8.2f}  "
+              f"({len(index.centroids)} clusters, trained in {elapsed:.1f}s; "
+              f"recall {recall:.1%})")
+        index.close()
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Storage worker pool concurrency benchmark.
+#
+# Drives the Storage service's database worker pool directly (no IPC),
+# with a mix of concurrent readers and writers, and reports throughput
+# and request latency for varying numbers of reader threads.  Zero
+# readers queues everything to the single writer thread, which
+# approximates the old behaviour of running every query in turn.
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "storage"))
+
+import darq
+
+from database import StorageDatabase
+from pool import WorkerPool
+
+
+def percentile(samples: list, fraction: float) -> float:
+    """Return the given percentile of a list of samples."""
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run(path: str, readers: int, args) -> dict:
+    """Run one benchmark configuration."""
+
+    pool = WorkerPool(lambda: StorageDatabase(path),
+                      lambda: StorageDatabase(path, readonly=True),
+                      readers)
+
+    rng = random.Random(1)
+    value = os.urandom(args.value_size)
+    read_latency = []
+    write_latency = []
+    outstanding = 0
+    submitted = 0
+
+    def done(latencies, start):
+        def callback(result, error):
+            nonlocal outstanding
+            outstanding -= 1
+            latencies.append(time.perf_counter() - start)
+        return callback
+
+    start_time = time.perf_counter()
+    while submitted < args.requests or outstanding > 0:
+        # Keep 'concurrency' requests in flight, like as many clients.
+        while submitted < args.requests and outstanding < args.concurrency:
+            key = f"key-{rng.randrange(args.keys)}"
+            now = time.perf_counter()
+            if rng.random() < args.write_ratio:
+                pool.write(StorageDatabase.update, key, value,
+                           callback=done(write_latency, now))
+            else:
+                pool.read(StorageDatabase.get, key,
+                          callback=done(read_latency, now))
+            submitted += 1
+            outstanding += 1
+
+        darq.loop().next()
+
+    elapsed = time.perf_counter() - start_time
+    pool.close()
+
+    return {"readers": readers,
+            "throughput": args.requests / elapsed,
+            "read_p50": percentile(read_latency, 0.5) * 1000,
+            "read_p99": percentile(read_latency, 0.99) * 1000,
+            "write_p50": percentile(write_latency, 0.5) * 1000,
+            "write_p99": percentile(write_latency, 0.99) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--value-size", type=int, default=1024)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--readers", type=int, nargs="+", default=[0, 1, 2, 4])
+    args = parser.parse_args()
+
+    darq.init(darq.SelectEventLoop())
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "storage.sqlite")
+
+        # Populate.
+        db = StorageDatabase(path)
+        value = os.urandom(args.value_size)
+        cursor = db.db.cursor()
+        for i in range(args.keys):
+            db.write_value(cursor, f"key-{i}", value, False)
+        db.db.commit()
+        db.close()
+
+        print(f"{args.keys} keys, {args.value_size} byte values, "
+              f"{args.requests} requests, {args.write_ratio:.0%} writes, "
+              f"{args.concurrency} in flight")
+        print(f"{'readers':>8} {'req/s':>10} "
+              f"{'read p50':>9} {'read p99':>9} "
+              f"{'write p50':>10} {'write p99':>10}  (ms)")
+
+        for readers in args.readers:
+            r = run(path, readers, args)
+            print(f"{r['readers']:>8} {r['throughput']:>10.0f} "
+                  f"{r['read_p50']:>9.2f} {r['read_p99']:>9.2f} "
+                  f"{r['write_p50']:>10.2f} {r['write_p99']:>10.2f}")
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# History database tests.
+
+import os
+import random
+
+import pytest
+
+from helpers import load_service
+
+database, compaction, segments = load_service("history", "database",
+                                              "compaction", "segments")
+
+DAY = database.DAY
+HOUR = compaction.HOUR
+
+
+def populate(db, days: int, per_day: int, seed: int = 1) -> int:
+    """Add events spread over some days; return the time of the last."""
+
+    rng = random.Random(seed)
+    events = []
+    for day in range(days):
+        for _ in range(per_day):
+            events.append((day * DAY + rng.randrange(DAY),
+                           f"subject{rng.randrange(20)}",
+                           rng.choice(list(database.EVENT_CODES.values()))))
+    events.sort()
+    db.add_events(events)
+    return events[-1][0]
+
+
+def check_rollups(db):
+    """Check the rollup tables against the events table."""
+
+    cursor = db.db.cursor()
+    cursor.execute("select subject, max(timestamp), sum(count) "
+                   "from history group by subject")
+    subjects = {subject: (latest, count) for subject, latest, count in cursor.fetchall()}
+    cursor.execute("select subject, last_touched, events from subjects")
+    assert {subject: (latest, count)
+            for subject, latest, count in cursor.fetchall()} == subjects
+
+    cursor.execute("select timestamp / ?, subject, event, sum(count) "
+                   "from history group by 1, 2, 3", (DAY,))
+    daily = {row[:3]: row[3] for row in cursor.fetchall()}
+    cursor.execute("select day, subject, event, count from daily_counts")
+    assert {row[:3]: row[3] for row in cursor.fetchall()} == daily
+    cursor.close()
+
+
+def test_expire_updates_rollups(tmp_path):
+    db = database.HistoryDatabase(str(tmp_path / "history.sqlite"))
+    last = populate(db, 20, 40)
+
+    policy = compaction.RetentionPolicy(max_age=10 * DAY + HOUR)
+    compactor = compaction.Compactor(db, policy)
+    while compactor.step(last):
+        pass
+
+    cursor = db.db.cursor()
+    cursor.execute("select min(timestamp) from history")
+    assert cursor.fetchone()[0] >= last - policy.max_age
+    cursor.close()
+    assert compactor.deleted > 0
+    check_rollups(db)
+    db.close()
+
+
+def count_events(db, start: int, end: int) -> int:
+    cursor = db.db.cursor()
+    cursor.execute("select count(*) from history "
+                   "where timestamp >= ? and timestamp < ?", (start, end))
+    count = cursor.fetchone()[0]
+    cursor.close()
+    return count
+
+
+def test_slices_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(compaction, "SLICE_EVENTS", 20)
+
+    db = database.HistoryDatabase(str(tmp_path / "history.sqlite"))
+    last = populate(db, 30, 40)
+    compactor = compaction.Compactor(db, compaction.RetentionPolicy(max_age=10 * DAY))
+    cursor = db.db.cursor()
+
+    # Slices end at a bucket boundary, after no more than SLICE_EVENTS
+    # events, unless a single bucket holds more.
+    end = compactor.slice_end(cursor, 0, 64 * HOUR, HOUR)
+    assert end % HOUR == 0 and 0 < end < 64 * HOUR
+    assert 0 < count_events(db, 0, end) <= 20
+    assert compactor.slice_end(cursor, 0, 64 * DAY, DAY) == DAY
+    assert compactor.slice_end(cursor, 29 * DAY, 64 * DAY, DAY) == 30 * DAY
+    assert compactor.slice_end(cursor, 30 * DAY, 64 * DAY, DAY) == 64 * DAY
+    cursor.close()
+
+    # So each expiry step deletes a bounded number of events.
+    deleted = 0
+    while compactor.step(last):
+        assert compactor.deleted - deleted <= 20
+        deleted = compactor.deleted
+    assert count_events(db, 0, last - 10 * DAY) == 0
+    check_rollups(db)
+    db.close()
+
+
+@pytest.fixture(params=["sqlite", "segments"])
+def history(request, tmp_path):
+    if request.param == "sqlite":
+        db = database.HistoryDatabase(str(tmp_path / "history.sqlite"))
+    else:
+        db = segments.SegmentDatabase(str(tmp_path / "history.segments"))
+    yield db
+    db.close()
+
+
+def add_tied_events(db, batches: int, per_time: int):
+    """Add events at a few timestamps, in batches, many sharing each."""
+
+    for batch in range(batches):
+        db.add_events([(1000 * (t + 1), f"subject{batch}", 1)
+                       for t in range(3) for _ in range(per_time)])
+        if isinstance(db, segments.SegmentDatabase):
+            db.seal()
+    return
+
+
+def read_pages(db, key: tuple, count: int, older: bool) -> list:
+    """Page through every event beyond a key."""
+
+    rows = []
+    while True:
+        page = db.get_page(key, count, older)
+        assert len(page) <= count
+        rows.extend(page)
+        if not page:
+            assert not db.has_events(key, older)
+            return rows
+        key = page[-1][:2]
+        assert db.has_events(key, older) == bool(db.get_page(key, 1, older))
+
+
+def test_pages_split_timestamp_ties(history):
+    """Page boundaries within events of the same timestamp neither
+    skip nor repeat events."""
+
+    add_tied_events(history, 3, 10)
+
+    older = read_pages(history, database.END_KEY, 7, True)
+    keys = [row[:2] for row in older]
+    assert len(older) == 90
+    assert keys == sorted(set(keys), reverse=True)
+
+    newer = read_pages(history, database.START_KEY, 7, False)
+    assert newer == older[::-1]
+
+    # Events added later at an already-paged timestamp are found on the
+    # newer side of the newest key.
+    newest = keys[0]
+    history.add_events([(newest[0], "late", 2)])
+    late = history.get_page(newest, 7, False)
+    assert [(row[0], row[2]) for row in late] == [(newest[0], "late")]
+    assert not history.has_events(late[0][:2], False)
+
+
+def test_seal_interrupted(tmp_path):
+    """Log records already sealed, when the process stopped before the
+    log was emptied, aren't replayed."""
+
+    path = str(tmp_path / "history.segments")
+    db = segments.SegmentDatabase(path)
+    db.add_events([(1000 + i, "subject", 1) for i in range(10)])
+    with open(os.path.join(path, "active.log"), "rb") as f:
+        log = f.read()
+    db.seal()
+    db.close()
+
+    # As if the process stopped between writing the segment and
+    # emptying the log.
+    with open(os.path.join(path, "active.log"), "wb") as f:
+        f.write(log)
+
+    db = segments.SegmentDatabase(path)
+    assert db.active.rows == 0
+    db.add_events([(2000, "subject", 2)])
+    db.close()
+
+    db = segments.SegmentDatabase(path)
+    rows = db.get_page(database.START_KEY, 100, False)
+    assert [row[0] for row in rows] == [1000 + i for i in range(10)] + [2000]
+    assert len({row[1] for row in rows}) == 11
+    db.close()
@@ -0,0 +1,364 @@
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Index database tests.
+
+import heapq
+import math
+import os
+import random
+
+import pytest
+
+from helpers import load_service
+
+database, segments, similarity, text = load_service("index", "database", "segments",
+                                                   "similarity", "text")
+
+from darq.services import index as api
+
+
+def bm25(documents: dict, query: str) -> dict:
+    """Score documents for a query, from scratch."""
+
+    frequencies = {o: text.term_frequencies(t) for o, t in documents.items()}
+    n = len(documents)
+    total = sum(length for _, length in frequencies.values())
+    k1, b = database.K1, database.B
+
+    scores = {}
+    for term in dict.fromkeys(text.tokenize(query)):
+        df = sum(1 for f, _ in frequencies.values() if term in f)
+        if df == 0:
+            continue
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5)) * (k1 + 1)
+        for o, (f, length) in frequencies.items():
+            if term in f:
+                tf = f[term]
+                scores[o] = scores.get(o, 0.0) + \
+                    idf * tf / (tf + k1 * (1 - b) + k1 * b * length * n / total)
+    return scores
+
+
+def check(db, documents: dict, queries: list):
+    for query in queries:
+        found = dict(db.search(query, len(documents) + 1))
+        expected = bm25(documents, query)
+        assert found.keys() == expected.keys(), query
+        for o, score in expected.items():
+            assert math.isclose(found[o], score, rel_tol=1e-9), (query, o)
+
+
+def test_live_frequency():
+    documents = [1, 4, 6, 9]
+    assert database.live_frequency(documents, set()) == 4
+    assert database.live_frequency(documents, {4}) == 3
+    assert database.live_frequency(documents, {0, 2, 3, 5, 6, 7, 8, 9}) == 2
+
+
+def test_scores_after_replace_and_delete(tmp_path):
+    """Document frequencies ignore replaced and deleted documents."""
+
+    rng = random.Random(1)
+    words = [f"word{i}" for i in range(20)]
+    db = database.IndexDatabase(str(tmp_path / "index"))
+    documents = {}
+    for step in range(1500):
+        object_id = f"object{rng.randrange(200)}"
+        if rng.random() < 0.2:
+            db.delete(object_id)
+            documents.pop(object_id, None)
+        else:
+            documents[object_id] = " ".join(rng.choices(words, k=rng.randrange(3, 15)))
+            db.add(object_id, documents[object_id])
+        if step % 200 == 199:
+            db.flush()
+
+    check(db, documents, ["word1", "word2 word3", "word4 word5 word19"])
+    db.close()
+
+
+def test_merge_with_concurrent_deletes(tmp_path):
+    """Documents deleted or replaced while a merge runs stay deleted."""
+
+    db = database.IndexDatabase(str(tmp_path / "index"))
+    documents = {}
+    for s in range(database.MERGE_FACTOR):
+        for i in range(10):
+            object_id = f"object{s}-{i}"
+            documents[object_id] = f"common segment{s} item{i}"
+            db.add(object_id, documents[object_id])
+        db.flush()
+
+    job = db.plan_merge()
+    assert job is not None and len(job.sources) == database.MERGE_FACTOR
+
+    # Merged from the sources as they were when it started ...
+    job.numbers = segments.merge_segments(job.path,
+                                          list(zip(job.sources, job.snapshots)))
+
+    # ... while objects are deleted and replaced.
+    for s in range(database.MERGE_FACTOR):
+        db.delete(f"object{s}-0")
+        del documents[f"object{s}-0"]
+        documents[f"object{s}-1"] = "replaced common"
+        db.add(f"object{s}-1", documents[f"object{s}-1"])
+
+    db.install_merge(job)
+    assert len(db.segments) == 1
+    assert db.documents == len(documents)
+    check(db, documents, ["common", "item0", "item1", "replaced segment3"])
+
+    # Objects' documents moved to the merged segment can still be
+    # replaced and deleted.
+    db.delete("object2-5")
+    del documents["object2-5"]
+    documents["object3-5"] = "moved"
+    db.add("object3-5", documents["object3-5"])
+    check(db, documents, ["common item5", "moved"])
+    db.close()
+
+
+def distance(a: str, b: str) -> int:
+    """Return the edits, including swaps of adjacent characters, between
+    two strings."""
+
+    d = [[i + j if i == 0 or j == 0 else 0 for j in range(len(b) + 1)]
+         for i in range(len(a) + 1)]
+    for i in range(1, len(a) + 1):
+        for j in range(1, len(b) + 1):
+            d[i][j] = min(d[i - 1][j] + 1, d[i][j - 1] + 1,
+                          d[i - 1][j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                d[i][j] = min(d[i][j], d[i - 2][j - 2] + 1)
+    return d[len(a)][len(b)]
+
+
+def random_word(rng, alphabet: str, low: int, high: int) -> str:
+    return "".join(rng.choices(alphabet, k=rng.randint(low, high)))
+
+
+def test_fuzzy_matches():
+    """The automaton finds exactly the keys within the edits."""
+
+    rng = random.Random(1)
+    keys = sorted(random_word(rng, "abcd", 0, 7) for _ in range(2000))
+    for _ in range(200):
+        query = random_word(rng, "abcde", 1, 6)
+        edits = rng.randint(0, 2)
+
+        found = api.fuzzy_matches(keys, query, edits)
+        expected = {key: distance(key, query) for key in set(keys)}
+        assert dict(found) == {key: d for key, d in expected.items() if d <= edits}, \
+            (query, edits)
+        assert len(found) == len(dict(found))
+
+
+def test_fuzzy_prefix_matches():
+    """In prefix mode, each key's best prefix within the edits is found."""
+
+    rng = random.Random(2)
+    keys = sorted(random_word(rng, "abcd", 1, 7) for _ in range(2000))
+    for _ in range(200):
+        query = random_word(rng, "abcde", 1, 5)
+        edits = rng.randint(1, 2)
+        exact = rng.randint(0, 1)
+
+        found = api.fuzzy_matches(keys, query, edits, prefix=True, exact=exact)
+        for match, d in found:
+            assert distance(match, query) == d
+
+        for key in set(keys):
+            best = min((d for match, d in found if key.startswith(match)), default=None)
+            expected = min(distance(key[:i], query) for i in range(len(key) + 1))
+            if expected > edits or not key.startswith(query[:exact]):
+                expected = None
+            assert best == expected, (query, edits, exact, key)
+
+
+def complete(entries: dict, prefix: str, limit: int, fuzzy: bool = False) -> list:
+    """Return the best completions of a prefix, by scanning every label."""
+
+    def rank(entry):
+        _, label, weight = entries[entry]
+        return weight, -len(label), entry
+
+    prefix = api.normalize(prefix)
+    keys = {entry: api.completion_keys(label) for entry, (_, label, _) in entries.items()}
+    best = heapq.nlargest(limit, [e for e, k in keys.items()
+                                  if any(key.startswith(prefix) for key in k)], key=rank)
+
+    edits = min(api.fuzzy_edits(prefix), api.COMPLETION_EDITS) if fuzzy else 0
+    if edits and len(best) < limit:
+        distances = {}
+        for entry, k in keys.items():
+            d = min((distance(key[:i], prefix) for key in k if key[:1] == prefix[:1]
+                     for i in range(1, len(key) + 1)), default=edits + 1)
+            if d <= edits:
+                distances[entry] = d
+        best = heapq.nlargest(limit, distances, key=lambda e: (-distances[e], rank(e)))
+    return [(entry, *entries[entry]) for entry in best]
+
+
+def test_completion(monkeypatch):
+    """Completions match a scan of the labels, through changes."""
+
+    # Small blocks, so prefixes span several, and their caches are used.
+    monkeypatch.setattr(api, "COMPLETION_BLOCK_SIZE", 8)
+
+    rng = random.Random(3)
+    index = api.CompletionIndex()
+    entries = {}
+    for step in range(1500):
+        entry = f"entry{rng.randrange(300)}"
+        if rng.random() < 0.2:
+            assert index.remove(entry) == (entries.pop(entry, None) is not None)
+        else:
+            label = " ".join(random_word(rng, "abcdef", 1, 6)
+                             for _ in range(rng.randint(1, 3)))
+            kind = rng.choice(["type", "object"])
+            weight = float(rng.randrange(3))
+            entries[entry] = (kind, label.title(), weight)
+            index.set(entry, kind, label.title(), weight)
+
+        if step % 10 == 9:
+            if step == 799:
+                index.warm()
+            for _ in range(3):
+                prefix = random_word(rng, "abcdef", 1, 4)
+                limit = rng.choice([1, 5, 20])
+                fuzzy = rng.random() < 0.5
+                assert index.complete(prefix, limit, fuzzy=fuzzy) == \
+                    complete(entries, prefix, limit, fuzzy), (prefix, limit, fuzzy)
+
+    types = {e: v for e, v in entries.items() if v[0] == "type"}
+    assert index.complete("ab", 20, kinds=["type"]) == complete(types, "ab", 20)
+    assert index.complete("Ab  ", 20) == complete(entries, "ab ", 20)
+
+
+def nearest_objects(vectors: dict, queries, limit: int) -> list:
+    """Return the objects most similar to each query, by scoring all."""
+
+    object_ids = list(vectors)
+    matrix = similarity.normalized(similarity.numpy.array([vectors[o] for o in object_ids]))
+    results = []
+    for query in similarity.normalized(queries):
+        scores = matrix @ query
+        results.append([(object_ids[i], float(scores[i]))
+                        for i in similarity.numpy.argsort(-scores)[:limit]])
+    return results
+
+
+def check_similar(index, vectors: dict, queries):
+    found = index.search(queries, 10)
+    for results, expected in zip(found, nearest_objects(vectors, queries, 10)):
+        assert [o for o, _ in results] == [o for o, _ in expected]
+        assert all(math.isclose(a, b, rel_tol=1e-4, abs_tol=1e-5)
+                   for (_, a), (_, b) in zip(results, expected))
+
+
+@pytest.fixture
+def small_ivf(monkeypatch):
+    if similarity.numpy is None:
+        pytest.skip("NumPy not installed")
+    monkeypatch.setattr(similarity, "IVF_MIN_OBJECTS", 200)
+    monkeypatch.setattr(similarity, "INITIAL_ROWS", 64)
+    return
+
+
+def test_ivf_search(tmp_path, small_ivf, monkeypatch):
+    """Searching every cluster finds what an exhaustive search does,
+    through clustering, additions, replacements, removals, and
+    re-clustering."""
+
+    numpy = similarity.numpy
+    rng = numpy.random.default_rng(1)
+    index = similarity.SimilarityIndex(str(tmp_path), similarity.HashedEmbedder(32))
+    vectors = {}
+
+    def add(count: int, first: int):
+        object_ids = [f"object{first + i}" for i in range(count)]
+        new = rng.standard_normal((count, 32)).astype(numpy.float32)
+        index.add_vectors(object_ids, new)
+        vectors.update(zip(object_ids, new))
+
+    queries = rng.standard_normal((20, 32))
+    add(150, 0)
+    index.flush()
+    assert index.centroids is None
+    check_similar(index, vectors, queries)
+
+    add(100, 150)
+    index.flush()
+    assert index.centroids is not None and index.generation == 1
+
+    # Added (and replaced) vectors are assigned to clusters.
+    add(50, 250)
+    add(20, 100)
+    for i in range(0, 40, 2):
+        assert index.remove(f"object{i}")
+        del vectors[f"object{i}"]
+
+    with monkeypatch.context() as m:
+        m.setattr(similarity, "IVF_PROBE_FRACTION", 1.0)
+        check_similar(index, vectors, queries)
+
+    # An object's own cluster is its nearest, so it's always probed.
+    own = list(vectors)[::25]
+    for object_id, results in zip(own, index.search(numpy.array([vectors[o] for o in own]), 1)):
+        assert results[0][0] == object_id
+
+    # Re-clustered once as many have been added as were clustered.
+    add(300, 300)
+    index.flush()
+    assert index.generation == 2 and index.trained == len(vectors)
+    assert sorted(os.listdir(tmp_path)) == ["vectors-000002.f32", "vectors-000002.npz",
+                                            "vectors.json"]
+    with monkeypatch.context() as m:
+        m.setattr(similarity, "IVF_PROBE_FRACTION", 1.0)
+        check_similar(index, vectors, queries)
+    index.close()
+
+
+@pytest.mark.parametrize("count", [100, 300])
+def test_similarity_reopen(tmp_path, small_ivf, monkeypatch, count):
+    """Reopened, an index has the vectors as of its last flush."""
+
+    monkeypatch.setattr(similarity, "IVF_PROBE_FRACTION", 1.0)
+    numpy = similarity.numpy
+    rng = numpy.random.default_rng(2)
+    embedder = similarity.HashedEmbedder(32)
+    index = similarity.SimilarityIndex(str(tmp_path), embedder)
+    object_ids = [f"object{i}" for i in range(count)]
+    vectors = dict(zip(object_ids, rng.standard_normal((count, 32)).astype(numpy.float32)))
+    index.add_vectors(object_ids, numpy.array(list(vectors.values())))
+    index.remove("object1")
+    del vectors["object1"]
+    index.flush()
+    clustered = index.centroids is not None
+    assert clustered == (count >= similarity.IVF_MIN_OBJECTS)
+
+    # Changes not yet flushed are lost, and don't damage what was.
+    index.remove("object2")
+    changed = rng.standard_normal((2, 32)).astype(numpy.float32)
+    index.add_vectors(["object3", "new"], changed)
+    queries = rng.standard_normal((20, 32))
+    reopened = similarity.SimilarityIndex(str(tmp_path), embedder)
+    assert len(reopened) == len(vectors)
+    assert (reopened.centroids is not None) == clustered
+    check_similar(reopened, vectors, queries)
+    reopened.close()
+
+    # Once flushed, they're kept.
+    index.close()
+    del vectors["object2"]
+    vectors["object3"], vectors["new"] = changed
+    reopened = similarity.SimilarityIndex(str(tmp_path), embedder)
+    assert len(reopened) == len(vectors)
+    check_similar(reopened, vectors, numpy.concatenate([queries, changed]))
+    reopened.close()
+
+    # A different embedder discards the index.
+    other = similarity.SimilarityIndex(str(tmp_path), similarity.HashedEmbedder(16))
+    assert len(other) == 0
+    other.close()
@@ -0,0 +1,54 @@
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Metadata query tests.
+
+import random
+
+from helpers import load_service
+
+database, query = load_service("metadata", "database", "query")
+
+INTEGER, TEXT = database.INTEGER, database.TEXT
+
+
+def populate(db, count: int, seed: int = 1):
+    rng = random.Random(seed)
+    db.set_objects((f"object{rng.randrange(10 ** 6):06d}",
+                    {"size": (INTEGER, rng.randrange(100)),
+                     "kind": (TEXT, rng.choice(["image", "index", "text"]))})
+                   for _ in range(count))
+    return
+
+
+def test_paged_search(tmp_path):
+    """Paging through a search returns every object once, in order."""
+
+    db = database.MetadataDatabase(str(tmp_path / "metadata.sqlite"))
+    populate(db, 300)
+    planner = query.Planner(db)
+
+    queries = [["eq", "kind", [TEXT, "text"]],
+               ["between", "size", [INTEGER, 10], [INTEGER, 40]],
+               ["prefix", "kind", "i"],
+               ["and", ["eq", "kind", [TEXT, "image"]],
+                ["lt", "size", [INTEGER, 50]]],
+               ["or", ["eq", "size", [INTEGER, 7]],
+                ["eq", "kind", [TEXT, "index"]]]]
+    for q in queries:
+        expected = planner.search(q)
+        assert expected == sorted(expected) and expected, q
+
+        found, after = [], None
+        while True:
+            page = planner.search(q, 8, after)
+            assert len(page) <= 8
+            found.extend(page)
+            if len(page) < 8:
+                break
+            after = page[-1]
+        assert found == expected, q
+
+        # Objects after the last match none.
+        assert planner.search(q, 8, expected[-1]) == []
+    db.close()
@@ -0,0 +1,267 @@
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Storage database tests.
+
+import random
+import socket
+import sqlite3
+import time
+from collections import Counter
+
+import pytest
+
+from helpers import load_service, running
+
+database, chunks = load_service("storage", "database", "chunks")
+
+
+@pytest.fixture(params=[False, True], ids=["plain", "chunked"])
+def db(request, tmp_path):
+    db = database.StorageDatabase(str(tmp_path / "storage.sqlite"),
+                                  chunked=request.param)
+    yield db
+    db.close()
+
+
+def test_cas_conflicts(db):
+    """A compare-and-swap with a stale version fails, and changes nothing."""
+
+    ok, first = db.cas("key", 0, b"one")
+    assert ok and first > 0
+
+    # Creating a key that's already set.
+    assert db.cas("key", 0, b"two") == (False, first)
+    assert db.set("key", b"two") == 0
+
+    ok, second = db.cas("key", first, b"two")
+    assert ok and second > first
+
+    # A writer that read the first version lost the race.
+    assert db.cas("key", first, b"three") == (False, second)
+    assert db.get("key") == (b"two", second)
+
+    # Expecting a key that isn't set.
+    assert db.cas("missing", first, b"one") == (False, 0)
+    assert db.update("missing", b"one") == 0
+    assert not db.exists("missing")
+
+
+def test_conditional_delete(db):
+    _, version = db.cas("key", 0, b"one")
+    newer = db.update("key", b"two")
+    assert newer > version
+
+    assert db.delete("key", version) == (False, newer)
+    assert db.get("key") == (b"two", newer)
+    assert db.delete("key", newer) == (True, newer)
+    assert db.delete("key", newer) == (False, 0)
+    assert db.delete("key") == (False, 0)
+
+
+def test_versions_not_reused(tmp_path):
+    """A key deleted and set again never gets an earlier version back,
+    even after the database is reopened."""
+
+    db = database.StorageDatabase(str(tmp_path / "storage.sqlite"))
+    _, old = db.cas("key", 0, b"one")
+    db.delete("key")
+    _, new = db.cas("key", 0, b"one")
+    assert new > old
+    assert db.cas("key", old, b"two") == (False, new)
+    db.delete("key")
+    db.close()
+
+    reopened = database.StorageDatabase(str(tmp_path / "storage.sqlite"))
+    _, newest = reopened.cas("key", 0, b"one")
+    assert newest > new
+    reopened.close()
+
+
+def test_concurrent_writers(tmp_path):
+    """Of two connections swapping from the same version, one wins."""
+
+    file = str(tmp_path / "storage.sqlite")
+    a = database.StorageDatabase(file)
+    b = database.StorageDatabase(file)
+
+    _, version = a.cas("key", 0, b"one")
+    assert b.get("key") == (b"one", version)
+
+    ok, winner = a.cas("key", version, b"a")
+    assert ok
+    assert b.cas("key", version, b"b") == (False, winner)
+    assert b.get("key") == (b"a", winner)
+    a.close()
+    b.close()
+
+
+def check_refs(db: sqlite3.Connection):
+    """Check chunk reference counts against the chunk map, and that
+    exactly the referenced chunks are stored."""
+
+    cursor = db.cursor()
+    cursor.execute("select hash from chunk_map")
+    expected = Counter(row[0] for row in cursor.fetchall())
+    cursor.execute("select hash, refs from chunk_refs")
+    assert dict(cursor.fetchall()) == expected
+    cursor.execute("select hash from chunks")
+    assert {row[0] for row in cursor.fetchall()} == set(expected)
+    cursor.close()
+
+
+def test_chunk_boundaries():
+    """Chunks are within the size limits, and an edit changes only the
+    chunks around it."""
+
+    data = random.Random(1).randbytes(500000)
+    boundaries = chunks.chunk_boundaries(data)
+    assert boundaries[-1] == len(data)
+    sizes = [end - start for start, end in zip([0] + boundaries, boundaries)]
+    assert all(chunks.MIN_CHUNK_SIZE <= size <= chunks.MAX_CHUNK_SIZE
+               for size in sizes[:-1])
+    assert 0 < sizes[-1] <= chunks.MAX_CHUNK_SIZE
+
+    edited = data[:250000] + b"edit" + data[250000:]
+    before = {digest for digest, _ in chunks.split(data)}
+    after = [digest for digest, _ in chunks.split(edited)]
+    assert len(after) - sum(digest in before for digest in after) <= 2
+
+
+def test_chunk_round_trip():
+    db = sqlite3.connect(":memory:")
+    store = chunks.ChunkStore(db)
+    cursor = db.cursor()
+
+    rng = random.Random(2)
+    values = {f"key{size}": rng.randbytes(size)
+              for size in (0, 1, chunks.MIN_CHUNK_SIZE, chunks.MAX_CHUNK_SIZE + 1,
+                           300000)}
+    for key, value in values.items():
+        store.put(cursor, key, value)
+    for key, value in values.items():
+        assert store.get(cursor, key) == value
+    assert store.get(cursor, "missing") == b""
+    check_refs(db)
+    db.close()
+
+
+def test_shared_chunks_stored_once():
+    db = sqlite3.connect(":memory:")
+    store = chunks.ChunkStore(db)
+    cursor = db.cursor()
+
+    value = random.Random(3).randbytes(200000)
+    store.put(cursor, "a", value)
+    written = store.chunks_written
+    store.put(cursor, "b", value)
+    store.put(cursor, "c", value[:100000] + b"edit" + value[100000:])
+    assert store.chunks_written - written <= 2
+
+    stats = store.stats()
+    assert stats["chunk_references"] == len(store.hashes(cursor, "a")) * 2 + \
+        len(store.hashes(cursor, "c"))
+    assert stats["stored_bytes"] < len(value) + 2 * chunks.MAX_CHUNK_SIZE
+    assert stats["dedup_ratio"] > 2.5
+    check_refs(db)
+
+    # A value repeating a chunk holds it once, with two references.
+    chunk = chunks.split(value)[0][1]
+    store.put(cursor, "d", chunk + chunk)
+    assert store.get(cursor, "d") == chunk + chunk
+    check_refs(db)
+    db.close()
+
+
+def test_chunks_released():
+    """Chunks no value uses any longer are deleted."""
+
+    db = sqlite3.connect(":memory:")
+    store = chunks.ChunkStore(db)
+    cursor = db.cursor()
+
+    rng = random.Random(4)
+    first, second = rng.randbytes(100000), rng.randbytes(100000)
+    store.put(cursor, "a", first)
+    store.put(cursor, "b", first)
+
+    # Overwriting one of two keys sharing chunks keeps them.
+    store.put(cursor, "a", second)
+    assert store.get(cursor, "b") == first
+    check_refs(db)
+
+    # Overwriting the other releases them.
+    store.put(cursor, "b", second[:50000])
+    assert store.get(cursor, "a") == second
+    check_refs(db)
+
+    store.delete(cursor, "a")
+    store.delete(cursor, "b")
+    check_refs(db)
+    cursor.execute("select count(*) from chunks")
+    assert cursor.fetchone()[0] == 0
+    cursor.execute("select count(*) from chunk_refs")
+    assert cursor.fetchone()[0] == 0
+    db.close()
+
+
+@pytest.fixture
+def storage_service(tmp_path):
+    with socket.socket() as s:
+        if s.connect_ex(("localhost", 11000)) == 0:
+            pytest.skip("A p-Kernel is already running")
+    with running(str(tmp_path), ("storage", 11001)):
+        yield
+
+
+def test_watch_notifications(storage_service):
+    """Watchers are notified of changes to watched keys, until they
+    unwatch them."""
+
+    import darq
+    from darq.services.storage import StorageAPI
+
+    class Watcher(StorageAPI):
+        """Records the keys of all changes notified by the service."""
+
+        def __init__(self):
+            super().__init__()
+            self.notified = []
+
+        def handle_request(self, source: int, message: dict):
+            self.notified.extend(event["key"] for event in message.get("events", []))
+            super().handle_request(source, message)
+
+    darq.init(darq.SelectEventLoop())
+    watcher, writer = Watcher(), StorageAPI()
+    seen = []
+    assert watcher.watch("watched/", prefix=True,
+                         callback=lambda *change: seen.append(change))
+    assert watcher.watch("marker", callback=lambda *change: seen.append(change))
+
+    # One client's notifications arrive in order, so once the marker's
+    # change is seen, any earlier ones have been too.
+    def changes(marker: bytes) -> list:
+        assert writer.update("marker", marker) or writer.set("marker", marker)
+        deadline = time.time() + 10
+        while not any(key == "marker" for key, _, _ in seen):
+            assert time.time() < deadline
+            darq.loop().next()
+        found = [change for change in seen if change[0] != "marker"]
+        seen.clear()
+        return found
+
+    assert writer.set("watched/a", b"1")
+    assert writer.set("other", b"1")
+    assert changes(b"1") == [("watched/a", writer.get_versioned("watched/a")[1], "set")]
+
+    assert writer.update("watched/a", b"2")
+    version = writer.get_versioned("watched/a")[1]
+    assert writer.delete("watched/a")
+    assert changes(b"2") == [("watched/a", version, "delete")]
+
+    assert watcher.unwatch("watched/", prefix=True)
+    assert writer.set("watched/b", b"1")
+    assert changes(b"3") == []
+    assert "watched/b" not in watcher.notified
+    assert "other" not in watcher.notified
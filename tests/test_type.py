@@ -0,0 +1,108 @@
+# darqos
+# Copyright (C) 2024 David Arnold
+
+# Type conformance graph tests.
+
+import random
+
+import pytest
+
+from helpers import load_service
+
+conformance, = load_service("type", "conformance")
+
+
+def closure(graph) -> dict:
+    """Return every type's supertypes, by walking its parents."""
+
+    def walk(uti: str) -> set:
+        supertypes = {uti}
+        for parent in graph.parents[uti]:
+            supertypes |= walk(parent)
+        return supertypes
+
+    return {uti: walk(uti) for uti in graph.parents}
+
+
+def check(graph):
+    """Check the graph's closure against a walk of its parents."""
+
+    expected = closure(graph)
+    assert graph.supertypes == expected
+    for uti in graph.parents:
+        assert graph.subtypes[uti] == {t for t, s in expected.items() if uti in s}
+        assert graph.children[uti] == {t for t in graph.parents
+                                       if uti in graph.parents[t]}
+
+
+def test_remove_updates_closure():
+    graph = conformance.ConformanceGraph()
+    graph.load([("public.text", ["public.data"]),
+                ("public.plain-text", ["public.text"]),
+                ("public.html", ["public.text", "public.markup"]),
+                ("public.xhtml", ["public.html", "public.xml"])])
+    assert graph.conforms("public.xhtml", "public.data")
+
+    # A type with subtypes stays, without parents, for them.
+    graph.remove("public.text")
+    check(graph)
+    assert "public.text" in graph
+    assert not graph.conforms("public.plain-text", "public.data")
+    assert not graph.conforms("public.xhtml", "public.data")
+    assert graph.conforms("public.xhtml", "public.text")
+    assert graph.conforms("public.xhtml", "public.markup")
+    assert graph.all_subtypes("public.data") == set()
+
+    # A type without subtypes goes.
+    graph.remove("public.xhtml")
+    check(graph)
+    assert "public.xhtml" not in graph
+    assert not graph.conforms("public.xhtml", "public.html")
+    assert graph.all_subtypes("public.html") == set()
+    assert graph.all_subtypes("public.xml") == set()
+    assert graph.all_supertypes("public.xhtml") == set()
+
+    # Once its subtypes go, so can it.
+    graph.remove("public.plain-text")
+    graph.remove("public.html")
+    graph.remove("public.text")
+    check(graph)
+    assert "public.text" not in graph
+
+
+def test_cycles_refused():
+    graph = conformance.ConformanceGraph()
+    graph.set_parents("b", ["a"])
+    graph.set_parents("c", ["b"])
+    with pytest.raises(ValueError):
+        graph.set_parents("a", ["c"])
+    with pytest.raises(ValueError):
+        graph.set_parents("b", ["b"])
+    check(graph)
+
+    # Removing the link allows the reverse.
+    graph.remove("b")
+    graph.set_parents("a", ["c"])
+    check(graph)
+    assert graph.conforms("a", "c") and not graph.conforms("c", "a")
+
+
+def test_random_changes():
+    """The closure stays correct through registrations, re-parenting
+    and removals."""
+
+    rng = random.Random(1)
+    graph = conformance.ConformanceGraph()
+    types = [f"type{i}" for i in range(40)]
+    for step in range(600):
+        uti = rng.choice(types)
+        if rng.random() < 0.3:
+            graph.remove(uti)
+        else:
+            try:
+                graph.set_parents(uti, rng.sample(types, rng.randrange(3)))
+            except ValueError:
+                pass
+        if step % 20 == 0:
+            check(graph)
+    check(graph)